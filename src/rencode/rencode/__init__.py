@@ -9,4 +9,4 @@ except ImportError:
     from rencode.rencode_orig import __version__
     rencode.rencode_orig.__all__ = prev_all
 
-__all__ = ['dumps', 'loads']
+__all__ = ['dumps', 'dumps_packet', 'loads']
@@ -31,8 +31,9 @@ if py3:
 from cpython cimport bool
 from libc.stdlib cimport realloc, malloc, free
 from libc.string cimport memcpy
+from cpython.bytes cimport PyBytes_FromStringAndSize
 
-__version__ = ("Cython", 1, 0, 3)
+__version__ = ("Cython", 1, 0, 4)
 
 cdef long long data_length = 0
 cdef bool _decode_utf8 = False
@@ -149,172 +150,263 @@ cdef swap_byte_order_double(char *c):
     p[7] = c[0]
     return d
 
-cdef write_buffer_char(char **buf, int *pos, char c):
-    buf[0] = <char*>realloc(buf[0], pos[0] + 1)
-    memcpy(&buf[0][pos[0]], &c, 1)
-    pos[0] += 1
-
-cdef write_buffer(char **buf, int *pos, void* data, int size):
-    buf[0] = <char*>realloc(buf[0], pos[0] + size)
-    memcpy(&buf[0][pos[0]], data, size)
-    pos[0] += size
+# The output buffer grows geometrically (instead of calling realloc for every byte written),
+# and the buffer is kept for the next call unless it has grown too big.
+cdef struct buffer_t:
+    char *data
+    Py_ssize_t pos
+    Py_ssize_t size
+    int reused
 
-cdef encode_char(char **buf, int *pos, signed char x):
+cdef enum:
+    INITIAL_BUFFER_SIZE = 1024
+    MAX_REUSE_BUFFER_SIZE = 1024*1024
+
+cdef buffer_t _reuse_buffer
+cdef int _reuse_buffer_busy = 0
+
+cdef void acquire_buffer(buffer_t *buf):
+    global _reuse_buffer_busy
+    buf.pos = 0
+    if not _reuse_buffer_busy:
+        #another thread may be using it (ie: when an object is freed whilst we encode)
+        _reuse_buffer_busy = 1
+        buf.data = _reuse_buffer.data
+        buf.size = _reuse_buffer.size
+        buf.reused = 1
+    else:
+        buf.data = NULL
+        buf.size = 0
+        buf.reused = 0
+
+cdef void release_buffer(buffer_t *buf):
+    global _reuse_buffer_busy
+    if buf.reused:
+        if buf.size>MAX_REUSE_BUFFER_SIZE:
+            free(buf.data)
+            buf.data = NULL
+            buf.size = 0
+        _reuse_buffer.data = buf.data
+        _reuse_buffer.size = buf.size
+        _reuse_buffer_busy = 0
+    else:
+        free(buf.data)
+
+cdef int grow_buffer(buffer_t *buf, Py_ssize_t size) except -1:
+    cdef Py_ssize_t needed = buf.pos + size
+    cdef Py_ssize_t newsize = buf.size*2
+    cdef char *data
+    if newsize<INITIAL_BUFFER_SIZE:
+        newsize = INITIAL_BUFFER_SIZE
+    while newsize<needed:
+        newsize *= 2
+    data = <char*>realloc(buf.data, newsize)
+    if data==NULL:
+        raise MemoryError("failed to allocate %i bytes for the output buffer" % newsize)
+    buf.data = data
+    buf.size = newsize
+    return 0
+
+cdef inline int write_buffer_char(buffer_t *buf, char c) except -1:
+    if buf.pos>=buf.size:
+        grow_buffer(buf, 1)
+    buf.data[buf.pos] = c
+    buf.pos += 1
+    return 0
+
+cdef inline int write_buffer(buffer_t *buf, void* data, Py_ssize_t size) except -1:
+    if buf.pos+size>buf.size:
+        grow_buffer(buf, size)
+    memcpy(&buf.data[buf.pos], data, size)
+    buf.pos += size
+    return 0
+
+cdef encode_char(buffer_t *buf, signed char x):
     if 0 <= x < INT_POS_FIXED_COUNT:
-        write_buffer_char(buf, pos, INT_POS_FIXED_START + x)
+        write_buffer_char(buf, INT_POS_FIXED_START + x)
     elif -INT_NEG_FIXED_COUNT <= x < 0:
-        write_buffer_char(buf, pos, INT_NEG_FIXED_START - 1 - x)
+        write_buffer_char(buf, INT_NEG_FIXED_START - 1 - x)
     elif -128 <= x < 128:
-        write_buffer_char(buf, pos, CHR_INT1)
-        write_buffer_char(buf, pos, x)
+        write_buffer_char(buf, CHR_INT1)
+        write_buffer_char(buf, x)
 
-cdef encode_short(char **buf, int *pos, short x):
-    write_buffer_char(buf, pos, CHR_INT2)
+cdef encode_short(buffer_t *buf, short x):
+    write_buffer_char(buf, CHR_INT2)
     if not big_endian:
         if x > 0:
             swap_byte_order_ushort(<unsigned short*>&x)
         else:
             x = swap_byte_order_short(<char*>&x)
 
-    write_buffer(buf, pos, &x, sizeof(x))
+    write_buffer(buf, &x, sizeof(x))
 
-cdef encode_int(char **buf, int *pos, int x):
-    write_buffer_char(buf, pos, CHR_INT4)
+cdef encode_int(buffer_t *buf, int x):
+    write_buffer_char(buf, CHR_INT4)
     if not big_endian:
         if x > 0:
             swap_byte_order_uint(&x)
         else:
             x = swap_byte_order_int(<char*>&x)
-    write_buffer(buf, pos, &x, sizeof(x))
+    write_buffer(buf, &x, sizeof(x))
 
-cdef encode_long_long(char **buf, int *pos, long long x):
-    write_buffer_char(buf, pos, CHR_INT8)
+cdef encode_long_long(buffer_t *buf, long long x):
+    write_buffer_char(buf, CHR_INT8)
     if not big_endian:
         if x > 0:
             swap_byte_order_ulong_long(&x)
         else:
             x = swap_byte_order_long_long(<char*>&x)
-    write_buffer(buf, pos, &x, sizeof(x))
+    write_buffer(buf, &x, sizeof(x))
 
-cdef encode_big_number(char **buf, int *pos, char *x):
-    write_buffer_char(buf, pos, CHR_INT)
-    write_buffer(buf, pos, x, len(x))
-    write_buffer_char(buf, pos, CHR_TERM)
+cdef encode_big_number(buffer_t *buf, char *x):
+    write_buffer_char(buf, CHR_INT)
+    write_buffer(buf, x, len(x))
+    write_buffer_char(buf, CHR_TERM)
 
-cdef encode_float32(char **buf, int *pos, float x):
-    write_buffer_char(buf, pos, CHR_FLOAT32)
+cdef encode_float32(buffer_t *buf, float x):
+    write_buffer_char(buf, CHR_FLOAT32)
     if not big_endian:
         x = swap_byte_order_float(<char *>&x)
-    write_buffer(buf, pos, &x, sizeof(x))
+    write_buffer(buf, &x, sizeof(x))
 
-cdef encode_float64(char **buf, int *pos, double x):
-    write_buffer_char(buf, pos, CHR_FLOAT64)
+cdef encode_float64(buffer_t *buf, double x):
+    write_buffer_char(buf, CHR_FLOAT64)
     if not big_endian:
         x = swap_byte_order_double(<char *>&x)
-    write_buffer(buf, pos, &x, sizeof(x))
+    write_buffer(buf, &x, sizeof(x))
 
-cdef encode_str(char **buf, int *pos, bytes x):
+cdef encode_str(buffer_t *buf, bytes x):
     cdef char *p
     cdef int lx = len(x)
     if lx < STR_FIXED_COUNT:
-        write_buffer_char(buf, pos, STR_FIXED_START + lx)
-        write_buffer(buf, pos, <char *>x, lx)
+        write_buffer_char(buf, STR_FIXED_START + lx)
+        write_buffer(buf, <char *>x, lx)
     else:
         s = str(lx) + ":"
         if py3:
             s = s.encode("ascii")
         p = s
-        write_buffer(buf, pos, p, len(s))
-        write_buffer(buf, pos, <char *>x, lx)
+        write_buffer(buf, p, len(s))
+        write_buffer(buf, <char *>x, lx)
 
-cdef encode_none(char **buf, int *pos):
-    write_buffer_char(buf, pos, CHR_NONE)
+cdef encode_none(buffer_t *buf):
+    write_buffer_char(buf, CHR_NONE)
 
-cdef encode_bool(char **buf, int *pos, bool x):
+cdef encode_bool(buffer_t *buf, bool x):
     if x:
-        write_buffer_char(buf, pos, CHR_TRUE)
+        write_buffer_char(buf, CHR_TRUE)
     else:
-        write_buffer_char(buf, pos, CHR_FALSE)
+        write_buffer_char(buf, CHR_FALSE)
 
-cdef encode_list(char **buf, int *pos, x):
+cdef encode_list(buffer_t *buf, x):
     if len(x) < LIST_FIXED_COUNT:
-        write_buffer_char(buf, pos, LIST_FIXED_START + len(x))
+        write_buffer_char(buf, LIST_FIXED_START + len(x))
         for i in x:
-            encode(buf, pos, i)
+            encode(buf, i)
     else:
-        write_buffer_char(buf, pos, CHR_LIST)
+        write_buffer_char(buf, CHR_LIST)
         for i in x:
-            encode(buf, pos, i)
-        write_buffer_char(buf, pos, CHR_TERM)
+            encode(buf, i)
+        write_buffer_char(buf, CHR_TERM)
 
-cdef encode_dict(char **buf, int *pos, x):
+cdef encode_dict(buffer_t *buf, x):
     if len(x) < DICT_FIXED_COUNT:
-        write_buffer_char(buf, pos, DICT_FIXED_START + len(x))
+        write_buffer_char(buf, DICT_FIXED_START + len(x))
         for k, v in x.items():
-            encode(buf, pos, k)
-            encode(buf, pos, v)
+            encode(buf, k)
+            encode(buf, v)
     else:
-        write_buffer_char(buf, pos, CHR_DICT)
+        write_buffer_char(buf, CHR_DICT)
         for k, v in x.items():
-            encode(buf, pos, k)
-            encode(buf, pos, v)
-        write_buffer_char(buf, pos, CHR_TERM)
-
-cdef object MAX_SIGNED_INT = 2**31
-cdef object MIN_SIGNED_INT = -MAX_SIGNED_INT
-#note: negating the Python value avoids compiler problems
-#(negating the "long long" constant can make it unsigned with some compilers!)
-cdef object MAX_SIGNED_LONGLONG = int(2**63)
-cdef object MIN_SIGNED_LONGLONG = -MAX_SIGNED_LONGLONG
-
-cdef encode(char **buf, int *pos, data):
+            encode(buf, k)
+            encode(buf, v)
+        write_buffer_char(buf, CHR_TERM)
+
+cdef encode_integer(buffer_t *buf, data):
+    cdef long long x
+    try:
+        x = data
+    except OverflowError:
+        #does not fit in a long long:
+        s = str(data)
+        if py3:
+            s = s.encode("ascii")
+        if len(s) >= MAX_INT_LENGTH:
+            raise ValueError("Number is longer than %d characters" % MAX_INT_LENGTH)
+        encode_big_number(buf, s)
+        return
+    if -128 <= x < 128:
+        encode_char(buf, <signed char> x)
+    elif -32768 <= x < 32768:
+        encode_short(buf, <short> x)
+    elif -2147483647-1 <= x <= 2147483647:
+        encode_int(buf, <int> x)
+    else:
+        encode_long_long(buf, x)
+
+cdef encode(buffer_t *buf, data):
     t = type(data)
     if t == int or t == long:
-        if -128 <= data < 128:
-            encode_char(buf, pos, data)
-        elif -32768 <= data < 32768:
-            encode_short(buf, pos, data)
-        elif MIN_SIGNED_INT <= data < MAX_SIGNED_INT:
-            encode_int(buf, pos, data)
-        elif MIN_SIGNED_LONGLONG <= data < MAX_SIGNED_LONGLONG:
-            encode_long_long(buf, pos, data)
-        else:
-            s = str(data)
-            if py3:
-                s = s.encode("ascii")
-            if len(s) >= MAX_INT_LENGTH:
-                raise ValueError("Number is longer than %d characters" % MAX_INT_LENGTH)
-            encode_big_number(buf, pos, s)
+        encode_integer(buf, data)
     elif t == float:
         if _float_bits == 32:
-            encode_float32(buf, pos, data)
+            encode_float32(buf, data)
         elif _float_bits == 64:
-            encode_float64(buf, pos, data)
+            encode_float64(buf, data)
         else:
             raise ValueError('Float bits (%d) is not 32 or 64' % _float_bits)
 
     elif t == bytes:
-        encode_str(buf, pos, data)
+        encode_str(buf, data)
 
     elif t == unicode:
         u = data.encode("utf8")
-        encode_str(buf, pos, u)
+        encode_str(buf, u)
 
     elif t == type(None):
-        encode_none(buf, pos)
+        encode_none(buf)
 
     elif t == bool:
-        encode_bool(buf, pos, data)
+        encode_bool(buf, data)
 
     elif t == list or t == tuple:
-        encode_list(buf, pos, data)
+        encode_list(buf, data)
 
     elif t == dict:
-        encode_dict(buf, pos, data)
+        encode_dict(buf, data)
 
     else:
         raise Exception("type %s not handled" % t)
 
+cdef encode_typed(buffer_t *buf, char typecode, data):
+    #fast path for the type we expect at this position,
+    #anything else goes through the generic encoder:
+    t = type(data)
+    if typecode == c'i':
+        if t is int:
+            encode_integer(buf, data)
+            return
+    elif typecode == c's':
+        if t is bytes:
+            encode_str(buf, data)
+            return
+        elif t is unicode:
+            encode_str(buf, data.encode("utf8"))
+            return
+    elif typecode == c'b':
+        if t is bool:
+            encode_bool(buf, data)
+            return
+    elif typecode == c'l':
+        if t is list or t is tuple:
+            encode_list(buf, data)
+            return
+    elif typecode == c'd':
+        if t is dict:
+            encode_dict(buf, data)
+            return
+    encode(buf, data)
+
 def dumps(data, float_bits=DEFAULT_FLOAT_BITS):
     """
     Encode the object data into a string.
@@ -325,12 +417,53 @@ def dumps(data, float_bits=DEFAULT_FLOAT_BITS):
     """
     global _float_bits
     _float_bits = float_bits
-    cdef char *buf = NULL
-    cdef int pos = 0
-    encode(&buf, &pos, data)
-    ret = buf[:pos]
-    free(buf)
-    return ret
+    cdef buffer_t buf
+    acquire_buffer(&buf)
+    try:
+        encode(&buf, data)
+        return PyBytes_FromStringAndSize(buf.data, buf.pos)
+    finally:
+        release_buffer(&buf)
+
+def dumps_packet(packet, schema=b"", float_bits=DEFAULT_FLOAT_BITS):
+    """
+    Encode a packet (a list or a tuple) into a string,
+    the output is identical to dumps(packet).
+
+    :param schema: the type codes of the items which follow the packet type,
+    one character per item: 'i' for int, 's' for strings, 'b' for bool,
+    'l' for lists and 'd' for dicts, anything else or any item which
+    does not have the expected type is handled by the generic encoder.
+    :type schema: bytes
+
+    """
+    global _float_bits
+    cdef buffer_t buf
+    cdef char *codes
+    cdef Py_ssize_t ncodes, n, i
+    t = type(packet)
+    if not schema or (t is not list and t is not tuple):
+        return dumps(packet, float_bits)
+    _float_bits = float_bits
+    codes = schema
+    ncodes = len(schema)
+    n = len(packet)
+    acquire_buffer(&buf)
+    try:
+        if n < LIST_FIXED_COUNT:
+            write_buffer_char(&buf, LIST_FIXED_START + n)
+        else:
+            write_buffer_char(&buf, CHR_LIST)
+        for i in range(n):
+            if 0 < i <= ncodes:
+                encode_typed(&buf, codes[i-1], packet[i])
+            else:
+                encode(&buf, packet[i])
+        if n >= LIST_FIXED_COUNT:
+            write_buffer_char(&buf, CHR_TERM)
+        return PyBytes_FromStringAndSize(buf.data, buf.pos)
+    finally:
+        release_buffer(&buf)
 
 cdef decode_char(char *data, int *pos):
     cdef signed char c
@@ -19,8 +19,8 @@ rencode module versions, so you should check that you are using the
 same rencode version throughout your project.
 """
 
-__version__ = ("Python", 1, 0, 3)
-__all__ = ['dumps', 'loads']
+__version__ = ("Python", 1, 0, 4)
+__all__ = ['dumps', 'dumps_packet', 'loads']
 
 # Original bencode module by Petru Paler, et al.
 #
@@ -390,6 +390,12 @@ def dumps(x, float_bits=DEFAULT_FLOAT_BITS):
         encode_func[type(x)](x, r)
     return b''.join(r)
 
+def dumps_packet(x, schema=b"", float_bits=DEFAULT_FLOAT_BITS):
+    """
+    Same as dumps, the schema is only used by the Cython version.
+    """
+    return dumps(x, float_bits)
+
 def test():
     f1 = struct.unpack('!f', struct.pack('!f', 25.5))[0]
     f2 = struct.unpack('!f', struct.pack('!f', 29.3))[0]
@@ -203,6 +203,29 @@ class TestRencode(unittest.TestCase):
         s = rencode.dumps(b"\x56\xe4foo\xc3")
         self.assertRaises(UnicodeDecodeError, rencode.loads, s, decode_utf8=True)
 
+    def test_encode_large_buffer(self):
+        #the output buffer must grow, and be reusable afterwards:
+        l = [b"a"*100000, list(range(-100000, 100000)), u("\u00e9")*1000]
+        self.assertEqual(rencode.dumps(l), rencode_orig.dumps(l))
+        self.assertEqual(rencode.dumps(l), rencode_orig.dumps(l))
+        self.assertEqual(rencode.dumps(1), rencode_orig.dumps(1))
+
+    def test_dumps_packet(self):
+        draw = (b"draw", 1, 0, 0, 1920, 1080, b"h264", b"x"*1000, 65536, 0, {b"frame" : 10, b"csc" : b"YUV420P"})
+        packets = (
+            (draw, b"iiiiissiid"),
+            #wrong types and missing items use the generic encoder:
+            ([b"pointer-position", 1, 2.5, [b"mod1"], None], b"illl"),
+            ([b"key-action", 1, u("\u00e9"), True, [], 2**40, b"", 10**30, -1], b"isblisii"),
+            ([b"short"], b"iiii"),
+            ([b"long"]+list(range(100)), b"i"*50),
+            ([b"no-schema", 1, 2], b""),
+            )
+        for packet, schema in packets:
+            self.assertEqual(rencode.dumps_packet(packet, schema), rencode_orig.dumps(packet))
+            self.assertEqual(rencode_orig.dumps_packet(packet, schema), rencode_orig.dumps(packet))
+            self.assertEqual(rencode.loads(rencode.dumps_packet(packet, schema)), rencode.loads(rencode_orig.dumps(packet)))
+
     def test_version_exposed(self):
         assert rencode.__version__
         assert rencode_orig.__version__
@@ -0,0 +1,3 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2014 Antoine Martin <antoine@devloop.org.uk>
\ No newline at end of file
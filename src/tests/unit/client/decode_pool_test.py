@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import time
+import threading
+from threading import Lock, Event
+
+from xpra.client.decode_pool import DecodeWorkerPool
+
+
+class TestDecodePool(unittest.TestCase):
+
+    def test_ordering(self):
+        results = {}
+        lock = Lock()
+        def draw(packet):
+            wid, i = packet[1:3]
+            time.sleep(0.001)
+            with lock:
+                results.setdefault(wid, []).append(i)
+        pool = DecodeWorkerPool(draw, lambda : False, 3)
+        pool.start()
+        for i in range(20):
+            for wid in (1, 2, 3, 4):
+                pool.queue(wid, ("draw", wid, i))
+        pool.stop()
+        for w in pool.workers:
+            w.thread.join(10)
+        for wid in (1, 2, 3, 4):
+            assert results.get(wid)==list(range(20)), "invalid order for window %i: %s" % (wid, results.get(wid))
+        assert pool.qsize()==0
+        info = pool.get_info()
+        assert sum(x["items"] for x in info["worker"].values())==80
+        assert sorted(info["window"].keys())==[1, 2, 3, 4]
+
+    def test_concurrent(self):
+        #a slow window does not delay the other windows:
+        slow = Event()
+        done = Event()
+        threads = {}
+        def draw(packet):
+            wid = packet[1]
+            threads[wid] = threading.current_thread().name
+            if wid==1:
+                slow.wait(10)
+            else:
+                done.set()
+        pool = DecodeWorkerPool(draw, lambda : False, 2)
+        pool.start()
+        pool.queue(1, ("draw", 1))
+        pool.queue(1, ("draw", 1))
+        pool.queue(2, ("draw", 2))
+        try:
+            assert done.wait(10)
+            assert threads[1]!=threads[2]
+            #the slow window still has a packet waiting:
+            for _ in range(100):
+                if pool.qsize(1)==1:
+                    break
+                time.sleep(0.01)
+            assert pool.qsize(1)==1 and pool.qsize(2)==0
+        finally:
+            slow.set()
+            pool.stop()
+        for w in pool.workers:
+            w.thread.join(10)
+        assert pool.qsize(1)==0
+
+    def test_idle_window(self):
+        #the packet being drawn (and acked) is not counted:
+        sizes = []
+        drawn = Event()
+        def draw(packet):
+            sizes.append(pool.qsize(packet[1]))
+            drawn.set()
+        pool = DecodeWorkerPool(draw, lambda : False, 1)
+        pool.start()
+        try:
+            for _ in range(3):
+                drawn.clear()
+                pool.queue(1, ("draw", 1))
+                assert drawn.wait(10)
+        finally:
+            pool.stop()
+        for w in pool.workers:
+            w.thread.join(10)
+        assert sizes==[0, 0, 0], "expected no packets waiting: %s" % sizes
+        assert pool.qsize(1)==0
+
+    def test_shared_key(self):
+        pool = DecodeWorkerPool(lambda packet : None, lambda : False, 4)
+        for wid in (1, 2, 3):
+            pool.queue(wid, ("draw", wid), 0)
+        assert pool.get_worker(0).qsize()==3
+        assert pool.qsize()==3 and pool.qsize(2)==1
+        pool.release(1)
+        assert 1 not in pool.assignments
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
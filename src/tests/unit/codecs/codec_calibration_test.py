@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xpra.codecs.codec_constants import csc_spec
+from xpra.codecs.codec_calibration import (CodecCalibration, make_calibration_image, measure_csc,
+                                           speed_from_mpps, setup_cost_from_ms)
+
+
+class FakeColorspaceConverter(object):
+
+    def init_context(self, src_width, src_height, src_format, dst_width, dst_height, dst_format, speed=100):
+        self.size = src_width, src_height
+
+    def convert_image(self, image):
+        assert (image.get_width(), image.get_height())==self.size
+        return image
+
+    def clean(self):
+        pass
+
+
+class FakeCSCModule(object):
+    ColorspaceConverter = FakeColorspaceConverter
+
+
+class TestCodecCalibration(unittest.TestCase):
+
+    def test_images(self):
+        image = make_calibration_image("BGRX", 64, 32)
+        assert image.get_rowstride()==256 and len(image.get_pixels())==256*32
+        #the frames are not all the same:
+        assert image.get_pixels()!=make_calibration_image("BGRX", 64, 32, 1).get_pixels()
+        image = make_calibration_image("YUV420P", 64, 32)
+        assert image.get_rowstride()==[64, 32, 32]
+        assert [len(x) for x in image.get_pixels()]==[64*32, 32*16, 32*16]
+        assert make_calibration_image("r210", 64, 32) is None
+
+    def test_scores(self):
+        assert speed_from_mpps(0, 1000)==1
+        assert speed_from_mpps(100, 1000)==10
+        assert speed_from_mpps(5000, 1000)==100
+        assert setup_cost_from_ms(0)==0
+        assert setup_cost_from_ms(10)<setup_cost_from_ms(100)<setup_cost_from_ms(1000)==100
+
+    def test_measure(self):
+        mpps, setup_ms, ratio = measure_csc(FakeCSCModule, "BGRX", "YUV420P", 64, 32, 2)
+        assert mpps>0 and setup_ms>=0 and ratio==0
+
+    def test_save_load(self):
+        c = CodecCalibration("test-signature")
+        c.add("csc", "cython", "BGRX", "YUV420P", 320, 240, 150.5, 0.1, 0)
+        c.add("csc", "cython", "BGRX", "YUV420P", 1920, 1080, 120, 0.5, 0)
+        c.add("encoder", "x264", "YUV420P", "h264", 1920, 1080, 100, 15, 50)
+        c.modules = set(["cython", "x264"])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "sub", "calibration.conf")
+            c.save(filename)
+            loaded = CodecCalibration("other")
+            loaded.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        assert loaded.signature=="test-signature"
+        assert loaded.records==c.records
+        assert loaded.modules==c.modules
+        #uses the largest size:
+        assert loaded.get_measurement("csc", "cython", "BGRX", "YUV420P")==(120, 0.5, 0)
+        spec = csc_spec(FakeColorspaceConverter, codec_type="cython", speed=10, setup_cost=10)
+        assert loaded.apply("csc", "BGRX", "YUV420P", spec)
+        assert spec.speed==speed_from_mpps(120, 1000) and spec.setup_cost==setup_cost_from_ms(0.5)
+        spec = csc_spec(FakeColorspaceConverter, codec_type="swscale", speed=100, setup_cost=20)
+        assert not loaded.apply("csc", "BGRX", "YUV420P", spec)
+        assert spec.speed==100 and spec.setup_cost==20
+        info = loaded.get_info()
+        assert info["encoder"]["x264"]["YUV420P_to_h264"]["1920x1080"]["ratio"]==50
+        assert info["encoder"]["x264"]["YUV420P_to_h264"]["1920x1080"]["setup"]==15
+
+    def test_update(self):
+        c = CodecCalibration("test-signature")
+        c.add("csc", "cython", "BGRX", "YUV420P", 320, 240, 150, 0.1, 0)
+        c.add("encoder", "x264", "YUV420P", "h264", 320, 240, 100, 15, 50)
+        c.modules = set(["cython", "x264"])
+        partial = CodecCalibration("test-signature")
+        partial.add("csc", "cython", "BGRX", "YUV420P", 1920, 1080, 120, 0.5, 0)
+        partial.modules = set(["cython"])
+        c.update(partial)
+        assert c.modules==set(["cython", "x264"])
+        #the new measurements replace the old ones:
+        assert list(c.records[("csc", "cython", "BGRX", "YUV420P")].keys())==[(1920, 1080)]
+        assert c.get_measurement("encoder", "x264", "YUV420P", "h264")==(100, 15, 50)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
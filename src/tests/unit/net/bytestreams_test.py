@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.os_util import _memoryview, memoryview_to_bytes
+from xpra.net.bytestreams import Connection, JOIN_WRITE_SIZE
+
+
+class FakeConnection(Connection):
+
+    def __init__(self):
+        Connection.__init__(self, "fake", "fake")
+        self.writes = []
+
+    def write(self, buf):
+        self.writes.append(memoryview_to_bytes(buf))
+        return len(buf)
+
+
+class TestWritev(unittest.TestCase):
+
+    def test_join(self):
+        c = FakeConnection()
+        buffers = [b"header", b"payload", b"x"*JOIN_WRITE_SIZE]
+        if _memoryview:
+            buffers = [_memoryview(x) for x in buffers]
+        #the small buffers are written together:
+        assert c.writev(buffers)==len(b"headerpayload")
+        assert c.writev(buffers[2:])==JOIN_WRITE_SIZE
+        assert c.writes==[b"headerpayload", b"x"*JOIN_WRITE_SIZE]
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
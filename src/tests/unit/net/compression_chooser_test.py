@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.net import compression
+from xpra.net.compression_chooser import CompressionChooser, DEFAULT_BANDWIDTH
+
+
+class TestCompressionChooser(unittest.TestCase):
+
+    def make_chooser(self):
+        c = CompressionChooser()
+        c.set_compressors(["zlib"])
+        #zlib-1 compresses to half the size at 10MB/s, zlib-6 to a third at 1MB/s:
+        for _ in range(4):
+            c.record("test", "none", 0, 1000, 1000, 0)
+            c.record("test", "zlib", 1, 1000, 500, 0.0001)
+            c.record("test", "zlib", 3, 1000, 450, 0.0002)
+            c.record("test", "zlib", 6, 1000, 333, 0.001)
+        return c
+
+    def choose(self, c, bandwidth):
+        c.set_bandwidth_limit(bandwidth)
+        c.counts["test"] = 1
+        return c.choose("test", 1000)
+
+    def test_bandwidth(self):
+        c = self.make_chooser()
+        #very fast link, don't waste time compressing:
+        assert self.choose(c, 1000*1000*1000)==("none", 0)
+        #very slow link, compress as much as we can:
+        assert self.choose(c, 10*1000)==("zlib", 6)
+        #in between:
+        assert self.choose(c, 1000*1000)==("zlib", 1)
+        info = c.get_info()
+        assert info["type"]["test"]["selected"]=="zlib-1"
+
+    def test_estimate(self):
+        c = self.make_chooser()
+        c.counts["test"] = 1
+        #until the link has been measured, we use the default value:
+        estimate = [0]
+        c.set_bandwidth_estimate(lambda : estimate[0])
+        assert c.get_bandwidth()==DEFAULT_BANDWIDTH
+        #slow link measured from the acks, in bits per second:
+        estimate[0] = 80*1000
+        assert c.get_bandwidth()==10*1000
+        assert c.choose("test", 1000)==("zlib", 6)
+        #the limit takes precedence:
+        c.set_bandwidth_limit(1000*1000*1000)
+        assert c.choose("test", 1000)==("none", 0)
+
+    def test_sampling(self):
+        c = CompressionChooser()
+        c.set_compressors(compression.get_enabled_compressors())
+        data = b"0123456789"*1000
+        candidates = c.get_candidates()
+        for _ in candidates:
+            cl, cdata = c.compress("sample", data)
+            #level zero means not compressed:
+            assert cl==0 or compression.decompress(cdata, cl)==data
+        #all the candidates have been tried once:
+        assert len(c.stats["sample"])==len(candidates)
+        #pixel data only uses the compressors allowed:
+        assert c.choose("rgb24", 1000, ["lz4"], 1)[0] in ("none", "lz4")
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.net import compression
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = b"0123456789abcdef"*1024
+        for c in compression.get_enabled_compressors():
+            for level in (1, 5, 9):
+                cl, cdata = compression.get_compressor(c)(data, level)
+                assert compression.get_compression_type(cl)==c, "expected %s but got %s" % (c, compression.get_compression_type(cl))
+                assert len(cdata)<len(data)
+                v = compression.decompress(cdata, cl)
+                assert v==data, "%s failed to decompress its own data" % c
+
+    def test_zstd_dictionary(self):
+        if not compression.use_zstd:
+            return
+        samples = [("pointer-position-%i-%i-%i" % (i%7, (i*13)%1920, (i*7)%1080)).encode() for i in range(1000)]
+        d = compression.zstandard.ZstdCompressionDict(compression.train_zstd_dictionary(samples, 1024))
+        dict_id = d.dict_id()
+        compression.zstd_dictionaries["test"] = d
+        compression.zstd_dictionaries_by_id[dict_id] = d
+        try:
+            assert compression.get_zstd_dictionaries([dict_id])=={"test" : d}
+            assert compression.get_zstd_dictionaries([])=={}
+            cl, cdata = compression.zstd_compress(samples[0], 1, d)
+            assert compression.decompress(cdata, cl)==samples[0]
+            #without the dictionary, we can't decompress it:
+            del compression.zstd_dictionaries_by_id[dict_id]
+            try:
+                compression.decompress(cdata, cl)
+            except compression.InvalidCompressionException:
+                pass
+            else:
+                raise Exception("decompression should have failed without the dictionary")
+        finally:
+            compression.zstd_dictionaries.pop("test", None)
+            compression.zstd_dictionaries_by_id.pop(dict_id, None)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
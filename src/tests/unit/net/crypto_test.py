@@ -6,11 +6,15 @@
 # later version. See the file COPYING for details.
 
 import time
+import hmac
+import hashlib
 import unittest
 import binascii
-from xpra.os_util import strtobytes
+from xpra.os_util import strtobytes, memoryview_to_bytes
 
-from xpra.net.crypto import DEFAULT_SALT, DEFAULT_ITERATIONS, DEFAULT_BLOCKSIZE, DEFAULT_IV
+from xpra.net.crypto import DEFAULT_SALT, DEFAULT_ITERATIONS, DEFAULT_BLOCKSIZE, DEFAULT_IV, \
+    AEADCipher, AEAD_CHUNK_SIZE, AEAD_TAG_SIZE
+from xpra.thread_pool import ThreadPool
 
 
 def log(message):
@@ -21,6 +25,64 @@ def hexstr(v):
     return binascii.hexlify(strtobytes(v))
 
 
+class StubAEAD(object):
+    """
+        Stands in for the backend AEAD objects:
+        xor with a keystream derived from the nonce, followed by an hmac tag.
+        (not secure, only for testing the chunking, nonces and tags)
+    """
+
+    def __init__(self, key):
+        self.key = strtobytes(key)
+
+    def xor(self, nonce, data):
+        stream = bytearray(hashlib.sha256(self.key+nonce).digest())
+        return bytes(bytearray(b ^ stream[i%32] for i,b in enumerate(bytearray(memoryview_to_bytes(data)))))
+
+    def tag(self, nonce, data):
+        return hmac.new(self.key, nonce+data, hashlib.sha256).digest()[:AEAD_TAG_SIZE]
+
+    def encrypt(self, nonce, data):
+        v = self.xor(nonce, data)
+        return v+self.tag(nonce, v)
+
+    def decrypt(self, nonce, data):
+        data = memoryview_to_bytes(data)
+        v, tag = data[:-AEAD_TAG_SIZE], data[-AEAD_TAG_SIZE:]
+        if not hmac.compare_digest(tag, self.tag(nonce, v)):
+            raise Exception("invalid tag")
+        return self.xor(nonce, v)
+
+
+def do_test_aead(name, get_aead):
+    for pool in (None, ThreadPool("crypto", 2)):
+        enc = AEADCipher(get_aead(), DEFAULT_IV, pool)
+        dec = AEADCipher(get_aead(), DEFAULT_IV, pool)
+        for size in (1, AEAD_CHUNK_SIZE, AEAD_CHUNK_SIZE*3+7):
+            message = b"0123456789ABCDEF"*(size//16)+b"x"*(size%16)
+            #no padding, one tag per chunk:
+            chunks = (size+AEAD_CHUNK_SIZE-1)//AEAD_CHUNK_SIZE
+            encrypted = enc.encrypt_chunks(message)
+            assert len(encrypted)==chunks
+            v = b"".join(encrypted)
+            assert len(v)==size+chunks*AEAD_TAG_SIZE
+            assert dec.decrypt(v)==message
+        #the nonce changes with every chunk, so the same message encrypts differently:
+        v1 = enc.encrypt(b"hello")
+        v2 = enc.encrypt(b"hello")
+        assert v1!=v2
+        assert dec.decrypt(v1)==dec.decrypt(v2)==b"hello"
+        #tampering is detected:
+        v = bytearray(enc.encrypt(b"some message1234"))
+        v[3] ^= 1
+        try:
+            dec.decrypt(bytes(v))
+        except Exception:
+            pass
+        else:
+            raise Exception("%s failed to detect modified data" % name)
+
+
 class TestCrypto(unittest.TestCase):
 
     def setUp(self):
@@ -104,6 +166,14 @@ class TestCrypto(unittest.TestCase):
     def test_backends(self):
         self.do_test_backend(self.backends)
 
+    def test_aead(self):
+        backends = [b for b in self.backends if "GCM" in getattr(b, "MODES", [])]
+        if not backends:
+            self.skipTest("no backend supports GCM")
+        for b in backends:
+            key = b.get_key("this is our secret", DEFAULT_SALT, DEFAULT_BLOCKSIZE, DEFAULT_ITERATIONS)
+            do_test_aead(b, lambda : b.get_aead(key))
+
     def do_test_perf(self, size=1024*4, enc_iterations=20, dec_iterations=20):
         asize = (size+15)//16
         print("test_perf: size: %i Bytes" % (asize*16))
@@ -136,6 +206,18 @@ class TestCrypto(unittest.TestCase):
             self.do_test_perf(i, 10, 10)
 
 
+class TestAEADCipher(unittest.TestCase):
+
+    def test_stub(self):
+        do_test_aead("stub", lambda : StubAEAD(b"this is our secret"))
+
+    def test_nonces(self):
+        c = AEADCipher(StubAEAD(b"key"), DEFAULT_IV)
+        nonces = c.get_nonces(3)+c.get_nonces(2)
+        assert len(set(nonces))==5 and c.counter==5
+        assert all(len(x)==12 for x in nonces)
+
+
 def main():
     unittest.main()
 
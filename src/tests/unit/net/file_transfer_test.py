@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xpra.net import file_transfer
+from xpra.net.file_transfer import FileTransferHandler
+
+
+class FakeTransferEnd(FileTransferHandler):
+    """ one end of the connection, the packets are queued until we deliver them """
+
+    def __init__(self, chunk_size):
+        FileTransferHandler.__init__(self)
+        self.file_transfer = True
+        self.remote_file_chunks = chunk_size
+        self.packets = []
+        self.timers = {}
+        self.received = []
+        self.peer = None
+
+    def send(self, *packet):
+        self.packets.append(packet)
+
+    def compressed_wrapper(self, datatype, data):
+        return data
+
+    def timeout_add(self, delay, fn, *args):
+        timer = len(self.timers)+1
+        self.timers[timer] = (delay, fn, args)
+        return timer
+
+    def source_remove(self, timer):
+        self.timers.pop(timer, None)
+
+    def _file_received(self, filename, mimetype, printit, openit, filesize, options):
+        self.received.append(filename)
+
+    def deliver(self, count=-1):
+        """ delivers 'count' packets to the other end, returns the number of packets delivered """
+        n = 0
+        while self.packets and n!=count:
+            packet = self.packets.pop(0)
+            handler = {
+                       "send-file"          : self.peer._process_send_file,
+                       "send-file-chunk"    : self.peer._process_send_file_chunk,
+                       "ack-file-chunk"     : self.peer._process_ack_file_chunk,
+                       }[packet[0]]
+            handler(packet)
+            n += 1
+        return n
+
+
+def make_ends(chunk_size=1000):
+    sender = FakeTransferEnd(chunk_size)
+    receiver = FakeTransferEnd(chunk_size)
+    sender.peer = receiver
+    receiver.peer = sender
+    return sender, receiver
+
+def run(sender, receiver):
+    while sender.deliver() or receiver.deliver():
+        pass
+
+
+class TestFileTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.saved_download_dir = os.environ.get("XPRA_DOWNLOAD_DIR")
+        os.environ["XPRA_DOWNLOAD_DIR"] = self.tmpdir
+        self.data = os.urandom(10*1000+123)
+
+    def tearDown(self):
+        if self.saved_download_dir is None:
+            del os.environ["XPRA_DOWNLOAD_DIR"]
+        else:
+            os.environ["XPRA_DOWNLOAD_DIR"] = self.saved_download_dir
+        shutil.rmtree(self.tmpdir)
+
+    def check_received(self, receiver):
+        assert len(receiver.received)==1
+        with open(receiver.received[0], "rb") as f:
+            assert f.read()==self.data
+        assert not [x for x in os.listdir(self.tmpdir) if x.endswith(".part")]
+        assert not receiver.receive_chunks_in_progress and not receiver.timers
+
+    def test_legacy(self):
+        sender, receiver = make_ends(0)
+        assert sender.do_send_file("legacy.bin", "", self.data, len(self.data), False, False)
+        assert len(sender.packets)==1 and sender.packets[0][6]==self.data
+        run(sender, receiver)
+        self.check_received(receiver)
+
+    def test_chunks(self):
+        sender, receiver = make_ends()
+        assert sender.do_send_file("chunked.bin", "", self.data, len(self.data), False, False)
+        #nothing is sent until the receiver accepts the transfer:
+        sender.deliver()
+        assert not sender.packets
+        receiver.deliver()
+        #the window limits the number of chunks in flight:
+        assert len(sender.packets)==file_transfer.FILE_CHUNK_WINDOW
+        info = sender.get_file_transfer_info()
+        assert info["sending"][0]["file"]=="chunked.bin"
+        run(sender, receiver)
+        self.check_received(receiver)
+        assert not sender.send_chunks_in_progress and not sender.timers
+
+    def test_stream_from_disk(self):
+        filename = os.path.join(self.tmpdir, "source.bin")
+        with open(filename, "wb") as f:
+            f.write(self.data)
+        sender, receiver = make_ends()
+        assert sender.do_send_file(filename, "", None, len(self.data), False, False)
+        run(sender, receiver)
+        self.check_received(receiver)
+        assert os.path.basename(receiver.received[0])=="source-1.bin"
+
+    def test_resume(self):
+        sender, receiver = make_ends()
+        sender.do_send_file("resume.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        receiver.deliver()
+        #only 3 chunks make it before the connection is lost:
+        sender.deliver(3)
+        sender.cleanup_file_transfers()
+        assert receiver.receive_chunks_in_progress
+        #the new connection sends the same file again:
+        sender, _ = make_ends()
+        sender.peer = receiver
+        receiver.peer = sender
+        receiver.packets = []
+        sender.do_send_file("resume.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        assert receiver.packets[-1][4]==3, "expected to resume from chunk 3: %s" % (receiver.packets[-1], )
+        receiver.deliver()
+        assert sender.packets[0][2]==3
+        run(sender, receiver)
+        self.check_received(receiver)
+
+    def test_corrupted(self):
+        sender, receiver = make_ends()
+        sender.do_send_file("corrupted.bin", "", self.data, len(self.data), False, False)
+        run_count = 0
+        while sender.packets or receiver.packets:
+            for i, packet in enumerate(sender.packets):
+                if packet[0]=="send-file-chunk" and packet[2]==5:
+                    sender.packets[i] = packet[:3]+(b"\0"*len(packet[3]), )+packet[4:]
+            sender.deliver() or receiver.deliver()
+            run_count += 1
+            assert run_count<100
+        assert not receiver.received
+        assert not sender.send_chunks_in_progress and not receiver.receive_chunks_in_progress
+        assert not os.listdir(self.tmpdir)
+
+    def test_rename_error(self):
+        sender, receiver = make_ends()
+        filename = os.path.join(self.tmpdir, "missing", "rename.bin")
+        receiver._get_download_filename = lambda *args : filename
+        sender.do_send_file("rename.bin", "", self.data, len(self.data), False, False)
+        run(sender, receiver)
+        assert not receiver.received and sender.packets==[]
+        assert not sender.send_chunks_in_progress and not receiver.receive_chunks_in_progress
+        assert not os.listdir(self.tmpdir)
+
+    def test_timeout(self):
+        sender, receiver = make_ends()
+        sender.do_send_file("timeout.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        state = list(receiver.receive_chunks_in_progress.values())[0]
+        #pretend the sender went away a long time ago:
+        state.last_activity -= file_transfer.FILE_CHUNK_TIMEOUT+1
+        delay, fn, args = list(receiver.timers.values())[0]
+        assert delay==file_transfer.FILE_CHUNK_TIMEOUT*1000
+        fn(*args)
+        assert not receiver.receive_chunks_in_progress and state.fd is None
+        #the transfer cannot be resumed, so the partial file is removed:
+        assert not os.path.exists(state.partname)
+
+    def test_stale_partial_files(self):
+        sender, receiver = make_ends()
+        sender.do_send_file("stale.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        receiver.deliver()
+        sender.deliver(3)
+        #the connection is lost, the partial file is kept for resuming:
+        receiver.cleanup_file_transfers()
+        partname = os.path.join(self.tmpdir, os.listdir(self.tmpdir)[0])
+        assert partname.endswith(".part")
+        old = os.path.getmtime(partname)-file_transfer.FILE_PART_MAX_AGE-1
+        os.utime(partname, (old, old))
+        #it is removed by the next transfer since it is too old:
+        sender, receiver = make_ends()
+        sender.do_send_file("other.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        assert not os.path.exists(partname)
+        run(sender, receiver)
+        self.check_received(receiver)
+
+    def test_too_large(self):
+        sender, receiver = make_ends()
+        receiver.file_size_limit = 0
+        sender.do_send_file("large.bin", "", self.data, len(self.data), False, False)
+        sender.deliver()
+        #the sender is told the transfer was refused:
+        assert len(receiver.packets)==1 and receiver.packets[0][0]=="ack-file-chunk" and receiver.packets[0][2] is False
+        receiver.deliver()
+        assert not sender.send_chunks_in_progress and not sender.timers
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import time
+import unittest
+import mmap
+from threading import Thread
+
+from xpra.net import mmap_pipe
+from xpra.net.mmap_pipe import MmapSlotWriter, mmap_read_frame, mmap_release, DATA_OFFSET
+
+
+class TestMmapSlots(unittest.TestCase):
+
+    def setUp(self):
+        self.size = DATA_OFFSET+1000
+        self.area = mmap.mmap(-1, self.size)
+        mmap_pipe.MMAP_WAIT = 0
+
+    def tearDown(self):
+        self.area.close()
+
+    def read(self, chunks):
+        #copy it so we don't keep a reference to the mmap buffer:
+        return bytes(bytearray(mmap_read_frame(self.area, chunks)))
+
+    def test_write_read(self):
+        w = MmapSlotWriter(self.area, self.size, 4)
+        chunks, free, options = w.write(b"hello")
+        assert chunks==[(DATA_OFFSET, 5)]
+        assert free==995
+        assert self.read(chunks)==b"hello"
+        mmap_release(self.area, options["mmap-slot"], options["mmap-seq"])
+        w.reclaim()
+        assert w.get_used()==0 and len(w.free_slots)==4
+
+    def test_full(self):
+        w = MmapSlotWriter(self.area, self.size, 4)
+        frames = [w.write(b"a"*400) for _ in range(2)]
+        assert all(f[0] for f in frames)
+        #not enough space left:
+        chunks, free, _ = w.write(b"b"*400)
+        assert chunks is None and free<0
+        assert w.waits==1 and w.failures==1
+        #releasing the second frame does not free anything until the first one is released:
+        mmap_release(self.area, frames[1][2]["mmap-slot"], frames[1][2]["mmap-seq"])
+        assert w.write(b"b"*400)[0] is None
+        mmap_release(self.area, frames[0][2]["mmap-slot"], frames[0][2]["mmap-seq"])
+        chunks, _, _ = w.write(b"c"*400)
+        assert chunks==[(DATA_OFFSET, 400)]
+        assert self.read(chunks)==b"c"*400
+
+    def test_wait(self):
+        mmap_pipe.MMAP_WAIT = 5
+        w = MmapSlotWriter(self.area, self.size, 4)
+        frames = [w.write(b"a"*400) for _ in range(2)]
+        def release():
+            mmap_release(self.area, frames[0][2]["mmap-slot"], frames[0][2]["mmap-seq"])
+            w.frames_released()
+        #the writer waits without holding the lock:
+        t = Thread(target=release)
+        def delayed_release():
+            time.sleep(0.1)
+            with w.lock:
+                t.start()
+        Thread(target=delayed_release).start()
+        start = time.time()
+        chunks, _, _ = w.write(b"b"*400)
+        t.join()
+        assert chunks==[(DATA_OFFSET, 400)]
+        assert time.time()-start<4 and w.waits==1 and w.failures==0
+
+    def test_wrap(self):
+        w = MmapSlotWriter(self.area, self.size, 8)
+        frames = [w.write(b"%i" % i * 300) for i in range(3)]
+        #release the first two, keep the third one at 600..900:
+        for f in frames[:2]:
+            mmap_release(self.area, f[2]["mmap-slot"], f[2]["mmap-seq"])
+        #does not fit at the end, so we wrap around:
+        chunks, _, _ = w.write(b"x"*200)
+        assert chunks==[(DATA_OFFSET, 200)]
+        #the frames are never split:
+        chunks, _, _ = w.write(b"y"*500)
+        assert chunks is None
+        chunks, _, _ = w.write(b"z"*400)
+        assert chunks==[(DATA_OFFSET+200, 400)]
+        assert self.read(frames[2][0])==b"2"*300
+
+    def test_slots(self):
+        w = MmapSlotWriter(self.area, self.size, 2)
+        assert w.write(b"1")[0] and w.write(b"2")[0]
+        #no slots left:
+        assert w.write(b"3")[0] is None
+        info = w.get_info()
+        assert info["slots"]["free"]==0 and info["frames"]==2
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+import hmac
+import hashlib
+import unittest
+from threading import Event, Timer
+
+from xpra.os_util import bytestostr, strtobytes, memoryview_to_bytes
+from xpra.net import crypto
+from xpra.net.protocol import Protocol
+from xpra.net.header import unpack_header, FLAGS_CIPHER, FLAGS_AEAD
+from xpra.net.compression import Compressed, LevelCompressed, compressed_wrapper
+from xpra.net.crypto import crypto_backend_init, MODE_OPTIONS, MODE_CBC, MODE_GCM, AEAD_TAG_SIZE, \
+    DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, PADDING_PKCS7
+
+
+class FakeScheduler(object):
+    def idle_add(self, fn, *args):
+        fn(*args)
+    def timeout_add(self, delay, fn, *args):
+        pass
+
+
+class FakeConnection(object):
+    input_bytecount = 0
+    output_bytecount = 0
+    def close(self):
+        pass
+
+
+class StubCipher(object):
+    """ not encrypted, only length preserving like CBC """
+    def encrypt(self, data):
+        return memoryview_to_bytes(data)
+    decrypt = encrypt
+
+class StubAEAD(object):
+    """ not encrypted, but authenticated with a tag which depends on the nonce """
+    def __init__(self, key):
+        self.key = key
+    def tag(self, nonce, data):
+        return hmac.new(self.key, nonce+data, hashlib.sha256).digest()[:AEAD_TAG_SIZE]
+    def encrypt(self, nonce, data):
+        data = memoryview_to_bytes(data)
+        return data+self.tag(nonce, data)
+    def decrypt(self, nonce, data):
+        data = memoryview_to_bytes(data)
+        v, tag = data[:-AEAD_TAG_SIZE], data[-AEAD_TAG_SIZE:]
+        if tag!=self.tag(nonce, v):
+            raise Exception("invalid tag")
+        return v
+
+class StubBackend(object):
+    """ used in place of the crypto libraries, which may not be available """
+    MODES = [MODE_GCM, MODE_CBC]
+    def get_key(self, password, key_salt, block_size, iterations):
+        return hashlib.sha256(strtobytes(password)+strtobytes(key_salt)).digest()[:block_size]
+    def get_encryptor(self, key, iv):
+        return StubCipher()
+    get_decryptor = get_encryptor
+    def get_aead(self, key):
+        return StubAEAD(key)
+
+
+def make_protocol(process_packet_cb, mode=None, mode_options=None):
+    p = Protocol(FakeScheduler(), FakeConnection(), process_packet_cb)
+    if mode:
+        cipher_args = ("AES", DEFAULT_IV, "secret", DEFAULT_SALT, DEFAULT_ITERATIONS, PADDING_PKCS7, mode)
+        p.set_cipher_in(*(cipher_args+(mode_options,)))
+        p.set_cipher_out(*cipher_args)
+    p.enable_encoder("bencode")
+    p.set_compression_level(0)
+    p.max_packet_size = p.abs_max_packet_size
+    return p
+
+
+class TestPacketReassembly(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels = os.urandom(4*1024*1024+13)
+        self.packets = [
+            ("hello", {"foo" : "bar"}),
+            ("draw", 1, 0, 0, 1024, 1024, "rgb32", Compressed("rgb32", self.pixels), 1, 4096, {}),
+            ("ping", 100),
+            ("draw", 1, 0, 0, 1, 1, "rgb32", Compressed("rgb32", b"\0"*4), 2, 4, {}),
+            ]
+        self.mode = None
+        self.in_mode = None
+        self.in_mode_options = None
+        self.data = self.encode(self.packets)
+
+    def encode(self, packets):
+        sender = make_protocol(None, self.mode)
+        items = []
+        for packet in packets:
+            sender._add_chunks_to_queue(sender.encode(packet))
+            items += sender._write_queue.get()
+        data = []
+        for buffers, _, _ in items:
+            if type(buffers)==list:
+                data += buffers
+            else:
+                data.append(buffers)
+        return b"".join(data)
+
+    def parse(self, chunk_size, passthrough_compressors=None):
+        received = []
+        done = Event()
+        def process_packet(proto, packet):
+            received.append(packet)
+            if len(received)==len(self.packets):
+                done.set()
+        p = make_protocol(process_packet, self.in_mode or self.mode, self.in_mode_options)
+        p.passthrough_compressors = passthrough_compressors
+        for i in range(0, len(self.data), chunk_size):
+            p.read_queue_put(self.data[i:i+chunk_size])
+        done.wait(10)
+        packets = list(received)
+        p.close()
+        return packets
+
+    def verify(self, chunk_size, passthrough_compressors=None):
+        received = self.parse(chunk_size, passthrough_compressors)
+        assert len(received)==len(self.packets), "expected %i packets but got %i with chunk size %i" % (len(self.packets), len(received), chunk_size)
+        return received
+
+    def verify_all(self, chunk_size):
+        received = self.verify(chunk_size)
+        assert bytestostr(received[0][0])=="hello"
+        assert received[1][7]==self.pixels
+        assert bytestostr(received[2][0])=="ping" and received[2][1]==100
+        assert received[3][7]==b"\0"*4
+
+    def test_whole(self):
+        self.verify_all(len(self.data))
+
+    def test_large_chunks(self):
+        self.verify_all(65536)
+
+    def test_odd_chunks(self):
+        self.verify_all(4099)
+
+    def test_small_chunks(self):
+        #splits the headers and payloads of the small packets:
+        self.packets = [self.packets[0], self.packets[2], self.packets[3]]
+        self.data = self.encode(self.packets)
+        for chunk_size in (1, 3, 7):
+            received = self.verify(chunk_size)
+            assert received[2][7]==b"\0"*4
+
+    def test_passthrough(self):
+        icon = b"icon"*10000
+        self.packets.append(("window-icon", 1, 64, 64, "premult_argb32", compressed_wrapper("icon", icon, zlib=True, can_inline=False)))
+        self.data = self.encode(self.packets)
+        received = self.verify(65536, set(["none", "zlib"]))
+        #the chunks are not decompressed:
+        pixels, cicon = received[1][7], received[4][5]
+        assert isinstance(pixels, LevelCompressed) and pixels.level==0 and pixels.data==self.pixels
+        assert isinstance(cicon, LevelCompressed) and cicon.algorithm=="zlib" and cicon.data!=icon
+        #forward them and check that the other end gets the original data:
+        self.packets = received
+        self.data = self.encode(self.packets)
+        received = self.verify(65536)
+        assert received[1][7]==self.pixels and received[4][5]==icon
+        #compressors not listed are decompressed as usual:
+        self.data = self.encode(self.packets)
+        received = self.verify(65536, set(["none"]))
+        assert received[4][5]==icon
+
+    def do_test_ciphers(self, modes):
+        for mode in modes:
+            self.mode = mode
+            self.data = self.encode(self.packets)
+            #the receiver knows which mode was used from the header flags:
+            flags = unpack_header(self.data[:8])[1]
+            assert flags & FLAGS_CIPHER
+            assert bool(flags & FLAGS_AEAD)==(mode==MODE_GCM)
+            self.verify_all(65536)
+
+    def do_test_cipher_mode_switch(self, modes):
+        #the receiver expects one mode but the sender chose another one it allowed:
+        self.in_mode_options = modes
+        for mode in modes:
+            for in_mode in modes:
+                self.mode = mode
+                self.in_mode = in_mode
+                self.data = self.encode(self.packets)
+                self.verify_all(65536)
+        #a mode which is not allowed is rejected:
+        self.mode = MODE_GCM
+        data = self.encode(self.packets)
+        received = []
+        rejected = Event()
+        def process_packet(proto, packet):
+            received.append(packet[0])
+            if packet[0]==Protocol.GIBBERISH:
+                rejected.set()
+        p = make_protocol(process_packet, MODE_CBC, [MODE_CBC])
+        p.read_queue_put(data)
+        assert rejected.wait(10)
+        p.close()
+        assert received[0]==Protocol.GIBBERISH
+
+    def test_ciphers(self):
+        crypto_backend_init()
+        if not crypto.backend:
+            self.skipTest("no crypto backend")
+        self.do_test_ciphers(MODE_OPTIONS)
+
+    def test_cipher_mode_switch(self):
+        crypto_backend_init()
+        if not crypto.backend:
+            self.skipTest("no crypto backend")
+        self.do_test_cipher_mode_switch(MODE_OPTIONS)
+
+    def with_stub_backend(self, fn):
+        saved = crypto.backend
+        crypto.backend = StubBackend()
+        try:
+            fn(StubBackend.MODES)
+        finally:
+            crypto.backend = saved
+
+    def test_stub_ciphers(self):
+        self.with_stub_backend(self.do_test_ciphers)
+
+    def test_stub_cipher_mode_switch(self):
+        self.with_stub_backend(self.do_test_cipher_mode_switch)
+
+
+class ThreadedScheduler(object):
+    def idle_add(self, fn, *args):
+        fn(*args)
+    def timeout_add(self, delay, fn, *args):
+        def run():
+            if fn(*args):
+                self.timeout_add(delay, fn, *args)
+        Timer(delay/1000.0, run).start()
+
+
+class SlowCipher(object):
+    def encrypt(self, data):
+        time.sleep(0.05)
+        return data
+
+
+class TestFlush(unittest.TestCase):
+
+    def test_flush_encrypted(self):
+        closed = Event()
+        p = Protocol(ThreadedScheduler(), FakeConnection(), lambda *args : None)
+        p.enable_encoder("bencode")
+        p.set_compression_level(0)
+        p.cipher_out = SlowCipher()
+        p.cipher_out_name = "AES"
+        p.cipher_out_mode = "CBC"
+        p.cipher_out_block_size = 16
+        p.cipher_out_padding = PADDING_PKCS7
+        #pretend to be the write thread:
+        write_queue = p._write_queue
+        written = []
+        def write_loop():
+            while True:
+                items = write_queue.get()
+                if items is None:
+                    return
+                for data, _, end_cb in items:
+                    written.append(bytes(data))
+                    if end_cb:
+                        end_cb()
+        writer = Timer(0, write_loop)
+        writer.start()
+        try:
+            for i in range(2):
+                p._encrypt_queue.put((p.encode(("ping", i)), None, None))
+            #the packets are encrypted after we start flushing:
+            p.flush_then_close(("disconnect", "bye"), closed.set)
+            p.start_encrypt_thread()
+            assert closed.wait(5)
+        finally:
+            write_queue.put(None)
+            writer.join()
+        #all the packets made it, and the last packet is last:
+        assert len(written)==3, "expected 3 packets, got %i" % len(written)
+        assert b"disconnect" in written[-1]
+
+
+class TestEncode(unittest.TestCase):
+
+    def test_packet_unmodified(self):
+        p = make_protocol(None)
+        p.send_aliases = {"draw" : 1}
+        pixels = Compressed("rgb32", b"\0"*4096)
+        for packet in (("draw", 1, 0, 0, 32, 32, "rgb32", pixels, 1, 128, {}),
+                       ["draw", 1, 0, 0, 32, 32, "rgb32", pixels, 1, 128, {}]):
+            copy = list(packet)
+            chunks = p.encode(packet)
+            assert len(chunks)==2 and chunks[0][3]==pixels.data
+            assert list(packet)==copy
+
+    def test_schemas(self):
+        from xpra.net import packet_encoding
+        if not packet_encoding.has_rencode:
+            return
+        packets = (
+                   ("draw", 1, 0, 0, 32, 32, "png", b"x"*100, 1, 0, {"compress_level" : 1}),
+                   ("key-action", 1, "a", True, ["shift"], 97, "a", 38, 0),
+                   #unexpected types:
+                   ("pointer-position", 10, 20),
+                   )
+        for packet in packets:
+            schema = packet_encoding.get_packet_schema(packet[0])
+            assert schema
+            assert packet_encoding.do_rencode(packet, schema)==packet_encoding.do_rencode(packet)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.bandwidth_estimator import BandwidthEstimator
+
+
+def simulate(bwe, link_rate, count, size=100*1000, interval=0.01, latency=0.020, start=1000, decode_time=0.002):
+    """
+        Sends 'count' packets of 'size' bytes every 'interval' seconds
+        over a link which can only deliver 'link_rate' bits per second.
+    """
+    events = []
+    link_free = start
+    for i in range(count):
+        now = start+i*interval
+        events.append((now, 0, i))
+        #the packet is queued behind the previous ones:
+        delivered_at = max(now, link_free)+size*8.0/link_rate
+        link_free = delivered_at
+        events.append((delivered_at+latency+decode_time, 1, i))
+    for event_time, ack, i in sorted(events):
+        if ack:
+            bwe.record_ack(i, event_time, decode_time)
+        else:
+            bwe.record_send(i, event_time, event_time, size)
+    return link_free
+
+
+class TestBandwidthEstimator(unittest.TestCase):
+
+    def test_estimate(self):
+        bwe = BandwidthEstimator()
+        assert bwe.get_estimate()==0 and bwe.get_load() is None
+        #20Mbps link, but we try to send 80Mbps:
+        simulate(bwe, 20*1000*1000, 100)
+        estimate = bwe.get_estimate()
+        assert 18*1000*1000<estimate<=21*1000*1000, "invalid estimate: %s" % estimate
+        #the round trip time includes the time it takes to transmit the packet:
+        assert abs(bwe.get_min_rtt()-0.060)<0.001
+        assert bwe.inflight_bytes==0 and not bwe.inflight
+
+    def test_app_limited(self):
+        bwe = BandwidthEstimator()
+        #100Mbps link, sending one packet every 100ms:
+        simulate(bwe, 100*1000*1000, 20, size=10*1000, interval=0.1)
+        #we can't measure more than what we send, but the idle time is not counted against the link:
+        estimate = bwe.get_estimate()
+        assert estimate>=10*1000*8, "estimate is too low: %s" % estimate
+
+    def test_congestion(self):
+        bwe = BandwidthEstimator()
+        link_rate = 10*1000*1000
+        simulate(bwe, link_rate, 20, interval=0.1)
+        #now send a burst without any acks:
+        now = 1010
+        for i in range(100, 120):
+            bwe.record_send(i, now, now, 100*1000)
+        load = bwe.get_load(now)
+        assert load>1, "load should be high with so much data in flight: %s" % load
+        factor = bwe.get_factor(now)
+        assert factor[0]=="bandwidth" and factor[2]>1 and factor[3]>0
+        #unacked packets eventually expire:
+        assert bwe.get_load(now+120)<1
+
+    def test_limit(self):
+        bwe = BandwidthEstimator(8*1000*1000)
+        #1MB/s: the burst allowance goes first,
+        assert bwe.get_pacing_delay(1000)==0
+        bwe.record_send(0, 1000, 1000, 100*1000)
+        delay = bwe.get_pacing_delay(1000)
+        assert 0.05<delay<0.1, "invalid pacing delay: %s" % delay
+        assert bwe.get_pacing_delay(1000+delay)==0
+        #sending at twice the limit:
+        for i in range(1, 20):
+            bwe.record_send(i, 1000+i*0.05, 1000+i*0.05, 100*1000)
+        assert bwe.get_load(1001)>1.5
+        bwe.set_bandwidth_limit(0)
+        assert bwe.get_pacing_delay(1001)==0
+        info = bwe.get_info()
+        assert "limit" not in info and info["inflight"]["packets"]==20
+
+    def test_reset(self):
+        bwe = BandwidthEstimator(1000*1000)
+        simulate(bwe, 1000*1000, 10)
+        bwe.reset()
+        assert bwe.get_estimate()==0 and bwe.bandwidth_limit==1000*1000
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
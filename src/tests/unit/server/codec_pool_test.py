@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.window.codec_pool import CodecPool
+
+
+class FakeCodec(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def is_closed(self):
+        return self.closed
+
+    def clean(self):
+        self.closed = True
+
+    def get_type(self):
+        return "fake"
+
+
+class TestCodecPool(unittest.TestCase):
+
+    def test_reuse(self):
+        pool = CodecPool(max_size=2, timeout=10)
+        key = ("csc", FakeCodec, "BGRX", 640, 480)
+        c = FakeCodec()
+        #unregistered instances cannot be pooled:
+        assert not pool.release(c)
+        pool.register(c, key)
+        assert pool.acquire(key) is None
+        assert pool.release(c)
+        assert pool.has(key) and not pool.has(("other", ))
+        assert pool.acquire(key) is c
+        assert pool.acquire(key) is None
+        assert not c.closed
+        #closed instances are not pooled:
+        c.clean()
+        assert not pool.release(c)
+        info = pool.get_info()
+        assert info["hits"]==1 and info["misses"]==2
+
+    def test_eviction(self):
+        pool = CodecPool(max_size=2, timeout=10)
+        codecs = [FakeCodec() for _ in range(3)]
+        for i, c in enumerate(codecs):
+            pool.register(c, ("key", i))
+            assert pool.release(c)
+        #the oldest one is freed:
+        assert codecs[0].closed and not codecs[1].closed
+        assert not pool.has(("key", 0)) and pool.has(("key", 2))
+        #disabled pool:
+        pool = CodecPool(max_size=0)
+        c = FakeCodec()
+        pool.register(c, "key")
+        assert not pool.release(c)
+
+    def test_expiry(self):
+        pool = CodecPool(max_size=4, timeout=10)
+        c = FakeCodec()
+        pool.register(c, "key")
+        assert pool.claim_timer() is False
+        pool.release(c)
+        assert pool.claim_timer() is True
+        assert pool.claim_timer() is False
+        released = pool.idle[0][2]
+        pool.expire(released+5)
+        assert pool.has("key") and not c.closed
+        pool.expire(released+10)
+        assert not pool.has("key") and c.closed
+        assert pool.expire_timer() is False
+        assert pool.get_info()["expired"]==1
+        c = FakeCodec()
+        pool.register(c, "key")
+        pool.release(c)
+        pool.cleanup()
+        assert c.closed and not pool.idle
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import time
+import unittest
+
+from xpra.server.window.csc_stage import CSCStage
+
+
+class FakeImage(object):
+
+    def __init__(self, n):
+        self.n = n
+        self.freed = False
+
+    def free(self):
+        self.freed = True
+
+
+class FakeCSC(object):
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.converted = []
+        self.busy = False
+
+    def convert_image(self, image):
+        assert not self.busy, "csc instance used by two threads at once"
+        self.busy = True
+        try:
+            time.sleep(self.delay)
+            self.converted.append(image.n)
+            return FakeImage(image.n)
+        finally:
+            self.busy = False
+
+
+class TestCSCStage(unittest.TestCase):
+
+    def make_stage(self, current):
+        return CSCStage("test", lambda csce : csce is current[0], lambda image : image.free())
+
+    def test_order(self):
+        csc = FakeCSC(0.001)
+        stage = self.make_stage([csc])
+        images = [FakeImage(i) for i in range(10)]
+        for image in images:
+            stage.submit(image, csc)
+        try:
+            for image in images:
+                #the caller converts some frames itself, holding the lock:
+                if image.n%3==0:
+                    with stage.lock:
+                        csc.convert_image(FakeImage(-1))
+                job = stage.take(image)
+                assert job.wait().n==image.n
+            assert [x for x in csc.converted if x>=0]==list(range(10))
+            assert stage.take(images[0]) is None
+            assert stage.get_info()["converted"]==10
+        finally:
+            stage.stop()
+
+    def test_replaced(self):
+        current = [None]
+        csc = FakeCSC()
+        stage = self.make_stage(current)
+        try:
+            #not the current csc instance, so the job is skipped:
+            image = FakeImage(0)
+            job = stage.submit(image, csc)
+            assert stage.take(image).wait() is None and job.cancelled is False
+            assert not csc.converted
+        finally:
+            stage.stop()
+
+    def test_discard(self):
+        csc = FakeCSC()
+        stage = self.make_stage([csc])
+        try:
+            images = [FakeImage(i) for i in range(3)]
+            jobs = [stage.submit(image, csc) for image in images]
+            jobs[-1].wait()
+            #the results of discarded jobs are freed:
+            result = jobs[0].result
+            stage.discard(images[0])
+            assert jobs[0].cancelled and result.freed
+            stage.drain()
+            assert not stage.jobs and all(job.cancelled for job in jobs)
+            assert stage.get_info()["cancelled"]==3
+        finally:
+            stage.stop()
+
+    def test_cancel_converting(self):
+        csc = FakeCSC(0.2)
+        stage = self.make_stage([csc])
+        try:
+            image = FakeImage(0)
+            job = stage.submit(image, csc)
+            while not job.converting:
+                time.sleep(0.001)
+            #cancelling does not wait for the conversion to finish:
+            start = time.time()
+            assert stage.discard(image) is False
+            stage.drain()
+            assert time.time()-start<0.1
+            assert job.cancelled and not image.freed
+            #the stage thread frees the source image and the result itself:
+            assert job.wait() is None
+            assert image.freed
+            assert not stage.jobs and stage.get_info()["cancelled"]==1
+        finally:
+            stage.stop()
+
+    def test_cancel_pending(self):
+        csc = FakeCSC()
+        stage = self.make_stage([csc])
+        try:
+            #hold the lock so the jobs cannot run yet:
+            with stage.lock:
+                image = FakeImage(0)
+                job = stage.submit(image, csc)
+                time.sleep(0.05)
+                stage.drain()
+            assert job.wait() is None and not csc.converted
+        finally:
+            stage.stop()
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.window.damage_trace import DamageTraceWriter, read_damage_trace, get_trace_filename
+from xpra.scripts.damage_replay import percentile, ReplayResult, load_records
+
+
+def make_image(x, y, w, h, value):
+    rowstride = w*4
+    return ImageWrapper(x, y, w, h, bytes(bytearray([value])*(rowstride*h)), "BGRX", 24, rowstride)
+
+
+class TestDamageTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        filename = get_trace_filename(5, self.tmpdir)
+        writer = DamageTraceWriter(filename)
+        assert writer.record(5, make_image(0, 0, 64, 32, 10), "png", 1000)
+        assert writer.record(5, make_image(10, 20, 16, 8, 200), "h264", 1000.5)
+        writer.close()
+        assert not writer.record(5, make_image(0, 0, 4, 4, 0), "png")
+        records = list(read_damage_trace(filename))
+        assert len(records)==2
+        timestamp, wid, coding, image = records[1]
+        assert timestamp==1000.5 and wid==5 and coding=="h264"
+        assert image.get_geometry()==(10, 20, 16, 8, 24)
+        assert image.get_pixel_format()=="BGRX" and image.get_rowstride()==64
+        assert image.get_pixels()==make_image(10, 20, 16, 8, 200).get_pixels()
+        #records from multiple files are merged in time order:
+        filename2 = os.path.join(self.tmpdir, "other.trace")
+        writer = DamageTraceWriter(filename2)
+        writer.record(6, make_image(0, 0, 8, 8, 0), "rgb24", 1000.2)
+        writer.close()
+        assert [r[1] for r in load_records([filename, filename2])]==[5, 6, 5]
+
+    def test_max_size(self):
+        filename = get_trace_filename(1, self.tmpdir)
+        writer = DamageTraceWriter(filename, max_size=1024)
+        #random data does not compress, so this fills the file:
+        image = ImageWrapper(0, 0, 32, 32, os.urandom(32*32*4), "BGRX", 24, 32*4)
+        assert not writer.record(1, image, "png")
+        assert writer.file is None and writer.records==0
+        assert list(read_damage_trace(filename))==[]
+
+    def test_invalid_file(self):
+        filename = os.path.join(self.tmpdir, "invalid.trace")
+        with open(filename, "wb") as f:
+            f.write(b"not a trace")
+        try:
+            list(read_damage_trace(filename))
+        except Exception:
+            pass
+        else:
+            raise Exception("invalid file should have been rejected")
+
+    def test_result(self):
+        assert percentile([], 50)==0
+        assert percentile(list(range(100)), 50)==50
+        assert percentile(list(range(100)), 99)==99
+        result = ReplayResult(("png", "pillow", "", ""))
+        result.frames = 2
+        result.pixels = 1000
+        result.bytes = 500
+        result.encode_times = [0.001, 0.003]
+        result.latencies = [0.001, 0.004]
+        info = result.get_info()
+        assert info["bits-per-pixel"]==4
+        assert info["encode-time"]["p99"]==3000 and info["latency"]["p50"]==4000
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import time
+
+from xpra.server.window.delta_cache import DeltaCache, DeltaEntry
+
+
+def make_entry(dc, w, h, value, store, coding="png"):
+    pixels = bytes(bytearray([value])*(w*h*4))
+    return DeltaEntry(w, h, "BGRX", coding, store, pixels, dc.get_key(w, h, "BGRX", pixels))
+
+
+class TestDeltaCache(unittest.TestCase):
+
+    def test_find(self):
+        dc = DeltaCache(4)
+        e = make_entry(dc, 10, 10, 1, 1)
+        dc.store(dc.choose_bucket(), e)
+        bucket, found = dc.find(make_entry(dc, 10, 10, 1, 2).key)
+        assert bucket==0 and found==e
+        assert dc.find(make_entry(dc, 10, 10, 2, 3).key)==(-1, None)
+        assert dc.hits==1 and dc.misses==1
+        #xor candidates only need the same dimensions:
+        assert dc.find_delta(10, 10, "BGRX", "png", 400)==(0, e)
+        assert dc.find_delta(10, 10, "BGRX", "rgb24", 400)==(-1, None)
+        assert dc.find_delta(10, 11, "BGRX", "png", 440)==(-1, None)
+
+    def test_lru(self):
+        dc = DeltaCache(2)
+        for i in range(2):
+            dc.store(dc.choose_bucket(), make_entry(dc, 4, 4, i, i+1))
+            time.sleep(0.001)
+        #use the first one, so the second one is the least recently used:
+        dc.find(dc.buckets[0].key)
+        assert dc.choose_bucket()==1
+
+    def test_memory_limit(self):
+        dc = DeltaCache(8, max_size=1000)
+        for i in range(3):
+            dc.store(dc.choose_bucket(), make_entry(dc, 10, 10, i, i+1))
+            time.sleep(0.001)
+        #each entry is 400 bytes, so the first one was evicted:
+        assert dc.size==800
+        assert dc.evicted==1
+        assert dc.buckets[0] is None
+        assert dc.take_evicted()==[0]
+        assert dc.take_evicted()==[]
+        #re-using an evicted bucket:
+        dc.store(1, make_entry(dc, 5, 5, 9, 10))
+        assert dc.size==500
+        dc.reset()
+        assert dc.size==0 and not any(dc.buckets)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
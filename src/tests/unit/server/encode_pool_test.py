@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import time
+from threading import Lock
+
+from xpra.server.encode_pool import EncodeWorkerPool, SliceEncodePool
+
+
+class TestEncodePool(unittest.TestCase):
+
+    def test_ordering(self):
+        closed = []
+        def is_closed():
+            return len(closed)>0
+        pool = EncodeWorkerPool(is_closed, 4)
+        pool.start()
+        results = {}
+        lock = Lock()
+        def work(wid, i):
+            time.sleep(0.001)
+            with lock:
+                results.setdefault(wid, []).append(i)
+        for i in range(20):
+            for wid in (1, 2, 3, 4, 5):
+                pool.queue(wid, (work, wid, i))
+        pool.stop()
+        for t in pool.get_threads():
+            t.join(10)
+        for wid in (1, 2, 3, 4, 5):
+            assert results.get(wid)==list(range(20)), "invalid order for window %i: %s" % (wid, results.get(wid))
+        #windows are always handled by the same worker:
+        assert pool.get_worker(1)==pool.get_worker(1)
+        info = pool.get_info()
+        assert info["workers"]==4
+        assert sum(x["items"] for x in info["worker"].values())==100
+
+    def test_spread(self):
+        pool = EncodeWorkerPool(lambda : False, 2)
+        assert pool.get_worker(1)!=pool.get_worker(2)
+        pool.release(1)
+        assert 1 not in pool.assignments
+
+    def test_single_worker(self):
+        pool = EncodeWorkerPool(lambda : False, 2)
+        pool.use_single_worker()
+        assert pool.get_worker(1)==pool.get_worker(2)==pool.workers[0]
+
+
+class TestSliceEncodePool(unittest.TestCase):
+
+    def test_map(self):
+        pool = SliceEncodePool(3)
+        threads = set()
+        def work(i):
+            import threading
+            time.sleep(0.01)
+            threads.add(threading.current_thread().name)
+            return i*2
+        assert pool.map(work, list(range(8)))==[i*2 for i in range(8)]
+        assert len(threads)>1
+        assert pool.map(work, [5])==[10]
+        info = pool.get_info()
+        assert info["jobs"]==2 and info["items"]==9
+
+    def test_errors(self):
+        pool = SliceEncodePool(2)
+        def fail(i):
+            if i==2:
+                raise ValueError("slice %i" % i)
+            return i
+        self.assertRaises(ValueError, pool.map, fail, [0, 1, 2, 3])
+        #the pool is still usable:
+        assert pool.map(fail, [0, 1])==[0, 1]
+
+    def test_no_threads(self):
+        pool = SliceEncodePool(0)
+        assert pool.map(lambda x : x+1, [1, 2, 3])==[2, 3, 4]
+        assert not pool.threads
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
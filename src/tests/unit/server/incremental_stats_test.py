@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import random
+
+from xpra.server.incremental_stats import TimeWeightedAverage, RingBuffer, TimeWeightedRecords, TimeSizeWeightedRecords
+
+
+class TestIncrementalStats(unittest.TestCase):
+
+    def test_average(self):
+        twa = TimeWeightedAverage()
+        assert twa.get() is None
+        for i in range(100):
+            twa.add(1000+i*0.1, 5)
+        avg, recent = twa.get()
+        assert abs(avg-5)<0.0001 and abs(recent-5)<0.0001
+        #a sudden change affects the recent value much more:
+        for i in range(5):
+            twa.add(1010+i*0.1, 10)
+        avg, recent = twa.get()
+        assert 5<avg<recent<10, "expected the recent value %s to be higher than the average %s" % (recent, avg)
+        #records which arrive late count less:
+        twa.add(1000, 100)
+        assert twa.get()[1]<recent+1
+        #very old values no longer count:
+        twa.add(1000000, 1)
+        assert twa.get()==(1, 1)
+
+    def test_ring(self):
+        rb = RingBuffer(10, 2, min_field=1)
+        for i in range(25):
+            rb.append((i, 100-i if i<20 else i))
+        assert len(rb)==10
+        assert list(rb)[0]==(15, 85) and rb[-1]==(24, 24)
+        assert rb.get_field(0)==list(range(15, 25))
+        assert rb.min()==min(x for _, x in rb)
+        try:
+            rb[10]
+        except IndexError:
+            pass
+        else:
+            raise Exception("index should be out of range")
+
+    def test_sliding_min(self):
+        rb = RingBuffer(16, 1, min_field=0)
+        values = []
+        for _ in range(1000):
+            v = random.randint(0, 1000)
+            values.append(v)
+            rb.append((v, ))
+            assert rb.min()==min(values[-16:])
+
+    def test_records(self):
+        twr = TimeWeightedRecords(10, 4, time_field=1, value_field=3)
+        for i in range(20):
+            twr.append((1, 1000+i, 0, 2.0))
+        assert twr.get_averages()==(2.0, 2.0)
+        twr.clear()
+        assert len(twr)==0 and twr.get_averages() is None
+
+    def test_speed(self):
+        tswr = TimeSizeWeightedRecords(100, sizeunit=1000)
+        #constant speed, whatever the size:
+        for i in range(1, 200):
+            tswr.append((1000+i, i*7, i))
+        avg, recent = tswr.get_averages()
+        assert abs(avg-7000)<0.01 and abs(recent-7000)<0.01
+        #invalid records are ignored:
+        tswr.append((2000, 100, 0))
+        assert tswr.get_averages()==(avg, recent)
+        #the size total only covers the records we keep:
+        assert tswr.size_total==sum(tswr.get_field(1))
+
+    def test_score(self):
+        tswr = TimeSizeWeightedRecords(100, score=True)
+        for i in range(50):
+            tswr.append((1000+i*0.01, 10000, 300))
+        tswr.append((1001, 10000, -1))
+        avg, recent = tswr.get_averages()
+        assert abs(avg-300)<0.01 and abs(recent-300)<0.01
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
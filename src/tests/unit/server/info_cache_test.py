@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.util import flatten_dict
+from xpra.server.info_cache import InfoCache, InfoSelection, info_delta
+
+
+class TestInfoCache(unittest.TestCase):
+
+    def test_cache(self):
+        calls = []
+        def get_info(x):
+            calls.append(x)
+            return {"value" : x, "nested" : {"a" : 1}}
+        cache = InfoCache()
+        v = cache.get("foo", get_info, 1)
+        assert v["value"]==1 and len(calls)==1
+        #modifying the value returned does not affect the cache:
+        v["nested"]["a"] = 2
+        v = cache.get("foo", get_info, 2)
+        assert v["value"]==1 and v["nested"]["a"]==1 and len(calls)==1
+        info = cache.get_info()
+        assert info["hits"]==1 and info["misses"]==1
+        #cached until it is marked as dirty:
+        cache.invalidate("foo")
+        assert cache.get("foo", get_info, 3)["value"]==3
+
+    def test_invalidated_during_collection(self):
+        cache = InfoCache()
+        def get_info():
+            #the owner invalidates the key whilst we collect it:
+            cache.invalidate("foo")
+            return {"a" : 1}
+        cache.get("foo", get_info)
+        assert "foo" not in cache.entries
+
+    def test_invalidate(self):
+        cache = InfoCache()
+        for key in ("client.1", "client.1.window", "client.10", "keyboard"):
+            cache.get(key, dict, {"key" : key})
+        cache.invalidate("client.1")
+        assert sorted(cache.entries.keys())==["client.10", "keyboard"]
+        cache.invalidate()
+        assert not cache.entries
+
+    def test_selection(self):
+        info = {
+                "server"    : {"pid" : 10, "type" : "x11"},
+                "client"    : {
+                               0 : {"window" : {1 : {"encoding" : "h264", "size" : (10, 10)}}},
+                               1 : {"window" : {2 : {"encoding" : "png"}}},
+                               },
+                }
+        assert InfoSelection([]).filter(info) is info
+        s = InfoSelection(["server.pid", "client.*.window.*.encoding"])
+        assert s.filter(info)=={
+                                "server"    : {"pid" : 10},
+                                "client"    : {
+                                               0 : {"window" : {1 : {"encoding" : "h264"}}},
+                                               1 : {"window" : {2 : {"encoding" : "png"}}},
+                                               },
+                                }
+        assert InfoSelection(["nomatch.*"]).filter(info)=={}
+        #subtrees which are not selected can be skipped before collecting them:
+        assert InfoSelection([]).wants("anything")
+        assert s.wants("server") and s.wants("client") and s.wants("client", 0, "window")
+        assert s.wants("server", "pid", "anything-below")
+        assert not s.wants("network") and not s.wants("server", "type")
+
+    def test_delta(self):
+        previous = flatten_dict({"a" : {"b" : 1, "c" : 2}, "d" : 3})
+        current = flatten_dict({"a" : {"b" : 1, "c" : 4}, "e" : 5})
+        changed, removed = info_delta(previous, current)
+        assert changed=={"a.c" : 4, "e" : 5}
+        assert removed==["d"]
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import unittest
+
+from xpra.server.window.scroll_data import ScrollData, hash_rows
+
+
+W = 64
+H = 200
+ROWSTRIDE = W*4
+
+
+def make_rows(n):
+    return [os.urandom(W*4) for _ in range(n)]
+
+def get_hashes(rows):
+    pixels = b"".join(rows)
+    return hash_rows(pixels, 0, len(rows), 0, W*4, ROWSTRIDE)
+
+
+class TestScrollData(unittest.TestCase):
+
+    def test_scroll_up(self):
+        rows = make_rows(H)
+        sd = ScrollData(W, H)
+        sd.update(0, get_hashes(rows))
+        #scroll up by 10 lines, with 10 new lines at the bottom:
+        new_rows = rows[10:]+make_rows(10)
+        hashes = get_hashes(new_rows)
+        distance = sd.calculate(0, hashes)
+        assert distance==-10, "expected a scroll distance of -10 but got %i" % distance
+        scrolls, unchanged, changed = sd.get_scroll_values(0, hashes, distance)
+        assert scrolls==[(0, H-10)], "invalid scrolls: %s" % (scrolls,)
+        assert unchanged==[]
+        assert changed==[(H-10, 10)], "invalid changed rows: %s" % (changed,)
+
+    def test_scroll_down_with_static_header(self):
+        rows = make_rows(H)
+        sd = ScrollData(W, H)
+        sd.update(0, get_hashes(rows))
+        #first 20 rows don't move, the rest scrolls down by 5:
+        new_rows = rows[:20]+make_rows(5)+rows[20:H-5]
+        hashes = get_hashes(new_rows)
+        distance = sd.calculate(0, hashes)
+        assert distance==5
+        scrolls, unchanged, changed = sd.get_scroll_values(0, hashes, distance)
+        assert unchanged==[(0, 20)]
+        assert changed==[(20, 5)]
+        assert scrolls==[(25, H-25)]
+
+    def test_no_scroll(self):
+        sd = ScrollData(W, H)
+        sd.update(0, get_hashes(make_rows(H)))
+        assert sd.calculate(0, get_hashes(make_rows(H)))==0
+        #invalidated rows can't be used:
+        rows = make_rows(H)
+        sd.update(0, get_hashes(rows))
+        sd.invalidate(0, H)
+        assert sd.calculate(0, get_hashes(rows[10:]+make_rows(10)))==0
+
+    def test_memoryview(self):
+        #image wrappers return the pixels as a memoryview:
+        rows = make_rows(10)
+        pixels = b"".join(rows)
+        hashes = hash_rows(memoryview(pixels), 0, 10, 0, W*4, ROWSTRIDE)
+        assert hashes==get_hashes(rows)
+
+    def test_blank_rows(self):
+        #identical rows are ignored when looking for the scroll distance:
+        blank = b"\0"*(W*4)
+        sd = ScrollData(W, H)
+        sd.update(0, get_hashes([blank]*H))
+        assert sd.calculate(0, get_hashes([blank]*H))==0
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+import time
+from threading import Thread, Lock
+
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.window.shared_encode import SharedEncodeCache
+
+
+def make_image(value=0, w=64, h=32):
+    pixels = bytearray([value])*(w*h*4)
+    return ImageWrapper(0, 0, w, h, bytes(pixels), "BGRX", 24, w*4)
+
+
+class TestSharedEncode(unittest.TestCase):
+
+    def make_encoder(self, delay=0):
+        calls = []
+        lock = Lock()
+        def encoder(coding, image, options):
+            time.sleep(delay)
+            with lock:
+                calls.append(image)
+            return coding, b"data", {"zlib" : 1}, image.get_width(), image.get_height(), 0, 24
+        return calls, encoder
+
+    def test_keys(self):
+        sec = SharedEncodeCache()
+        image = make_image()
+        k1 = sec.get_key(1, image, "png", (50, 50))
+        assert k1==sec.get_key(1, make_image(), "png", (50, 50))
+        assert k1!=sec.get_key(2, image, "png", (50, 50))
+        assert k1!=sec.get_key(1, make_image(1), "png", (50, 50))
+        assert k1!=sec.get_key(1, image, "png", (60, 50))
+        #image wrappers may return the pixels as a memoryview:
+        mv = ImageWrapper(0, 0, 64, 32, memoryview(image.get_pixels()), "BGRX", 24, 64*4)
+        assert k1==sec.get_key(1, mv, "png", (50, 50))
+
+    def test_reuse(self):
+        sec = SharedEncodeCache()
+        sec.set_clients(2)
+        assert sec.is_enabled()
+        calls, encoder = self.make_encoder()
+        image = make_image()
+        key = sec.get_key(1, image, "png", ())
+        r1 = sec.encode(key, encoder, "png", image, {})
+        r1[2]["flush"] = 1
+        r2 = sec.encode(key, encoder, "png", image, {})
+        assert len(calls)==1
+        assert r2[1]==r1[1]
+        #client options must not be shared:
+        assert "flush" not in r2[2]
+        assert sec.hits==1 and sec.misses==1
+        sec.set_clients(1)
+        assert not sec.is_enabled()
+        assert not sec.results
+
+    def test_expiry(self):
+        sec = SharedEncodeCache(expiry=0)
+        calls, encoder = self.make_encoder()
+        image = make_image()
+        key = sec.get_key(1, image, "png", ())
+        sec.encode(key, encoder, "png", image, {})
+        time.sleep(0.01)
+        sec.encode(key, encoder, "png", image, {})
+        assert len(calls)==2
+
+    def test_concurrent(self):
+        sec = SharedEncodeCache()
+        calls, encoder = self.make_encoder(0.1)
+        image = make_image()
+        key = sec.get_key(1, image, "jpeg", ())
+        results = []
+        def encode():
+            results.append(sec.encode(key, encoder, "jpeg", image, {}))
+        threads = [Thread(target=encode) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results)==4
+        assert len(calls)==1, "expected a single encoding but got %i" % len(calls)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.source_stats import GlobalPerformanceStatistics
+from xpra.server.window.batch_config import DamageBatchConfig
+from xpra.server.window.batch_delay_calculator import update_batch_delay
+
+
+class TestGlobalPerformanceStatistics(unittest.TestCase):
+
+    def test_factors_before_ack(self):
+        stats = GlobalPerformanceStatistics()
+        #no acks yet, so no bandwidth factor:
+        assert stats.bandwidth.get_factor() is None
+        factors = stats.get_factors(0.1, 1024*1024)
+        assert None not in factors
+        assert "bandwidth" not in [x[0] for x in factors]
+        batch = DamageBatchConfig()
+        update_batch_delay(batch, factors)
+        #once a limit is set, we have a bandwidth factor:
+        stats.bandwidth.set_bandwidth_limit(10*1000*1000)
+        factors = stats.get_factors(0.1, 1024*1024)
+        assert "bandwidth" in [x[0] for x in factors]
+        update_batch_delay(batch, factors)
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import unittest
+
+from xpra.server.window.tile_cache import TileCache
+
+
+def make_pixels(w, h, Bpp=4, value=0):
+    return bytearray([value])*(w*h*Bpp)
+
+def fill(pixels, w, x, y, fw, fh, value, Bpp=4):
+    for j in range(y, y+fh):
+        start = (j*w+x)*Bpp
+        pixels[start:start+fw*Bpp] = bytearray([value])*(fw*Bpp)
+
+
+class TestTileCache(unittest.TestCase):
+
+    def test_tile_range(self):
+        tc = TileCache(256, 256, 64)
+        assert tc.get_tile_range(0, 0, 256, 256)==(0, 0, 4, 4)
+        assert tc.get_tile_range(10, 10, 100, 100)==(1, 1, 1, 1)
+        assert tc.get_tile_range(64, 0, 128, 63)==(1, 0, 3, 0)
+
+    def test_unchanged(self):
+        w, h = 256, 128
+        tc = TileCache(w, h, 64)
+        pixels = make_pixels(w, h)
+        hashes = tc.hash_tiles(0, 0, w, h, pixels, w*4, 4)
+        assert len(hashes)==8
+        assert tc.get_unchanged(hashes)==[]
+        tc.update(hashes)
+        #modify one tile:
+        fill(pixels, w, 70, 10, 4, 4, 255)
+        hashes = tc.hash_tiles(0, 0, w, h, pixels, w*4, 4)
+        unchanged = tc.get_unchanged(hashes)
+        assert len(unchanged)==7
+        assert (1, 0) not in unchanged
+        assert tc.hits==7 and tc.misses==9
+        #sub-rectangle, using the same tile grid:
+        sub = bytearray(pixels[(64*w)*4:])
+        hashes = tc.hash_tiles(0, 64, w, 64, sub, w*4, 4)
+        assert sorted(hashes.keys())==[(0, 1), (1, 1), (2, 1), (3, 1)]
+        assert len(tc.get_unchanged(hashes))==4
+
+    def test_memoryview(self):
+        #image wrappers return the pixels as a memoryview:
+        w, h = 128, 64
+        tc = TileCache(w, h, 64)
+        pixels = make_pixels(w, h)
+        fill(pixels, w, 0, 0, 8, 8, 128)
+        hashes = tc.hash_tiles(0, 0, w, h, memoryview(pixels), w*4, 4)
+        assert hashes==tc.hash_tiles(0, 0, w, h, bytes(pixels), w*4, 4)
+        assert len(hashes)==2 and hashes[(0, 0)]!=hashes[(1, 0)]
+
+    def test_invalidate(self):
+        w, h = 256, 256
+        tc = TileCache(w, h, 64)
+        tc.update(tc.hash_tiles(0, 0, w, h, make_pixels(w, h), w*4, 4))
+        assert len(tc.tiles)==16
+        tc.invalidate(60, 60, 10, 10)
+        assert len(tc.tiles)==12
+        for k in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            assert k not in tc.tiles
+
+    def test_eviction(self):
+        tc = TileCache(1024, 1024, 16, max_size=16)
+        tc.update(dict(((i, 0), (i, i)) for i in range(20)))
+        assert len(tc.tiles)==16
+        assert tc.evicted==4
+        #the oldest ones are gone:
+        assert (0, 0) not in tc.tiles and (19, 0) in tc.tiles
+
+    def test_tile_rects(self):
+        tc = TileCache(256, 256, 64)
+        assert tc.get_tile_rects([])==[]
+        assert tc.get_tile_rects([(0, 0), (1, 0), (0, 1), (1, 1)])==[(0, 0, 128, 128)]
+        rects = sorted(tc.get_tile_rects([(0, 0), (2, 0), (0, 1)]))
+        assert rects==[(0, 0, 64, 128), (128, 0, 64, 64)], rects
+        #the area covered must match the tiles:
+        tiles = [(0, 0), (1, 0), (3, 0), (1, 1), (2, 1), (1, 3)]
+        area = sum(w*h for _, _, w, h in tc.get_tile_rects(tiles))
+        assert area==len(tiles)*64*64
+
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Measures how the cython csc module scales with the number of threads,
+# ie: XPRA_CSC_CYTHON_THREADS=16 python ./tests/xpra/codecs/test_csc_cython_threads.py
+
+import sys
+import time
+
+from xpra.codecs.codec_calibration import make_calibration_image
+
+SIZES = [(1920, 1080), (3840, 2160)]
+CONVERSIONS = [("BGRX", "YUV420P"), ("YUV420P", "BGRX"), ("GBRP", "BGRX")]
+N = 10
+
+
+def get_thread_counts(max_threads):
+    counts = []
+    n = 1
+    while n<max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    return counts
+
+def measure(csc_module, src_format, dst_format, w, h):
+    image = make_calibration_image(src_format, w, h)
+    csc = csc_module.ColorspaceConverter()
+    csc.init_context(w, h, src_format, w, h, dst_format)
+    try:
+        #warm up (starts the threads):
+        csc.convert_image(image).free()
+        start = time.time()
+        for _ in range(N):
+            csc.convert_image(image).free()
+        end = time.time()
+        return w*h*N/(end-start)/1000.0/1000.0, csc.get_info().get("bands", 1)
+    finally:
+        csc.clean()
+
+def main():
+    from xpra.codecs.csc_cython import colorspace_converter     #@UnresolvedImport
+    colorspace_converter.init_module()
+    max_threads = colorspace_converter.get_info().get("threads", 1)
+    if len(sys.argv)>1:
+        max_threads = int(sys.argv[1])
+    counts = get_thread_counts(max_threads)
+    print("%-20s %-10s %s" % ("conversion", "size", " ".join("%10s" % ("%i threads" % n) for n in counts)))
+    for src_format, dst_format in CONVERSIONS:
+        for w, h in SIZES:
+            results = []
+            for n in counts:
+                colorspace_converter.set_threads(n)
+                mpps, _ = measure(colorspace_converter, src_format, dst_format, w, h)
+                results.append(mpps)
+            print("%-20s %-10s %s" % ("%s to %s" % (src_format, dst_format), "%ix%i" % (w, h),
+                                      " ".join("%10.1f" % x for x in results)))
+    print("(MPixels/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
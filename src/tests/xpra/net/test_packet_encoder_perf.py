@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Measures how many packets per second we can encode for the most frequent packet types,
+# with the generic encoders and with the rencode packet schemas.
+# To compare with an older rencode build, run this script against both builds.
+
+import sys
+import time
+
+from xpra.net import packet_encoding
+from xpra.net.packet_encoding import get_packet_schema
+
+N = 100000
+
+PACKETS = [
+           ("draw", 1, 0, 0, 1920, 1080, "h264", "", 10000, 0, {"frame" : 100, "csc" : "YUV420P", "speed" : 80, "quality" : 70}),
+           ("draw", 1, 100, 200, 64, 32, "png", b"\0"*600, 10001, 0, {"compress_level" : 1}),
+           ("damage-sequence", 10000, 1, 1920, 1080, 2000, "", {"queue" : 0}),
+           ("pointer-position", 1, [100, 200], ["mod2"], []),
+           ("key-action", 1, "a", True, ["mod2"], 97, "a", 38, 0),
+           ("sound-data", "opus", b"\0"*200, {"timestamp" : 1000, "sequence" : 10}),
+           ]
+
+
+def bench(fn, packet):
+    start = time.time()
+    for _ in range(N):
+        fn(packet)
+    elapsed = time.time()-start
+    return N/elapsed
+
+def main():
+    encoders = []
+    if packet_encoding.use_bencode:
+        encoders.append(("bencode", lambda packet : packet_encoding.bencode(packet)))
+    if packet_encoding.use_rencode:
+        encoders.append(("rencode", lambda packet : packet_encoding.rencode_dumps(packet)))
+        if packet_encoding.rencode_dumps_packet:
+            def schema_encode(packet):
+                return packet_encoding.rencode_dumps_packet(packet, get_packet_schema(packet[0]))
+            encoders.append(("rencode+schema", schema_encode))
+        print("rencode version %s" % (packet_encoding.rencode_version, ))
+    if not encoders:
+        print("no packet encoders available")
+        return 1
+    print("%-18s %s" % ("packet", " ".join("%16s" % name for name, _ in encoders)))
+    for packet in PACKETS:
+        rates = [bench(fn, packet) for _, fn in encoders]
+        print("%-18s %s" % (packet[0], " ".join("%14i/s" % rate for rate in rates)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+#compares the throughput of the protocol layer
+#with and without the separate encryption thread,
+#with and without encryption
+
+import os
+import sys
+import time
+import socket
+import threading
+
+from xpra.net import protocol
+from xpra.net.protocol import Protocol
+from xpra.net.bytestreams import SocketConnection
+from xpra.net.compression import Compressed
+from xpra.net.crypto import crypto_backend_init, ENCRYPTION_CIPHERS, MODE_OPTIONS, DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, PADDING_PKCS7
+
+
+N = int(os.environ.get("XPRA_TEST_PACKETS", "500"))
+PIXEL_DATA_SIZE = int(os.environ.get("XPRA_TEST_PACKET_SIZE", 1024*1024))
+
+
+class FakeScheduler(object):
+    def idle_add(self, fn, *args):
+        fn(*args)
+    def timeout_add(self, delay, fn, *args):
+        t = threading.Timer(delay/1000.0, fn, args)
+        t.daemon = True
+        t.start()
+
+
+def read_all(sock, expected, done):
+    total = 0
+    while total<expected:
+        v = sock.recv(1024*1024)
+        if not v:
+            break
+        total += len(v)
+    done.append(total)
+
+def run_test(encrypt, threaded, mode=None):
+    protocol.ENCRYPT_THREAD = threaded
+    a, b = socket.socketpair()
+    conn = SocketConnection(a, "local", "remote", "pipeline-test", "socket")
+    p = Protocol(FakeScheduler(), conn, lambda *args : None)
+    p.enable_encoder("bencode")
+    p.set_compression_level(0)
+    if encrypt:
+        p.set_cipher_out("AES", DEFAULT_IV, "secret", DEFAULT_SALT, DEFAULT_ITERATIONS, PADDING_PKCS7, mode)
+    pixels = os.urandom(PIXEL_DATA_SIZE)
+    packets = [("draw", 1, 0, 0, 1920, 1080, "rgb24", Compressed("rgb24", pixels), i, 1920*3, {}) for i in range(N)]
+    done = threading.Event()
+    def packet_source():
+        packet = packets.pop(0)
+        if not packets:
+            def sent(*args):
+                done.set()
+            return packet, None, sent, False
+        return packet, None, None, True
+    done_read = []
+    #each packet is at least this big:
+    reader = threading.Thread(target=read_all, args=(b, N*PIXEL_DATA_SIZE, done_read))
+    reader.daemon = True
+    reader.start()
+    start = time.time()
+    p._write_thread.start()
+    p.set_packet_source(packet_source)
+    p.source_has_more()
+    done.wait(600)
+    reader.join(60)
+    end = time.time()
+    p.close()
+    b.close()
+    elapsed = end-start
+    info = p.get_info().get("pipeline", {})
+    print("encryption=%-5s threaded=%-5s: %4i packets in %5.1fms, %6.1f MB/s, stages: %s" %
+          (encrypt and mode, threaded, N, elapsed*1000, N*PIXEL_DATA_SIZE/elapsed/1024/1024,
+           dict((k, v.get("time")) for k,v in info.items())))
+
+
+def main():
+    crypto_backend_init()
+    for encrypt in (False, True):
+        if encrypt and "AES" not in ENCRYPTION_CIPHERS:
+            print("AES is not available, skipping encryption tests")
+            continue
+        for threaded in (False, True):
+            if not encrypt:
+                run_test(encrypt, threaded)
+                continue
+            for mode in MODE_OPTIONS:
+                run_test(encrypt, threaded, mode)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+#trains zstd dictionaries for small and repetitive packets,
+#the resulting files can be used by pointing XPRA_ZSTD_DICTIONARY_DIR to the output directory
+#(both ends of the connection must have the same dictionaries for them to be used)
+
+import os
+import sys
+import random
+
+from xpra.net import compression
+from xpra.net.packet_encoding import get_enabled_encoders, get_encoder, PERFORMANCE_ORDER
+
+#packet aliases are sent instead of the packet type:
+ALIASES = {
+           "damage-sequence"    : 10,
+           "pointer-position"   : 37,
+           "cursor"             : 41,
+           }
+
+def pointer_position(i):
+    return ["pointer-position", random.randint(1, 20), [random.randint(0, 3840), random.randint(0, 2160)], ["mod2"], []]
+
+def damage_sequence(i):
+    return ["damage-sequence", i, random.randint(1, 20), random.randint(1, 3840), random.randint(1, 2160), random.randint(100, 100000), ""]
+
+def cursor(i):
+    size = random.choice((16, 24, 32))
+    return ["cursor", random.randint(0, 100), random.randint(0, 100), size, size, random.randint(0, 31), random.randint(0, 31), i, "", random.choice(("xterm", "left_ptr", "hand2", "watch", ""))]
+
+GENERATORS = {
+              "damage-sequence"     : damage_sequence,
+              "pointer-position"    : pointer_position,
+              "cursor"              : cursor,
+              }
+
+
+def main():
+    if not compression.has_zstd:
+        print("zstd is not available")
+        return 1
+    outdir = "."
+    if len(sys.argv)>1:
+        outdir = sys.argv[1]
+    N = int(os.environ.get("XPRA_TRAINING_SAMPLES", "10000"))
+    dict_size = int(os.environ.get("XPRA_DICTIONARY_SIZE", "4096"))
+    encoder = get_encoder(get_enabled_encoders(order=PERFORMANCE_ORDER)[0])
+    for packet_type, gen in GENERATORS.items():
+        samples = []
+        for i in range(N):
+            packet = gen(i)
+            packet[0] = ALIASES.get(packet_type, packet_type)
+            data, _ = encoder(packet)
+            samples.append(data)
+        dict_data = compression.train_zstd_dictionary(samples, dict_size)
+        filename = os.path.join(outdir, "%s%s" % (packet_type, compression.ZSTD_DICTIONARY_EXT))
+        with open(filename, "wb") as f:
+            f.write(dict_data)
+        avg = sum(len(x) for x in samples)//len(samples)
+        print("%-20s: %i samples of %i bytes on average, dictionary saved to %s" % (packet_type, N, avg, filename))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
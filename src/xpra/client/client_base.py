@@ -24,12 +24,13 @@ from xpra.scripts.config import InitExit
 from xpra.child_reaper import getChildReaper, reaper_cleanup
 from xpra.net import compression
 from xpra.net.protocol import Protocol, get_network_caps, sanity_checks
-from xpra.net.crypto import crypto_backend_init, get_iterations, get_iv, get_salt, choose_padding, \
-    ENCRYPTION_CIPHERS, ENCRYPT_FIRST_PACKET, DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, DEFAULT_PADDING, ALL_PADDING_OPTIONS, PADDING_OPTIONS
+from xpra.net.crypto import crypto_backend_init, get_iterations, get_iv, get_salt, choose_padding, choose_mode, get_cipher_modes, \
+    ENCRYPTION_CIPHERS, ENCRYPT_FIRST_PACKET, DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, DEFAULT_PADDING, ALL_PADDING_OPTIONS, PADDING_OPTIONS, \
+    INITIAL_MODE, DEFAULT_MODE, MODE_OPTIONS
 from xpra.version_util import version_compat_check, get_version_info, local_version
 from xpra.platform.info import get_name
 from xpra.os_util import get_hex_uuid, get_machine_id, get_user_uuid, load_binary_file, SIGNAMES, strtobytes, bytestostr
-from xpra.util import flatten_dict, typedict, updict, xor, repr_ellipsized, nonl, disconnect_is_an_error, dump_all_frames
+from xpra.util import flatten_dict, typedict, updict, xor, repr_ellipsized, nonl, disconnect_is_an_error, dump_all_frames, parse_with_unit
 from xpra.net.file_transfer import FileTransferHandler
 
 EXIT_OK = 0
@@ -99,6 +100,7 @@ class XpraClientBase(FileTransferHandler):
         self.min_quality = 0
         self.speed = 0
         self.min_speed = -1
+        self.bandwidth_limit = 0
         self.printer_attributes = []
         self.send_printers_pending = False
         self.exported_printers = None
@@ -134,6 +136,10 @@ class XpraClientBase(FileTransferHandler):
         self.min_quality = opts.min_quality
         self.speed = opts.speed
         self.min_speed = opts.min_speed
+        try:
+            self.bandwidth_limit = parse_with_unit(opts.bandwidth_limit)
+        except ValueError as e:
+            log.warn("Warning: invalid bandwidth limit '%s': %s", opts.bandwidth_limit, e)
         #printing and file transfer:
         FileTransferHandler.init(self, opts)
 
@@ -239,7 +245,7 @@ class XpraClientBase(FileTransferHandler):
         self._protocol.enable_default_compressor()
         if self.encryption and ENCRYPT_FIRST_PACKET:
             key = self.get_encryption_key()
-            self._protocol.set_cipher_out(self.encryption, DEFAULT_IV, key, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING)
+            self._protocol.set_cipher_out(self.encryption, DEFAULT_IV, key, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, INITIAL_MODE)
         self.have_more = self._protocol.source_has_more
         if conn.timeout>0:
             self.timeout_add((conn.timeout + EXTRA_TIMEOUT) * 1000, self.verify_connected)
@@ -279,7 +285,11 @@ class XpraClientBase(FileTransferHandler):
             })
 
     def init_authenticated_packet_handlers(self):
-        self.set_packet_handlers(self._packet_handlers, {"send-file" : self._process_send_file})
+        self.set_packet_handlers(self._packet_handlers, {
+            "send-file"         : self._process_send_file,
+            "send-file-chunk"   : self._process_send_file_chunk,
+            "ack-file-chunk"    : self._process_ack_file_chunk,
+            })
 
 
     def init_aliases(self):
@@ -357,6 +367,10 @@ class XpraClientBase(FileTransferHandler):
             key_salt = get_salt()
             iterations = get_iterations()
             padding = choose_padding(self.server_padding_options)
+            #the server chooses the mode it sends with from the ones we support,
+            #we expect our preferred mode and switch if the server uses another one:
+            mode_options = get_cipher_modes(self.encryption)
+            mode = choose_mode(mode_options, self.encryption)
             up("cipher", {
                     ""                      : self.encryption,
                     "iv"                    : iv,
@@ -364,12 +378,14 @@ class XpraClientBase(FileTransferHandler):
                     "key_stretch_iterations": iterations,
                     "padding"               : padding,
                     "padding.options"       : PADDING_OPTIONS,
+                    "mode"                  : mode,
+                    "mode.options"          : mode_options,
                     })
             key = self.get_encryption_key()
             if key is None:
                 self.warn_and_quit(EXIT_ENCRYPTION, "encryption key is missing")
                 return
-            self._protocol.set_cipher_in(self.encryption, iv, key, key_salt, iterations, padding)
+            self._protocol.set_cipher_in(self.encryption, iv, key, key_salt, iterations, padding, mode, mode_options)
             netlog("encryption capabilities: %s", dict((k,v) for k,v in capabilities.items() if k.startswith("cipher")))
         return capabilities
 
@@ -447,6 +463,7 @@ class XpraClientBase(FileTransferHandler):
             p.close()
             self._protocol = None
         self.cleanup_printing()
+        self.cleanup_file_transfers()
         log("cleanup done")
         dump_all_frames()
 
@@ -572,6 +589,7 @@ class XpraClientBase(FileTransferHandler):
         #server may tell us what it supports,
         #either from hello response or from challenge packet:
         self.server_padding_options = caps.strlistget("cipher.padding.options", [DEFAULT_PADDING])
+        mode = caps.strget("cipher.mode", DEFAULT_MODE)
         if not cipher or not cipher_iv:
             self.warn_and_quit(EXIT_ENCRYPTION, "the server does not use or support encryption/password, cannot continue with %s cipher" % self.encryption)
             return False
@@ -581,10 +599,13 @@ class XpraClientBase(FileTransferHandler):
         if padding not in ALL_PADDING_OPTIONS:
             self.warn_and_quit(EXIT_ENCRYPTION, "unsupported server cipher padding: %s, allowed ciphers: %s" % (padding, ", ".join(ALL_PADDING_OPTIONS)))
             return False
+        if mode not in MODE_OPTIONS:
+            self.warn_and_quit(EXIT_ENCRYPTION, "unsupported server cipher mode: %s, allowed modes: %s" % (mode, ", ".join(MODE_OPTIONS)))
+            return False
         p = self._protocol
         if not p:
             return False
-        p.set_cipher_out(cipher, cipher_iv, key, key_salt, iterations, padding)
+        p.set_cipher_out(cipher, cipher_iv, key, key_salt, iterations, padding, mode)
         return True
 
 
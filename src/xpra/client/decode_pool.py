@@ -0,0 +1,209 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("paint")
+
+from xpra.os_util import Queue
+from xpra.make_thread import make_thread
+
+
+def get_default_decode_threads():
+    try:
+        from multiprocessing import cpu_count
+        return max(1, min(4, cpu_count()))
+    except:
+        return 1
+try:
+    DECODE_THREADS = max(1, int(os.environ.get("XPRA_DECODE_THREADS", get_default_decode_threads())))
+except:
+    DECODE_THREADS = 1
+
+
+class DecodeWorker(object):
+    """
+        A single decode thread with its own queue of draw packets,
+        the packets are processed in the order they were queued.
+    """
+
+    def __init__(self, name, process_draw, pool):
+        self.name = name
+        self.process_draw = process_draw
+        self.pool = pool
+        self.draw_queue = Queue()
+        self.busy_time = 0.0
+        self.items_processed = 0
+        self.current_start = 0
+        self.thread = make_thread(self.draw_loop, name)
+
+    def __repr__(self):
+        return "DecodeWorker(%s)" % self.name
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        #end of queue marker:
+        self.draw_queue.put(None)
+
+    def qsize(self):
+        return self.draw_queue.qsize()
+
+    def add(self, wid, packet):
+        self.draw_queue.put((wid, packet))
+
+    def draw_loop(self):
+        while not self.pool.is_closed():
+            item = self.draw_queue.get()
+            if item is None:
+                break
+            wid, packet = item
+            #no longer waiting, so the damage ack sent for this packet does not count it:
+            self.pool.dequeued(wid)
+            self.current_start = time.time()
+            try:
+                self.process_draw(packet)
+                time.sleep(0)
+            except KeyboardInterrupt:
+                raise
+            except:
+                log.error("error processing draw packet", exc_info=True)
+            finally:
+                elapsed = time.time()-self.current_start
+                self.current_start = 0
+                self.busy_time += elapsed
+                self.items_processed += 1
+                self.pool.processed(wid, elapsed)
+        log("%s thread ended", self.name)
+
+    def get_info(self):
+        busy = self.busy_time
+        if self.current_start>0:
+            busy += time.time()-self.current_start
+        return {
+                "queue"     : self.draw_queue.qsize(),
+                "busy"      : int(busy*1000),
+                "items"     : self.items_processed,
+                "active"    : self.current_start>0,
+                }
+
+
+class DecodeWorkerPool(object):
+    """
+        Dispatches the draw packets to a pool of decode threads.
+        All the packets for a given window are handled by the same thread,
+        so the frames of a window are decoded and painted in the order they were received,
+        but different windows can be decoded concurrently.
+        (the decoders release the GIL)
+        We keep track of the number of packets queued for each window,
+        and of the time it takes to process them.
+    """
+
+    def __init__(self, process_draw, is_closed, nworkers=DECODE_THREADS):
+        assert nworkers>0, "invalid number of decode workers: %s" % nworkers
+        self.is_closed = is_closed
+        self.workers = []
+        for i in range(nworkers):
+            name = "draw"
+            if i>0:
+                name = "draw-%i" % i
+            self.workers.append(DecodeWorker(name, process_draw, self))
+        self.assignments = {}
+        self.pending = {}               #wid -> number of packets waiting to be processed
+        self.decode_time = {}           #wid -> last processing time (in seconds)
+        self.lock = Lock()
+        log("DecodeWorkerPool(%s, %s, %i)", process_draw, is_closed, nworkers)
+
+    def __repr__(self):
+        return "DecodeWorkerPool(%i)" % len(self.workers)
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+
+    def get_worker(self, wid):
+        """
+            Returns the worker assigned to this window,
+            new windows are given to the worker with the fewest windows and the smallest queue.
+        """
+        w = self.assignments.get(wid)
+        if w is not None:
+            return w
+        with self.lock:
+            w = self.assignments.get(wid)
+            if w is None:
+                counts = dict((x, 0) for x in self.workers)
+                for x in self.assignments.values():
+                    counts[x] += 1
+                w = sorted(self.workers, key=lambda x : (counts[x], x.qsize()))[0]
+                self.assignments[wid] = w
+                log("window %i assigned to %s", wid, w)
+        return w
+
+    def release(self, wid):
+        """ the window is gone, it can be assigned a new worker if it comes back """
+        with self.lock:
+            self.assignments.pop(wid, None)
+            self.decode_time.pop(wid, None)
+
+    def queue(self, wid, packet, key=None):
+        """
+            The 'key' chooses the worker, it defaults to the window id.
+            Packets queued with the same key are processed in order.
+        """
+        if key is None:
+            key = wid
+        with self.lock:
+            self.pending[wid] = self.pending.get(wid, 0)+1
+        self.get_worker(key).add(wid, packet)
+
+    def dequeued(self, wid):
+        with self.lock:
+            n = self.pending.get(wid, 0)-1
+            if n>0:
+                self.pending[wid] = n
+            else:
+                self.pending.pop(wid, None)
+
+    def processed(self, wid, elapsed):
+        with self.lock:
+            self.decode_time[wid] = elapsed
+
+    def qsize(self, wid=None):
+        """ the number of draw packets waiting to be processed, for this window or for all windows """
+        if wid is None:
+            return sum(list(self.pending.values()))
+        return self.pending.get(wid, 0)
+
+    def get_info(self):
+        winfo = {}
+        for i, w in enumerate(self.workers):
+            wi = w.get_info()
+            wi["name"] = w.name
+            wi["windows"] = sorted(wid for wid,x in list(self.assignments.items()) if x==w)
+            winfo[i] = wi
+        info = {
+                "workers"   : len(self.workers),
+                "worker"    : winfo,
+                "queue"     : self.qsize(),
+                }
+        windows = {}
+        for wid, elapsed in list(self.decode_time.items()):
+            windows[wid] = {
+                            "queue"         : self.qsize(wid),
+                            "decode-time"   : int(elapsed*1000),
+                            }
+        if windows:
+            info["window"] = windows
+        return info
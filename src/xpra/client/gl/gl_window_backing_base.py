@@ -29,6 +29,7 @@ _DEFAULT_BOX_COLORS = {
               "h265"    : "khaki",
               "vp9"     : "lavender",
               "mpeg4"   : "black",
+              "scroll"  : "brown",
               }
 
 def get_fcolor(encoding):
@@ -87,7 +88,7 @@ from OpenGL.GL import \
     glGenTextures, glDisable, \
     glBindTexture, glPixelStorei, glEnable, glEnablei, glBegin, glFlush, \
     glTexParameteri, \
-    glTexImage2D, \
+    glTexImage2D, glCopyTexImage2D, \
     glMultiTexCoord2i, \
     glTexCoord2i, glVertex2i, glEnd, \
     glClear, glClearColor, glLineWidth, glColor4f
@@ -189,6 +190,7 @@ class GLWindowBackingBase(GTKWindowBacking):
 
     RGB_MODES = ["YUV420P", "YUV422P", "YUV444P", "GBRP", "BGRA", "BGRX", "RGBA", "RGBX", "RGB", "BGR"]
     HAS_ALPHA = GL_ALPHA_SUPPORTED
+    HAS_SCROLL = True
 
     def __init__(self, wid, window_alpha):
         self.wid = wid
@@ -630,6 +632,47 @@ class GLWindowBackingBase(GTKWindowBacking):
             return  "copy:str", img_data
 
 
+    def _do_paint_scroll(self, scrolls, options):
+        log("%s._do_paint_scroll(%s, %s)", self, scrolls, options)
+        context = self.gl_context()
+        if not context:
+            log("%s._do_paint_scroll(..) no context!", self)
+            return False
+        bw, bh = self.size
+        with context:
+            self.gl_init()
+            self.set_rgb_paint_state()
+            #copy the current FBO contents to a temporary texture,
+            #so the rectangles can't overwrite each other's source pixels:
+            glBindTexture(GL_TEXTURE_RECTANGLE_ARB, self.textures[TEX_RGB])
+            glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_BASE_LEVEL, 0)
+            glTexParameteri(GL_TEXTURE_RECTANGLE_ARB, GL_TEXTURE_MAX_LEVEL, 0)
+            glCopyTexImage2D(GL_TEXTURE_RECTANGLE_ARB, 0, self.texture_pixel_format, 0, 0, bw, bh, 0)
+            #now paint the rectangles from the copy, note how we invert the texture coordinates
+            #since the FBO rows are stored upside down:
+            glBegin(GL_QUADS)
+            for x, y, w, h, xdelta, ydelta in scrolls:
+                dx, dy = x+xdelta, y+ydelta
+                glTexCoord2i(x, bh-y)
+                glVertex2i(dx, dy)
+                glTexCoord2i(x, bh-y-h)
+                glVertex2i(dx, dy+h)
+                glTexCoord2i(x+w, bh-y-h)
+                glVertex2i(dx+w, dy+h)
+                glTexCoord2i(x+w, bh-y)
+                glVertex2i(dx+w, dy)
+            glEnd()
+            #present the area covered by all the rectangles:
+            x1 = min(x+xdelta for x, _, _, _, xdelta, _ in scrolls)
+            y1 = min(y+ydelta for _, y, _, _, _, ydelta in scrolls)
+            x2 = max(x+xdelta+w for x, _, w, _, xdelta, _ in scrolls)
+            y2 = max(y+ydelta+h for _, y, _, h, _, ydelta in scrolls)
+            self.paint_box("scroll", False, x1, y1, x2-x1, y2-y1)
+            self.present_fbo(x1, y1, x2-x1, y2-y1, options.get("flush", 0))
+        return True
+
     def _do_paint_rgb32(self, img_data, x, y, width, height, rowstride, options):
         return self._do_paint_rgb(32, img_data, x, y, width, height, rowstride, options)
 
@@ -195,6 +195,8 @@ class InfoXpraClient(CommandConnectClient):
         it queries the server with an 'info' request
     """
 
+    info_select = []
+
     def timeout(self, *args):
         self.warn_and_quit(EXIT_TIMEOUT, "timeout: did not receive the info")
 
@@ -226,6 +228,8 @@ class InfoXpraClient(CommandConnectClient):
         capabilities["info_request"] = True
         if FLATTEN_INFO!=1:
             capabilities["info-namespace"] = True
+        if self.info_select:
+            capabilities["info-select"] = self.info_select
         return capabilities
 
 
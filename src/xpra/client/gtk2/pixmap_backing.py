@@ -38,6 +38,7 @@ Backing using a gdk.Pixmap
 class PixmapBacking(GTK2WindowBacking):
 
     HAS_ALPHA = False
+    HAS_SCROLL = True
     RGB_MODES = PIXMAP_RGB_MODES
 
     def __init__(self, *args):
@@ -140,6 +141,19 @@ class PixmapBacking(GTK2WindowBacking):
             self._backing.draw_rgb_32_image(gc, x, y, width, height, gdk.RGB_DITHER_NONE, img_data, rowstride)
         return True
 
+    def _do_paint_scroll(self, scrolls, options):
+        gc = self._backing.new_gc()
+        source = self._backing
+        if len(scrolls)>1:
+            #copy from a snapshot so the rectangles can't overwrite each other's source pixels:
+            #(a single copy is safe as the X11 server handles overlapping areas)
+            w, h = self._backing.get_size()
+            source = gdk.Pixmap(self._backing, w, h)
+            source.draw_drawable(gc, self._backing, 0, 0, 0, 0, w, h)
+        for x, y, w, h, xdelta, ydelta in scrolls:
+            self._backing.draw_drawable(gc, source, x, y, x+xdelta, y+ydelta, w, h)
+        return True
+
     def cairo_draw(self, context):
         self.cairo_draw_from_drawable(context, self._backing)
 
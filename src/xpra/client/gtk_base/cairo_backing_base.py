@@ -29,6 +29,7 @@ Superclass for gtk2 and gtk3 cairo implementations.
 """
 class CairoBackingBase(GTKWindowBacking):
 
+    HAS_SCROLL = True
 
     def init(self, ww, wh, w, h):
         self.size = w, h
@@ -98,6 +99,26 @@ class CairoBackingBase(GTKWindowBacking):
         gc.paint()
 
 
+    def _do_paint_scroll(self, scrolls, options):
+        """ must be called from UI thread """
+        w = self._backing.get_width()
+        h = self._backing.get_height()
+        #copy from a snapshot so the rectangles can't overwrite each other's source pixels:
+        snapshot = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        gc = cairo.Context(snapshot)
+        gc.set_operator(cairo.OPERATOR_SOURCE)
+        gc.set_source_surface(self._backing, 0, 0)
+        gc.paint()
+        gc = cairo.Context(self._backing)
+        gc.set_operator(cairo.OPERATOR_SOURCE)
+        for x, y, w, h, xdelta, ydelta in scrolls:
+            gc.set_source_surface(snapshot, xdelta, ydelta)
+            gc.rectangle(x+xdelta, y+ydelta, w, h)
+            gc.fill()
+        snapshot.finish()
+        return True
+
+
     def _do_paint_rgb24(self, img_data, x, y, width, height, rowstride, options):
         return self._do_paint_rgb(cairo.FORMAT_RGB24, False, img_data, x, y, width, height, rowstride, options)
 
@@ -395,12 +395,13 @@ class GTKXpraClient(UIXpraClient, GObjectXpraClient):
                "configure.pointer"      : True,
                "frame_sizes"            : self.get_window_frame_sizes()
                })
-        from xpra.client.window_backing_base import DELTA_BUCKETS
+        from xpra.client.window_backing_base import DELTA_BUCKETS, DELTA_CACHE
         updict(capabilities, "encoding", {
                     "icons.greedy"      : True,         #we don't set a default window icon any more
                     "icons.size"        : (64, 64),     #size we want
                     "icons.max_size"    : (128, 128),   #limit
                     "delta_buckets"     : DELTA_BUCKETS,
+                    "delta_cache"       : DELTA_CACHE,
                     })
         return capabilities
 
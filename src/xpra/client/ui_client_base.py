@@ -12,7 +12,6 @@ import time
 import datetime
 import traceback
 import logging
-import hashlib
 from collections import deque
 from threading import RLock
 
@@ -42,7 +41,9 @@ from xpra import __version__ as XPRA_VERSION
 from xpra.gtk_common.gobject_util import no_arg_signal
 from xpra.client.client_base import XpraClientBase, EXIT_TIMEOUT, EXIT_MMAP_TOKEN_FAILURE
 from xpra.client.client_tray import ClientTray
+from xpra.client.window_backing_base import SCROLL_ENCODING
 from xpra.client.keyboard_helper import KeyboardHelper
+from xpra.client.decode_pool import DecodeWorkerPool
 from xpra.platform.features import MMAP_SUPPORTED, SYSTEM_TRAY_SUPPORTED, CLIPBOARD_WANT_TARGETS, CLIPBOARD_GREEDY, CLIPBOARDS, REINIT_WINDOWS
 from xpra.platform.gui import (ready as gui_ready, get_vrefresh, get_antialias_info, get_icc_info, get_double_click_time, show_desktop, get_cursor_size,
                                get_double_click_distance, get_native_notifier_classes, get_native_tray_classes, get_native_system_tray_classes,
@@ -55,8 +56,7 @@ from xpra.simple_stats import std_unit
 from xpra.net import compression, packet_encoding
 from xpra.net.compression import Compressed
 from xpra.child_reaper import reaper_cleanup
-from xpra.make_thread import make_thread
-from xpra.os_util import BytesIOClass, Queue, platform_name, get_machine_id, get_user_uuid, bytestostr
+from xpra.os_util import BytesIOClass, platform_name, get_machine_id, get_user_uuid, bytestostr
 from xpra.util import nonl, std, iround, AtomicInteger, log_screen_sizes, typedict, updict, csv, engs, CLIENT_EXIT
 from xpra.version_util import get_version_info_full, get_platform_info
 try:
@@ -150,8 +150,8 @@ class UIXpraClient(XpraClientBase):
         self.shadow_fullscreen = False
 
         #draw thread:
-        self._draw_queue = None
-        self._draw_thread = None
+        self._decode_pool = None
+        self.mmap_slots = 0
         self._draw_counter = 0
 
         #statistics and server info:
@@ -464,9 +464,8 @@ class UIXpraClient(XpraClientBase):
         else:
             self.window_close_action = opts.window_close
 
-        #draw thread:
-        self._draw_queue = Queue()
-        self._draw_thread = make_thread(self._draw_thread_loop, "draw")
+        #draw threads:
+        self._decode_pool = DecodeWorkerPool(self._do_draw, self.is_exiting)
 
     def setup_connection(self, conn):
         XpraClientBase.setup_connection(self, conn)
@@ -586,7 +585,7 @@ class UIXpraClient(XpraClientBase):
         if self.client_extras:
             self.idle_add(self.client_extras.ready)
         XpraClientBase.run(self)    #start network threads
-        self._draw_thread.start()
+        self._decode_pool.start()
         self.send_hello()
 
 
@@ -596,10 +595,10 @@ class UIXpraClient(XpraClientBase):
     def cleanup(self):
         log("UIXpraClient.cleanup()")
         XpraClientBase.cleanup(self)
-        #tell the draw thread to exit:
-        dq = self._draw_queue
-        if dq:
-            dq.put(None)
+        #tell the draw threads to exit:
+        dp = self._decode_pool
+        if dp:
+            dp.stop()
         self.stop_all_sound()
         for x in (self.keyboard_helper, self.clipboard_helper, self.tray, self.notifier, self.menu_helper, self.client_extras, getVideoHelper()):
             if x is None:
@@ -1175,10 +1174,7 @@ class UIXpraClient(XpraClientBase):
         assert len(data)>=filesize
         data = data[:filesize]          #gio may null terminate it
         filelog("send_file%s", (filename, "%i bytes" % filesize, openit))
-        absfile = os.path.abspath(filename)
         basefilename = os.path.basename(filename)
-        cdata = self.compressed_wrapper("file-data", data)
-        assert len(cdata)<=filesize     #compressed wrapper ensures this is true
         if filesize>self.file_size_limit*1024*1024:
             filelog.warn("Warning: cannot upload the file '%s'", basefilename)
             filelog.warn(" this file is too large: %sB", std_unit(filesize, unit=1024))
@@ -1189,14 +1185,7 @@ class UIXpraClient(XpraClientBase):
             filelog.warn(" this file is too large: %sB", std_unit(filesize, unit=1024))
             filelog.warn(" the file size limit for %s is %iMB", self._protocol, self.server_file_size_limit)
             return False
-        printit = False
-        mimetype = ""
-        u = hashlib.sha1()
-        u.update(data)
-        filelog("sha1 digest(%s)=%s", absfile, u.hexdigest())
-        options = {"sha1"       : u.hexdigest()}
-        self.send("send-file", basefilename, mimetype, printit, openit, filesize, cdata, options)
-        return True
+        return self.do_send_file(filename, "", data, filesize, False, openit)
 
 
     def send_focus(self, wid):
@@ -1389,9 +1378,13 @@ class UIXpraClient(XpraClientBase):
                 self.keyboard_helper.keyboard_sync = False
             capabilities["keyboard_sync"] = self.keyboard_helper.keyboard_sync
             log("keyboard capabilities: %s", [(k,v) for k,v in capabilities.items() if k.startswith("key")])
+        if self.bandwidth_limit>0:
+            capabilities["bandwidth-limit"] = self.bandwidth_limit
         if self.mmap_enabled:
             capabilities["mmap_file"] = self.mmap_filename
             capabilities["mmap_token"] = self.mmap_token
+            from xpra.net.mmap_pipe import MMAP_SLOTS
+            capabilities["mmap.slots"] = MMAP_SLOTS
         #don't try to find the server uuid if this platform cannot run servers..
         #(doing so causes lockups on win32 and startup errors on osx)
         if MMAP_SUPPORTED:
@@ -1508,6 +1501,10 @@ class UIXpraClient(XpraClientBase):
         full_csc_modes = getVideoHelper().get_server_full_csc_modes_for_rgb(*rgb_formats)
         log("supported full csc_modes=%s", full_csc_modes)
         encoding_caps["full_csc_modes"] = full_csc_modes
+        #the window backings can copy rows of pixels (see "scroll" paint):
+        encoding_caps["scrolling"] = SCROLL_ENCODING
+        #the window backings keep the pixels of the tiles which have not changed:
+        encoding_caps["tile_cache"] = True
 
         if "h264" in self.get_core_encodings():
             # some profile options: "baseline", "main", "high", "high10", ...
@@ -1736,8 +1733,10 @@ class UIXpraClient(XpraClientBase):
         self.start_new_commands = c.boolget("start-new-commands")
         self.server_file_transfer = c.boolget("file-transfer")
         self.server_file_size_limit = c.intget("file-size-limit", 10)
+        self.remote_file_chunks = c.intget("file-chunks")
         self.server_open_files = c.boolget("open-files")
         self.mmap_enabled = self.supports_mmap and self.mmap_enabled and c.boolget("mmap_enabled")
+        self.mmap_slots = c.intget("mmap.slots")
         if self.mmap_enabled:
             mmap_token = c.intget("mmap_token")
             from xpra.net.mmap_pipe import read_mmap_token
@@ -2815,28 +2814,25 @@ class UIXpraClient(XpraClientBase):
         if window:
             window.resize(aw, ah, resize_counter)
 
+    def is_exiting(self):
+        return self.exit_code is not None
+
     def _process_draw(self, packet):
-        self._draw_queue.put(packet)
+        wid = packet[1]
+        key = None
+        if self.mmap_enabled and not self.mmap_slots:
+            #the legacy mmap ring must be read in order,
+            #so all the windows must use the same draw thread:
+            key = 0
+        self._decode_pool.queue(wid, packet, key)
 
     def send_damage_sequence(self, wid, packet_sequence, width, height, decode_time, message=""):
-        self.send_now("damage-sequence", packet_sequence, wid, width, height, decode_time, message)
-
-    def _draw_thread_loop(self):
-        while self.exit_code is None:
-            packet = self._draw_queue.get()
-            if packet is None:
-                break
-            try:
-                self._do_draw(packet)
-                time.sleep(0)
-            except KeyboardInterrupt:
-                raise
-            except:
-                log.error("error processing draw packet", exc_info=True)
-        log("draw thread ended")
+        #let the server know how many draw packets are waiting for this window:
+        decode_info = {"queue" : self._decode_pool.qsize(wid)}
+        self.send_now("damage-sequence", packet_sequence, wid, width, height, decode_time, message, decode_info)
 
     def _do_draw(self, packet):
-        """ this runs from the draw thread above """
+        """ this runs from one of the draw threads, see DecodeWorkerPool """
         wid, x, y, width, height, coding, data, packet_sequence, rowstride = packet[1:10]
         #rename old encoding aliases early:
         window = self._id_to_window.get(wid)
@@ -2845,14 +2841,18 @@ class UIXpraClient(XpraClientBase):
             def draw_cleanup():
                 if coding=="mmap":
                     assert self.mmap_enabled
-                    from xpra.net.mmap_pipe import int_from_buffer
-                    def free_mmap_area():
-                        #we need to ack the data to free the space!
+                    #we need to ack the data to free the space!
+                    #(this runs via idle_add so any pending draw requests
+                    # will get a chance to run first, preserving the order)
+                    from xpra.net.mmap_pipe import int_from_buffer, mmap_release
+                    options = typedict(packet[10] if len(packet)>10 else {})
+                    slot = options.intget("mmap-slot", -1)
+                    if slot>=0:
+                        mmap_release(self.mmap, slot, options.intget("mmap-seq"))
+                    else:
                         data_start = int_from_buffer(self.mmap, 0)
                         offset, length = data[-1]
                         data_start.value = offset+length
-                    #clear the mmap area via idle_add so any pending draw requests
-                    #will get a chance to run first (preserving the order)
                 self.send_damage_sequence(wid, packet_sequence, width, height, -1)
             self.idle_add(draw_cleanup)
             return
@@ -2988,6 +2988,7 @@ class UIXpraClient(XpraClientBase):
             del self._id_to_window[wid]
             del self._window_to_id[window]
             self.destroy_window(wid, window)
+            self._decode_pool.release(wid)
         if len(self._id_to_window)==0:
             windowlog("last window gone, clearing key repeat")
             if self.keyboard_helper:
@@ -11,7 +11,7 @@ log = Logger("paint")
 deltalog = Logger("delta")
 
 from threading import Lock
-from xpra.net.mmap_pipe import mmap_read
+from xpra.net.mmap_pipe import mmap_read, mmap_read_frame, mmap_release
 from xpra.net import compression
 from xpra.util import typedict, csv
 from xpra.codecs.loader import get_codec
@@ -20,9 +20,12 @@ from xpra.os_util import BytesIOClass, bytestostr, _buffer
 from xpra.codecs.xor.cyxor import xor_str   #@UnresolvedImport
 from xpra.codecs.argb.argb import unpremultiply_argb, unpremultiply_argb_in_place   #@UnresolvedImport
 
-DELTA_BUCKETS = int(os.environ.get("XPRA_DELTA_BUCKETS", "5"))
+DELTA_BUCKETS = int(os.environ.get("XPRA_DELTA_BUCKETS", "16"))
+DELTA_CACHE = os.environ.get("XPRA_DELTA_CACHE", "1")=="1"
+DELTA_CACHE_ENCODING = "cache"
 INTEGRITY_HASH = os.environ.get("XPRA_INTEGRITY_HASH", "0")=="1"
 WEBP_PILLOW = os.environ.get("XPRA_WEBP_PILLOW", "0")=="1"
+SCROLL_ENCODING = os.environ.get("XPRA_SCROLL_ENCODING", "1")=="1"
 
 #ie:
 #CSC_OPTIONS = { "YUV420P" : {"RGBX" : [opencl.spec, swscale.spec], "BGRX" : ...} }
@@ -70,6 +73,11 @@ Generic superclass for all Backing code,
 see CairoBacking and GTKWindowBacking for actual implementations
 """
 class WindowBackingBase(object):
+
+    #backings that can copy pixels within the window set this to True
+    #and implement _do_paint_scroll:
+    HAS_SCROLL = False
+
     def __init__(self, wid, window_alpha, idle_add):
         load_csc_options()
         load_video_decoders()
@@ -130,6 +138,7 @@ class WindowBackingBase(object):
                  "encodings.rgb_formats"    : self.RGB_MODES,
                  "encoding.transparency"    : self._alpha_enabled,
                  "encoding.full_csc_modes"  : self._get_full_csc_modes(self.RGB_MODES),
+                 "encoding.scrolling"       : SCROLL_ENCODING and self.HAS_SCROLL,
                  }
 
     def _get_full_csc_modes(self, rgb_modes):
@@ -170,6 +179,10 @@ class WindowBackingBase(object):
             deltalog.error("invalid img data length: expected %s but got %s (%s: %s)", rowstride * height, len(img_data), type(img_data), str(img_data)[:256])
             raise Exception("expected %s bytes for %sx%s with rowstride=%s but received %s (%s compressed)" %
                                 (rowstride * height, width, height, rowstride, len(img_data), len(raw_data)))
+        #the server no longer needs these buckets:
+        for b in options.intlistget("evict", []):
+            if 0<=b<DELTA_BUCKETS:
+                self._delta_pixel_data[b] = None
         delta = options.intget("delta", -1)
         bucket = options.intget("bucket", 0)
         rgb_format = options.strget("rgb_format")
@@ -234,12 +247,12 @@ class WindowBackingBase(object):
             #PIL flattens the data to a continuous straightforward RGB format:
             rowstride = width*3
             paint_options["rgb_format"] = "RGB"
-            img_data = self.process_delta(raw_data, width, height, rowstride, options)
+            img_data = self.process_delta(raw_data, width, height, rowstride, paint_options)
             self.idle_add(self.do_paint_rgb24, img_data, x, y, width, height, rowstride, paint_options, callbacks)
         elif img.mode=="RGBA":
             rowstride = width*4
             paint_options["rgb_format"] = "RGBA"
-            img_data = self.process_delta(raw_data, width, height, rowstride, options)
+            img_data = self.process_delta(raw_data, width, height, rowstride, paint_options)
             self.idle_add(self.do_paint_rgb32, img_data, x, y, width, height, rowstride, paint_options, callbacks)
         return False
 
@@ -326,6 +339,57 @@ class WindowBackingBase(object):
         raise Exception("override me!")
 
 
+    def paint_cached(self, x, y, width, height, options, callbacks):
+        """ called from non-UI thread
+            paints the pixels we have stored in one of the delta buckets
+        """
+        bucket = options.intget("bucket", -1)
+        seq = options.intget("delta", -1)
+        assert 0<=bucket<DELTA_BUCKETS, "invalid delta bucket number: %s" % bucket
+        v = self._delta_pixel_data[bucket]
+        if v is None:
+            raise Exception("cached region bucket %s references pixmap data we do not have!" % bucket)
+        lwidth, lheight, rgb_format, lseq, rgb_data = v
+        assert width==lwidth and height==lheight and seq==lseq, \
+            "cached region bucket %s data does not match: expected %s but got %s" % (bucket, (width, height, seq), (lwidth, lheight, lseq))
+        deltalog("paint_cached: using bucket %i", bucket)
+        options["rgb_format"] = rgb_format
+        rowstride = len(rgb_data)//height
+        if len(rgb_format)==4:
+            self.idle_add(self.do_paint_rgb32, rgb_data, x, y, width, height, rowstride, options, callbacks)
+        else:
+            self.idle_add(self.do_paint_rgb24, rgb_data, x, y, width, height, rowstride, options, callbacks)
+
+
+    def paint_scroll(self, scrolls, options, callbacks):
+        """ called from non-UI thread """
+        self.idle_add(self.do_paint_scroll, scrolls, options, callbacks)
+
+    def do_paint_scroll(self, scrolls, options, callbacks):
+        """ must be called from UI thread
+            each item in the scrolls list is a rectangle (x, y, w, h) and the distance (xdelta, ydelta)
+            it must be moved by, all the rectangles are copied from the pixels
+            the backing had before processing this packet
+        """
+        try:
+            if self._backing is None:
+                fire_paint_callbacks(callbacks, -1, "no backing")
+                return
+            success = self._do_paint_scroll(scrolls, options)
+            fire_paint_callbacks(callbacks, success)
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            if not self._backing:
+                fire_paint_callbacks(callbacks, -1, "paint error on closed backing ignored")
+            else:
+                log.error("do_paint_scroll error", exc_info=True)
+                fire_paint_callbacks(callbacks, False, "do_paint_scroll error: %s" % e)
+
+    def _do_paint_scroll(self, scrolls, options):
+        raise Exception("override me!")
+
+
     def make_csc(self, src_width, src_height, src_format,
                        dst_width, dst_height, dst_format_options, speed):
         global CSC_OPTIONS
@@ -473,7 +537,17 @@ class WindowBackingBase(object):
         #and would complicate the code (add a callback to free mmap area)
         """ see _mmap_send() in server.py for details """
         assert self.mmap_enabled
-        data = mmap_read(self.mmap, img_data)
+        slot = options.intget("mmap-slot", -1)
+        if slot>=0:
+            #read the frame in place, and only release it once it has been painted:
+            data = mmap_read_frame(self.mmap, img_data)
+            seq = options.intget("mmap-seq")
+            mmap_area = self.mmap
+            def release_slot(*args):
+                mmap_release(mmap_area, slot, seq)
+            callbacks.append(release_slot)
+        else:
+            data = mmap_read(self.mmap, img_data)
         rgb_format = options.strget("rgb_format", "RGB")
         #Note: BGR(A) is only handled by gl_window_backing
         if rgb_format in ("RGB", "BGR"):
@@ -519,6 +593,10 @@ class WindowBackingBase(object):
                     self.paint_rgb24(img_data, x, y, width, height, rowstride, options, callbacks)
                 else:
                     self.paint_rgb32(img_data, x, y, width, height, rowstride, options, callbacks)
+            elif coding == "scroll":
+                self.paint_scroll(img_data, options, callbacks)
+            elif coding == DELTA_CACHE_ENCODING:
+                self.paint_cached(x, y, width, height, options, callbacks)
             elif coding in VIDEO_DECODERS:
                 self.paint_with_video_decoder(VIDEO_DECODERS.get(coding), coding, img_data, x, y, width, height, options, callbacks)
             elif coding == "webp":
@@ -0,0 +1,409 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Measures the actual performance of the video encoders and csc modules
+# on this host, using synthetic frames at several sizes.
+# The results are saved to a cache file ("xpra codec-calibrate")
+# and the video helper uses them to replace the hardcoded
+# speed and setup cost values found in the codec specs.
+
+import os
+import sys
+import time
+import platform
+
+from xpra.log import Logger
+log = Logger("codec", "video")
+
+from xpra.util import csv
+
+#use the calibration cache file if there is one:
+CODEC_CALIBRATION = os.environ.get("XPRA_CODEC_CALIBRATION", "1")=="1"
+CALIBRATION_FILENAME = os.environ.get("XPRA_CODEC_CALIBRATION_FILE", "")
+CALIBRATION_SIZES = [tuple(int(v) for v in x.split("x")) for x in os.environ.get("XPRA_CODEC_CALIBRATION_SIZES", "320x240,1280x720,1920x1080").split(",")]
+CALIBRATION_FRAMES = int(os.environ.get("XPRA_CODEC_CALIBRATION_FRAMES", "10"))
+#the throughput (in MPixels/s) that maps to a speed of 100:
+CSC_REFERENCE_MPPS = float(os.environ.get("XPRA_CODEC_CALIBRATION_CSC_MPPS", "1000"))
+ENCODER_REFERENCE_MPPS = float(os.environ.get("XPRA_CODEC_CALIBRATION_ENCODER_MPPS", "200"))
+
+CALIBRATION_HEADER = "# xpra codec calibration"
+PACKED_FORMATS = ("RGB", "BGR", "RGBX", "BGRX", "XRGB", "XBGR", "RGBA", "BGRA", "ARGB", "ABGR")
+
+
+def get_calibration_filename():
+    if CALIBRATION_FILENAME:
+        return os.path.expanduser(CALIBRATION_FILENAME)
+    from xpra.platform.paths import get_user_conf_dirs
+    return os.path.join(os.path.expanduser(get_user_conf_dirs()[0]), "codec-calibration.conf")
+
+def get_host_signature():
+    """ the measurements are only valid for the same hardware and xpra version """
+    from multiprocessing import cpu_count
+    from xpra import __version__
+    return "%s-%s-%i-%s" % (platform.machine(), (platform.processor() or "").replace(" ", "_"), cpu_count(), __version__)
+
+
+def speed_from_mpps(mpps, reference_mpps):
+    return int(max(1, min(100, 100.0*mpps/reference_mpps)))
+
+def setup_cost_from_ms(setup_ms):
+    #logarithmic: 1ms -> 10, 10ms -> 36, 100ms -> 70
+    from math import log10
+    return int(max(0, min(100, 35*log10(1+setup_ms))))
+
+
+def make_pattern(size, seed):
+    #cheap to generate but not trivial to compress:
+    return bytes(bytearray(((i*i)//7 + i//13 + seed) & 0xff for i in range(size)))
+
+def make_plane(width, height, bpp, frame, seed=0):
+    """
+        A plane of pixels which scrolls by a few lines on every frame,
+        so the encoders have to deal with some motion.
+    """
+    stride = width*bpp
+    period = 251*bpp
+    pattern = make_pattern(stride+period, seed)
+    rows = []
+    for y in range(height):
+        offset = ((y+frame*3)*bpp*7) % period
+        rows.append(pattern[offset:offset+stride])
+    return stride, b"".join(rows)
+
+def make_calibration_image(pixel_format, width, height, frame=0):
+    from xpra.codecs.image_wrapper import ImageWrapper
+    from xpra.codecs.codec_constants import PIXEL_SUBSAMPLING
+    if pixel_format in PIXEL_SUBSAMPLING:
+        strides = []
+        planes = []
+        for i, (xdiv, ydiv) in enumerate(PIXEL_SUBSAMPLING[pixel_format]):
+            stride, pixels = make_plane(width//xdiv, height//ydiv, 1, frame, i*64)
+            strides.append(stride)
+            planes.append(pixels)
+        return ImageWrapper(0, 0, width, height, planes, pixel_format, 24, strides, planes=ImageWrapper._3_PLANES)
+    if pixel_format in PACKED_FORMATS:
+        stride, pixels = make_plane(width, height, len(pixel_format), frame)
+        return ImageWrapper(0, 0, width, height, pixels, pixel_format, 24, stride, planes=ImageWrapper.PACKED)
+    return None
+
+def get_image_size(image):
+    if image.get_planes()==image.PACKED:
+        return image.get_rowstride()*image.get_height()
+    return sum(len(x) for x in image.get_pixels())
+
+
+def do_measure(setup, process, pixel_format, width, height, frames):
+    """
+        Returns the throughput in MPixels/s, the setup time in ms
+        and the compression ratio (zero if not compressed)
+    """
+    images = [make_calibration_image(pixel_format, width, height, i) for i in range(frames)]
+    start = time.time()
+    instance = setup()
+    try:
+        setup_end = time.time()
+        in_size = out_size = 0
+        for image in images:
+            in_size += get_image_size(image)
+            out_size += process(instance, image)
+        end = time.time()
+    finally:
+        instance.clean()
+    elapsed = max(end-setup_end, 0.000001)
+    mpps = width*height*frames/elapsed/1000.0/1000.0
+    ratio = 0
+    if out_size>0:
+        ratio = float(in_size)/out_size
+    return mpps, (setup_end-start)*1000.0, ratio
+
+def measure_csc(csc_module, in_csc, out_csc, width, height, frames=CALIBRATION_FRAMES):
+    def setup():
+        csc = csc_module.ColorspaceConverter()
+        csc.init_context(width, height, in_csc, width, height, out_csc, 100)
+        return csc
+    def process(csc, image):
+        csc.convert_image(image)
+        return 0
+    return do_measure(setup, process, in_csc, width, height, frames)
+
+def measure_encoder(encoder_module, encoding, colorspace, width, height, frames=CALIBRATION_FRAMES, quality=50, speed=50):
+    def setup():
+        encoder = encoder_module.Encoder()
+        dst_formats = list(encoder_module.get_output_colorspaces(encoding, colorspace))
+        encoder.init_context(width, height, colorspace, dst_formats, encoding, quality, speed, (1, 1), {})
+        return encoder
+    def process(encoder, image):
+        data, _ = encoder.compress_image(image, quality, speed, {})
+        return len(data or b"")
+    return do_measure(setup, process, colorspace, width, height, frames)
+
+
+class CodecCalibration(object):
+    """
+        The measurements for each csc module and video encoder,
+        keyed by (kind, codec_type, input format, output format),
+        then by frame size.
+        For encoders, the output format is the encoding.
+    """
+
+    def __init__(self, signature=None):
+        self.signature = signature or get_host_signature()
+        self.timestamp = 0
+        self.records = {}
+        #the video helper names of the modules measured:
+        self.modules = set()
+
+    def __repr__(self):
+        return "CodecCalibration(%i records)" % len(self.records)
+
+    def add(self, kind, codec_type, in_format, out_format, width, height, mpps, setup_ms, ratio):
+        key = (kind, codec_type, in_format, out_format)
+        self.records.setdefault(key, {})[(width, height)] = (mpps, setup_ms, ratio)
+
+    def update(self, other):
+        """ the records from other replace ours """
+        for key, sizes in other.records.items():
+            self.records[key] = dict(sizes)
+        self.modules.update(other.modules)
+        self.timestamp = other.timestamp
+
+    def get_measurement(self, kind, codec_type, in_format, out_format):
+        """ use the largest frame size measured, that's what video regions look like """
+        sizes = self.records.get((kind, codec_type, in_format, out_format))
+        if not sizes:
+            return None
+        size = max(sizes.keys(), key=lambda wh : wh[0]*wh[1])
+        return sizes[size]
+
+    def apply(self, kind, in_format, out_format, spec):
+        m = self.get_measurement(kind, spec.codec_type, in_format, out_format)
+        if not m:
+            return False
+        mpps, setup_ms, ratio = m
+        if kind=="csc":
+            reference = CSC_REFERENCE_MPPS
+        else:
+            reference = ENCODER_REFERENCE_MPPS
+        speed = speed_from_mpps(mpps, reference)
+        setup_cost = setup_cost_from_ms(setup_ms)
+        log("calibrated %s %s %s to %s: speed %i -> %i, setup cost %i -> %i (%.1fMPixels/s, %.1fms, ratio %.1f)",
+            kind, spec.codec_type, in_format, out_format, spec.speed, speed, spec.setup_cost, setup_cost, mpps, setup_ms, ratio)
+        spec.speed = speed
+        spec.setup_cost = setup_cost
+        return True
+
+    def save(self, filename):
+        lines = [CALIBRATION_HEADER,
+                 "signature=%s" % self.signature,
+                 "timestamp=%i" % (self.timestamp or time.time()),
+                 "modules=%s" % ",".join(sorted(self.modules)),
+                 "# kind codec in out width height mpixels/s setup(ms) ratio"]
+        for key in sorted(self.records.keys()):
+            for (w, h), (mpps, setup_ms, ratio) in sorted(self.records[key].items()):
+                lines.append("%s %s %s %s %i %i %.3f %.3f %.3f" % (key+(w, h, mpps, setup_ms, ratio)))
+        d = os.path.dirname(filename)
+        if d and not os.path.exists(d):
+            os.makedirs(d, 0o700)
+        with open(filename, "w") as f:
+            f.write("\n".join(lines)+"\n")
+
+    def load(self, filename):
+        with open(filename, "r") as f:
+            lines = f.read().splitlines()
+        if not lines or lines[0]!=CALIBRATION_HEADER:
+            raise Exception("'%s' is not a codec calibration file" % filename)
+        for line in lines[1:]:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("signature="):
+                self.signature = line[len("signature="):]
+            elif line.startswith("timestamp="):
+                self.timestamp = int(line[len("timestamp="):])
+            elif line.startswith("modules="):
+                self.modules = set(x for x in line[len("modules="):].split(",") if x)
+            else:
+                parts = line.split()
+                if len(parts)!=9:
+                    log.warn("Warning: invalid calibration record '%s'", line)
+                    continue
+                self.add(parts[0], parts[1], parts[2], parts[3], int(parts[4]), int(parts[5]),
+                         float(parts[6]), float(parts[7]), float(parts[8]))
+
+    def get_info(self):
+        info = {
+                "signature" : self.signature,
+                "timestamp" : self.timestamp,
+                "modules"   : sorted(self.modules),
+                }
+        for (kind, codec_type, in_format, out_format), sizes in self.records.items():
+            for (w, h), (mpps, setup_ms, ratio) in sizes.items():
+                info.setdefault(kind, {}).setdefault(codec_type, {}).setdefault("%s_to_%s" % (in_format, out_format), {})["%ix%i" % (w, h)] = {
+                        "mpixels"   : round(mpps, 1),
+                        "setup"     : int(setup_ms),
+                        "ratio"     : round(ratio, 1),
+                        }
+        return info
+
+
+_codec_calibration = False
+def get_codec_calibration():
+    """ loads the calibration cache file just once, returns None if we don't have a valid one """
+    global _codec_calibration
+    if _codec_calibration is False:
+        _codec_calibration = None
+        if CODEC_CALIBRATION:
+            filename = get_calibration_filename()
+            if os.path.exists(filename):
+                c = CodecCalibration()
+                try:
+                    c.load(filename)
+                except Exception as e:
+                    log.warn("Warning: failed to load codec calibration file '%s':", filename)
+                    log.warn(" %s", e)
+                else:
+                    if c.signature!=get_host_signature():
+                        log.warn("Warning: codec calibration file '%s' is stale", filename)
+                        log.warn(" run 'xpra codec-calibrate' to update it")
+                    else:
+                        missing = [x for x in get_available_modules() if x not in c.modules]
+                        if missing:
+                            #mixing measured and hardcoded speeds would skew the pipeline scores:
+                            log.warn("Warning: codec calibration file '%s' is incomplete", filename)
+                            log.warn(" %s not calibrated, run 'xpra codec-calibrate' to update it", csv(missing))
+                        else:
+                            log("loaded %s from '%s'", c, filename)
+                            _codec_calibration = c
+    return _codec_calibration
+
+def apply_calibration(kind, in_format, out_format, spec):
+    c = get_codec_calibration()
+    if c:
+        c.apply(kind, in_format, out_format, spec)
+
+
+def get_available_modules(video_encoders=None, csc_modules=None):
+    """ the video encoders and csc modules which can be loaded """
+    from xpra.codecs.loader import get_codec
+    from xpra.codecs.video_helper import ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS, get_encoder_module_names, get_csc_module_name
+    if video_encoders is None:
+        video_encoders = ALL_VIDEO_ENCODER_OPTIONS
+    if csc_modules is None:
+        csc_modules = ALL_CSC_MODULE_OPTIONS
+    modules = [x for x in csc_modules if get_codec(get_csc_module_name(x))]
+    modules += [x for x in video_encoders if any(get_codec(m) for m in get_encoder_module_names(x))]
+    return modules
+
+
+def calibrate(video_encoders, csc_modules, sizes=CALIBRATION_SIZES, frames=CALIBRATION_FRAMES, progress_cb=None):
+    """
+        Benchmarks the given encoder and csc modules (names as used by the video helper),
+        returns a CodecCalibration object.
+    """
+    from xpra.codecs.loader import get_codec
+    from xpra.codecs.video_helper import get_encoder_module_names, get_csc_module_name
+    calibration = CodecCalibration()
+    def run(kind, module, in_format, out_format, spec, measure_fn, *args):
+        for w, h in sizes:
+            if w<spec.min_w or h<spec.min_h or w>spec.max_w or h>spec.max_h:
+                continue
+            w &= spec.width_mask
+            h &= spec.height_mask
+            try:
+                mpps, setup_ms, ratio = measure_fn(module, *(args+(w, h, frames)))
+            except Exception as e:
+                log("%s(%s)", measure_fn, args, exc_info=True)
+                log.warn("Warning: failed to calibrate %s %s from %s to %s at %ix%i:", module.get_type(), kind, in_format, out_format, w, h)
+                log.warn(" %s", e)
+                continue
+            calibration.add(kind, spec.codec_type, in_format, out_format, w, h, mpps, setup_ms, ratio)
+            if progress_cb:
+                progress_cb(kind, spec.codec_type, in_format, out_format, w, h, mpps, setup_ms, ratio)
+    for csc_name in csc_modules:
+        csc_module = get_codec(get_csc_module_name(csc_name))
+        if not csc_module:
+            continue
+        calibration.modules.add(csc_name)
+        csc_module.init_module()
+        try:
+            for in_csc in csc_module.get_input_colorspaces():
+                if make_calibration_image(in_csc, 2, 2) is None:
+                    continue
+                for out_csc in csc_module.get_output_colorspaces(in_csc):
+                    spec = csc_module.get_spec(in_csc, out_csc)
+                    run("csc", csc_module, in_csc, out_csc, spec, measure_csc, in_csc, out_csc)
+        finally:
+            csc_module.cleanup_module()
+    for encoder_name in video_encoders:
+        for module_name in get_encoder_module_names(encoder_name):
+            encoder_module = get_codec(module_name)
+            if not encoder_module:
+                continue
+            calibration.modules.add(encoder_name)
+            encoder_module.init_module()
+            try:
+                for encoding in encoder_module.get_encodings():
+                    for colorspace in encoder_module.get_input_colorspaces(encoding):
+                        if make_calibration_image(colorspace, 2, 2) is None:
+                            continue
+                        spec = encoder_module.get_spec(encoding, colorspace)
+                        run("encoder", encoder_module, colorspace, encoding, spec, measure_encoder, encoding, colorspace)
+            finally:
+                encoder_module.cleanup_module()
+            break
+    calibration.timestamp = int(time.time())
+    return calibration
+
+
+def run_calibration(args):
+    """ the "xpra codec-calibrate [CODEC]..." subcommand """
+    from xpra.codecs.loader import load_codecs
+    from xpra.codecs.video_helper import ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+    load_codecs(decoders=False)
+    video_encoders = [x for x in ALL_VIDEO_ENCODER_OPTIONS if not args or x in args]
+    csc_modules = [x for x in ALL_CSC_MODULE_OPTIONS if not args or x in args]
+    if not video_encoders and not csc_modules:
+        print("no video encoders or csc modules to calibrate")
+        return 1
+    print("calibrating %s" % csv(csc_modules+video_encoders))
+    print("%-8s %-10s %-8s %-8s %10s %10s %10s %8s" % ("kind", "codec", "input", "output", "size", "MPixels/s", "setup(ms)", "ratio"))
+    def progress(kind, codec_type, in_format, out_format, w, h, mpps, setup_ms, ratio):
+        print("%-8s %-10s %-8s %-8s %10s %10.1f %10.1f %8.1f" % (kind, codec_type, in_format, out_format, "%ix%i" % (w, h), mpps, setup_ms, ratio))
+        sys.stdout.flush()
+    calibration = calibrate(video_encoders, csc_modules, progress_cb=progress)
+    if not calibration.records:
+        print("no measurements")
+        return 1
+    filename = get_calibration_filename()
+    if args and os.path.exists(filename):
+        #only some modules were measured, keep the records for the other ones:
+        previous = CodecCalibration()
+        try:
+            previous.load(filename)
+        except Exception:
+            log("failed to load '%s'", filename, exc_info=True)
+        else:
+            if previous.signature==calibration.signature:
+                previous.update(calibration)
+                calibration = previous
+    missing = [x for x in get_available_modules() if x not in calibration.modules]
+    if missing:
+        print("%s not calibrated yet, the calibration will not be used until they are" % csv(missing))
+    calibration.save(filename)
+    print("calibration saved to '%s'" % filename)
+    return 0
+
+
+def main():
+    from xpra.platform import program_context
+    with program_context("Codec-Calibration", "Codec Calibration"):
+        if "-v" in sys.argv or "--verbose" in sys.argv:
+            log.enable_debug()
+        return run_calibration([x for x in sys.argv[1:] if x not in ("-v", "--verbose")])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,6 +10,7 @@
 import os
 import time
 import struct
+from threading import Lock, Event
 try:
     from xpra.build_info import CYTHON_VERSION as CYTHON_VERSION_STR
     CYTHON_VERSION = CYTHON_VERSION_STR.split(".")
@@ -22,6 +23,8 @@ log = Logger("csc", "cython")
 
 from xpra.codecs.codec_constants import csc_spec
 from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.os_util import Queue
+from xpra.make_thread import make_thread
 
 cdef extern from "stdlib.h":
     void free(void *ptr)
@@ -38,7 +41,7 @@ cdef extern from "../../buffers/memalign.h":
 
 from libc.stdint cimport uint8_t
 
-cdef inline int roundup(int n, int m):
+cdef inline int roundup(int n, int m) nogil:
     return (n + m - 1) & ~(m - 1)
 
 #precalculate indexes in native endianness:
@@ -97,6 +100,18 @@ if dp:
 
 CSC_CYTHON_VERSION = [1]
 
+def get_default_csc_threads():
+    try:
+        from multiprocessing import cpu_count
+        return min(8, cpu_count())
+    except:
+        return 1
+#the conversion loops release the GIL, so we split large frames in bands of rows
+#which are converted concurrently:
+CSC_THREADS = max(1, int(os.environ.get("XPRA_CSC_CYTHON_THREADS", get_default_csc_threads())))
+#don't bother with threads for bands smaller than this number of rows:
+CSC_MIN_BAND_HEIGHT = max(2, int(os.environ.get("XPRA_CSC_CYTHON_MIN_BAND_HEIGHT", "64")))
+
 
 def init_module():
     #nothing to do!
@@ -113,7 +128,8 @@ def get_version():
 
 def get_info():
     info = {"version"   : CSC_CYTHON_VERSION,
-            "buffer_api": get_buffer_api_version()}
+            "buffer_api": get_buffer_api_version(),
+            "threads"   : CSC_THREADS}
     if CYTHON_VERSION:
         info["Cython"] = CYTHON_VERSION
     return info
@@ -127,9 +143,16 @@ def get_output_colorspaces(input_colorspace):
 def get_spec(in_colorspace, out_colorspace):
     assert in_colorspace in COLORSPACES, "invalid input colorspace: %s (must be one of %s)" % (in_colorspace, get_input_colorspaces())
     assert out_colorspace in COLORSPACES.get(in_colorspace), "invalid output colorspace: %s (must be one of %s)" % (out_colorspace, get_output_colorspaces(in_colorspace))
-    #low score as this should be used as fallback only:
+    #low score as this should be used as fallback only
+    #(the speedup from the threads is measured by "xpra codec-calibrate"):
     return csc_spec(ColorspaceConverter, codec_type=get_type(), quality=50, speed=10, setup_cost=10, min_w=2, min_h=2, max_w=16*1024, max_h=16*1024, can_scale=True)
 
+def set_threads(int threads):
+    """ used by the benchmarks, the default comes from XPRA_CSC_CYTHON_THREADS """
+    global CSC_THREADS
+    assert threads>0, "invalid number of threads: %s" % threads
+    CSC_THREADS = threads
+
 
 class CythonImageWrapper(ImageWrapper):
 
@@ -211,6 +234,282 @@ cdef inline unsigned char clamp(const long v) nogil:
         return <unsigned char> (v>>shift)
 
 
+ctypedef struct csc_params:
+    const unsigned char *src[3]
+    unsigned int src_strides[3]
+    unsigned char *dst[3]
+    unsigned int dst_strides[3]
+    unsigned int src_width
+    unsigned int src_height
+    unsigned int dst_width
+    unsigned int dst_height
+    uint8_t Bpp
+    #byte or plane indexes:
+    uint8_t Rindex
+    uint8_t Gindex
+    uint8_t Bindex
+    uint8_t Xindex
+
+
+cdef void RGB_to_YUV420P_rows(const csc_params *p, unsigned int ystart, unsigned int yend) nogil:
+    """ converts the rows ystart to yend, each row of U and V pixels covers 2 rows of Y pixels """
+    cdef const unsigned char *input_image = p.src[0]
+    cdef unsigned int input_stride = p.src_strides[0]
+    cdef unsigned char *Y = p.dst[0]
+    cdef unsigned char *U = p.dst[1]
+    cdef unsigned char *V = p.dst[2]
+    cdef unsigned int Ystride = p.dst_strides[0]
+    cdef unsigned int Ustride = p.dst_strides[1]
+    cdef unsigned int Vstride = p.dst_strides[2]
+    cdef unsigned int src_width = p.src_width
+    cdef unsigned int src_height = p.src_height
+    cdef unsigned int dst_width = p.dst_width
+    cdef unsigned int dst_height = p.dst_height
+    cdef uint8_t Bpp = p.Bpp
+    cdef uint8_t Rindex = p.Rindex
+    cdef uint8_t Gindex = p.Gindex
+    cdef uint8_t Bindex = p.Bindex
+    cdef unsigned int x, y, o
+    cdef unsigned int sx, sy, ox, oy
+    cdef unsigned char R, G, B
+    cdef unsigned short Rsum, Gsum, Bsum
+    cdef unsigned char sum, dx, dy
+    #we process 4 pixels at a time:
+    cdef unsigned int workw = roundup(dst_width/2, 2)
+    for y in range(ystart, yend):
+        for x in range(workw):
+            R = G = B = 0
+            Rsum = Gsum = Bsum = 0
+            sum = 0
+            for dy in range(2):
+                oy = y*2 + dy
+                if oy>=dst_height:
+                    break
+                sy = oy*src_height//dst_height
+                for dx in range(2):
+                    ox = x*2 + dx
+                    if ox>=dst_width:
+                        break
+                    sx = ox*src_width//dst_width
+                    o = sy*input_stride + sx*Bpp
+                    R = input_image[o + Rindex]
+                    G = input_image[o + Gindex]
+                    B = input_image[o + Bindex]
+                    o = oy*Ystride + ox
+                    Y[o] = clamp(YR * R + YG * G + YB * B + YC)
+                    sum += 1
+                    Rsum += R
+                    Gsum += G
+                    Bsum += B
+            #write 1U and 1V:
+            if sum>0:
+                Rsum /= sum
+                Gsum /= sum
+                Bsum /= sum
+                U[y*Ustride + x] = clamp(UR * Rsum + UG * Gsum + UB * Bsum + UC)
+                V[y*Vstride + x] = clamp(VR * Rsum + VG * Gsum + VB * Bsum + VC)
+
+cdef void YUV420P_to_RGB_rows(const csc_params *p, unsigned int ystart, unsigned int yend) nogil:
+    """ converts the rows ystart to yend, each row covers 2 rows of RGB pixels """
+    cdef const unsigned char *Ybuf = p.src[0]
+    cdef const unsigned char *Ubuf = p.src[1]
+    cdef const unsigned char *Vbuf = p.src[2]
+    cdef unsigned int Ystride = p.src_strides[0]
+    cdef unsigned int Ustride = p.src_strides[1]
+    cdef unsigned int Vstride = p.src_strides[2]
+    cdef unsigned char *output_image = p.dst[0]
+    cdef unsigned int stride = p.dst_strides[0]
+    cdef unsigned int src_width = p.src_width
+    cdef unsigned int src_height = p.src_height
+    cdef unsigned int dst_width = p.dst_width
+    cdef unsigned int dst_height = p.dst_height
+    cdef uint8_t Bpp = p.Bpp
+    cdef uint8_t Rindex = p.Rindex
+    cdef uint8_t Gindex = p.Gindex
+    cdef uint8_t Bindex = p.Bindex
+    cdef uint8_t Xindex = p.Xindex
+    cdef unsigned int x, y, o
+    cdef unsigned int sx, sy, ox, oy
+    cdef unsigned char dx, dy
+    cdef short Y, U, V
+    #we process 4 pixels at a time:
+    cdef unsigned int workw = roundup(dst_width//2, 2)
+    for y in range(ystart, yend):
+        for x in range(workw):
+            #read U and V for the next 4 pixels:
+            sx = x*src_width//dst_width
+            sy = y*src_height//dst_height
+            U = Ubuf[sy*Ustride + sx] - Uc
+            V = Vbuf[sy*Vstride + sx] - Vc
+            #now read up to 4 Y values and write an RGBX pixel for each:
+            for dy in range(2):
+                oy = y*2 + dy
+                if oy>=dst_height:
+                    break
+                sy = oy*src_height//dst_height
+                for dx in range(2):
+                    ox = x*2 + dx
+                    if ox>=dst_width:
+                        break
+                    sx = ox*src_width//dst_width
+                    Y = Ybuf[sy*Ystride + sx] - Yc
+                    o = oy*stride + ox * Bpp
+                    output_image[o + Rindex] = clamp(RY * Y + RU * U + RV * V)
+                    output_image[o + Gindex] = clamp(GY * Y + GU * U + GV * V)
+                    output_image[o + Bindex] = clamp(BY * Y + BU * U + BV * V)
+                    if Bpp==4:
+                        output_image[o + Xindex] = 255
+
+cdef void RGBP_to_RGB_rows(const csc_params *p, unsigned int ystart, unsigned int yend) nogil:
+    """ the source planes are in R, G, B order, the indexes are for the destination """
+    cdef const unsigned char *Rptr
+    cdef const unsigned char *Gptr
+    cdef const unsigned char *Bptr
+    cdef unsigned char *output_image = p.dst[0]
+    cdef unsigned int stride = p.dst_strides[0]
+    cdef unsigned int src_width = p.src_width
+    cdef unsigned int src_height = p.src_height
+    cdef unsigned int dst_width = p.dst_width
+    cdef unsigned int dst_height = p.dst_height
+    cdef uint8_t Rdst = p.Rindex
+    cdef uint8_t Gdst = p.Gindex
+    cdef uint8_t Bdst = p.Bindex
+    cdef uint8_t Xdst = p.Xindex
+    cdef unsigned int x, y, o
+    cdef unsigned int sx, sy
+    for y in range(ystart, yend):
+        o = stride*y
+        sy = y*src_height/dst_height
+        Rptr  = p.src[0] + (sy * p.src_strides[0])
+        Gptr  = p.src[1] + (sy * p.src_strides[1])
+        Bptr  = p.src[2] + (sy * p.src_strides[2])
+        for x in range(dst_width):
+            sx = x*src_width/dst_width
+            output_image[o+Rdst] = Rptr[sx]
+            output_image[o+Gdst] = Gptr[sx]
+            output_image[o+Bdst] = Bptr[sx]
+            output_image[o+Xdst] = 255
+            o += 4
+
+
+DEF RGB_TO_YUV420P = 0
+DEF YUV420P_TO_RGB = 1
+DEF RGBP_TO_RGB = 2
+
+cdef class CSCJob:
+    """
+        The parameters of a conversion,
+        so it can be split into bands of rows processed by different threads.
+    """
+    cdef csc_params params
+    cdef int function
+
+    def run(self, band):
+        cdef unsigned int ystart = band[0]
+        cdef unsigned int yend = band[1]
+        with nogil:
+            if self.function==RGB_TO_YUV420P:
+                RGB_to_YUV420P_rows(&self.params, ystart, yend)
+            elif self.function==YUV420P_TO_RGB:
+                YUV420P_to_RGB_rows(&self.params, ystart, yend)
+            else:
+                RGBP_to_RGB_rows(&self.params, ystart, yend)
+
+
+class CSCThreadPool(object):
+    """
+        The threads used for converting the bands of a frame concurrently,
+        shared by all the converters.
+        The calling thread also converts one of the bands,
+        so it always makes progress even when the pool threads are busy.
+    """
+
+    def __init__(self, nthreads):
+        self.nthreads = nthreads
+        self.work_queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+
+    def __repr__(self):
+        return "CSCThreadPool(%i)" % self.nthreads
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.nthreads):
+                t = make_thread(self.band_loop, "csc-cython-%i" % i, daemon=True)
+                self.threads.append(t)
+                t.start()
+
+    def band_loop(self):
+        while True:
+            item = self.work_queue.get(True)
+            if item is None:
+                return
+            item[0](*item[1:])
+
+    def map(self, fn, items):
+        """ calls fn for each item and waits for all of them to complete """
+        n = len(items)
+        if n<=1 or self.nthreads<=0:
+            for x in items:
+                fn(x)
+            return
+        self.start()
+        errors = []
+        remaining = [n]
+        done = Event()
+        lock = Lock()
+        def run(i):
+            try:
+                fn(items[i])
+            except Exception as e:
+                log("error converting band %i", i, exc_info=True)
+                errors.append(e)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]==0:
+                        done.set()
+        for i in range(1, n):
+            self.work_queue.put((run, i))
+        run(0)
+        done.wait()
+        if errors:
+            raise errors[0]
+
+_csc_pool = None
+def get_csc_pool():
+    global _csc_pool
+    if _csc_pool is None:
+        _csc_pool = CSCThreadPool(CSC_THREADS-1)
+    return _csc_pool
+
+def get_bands(unsigned int rows, unsigned int threads, unsigned int min_rows):
+    """ splits the rows into at most 'threads' bands of at least min_rows """
+    cdef unsigned int n = max(1, min(threads, rows//max(1, min_rows)))
+    cdef unsigned int i
+    return [(rows*i//n, rows*(i+1)//n) for i in range(n)]
+
+def run_job(CSCJob job, unsigned int rows, unsigned int row_height):
+    """ row_height is the number of pixel rows processed for each row of the job """
+    global _csc_pool
+    cdef unsigned int threads = CSC_THREADS
+    bands = get_bands(rows, threads, max(1, CSC_MIN_BAND_HEIGHT//row_height))
+    if len(bands)==1:
+        job.run(bands[0])
+        return 1
+    pool = get_csc_pool()
+    if pool.nthreads!=threads-1:
+        #the number of threads has been changed, make a new pool:
+        for _ in pool.threads:
+            pool.work_queue.put(None)
+        pool = _csc_pool = CSCThreadPool(threads-1)
+    pool.map(job.run, bands)
+    return len(bands)
+
+
 cdef class ColorspaceConverter:
     cdef unsigned int src_width
     cdef unsigned int src_height
@@ -227,6 +526,7 @@ cdef class ColorspaceConverter:
     cdef unsigned long frames
     cdef double time
     cdef unsigned long buffer_size
+    cdef unsigned int bands
 
     cdef object __weakref__
 
@@ -245,6 +545,7 @@ cdef class ColorspaceConverter:
 
         self.time = 0
         self.frames = 0
+        self.bands = 0
 
         #explicity clear all strides / sizes / offsets:
         for i in range(2):
@@ -334,7 +635,8 @@ cdef class ColorspaceConverter:
                 "src_width" : self.src_width,
                 "src_height": self.src_height,
                 "dst_width" : self.dst_width,
-                "dst_height": self.dst_height}
+                "dst_height": self.dst_height,
+                "bands"     : self.bands}
         if self.src_format:
             info["src_format"] = self.src_format
         if self.dst_format:
@@ -396,12 +698,9 @@ cdef class ColorspaceConverter:
         cdef unsigned char *output_image
         cdef unsigned int input_stride
         cdef unsigned int x,y,o             #@DuplicatedSignature
-        cdef unsigned int sx, sy, ox, oy
-        cdef unsigned int workw, workh
+        cdef unsigned int workh
         cdef unsigned int Ystride, Ustride, Vstride
-        cdef unsigned char R, G, B
-        cdef unsigned short Rsum, Gsum, Bsum
-        cdef unsigned char sum, i, dx, dy
+        cdef unsigned char i
         cdef unsigned char *Y
         cdef unsigned char *U
         cdef unsigned char *V
@@ -433,42 +732,26 @@ cdef class ColorspaceConverter:
         cdef unsigned int dst_height = self.dst_height
 
         #we process 4 pixels at a time:
-        workw = roundup(dst_width/2, 2)
         workh = roundup(dst_height/2, 2)
-        #from now on, we can release the gil:
-        with nogil:
-            for y in range(workh):
-                for x in range(workw):
-                    R = G = B = 0
-                    Rsum = Gsum = Bsum = 0
-                    sum = 0
-                    for dy in range(2):
-                        oy = y*2 + dy
-                        if oy>=dst_height:
-                            break
-                        sy = oy*src_height//dst_height
-                        for dx in range(2):
-                            ox = x*2 + dx
-                            if ox>=dst_width:
-                                break
-                            sx = ox*src_width//dst_width
-                            o = sy*input_stride + sx*Bpp
-                            R = input_image[o + Rindex]
-                            G = input_image[o + Gindex]
-                            B = input_image[o + Bindex]
-                            o = oy*Ystride + ox
-                            Y[o] = clamp(YR * R + YG * G + YB * B + YC)
-                            sum += 1
-                            Rsum += R
-                            Gsum += G
-                            Bsum += B
-                    #write 1U and 1V:
-                    if sum>0:
-                        Rsum /= sum
-                        Gsum /= sum
-                        Bsum /= sum
-                        U[y*Ustride + x] = clamp(UR * Rsum + UG * Gsum + UB * Bsum + UC)
-                        V[y*Vstride + x] = clamp(VR * Rsum + VG * Gsum + VB * Bsum + VC)
+        cdef CSCJob job = CSCJob()
+        job.function = RGB_TO_YUV420P
+        job.params.src[0] = input_image
+        job.params.src_strides[0] = input_stride
+        job.params.dst[0] = Y
+        job.params.dst[1] = U
+        job.params.dst[2] = V
+        for i in range(3):
+            job.params.dst_strides[i] = self.dst_strides[i]
+        job.params.src_width = src_width
+        job.params.src_height = src_height
+        job.params.dst_width = dst_width
+        job.params.dst_height = dst_height
+        job.params.Bpp = Bpp
+        job.params.Rindex = Rindex
+        job.params.Gindex = Gindex
+        job.params.Bindex = Bindex
+        #the GIL is released while converting:
+        self.bands = run_job(job, workh, 2)
 
         if DEBUG_POINTS:
             for x,y in DEBUG_POINTS:
@@ -516,14 +799,11 @@ cdef class ColorspaceConverter:
         cdef Py_ssize_t buf_len = 0
         cdef unsigned char *output_image        #
         cdef unsigned int x,y,o                 #@DuplicatedSignature
-        cdef unsigned int sx, sy, ox, oy
-        cdef unsigned int workw, workh          #
+        cdef unsigned int workh                 #
         cdef unsigned int stride
         cdef unsigned char *Ybuf
         cdef unsigned char *Ubuf
         cdef unsigned char *Vbuf
-        cdef unsigned char dx, dy
-        cdef short Y, U, V
         cdef unsigned int Ystride, Ustride, Vstride      #
         cdef object rgb
 
@@ -558,36 +838,28 @@ cdef class ColorspaceConverter:
         output_image = <unsigned char*> xmemalign(self.buffer_size)
 
         #we process 4 pixels at a time:
-        workw = roundup(dst_width//2, 2)
         workh = roundup(dst_height//2, 2)
-        #from now on, we can release the gil:
-        with nogil:
-            for y in range(workh):
-                for x in range(workw):
-                    #assert x*2<=src_width and y*2<=src_height
-                    #read U and V for the next 4 pixels:
-                    sx = x*src_width//dst_width
-                    sy = y*src_height//dst_height
-                    U = Ubuf[sy*Ustride + sx] - Uc
-                    V = Vbuf[sy*Vstride + sx] - Vc
-                    #now read up to 4 Y values and write an RGBX pixel for each:
-                    for dy in range(2):
-                        oy = y*2 + dy
-                        if oy>=dst_height:
-                            break
-                        sy = oy*src_height//dst_height
-                        for dx in range(2):
-                            ox = x*2 + dx
-                            if ox>=dst_width:
-                                break
-                            sx = ox*src_width//dst_width
-                            Y = Ybuf[sy*Ystride + sx] - Yc
-                            o = oy*stride + ox * Bpp
-                            output_image[o + Rindex] = clamp(RY * Y + RU * U + RV * V)
-                            output_image[o + Gindex] = clamp(GY * Y + GU * U + GV * V)
-                            output_image[o + Bindex] = clamp(BY * Y + BU * U + BV * V)
-                            if Bpp==4:
-                                output_image[o + Xindex] = 255
+        cdef CSCJob job = CSCJob()
+        job.function = YUV420P_TO_RGB
+        job.params.src[0] = Ybuf
+        job.params.src[1] = Ubuf
+        job.params.src[2] = Vbuf
+        job.params.src_strides[0] = Ystride
+        job.params.src_strides[1] = Ustride
+        job.params.src_strides[2] = Vstride
+        job.params.dst[0] = output_image
+        job.params.dst_strides[0] = stride
+        job.params.src_width = src_width
+        job.params.src_height = src_height
+        job.params.dst_width = dst_width
+        job.params.dst_height = dst_height
+        job.params.Bpp = Bpp
+        job.params.Rindex = Rindex
+        job.params.Gindex = Gindex
+        job.params.Bindex = Bindex
+        job.params.Xindex = Xindex
+        #the GIL is released while converting:
+        self.bands = run_job(job, workh, 2)
         if DEBUG_POINTS:
             for x,y in DEBUG_POINTS:
                 o = min(y, dst_height)*stride + min(x, dst_width) * Bpp
@@ -623,16 +895,10 @@ cdef class ColorspaceConverter:
                                      const uint8_t Rdst, const uint8_t Gdst, const uint8_t Bdst, const uint8_t Xdst):
         cdef Py_ssize_t buf_len = 0             #
         cdef unsigned char *output_image        #@DuplicatedSignature
-        cdef unsigned int x,y,o                 #@DuplicatedSignature
-        cdef unsigned int sx, sy                #@DuplicatedSignature
         cdef unsigned int stride                #@DuplicatedSignature
         cdef unsigned char *Gbuf                #@DuplicatedSignature
-        cdef unsigned char *Gptr
         cdef unsigned char *Bbuf                #@DuplicatedSignature
-        cdef unsigned char *Bptr
         cdef unsigned char *Rbuf                #@DuplicatedSignature
-        cdef unsigned char *Rptr
-        cdef unsigned char sum
         cdef unsigned int Gstride, Bstride, Rstride
         cdef object rgb                         #@DuplicatedSignature
 
@@ -666,21 +932,26 @@ cdef class ColorspaceConverter:
         #allocate output buffer:
         output_image = <unsigned char*> xmemalign(self.buffer_size)
 
-        #from now on, we can release the gil:
-        with nogil:
-            for y in range(dst_height):
-                o = stride*y
-                sy = y*src_height/dst_height
-                Rptr  = Rbuf + (sy * Rstride)
-                Gptr  = Gbuf + (sy * Gstride)
-                Bptr  = Bbuf + (sy * Bstride)
-                for x in range(dst_width):
-                    sx = x*src_width/dst_width
-                    output_image[o+Rdst] = Rptr[sx]
-                    output_image[o+Gdst] = Gptr[sx]
-                    output_image[o+Bdst] = Bptr[sx]
-                    output_image[o+Xdst] = 255
-                    o += 4
+        cdef CSCJob job = CSCJob()
+        job.function = RGBP_TO_RGB
+        job.params.src[0] = Rbuf
+        job.params.src[1] = Gbuf
+        job.params.src[2] = Bbuf
+        job.params.src_strides[0] = Rstride
+        job.params.src_strides[1] = Gstride
+        job.params.src_strides[2] = Bstride
+        job.params.dst[0] = output_image
+        job.params.dst_strides[0] = stride
+        job.params.src_width = src_width
+        job.params.src_height = src_height
+        job.params.dst_width = dst_width
+        job.params.dst_height = dst_height
+        job.params.Rindex = Rdst
+        job.params.Gindex = Gdst
+        job.params.Bindex = Bdst
+        job.params.Xindex = Xdst
+        #the GIL is released while converting:
+        self.bands = run_job(job, dst_height, 1)
 
         rgb = memory_as_pybuffer(<void *> output_image, self.dst_sizes[0], True)
         elapsed = time.time()-start
@@ -549,6 +549,16 @@ cdef class Encoder:
     def is_closed(self):
         return self.context==NULL
 
+    def restart(self):
+        """
+            The next frame will start a new stream (IDR frame with the headers),
+            so this encoder can be re-used for another window or client.
+        """
+        assert self.context!=NULL
+        self.frames = 0
+        self.time = 0
+        self.last_frame_times = deque(maxlen=200)
+
     def get_encoding(self):
         return "h264"
 
@@ -588,7 +598,8 @@ cdef class Encoder:
         cdef int i                        #@DuplicatedSignature
         start = time.time()
 
-        if self.frames==0:
+        if self.first_frame_timestamp==0:
+            #(not reset on restart, so the pts keep increasing)
             self.first_frame_timestamp = image.get_timestamp()
 
         if speed>=0:
@@ -606,6 +617,8 @@ cdef class Encoder:
 
         x264_picture_init(&pic_out)
         x264_picture_init(&pic_in)
+        if self.frames==0:
+            pic_in.i_type = X264_TYPE_IDR
 
         if self.src_format.find("RGB")>=0 or self.src_format.find("BGR")>=0:
             assert len(pixels)>0
@@ -11,6 +11,7 @@ from xpra.log import Logger
 log = Logger("codec", "video")
 
 from xpra.codecs.loader import get_codec, get_codec_error
+from xpra.codecs.codec_calibration import apply_calibration, get_codec_calibration
 from xpra.util import csv, engs
 
 
@@ -221,6 +222,9 @@ class VideoHelper(object):
         cscm = einfo.setdefault("csc-module", {})
         for x in ALL_CSC_MODULE_OPTIONS:
             cscm["%s" % x] = modstatus(x, get_DEFAULT_CSC_MODULES(), self.csc_modules)
+        calibration = get_codec_calibration()
+        if calibration:
+            d["calibration"] = calibration.get_info()
         return d
 
     def init(self):
@@ -297,6 +301,7 @@ class VideoHelper(object):
             log(" %s input colorspaces for %s: %s", encoder_type, encoding, csv(colorspaces))
             for colorspace in colorspaces:
                 spec = encoder_module.get_spec(encoding, colorspace)
+                apply_calibration("encoder", colorspace, encoding, spec)
                 self.add_encoder_spec(encoding, colorspace, spec)
 
     def add_encoder_spec(self, encoding, colorspace, spec):
@@ -340,6 +345,7 @@ class VideoHelper(object):
             log("%s output colorspaces for %s: %s", csc_module.get_type(), in_csc, csv(out_cscs))
             for out_csc in out_cscs:
                 spec = csc_module.get_spec(in_csc, out_csc)
+                apply_calibration("csc", in_csc, out_csc, spec)
                 self.add_csc_spec(in_csc, out_csc, spec)
 
     def add_csc_spec(self, in_csc, out_csc, spec):
@@ -13,6 +13,7 @@ import socket
 from xpra.log import Logger
 log = Logger("network", "protocol")
 from xpra.net import ConnectionClosedException
+from xpra.os_util import memoryview_to_bytes
 
 #on some platforms (ie: OpenBSD), reading and writing from sockets
 #raises an IOError but we should continue if the error code is EINTR
@@ -27,6 +28,12 @@ ABORT = {
     errno.EPIPE         : "EPIPE"}
 continue_wait = 0
 
+#use sendmsg for scatter/gather writes on sockets when available:
+USE_SENDMSG = os.environ.get("XPRA_SENDMSG", "1")=="1"
+#without vectored writes (ie: python2 has no socket.sendmsg),
+#buffers are joined up to this size so small chunks still go out in a single write:
+JOIN_WRITE_SIZE = int(os.environ.get("XPRA_JOIN_WRITE_SIZE", 64*1024))
+
 #default to using os.read and os.write for both tty devices and regular streams
 #(but overriden for win32 below for tty devices to workaround an OS "feature")
 OS_READ = os.read
@@ -156,6 +163,22 @@ class Connection(object):
         self.output_bytecount += w or 0
         return w
 
+    def writev(self, buffers):
+        """
+            Writes data from the list of buffers and returns the number of bytes written.
+            This generic version copies the leading buffers into a single write,
+            up to JOIN_WRITE_SIZE (large buffers are written on their own, without copying),
+            connections which support vectored writes override it.
+        """
+        size = len(buffers[0])
+        n = 1
+        while n<len(buffers) and size+len(buffers[n])<=JOIN_WRITE_SIZE:
+            size += len(buffers[n])
+            n += 1
+        if n==1:
+            return self.write(buffers[0])
+        return self.write(b"".join(memoryview_to_bytes(x) for x in buffers[:n]))
+
     def _read(self, *args):
         r = self.untilConcludes(*args)
         self.input_bytecount += len(r or "")
@@ -243,6 +266,9 @@ class SocketConnection(Connection):
     def __init__(self, socket, local, remote, target, info):
         Connection.__init__(self, target, info)
         self._socket = socket
+        self._sendmsg = None
+        if USE_SENDMSG:
+            self._sendmsg = getattr(socket, "sendmsg", None)
         self.local = local
         self.remote = remote
         if type(remote)==str:
@@ -254,6 +280,14 @@ class SocketConnection(Connection):
     def write(self, buf):
         return self._write(self._socket.send, buf)
 
+    def writev(self, buffers):
+        if len(buffers)==1:
+            return self.write(buffers[0])
+        if not self._sendmsg:
+            #python2 sockets have no sendmsg:
+            return Connection.writev(self, buffers)
+        return self._write(self._sendmsg, buffers)
+
     def close(self):
         log("%s.close() for socket=%s", self, self._socket)
         Connection.close(self)
@@ -277,6 +311,7 @@ class SocketConnection(Connection):
                         "timeout"       : int(1000*(s.gettimeout() or 0)),
                         "family"        : FAMILY_STR.get(s.family, s.family),
                         "proto"         : s.proto,
+                        "sendmsg"       : bool(self._sendmsg),
                         "type"          : PROTOCOL_STR.get(s.type, s.type)}
         except:
             log.warn("failed to get socket information", exc_info=True)
@@ -5,12 +5,14 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
+import os
 import sys
 import zlib
+from threading import local
 
 from xpra.log import Logger
 log = Logger("network", "protocol")
-from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG
+from xpra.net.header import LZ4_FLAG, ZLIB_FLAG, LZO_FLAG, ZSTD_FLAG
 from xpra.os_util import _memoryview
 
 
@@ -79,6 +81,85 @@ except Exception as e:
         raise Exception("lzo is not supported!")
 
 
+#directory containing trained zstd dictionaries,
+#one file per packet type: ie: "pointer-position.zdict"
+ZSTD_DICTIONARY_DIR = os.environ.get("XPRA_ZSTD_DICTIONARY_DIR", "")
+ZSTD_DICTIONARY_EXT = ".zdict"
+#map xpra compression levels (1 to 10) to zstd levels:
+ZSTD_LEVELS = (1, 1, 1, 2, 3, 3, 5, 7, 9, 12, 19)
+
+zstd_version = None
+python_zstd_version = None
+#dictionaries we have loaded, indexed by packet type:
+zstd_dictionaries = {}
+#same dictionaries, indexed by their id:
+zstd_dictionaries_by_id = {}
+try:
+    import zstandard
+    has_zstd = True
+    python_zstd_version = zstandard.__version__
+    try:
+        zstd_version = ".".join(str(x) for x in zstandard.ZSTD_VERSION)
+    except:
+        pass
+    #compressors are not thread safe, so we cache them per thread:
+    _zstd_state = local()
+    def _get_zstd_compressor(level, dictionary=None):
+        cache = getattr(_zstd_state, "compressors", None)
+        if cache is None:
+            cache = _zstd_state.compressors = {}
+        key = level, dictionary
+        c = cache.get(key)
+        if c is None:
+            c = zstandard.ZstdCompressor(level=ZSTD_LEVELS[max(0, min(10, level))], dict_data=dictionary, write_content_size=True)
+            cache[key] = c
+        return c
+    def zstd_compress(packet, level, dictionary=None):
+        return (level & 0xF) | ZSTD_FLAG, _get_zstd_compressor(level, dictionary).compress(packet)
+    def ZSTD_decompress(data):
+        params = zstandard.get_frame_parameters(data)
+        assert 0<=params.content_size<=(256*1024*1024), "invalid zstd content size: %s" % params.content_size
+        #the frame header tells us which dictionary was used, if any:
+        dict_id = params.dict_id
+        dictionary = None
+        if dict_id:
+            dictionary = zstd_dictionaries_by_id.get(dict_id)
+            if dictionary is None:
+                raise InvalidCompressionException("unknown zstd dictionary %#x" % dict_id)
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+    def load_zstd_dictionaries(dirname=ZSTD_DICTIONARY_DIR):
+        if not dirname or not os.path.exists(dirname):
+            return
+        for filename in sorted(os.listdir(dirname)):
+            if not filename.endswith(ZSTD_DICTIONARY_EXT):
+                continue
+            packet_type = filename[:-len(ZSTD_DICTIONARY_EXT)]
+            try:
+                with open(os.path.join(dirname, filename), "rb") as f:
+                    d = zstandard.ZstdCompressionDict(f.read())
+                dict_id = d.dict_id()
+                assert dict_id, "not a trained dictionary"
+                zstd_dictionaries[packet_type] = d
+                zstd_dictionaries_by_id[dict_id] = d
+                log("loaded zstd dictionary %#x for '%s' packets", dict_id, packet_type)
+            except Exception as e:
+                log.warn("Warning: failed to load zstd dictionary '%s':", filename)
+                log.warn(" %s", e)
+
+    def train_zstd_dictionary(samples, dict_size=4096):
+        """ trains a dictionary from a list of sample packets, returns the raw dictionary data """
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+    load_zstd_dictionaries()
+except Exception as e:
+    log("zstd not found: %s", e)
+    ZSTD_decompress = None
+    has_zstd = False
+    def zstd_compress(packet, level, dictionary=None):
+        raise Exception("zstd is not supported!")
+
+
 #stupid python version breakage:
 if sys.version > '3':
     def zcompress(packet, level):
@@ -100,18 +181,20 @@ else:
 use_zlib = True
 use_lzo = has_lzo
 use_lz4 = has_lz4
+use_zstd = has_zstd
 
 #all the compressors we know about, in best compatibility order:
-ALL_COMPRESSORS = ["zlib", "lz4", "lzo"]
+ALL_COMPRESSORS = ["zlib", "lz4", "lzo", "zstd"]
 
 #order for performance:
-PERFORMANCE_ORDER = ["lz4", "lzo", "zlib"]
+PERFORMANCE_ORDER = ["lz4", "zstd", "lzo", "zlib"]
 
 
 _COMPRESSORS = {
         "zlib"  : zcompress,
         "lz4"   : lz4_compress,
         "lzo"   : lzo_compress,
+        "zstd"  : zstd_compress,
         "none"  : nocompress,
                }
 
@@ -137,10 +220,21 @@ def get_compression_caps():
              ""             : use_zlib,
              "version"      : zlib.__version__
              }
+    _zstd = {"" : use_zstd}
+    if zstd_version:
+        _zstd["version"] = zstd_version
+    if use_zstd and zstd_dictionaries_by_id:
+        _zstd["dictionaries"] = sorted(zstd_dictionaries_by_id.keys())
+    if python_zstd_version:
+        caps["python-zstd"] = {
+                               ""           : True,
+                               "version"    : python_zstd_version,
+                               }
     caps.update({
                  "lz4"                   : _lz4,
                  "lzo"                   : _lzo,
                  "zlib"                  : _zlib,
+                 "zstd"                  : _zstd,
                  })
     return caps
 
@@ -149,6 +243,7 @@ def get_enabled_compressors(order=ALL_COMPRESSORS):
             "lz4"                   : use_lz4,
             "lzo"                   : use_lzo,
             "zlib"                  : use_zlib,
+            "zstd"                  : use_zstd,
             }.items() if b]
     #order them:
     return [x for x in order if x in enabled]
@@ -157,6 +252,12 @@ def get_compressor(c):
     assert c=="none" or c in ALL_COMPRESSORS
     return _COMPRESSORS[c]
 
+def get_zstd_dictionaries(dict_ids):
+    """ returns the dictionaries we can use with a peer which has the given dictionary ids """
+    if not use_zstd:
+        return {}
+    return dict((packet_type, d) for packet_type, d in zstd_dictionaries.items() if d.dict_id() in dict_ids)
+
 def get_compressor_name(c):
     assert c in _COMPRESSORS.values(), "invalid compressor: %s" % c
     for k,v in _COMPRESSORS.items():
@@ -206,10 +307,14 @@ class Uncompressed(object):
     def compress(self):
         raise Exception("compress() not defined on %s" % self)
 
-def compressed_wrapper(datatype, data, level=5, zlib=False, lz4=False, lzo=False, can_inline=True):
+def compressed_wrapper(datatype, data, level=5, zlib=False, lz4=False, lzo=False, zstd=False, can_inline=True):
     if _memoryview and isinstance(data, _memoryview):
         data = data.tobytes()
-    if lz4:
+    if zstd:
+        assert use_zstd, "cannot use zstd"
+        algo = "zstd"
+        cl, cdata = zstd_compress(data, level)
+    elif lz4:
         assert use_lz4, "cannot use lz4"
         algo = "lz4"
         cl, cdata = lz4_compress(data, level)
@@ -229,7 +334,9 @@ class InvalidCompressionException(Exception):
 
 
 def get_compression_type(level):
-    if level & LZ4_FLAG:
+    if level & ZSTD_FLAG:
+        return "zstd"
+    elif level & LZ4_FLAG:
         return "lz4"
     elif level & LZO_FLAG:
         return "lzo"
@@ -240,7 +347,13 @@ import struct
 LZ4_HEADER = struct.Struct('<L')
 def decompress(data, level):
     #log.info("decompress(%s bytes, %s) type=%s", len(data), get_compression_type(level))
-    if level & LZ4_FLAG:
+    if level & ZSTD_FLAG:
+        if not has_zstd:
+            raise InvalidCompressionException("zstd is not available")
+        if not use_zstd:
+            raise InvalidCompressionException("zstd is not enabled")
+        return ZSTD_decompress(data)
+    elif level & LZ4_FLAG:
         if not has_lz4:
             raise InvalidCompressionException("lz4 is not available")
         if not use_lz4:
@@ -265,6 +378,7 @@ NAME_TO_FLAG = {
                 "lz4"   : LZ4_FLAG,
                 "zlib"  : 0,
                 "lzo"   : LZO_FLAG,
+                "zstd"  : ZSTD_FLAG,
                 }
 
 def decompress_by_name(data, algo):
@@ -0,0 +1,199 @@
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("network", "compress")
+
+from xpra.net import compression
+
+
+ADAPTIVE_COMPRESSION = os.environ.get("XPRA_ADAPTIVE_COMPRESSION", "1")=="1"
+#try a different compressor once every N packets:
+EXPLORE_INTERVAL = max(2, int(os.environ.get("XPRA_COMPRESSION_EXPLORE_INTERVAL", "32")))
+#how much we care about the time spent compressing,
+#relative to the time it takes to transfer the data:
+CPU_WEIGHT = float(os.environ.get("XPRA_COMPRESSION_CPU_WEIGHT", "1.0"))
+#in bytes per second, used until we have measured the link:
+DEFAULT_BANDWIDTH = int(os.environ.get("XPRA_COMPRESSION_DEFAULT_BANDWIDTH", 10*1024*1024))
+#weight given to new samples:
+SAMPLE_WEIGHT = 0.25
+
+#compressor and level:
+CANDIDATES = [("none", 0), ("lz4", 1), ("lzo", 1), ("zstd", 1), ("zlib", 1), ("zlib", 3), ("zlib", 6)]
+
+
+def candidate_name(compressor, level):
+    if compressor=="none":
+        return "none"
+    return "%s-%i" % (compressor, level)
+
+
+class CompressionStats(object):
+    """
+        Running averages for one compressor and level,
+        for one type of data.
+    """
+
+    def __init__(self):
+        self.samples = 0
+        self.ratio = 1.0
+        self.speed = 0
+
+    def record(self, insize, outsize, elapsed):
+        ratio = float(outsize)/max(1, insize)
+        speed = insize/max(0.000001, elapsed)
+        if self.samples==0:
+            self.ratio = ratio
+            self.speed = speed
+        else:
+            self.ratio += (ratio-self.ratio)*SAMPLE_WEIGHT
+            self.speed += (speed-self.speed)*SAMPLE_WEIGHT
+        self.samples += 1
+
+    def get_info(self):
+        return {
+                "samples"   : self.samples,
+                "ratio"     : int(self.ratio*100),
+                "speed"     : int(self.speed/1024),
+                }
+
+
+class CompressionChooser(object):
+    """
+        Picks the compressor and level to use for each type of data
+        (packet type or pixel encoding),
+        by sampling the compression ratio and speed of all the candidates
+        and comparing the time it would take to compress and send the data
+        over the link, using the bandwidth measured from the packet acks.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.compressors = ["none"]
+        self.stats = {}
+        self.selected = {}
+        self.counts = {}
+        self.bandwidth_limit = 0
+        self.bandwidth_estimate = None
+
+    def __repr__(self):
+        return "CompressionChooser(%s)" % self.compressors
+
+    def set_compressors(self, compressors):
+        """ the compressors we can use (both ends must support them) """
+        self.compressors = ["none"]+[x for x in compressors if x!="none"]
+        log("CompressionChooser.set_compressors(%s) candidates=%s", compressors, self.get_candidates())
+
+    def set_bandwidth_limit(self, bandwidth_limit):
+        """ in bytes per second, overrides the value measured """
+        self.bandwidth_limit = bandwidth_limit
+
+    def set_bandwidth_estimate(self, bandwidth_estimate):
+        """
+            A callable returning the bandwidth measured from the packet acks,
+            in bits per second, or 0 until it has been measured.
+            (the time spent writing to the socket tells us nothing about the link)
+        """
+        self.bandwidth_estimate = bandwidth_estimate
+
+    def get_bandwidth(self):
+        """ in bytes per second """
+        if self.bandwidth_limit>0:
+            return self.bandwidth_limit
+        be = self.bandwidth_estimate
+        if be:
+            estimate = be()
+            if estimate>0:
+                return estimate//8
+        return DEFAULT_BANDWIDTH
+
+    def get_candidates(self, allowed=None, max_level=9):
+        compressors = self.compressors
+        if allowed is not None:
+            #ie: pixel compressors negotiated separately
+            compressors = ["none"]+list(allowed)
+        return [(c, l) for c, l in CANDIDATES if c in compressors and l<=max_level]
+
+
+    def choose(self, key, size, allowed=None, max_level=9):
+        """
+            Returns the compressor and level to use for the data identified by key.
+            Candidates we have not measured yet are tried first,
+            then we try a different candidate every EXPLORE_INTERVAL,
+            and otherwise use the one with the lowest estimated cost.
+        """
+        candidates = self.get_candidates(allowed, max_level)
+        if len(candidates)<=1:
+            return candidates[0]
+        with self.lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count+1
+            kstats = self.stats.setdefault(key, {})
+            for c in candidates:
+                s = kstats.get(c)
+                if s is None or s.samples==0:
+                    return c
+            if count%EXPLORE_INTERVAL==0:
+                #pick the candidate with the oldest data (round robin):
+                return candidates[(count//EXPLORE_INTERVAL)%len(candidates)]
+            bandwidth = max(1, self.get_bandwidth())
+            def cost(c):
+                s = kstats[c]
+                t = size*s.ratio/bandwidth
+                if c[0]!="none":
+                    t += CPU_WEIGHT*size/max(1, s.speed)
+                return t
+            best = sorted(candidates, key=cost)[0]
+            self.selected[key] = best
+            return best
+
+    def record(self, key, compressor, level, insize, outsize, elapsed):
+        with self.lock:
+            kstats = self.stats.setdefault(key, {})
+            s = kstats.get((compressor, level))
+            if s is None:
+                s = kstats[(compressor, level)] = CompressionStats()
+            s.record(insize, outsize, elapsed)
+
+    def compress(self, key, data, max_level=9):
+        """
+            Compress the data using the best network compressor for this key,
+            returns the compression level with the compressor flags and the data.
+        """
+        compressor, level = self.choose(key, len(data), None, max_level)
+        if compressor=="none":
+            self.record(key, compressor, level, len(data), len(data), 0)
+            return 0, data
+        start = time.time()
+        cl, cdata = compression.get_compressor(compressor)(data, level)
+        self.record(key, compressor, level, len(data), len(cdata), time.time()-start)
+        if len(cdata)>=len(data):
+            return 0, data
+        return cl, cdata
+
+
+    def get_info(self):
+        info = {
+                "enabled"   : ADAPTIVE_COMPRESSION,
+                "bandwidth" : int(self.get_bandwidth()),
+                "candidates": [candidate_name(*x) for x in self.get_candidates()],
+                }
+        if self.bandwidth_limit>0:
+            info["bandwidth-limit"] = self.bandwidth_limit
+        tinfo = {}
+        with self.lock:
+            for key, kstats in self.stats.items():
+                kinfo = dict((candidate_name(*c), s.get_info()) for c, s in kstats.items())
+                kinfo["count"] = self.counts.get(key, 0)
+                sel = self.selected.get(key)
+                if sel:
+                    kinfo["selected"] = candidate_name(*sel)
+                tinfo[key] = kinfo
+        info["type"] = tinfo
+        return info
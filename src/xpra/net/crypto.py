@@ -5,6 +5,8 @@
 # later version. See the file COPYING for details.
 
 import os
+
+from xpra.os_util import strtobytes, _memoryview
 from xpra.log import Logger
 log = Logger("network", "crypto")
 
@@ -30,6 +32,35 @@ PADDING_OPTIONS = [PREFERRED_PADDING]
 for x in ALL_PADDING_OPTIONS:
     if x not in PADDING_OPTIONS:
         PADDING_OPTIONS.append(x)
+
+#cipher modes:
+MODE_CBC = "CBC"
+MODE_GCM = "GCM"
+ALL_MODE_OPTIONS = (MODE_CBC, MODE_GCM)
+#authenticated modes, which don't use any padding:
+AEAD_MODES = (MODE_GCM, )
+#the mode used for the first packet, and with peers that do not specify one:
+INITIAL_MODE = os.environ.get("XPRA_CRYPTO_INITIAL_MODE", MODE_CBC)
+DEFAULT_MODE = MODE_CBC
+PREFERRED_MODE = os.environ.get("XPRA_CRYPTO_PREFERRED_MODE", MODE_GCM)
+assert PREFERRED_MODE in ALL_MODE_OPTIONS, "invalid preferred mode: %s" % PREFERRED_MODE
+assert INITIAL_MODE in ALL_MODE_OPTIONS, "invalid mode: %s" % INITIAL_MODE
+#the modes supported by the backend, preferred one first (populated by crypto_backend_init):
+MODE_OPTIONS = []
+#authenticated modes encrypt the packets in chunks of this size,
+#each one with its own nonce and tag (this is part of the wire format):
+AEAD_CHUNK_SIZE = 256*1024
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+#number of threads used for encrypting and decrypting the chunks of large packets:
+def get_default_crypto_threads():
+    try:
+        from multiprocessing import cpu_count
+        return min(4, cpu_count()-1)
+    except:
+        return 0
+CRYPTO_THREADS = max(0, int(os.environ.get("XPRA_CRYPTO_THREADS", get_default_crypto_threads())))
+
 CRYPTO_LIBRARY = os.environ.get("XPRA_CRYPTO_BACKEND", "python-cryptography")    #pycrypto
 
 
@@ -60,7 +91,11 @@ def crypto_backend_init():
 
             #validate it:
             validate_backend(try_backend)
-            ENCRYPTION_CIPHERS[:] = try_backend.ENCRYPTION_CIPHERS[:]
+            modes = getattr(try_backend, "MODES", [MODE_CBC])
+            MODE_OPTIONS[:] = [x for x in [PREFERRED_MODE]+list(ALL_MODE_OPTIONS) if x in modes]
+            MODE_OPTIONS[:] = [x for i,x in enumerate(MODE_OPTIONS) if x not in MODE_OPTIONS[:i]]
+            #"AES" negotiates the mode, "AES-GCM" requires it:
+            ENCRYPTION_CIPHERS[:] = try_backend.ENCRYPTION_CIPHERS[:] + ["%s-%s" % (c, m) for c in try_backend.ENCRYPTION_CIPHERS for m in MODE_OPTIONS]
             backend = try_backend
             break
         except ImportError as e:
@@ -105,14 +140,20 @@ def validate_backend(try_backend):
     dv = dec.decrypt(ev)
     log("validate_backend(%s) decrypted(%s)=%s", try_backend, evs, dv)
     assert dv==message
+    if MODE_GCM in getattr(try_backend, "MODES", []):
+        nonce = b"0"*AEAD_NONCE_SIZE
+        ev = try_backend.get_aead(key).encrypt(nonce, message)
+        assert len(ev)==len(message)+AEAD_TAG_SIZE
+        dv = try_backend.get_aead(key).decrypt(nonce, ev)
+        assert dv==message
     log("validate_backend(%s) passed", try_backend)
 
 
 def pad(padding, size):
     if padding==PADDING_LEGACY:
-        return " "*size
+        return strtobytes(" "*size)
     elif padding==PADDING_PKCS7:
-        return chr(size)*size
+        return strtobytes(chr(size)*size)
     else:
         raise Exception("invalid padding: %s" % padding)
 
@@ -123,6 +164,95 @@ def choose_padding(options):
     raise Exception("cannot find a valid padding in %s" % str(options))
 
 
+def get_cipher_modes(ciphername):
+    """ the modes we can use with this cipher: 'AES-GCM' only allows GCM """
+    parts = (ciphername or "").split("-", 1)
+    if len(parts)==2:
+        return [parts[1]]
+    return MODE_OPTIONS
+
+def choose_mode(options, ciphername="AES"):
+    for x in MODE_OPTIONS:
+        if x in options and x in get_cipher_modes(ciphername):
+            return x
+    raise Exception("cannot find a valid cipher mode for %s in %s" % (ciphername, str(options)))
+
+
+class AEADCipher(object):
+    """
+        Encrypts or decrypts each packet as a sequence of chunks,
+        each chunk is authenticated with its own tag.
+        The nonces are derived from the iv and a counter incremented for every chunk,
+        both ends process the chunks in the same order so the nonces are never sent,
+        and never re-used.
+        Since the chunks are independent, those of large packets
+        can be processed in parallel.
+    """
+
+    def __init__(self, aead, iv, pool=None):
+        self.aead = aead
+        iv = bytearray(strtobytes(iv))
+        assert len(iv)>=AEAD_NONCE_SIZE, "iv is too short: %i bytes" % len(iv)
+        self.iv = iv[:AEAD_NONCE_SIZE]
+        self.counter = 0
+        self.pool = pool
+
+    def __repr__(self):
+        return "AEADCipher(%s)" % self.aead
+
+    def get_nonces(self, n):
+        """ the nonces for the next n chunks: the counter xor-ed into the last 8 bytes of the iv """
+        nonces = []
+        for i in range(n):
+            c = self.counter+i
+            nonce = bytearray(self.iv)
+            for j in range(8):
+                nonce[AEAD_NONCE_SIZE-1-j] ^= (c>>(j*8)) & 0xff
+            nonces.append(bytes(nonce))
+        self.counter += n
+        return nonces
+
+    def process(self, fn, data, size):
+        """ returns the list of processed chunks """
+        l = len(data)
+        n = max(1, (l+size-1)//size)
+        nonces = self.get_nonces(n)
+        if n==1:
+            return [fn(nonces[0], data)]
+        mv = _memoryview(data)
+        items = [(nonces[i], mv[i*size:(i+1)*size]) for i in range(n)]
+        pool = self.pool
+        if pool:
+            return pool.map(lambda x : fn(*x), items)
+        return [fn(*x) for x in items]
+
+    def encrypt(self, data):
+        return b"".join(self.encrypt_chunks(data))
+
+    def encrypt_chunks(self, data):
+        """ the encrypted chunks can be written out without joining them """
+        return self.process(self.encrypt_chunk, data, AEAD_CHUNK_SIZE)
+
+    def encrypt_chunk(self, nonce, data):
+        return self.aead.encrypt(nonce, data)
+
+    def decrypt(self, data):
+        """ raises an exception if any of the chunks fails authentication """
+        return b"".join(self.process(self.decrypt_chunk, data, AEAD_CHUNK_SIZE+AEAD_TAG_SIZE))
+
+    def decrypt_chunk(self, nonce, data):
+        return self.aead.decrypt(nonce, data)
+
+
+_crypto_pool = None
+def get_crypto_pool():
+    global _crypto_pool
+    if _crypto_pool is None and CRYPTO_THREADS>0:
+        from xpra.thread_pool import ThreadPool
+        _crypto_pool = ThreadPool("crypto", CRYPTO_THREADS)
+    return _crypto_pool
+
+
 def get_hex_uuid():
     from xpra.os_util import get_hex_uuid as ghu
     return ghu()
@@ -141,13 +271,14 @@ def get_iterations():
     return DEFAULT_ITERATIONS
 
 
-def new_cipher_caps(proto, cipher, encryption_key, padding_options):
+def new_cipher_caps(proto, cipher, encryption_key, padding_options, mode_options=(DEFAULT_MODE,)):
     assert backend
     iv = get_iv()
     key_salt = get_salt()
     iterations = get_iterations()
     padding = choose_padding(padding_options)
-    proto.set_cipher_in(cipher, iv, encryption_key, key_salt, iterations, padding)
+    mode = choose_mode(mode_options, cipher)
+    proto.set_cipher_in(cipher, iv, encryption_key, key_salt, iterations, padding, mode)
     return {
          "cipher"                       : cipher,
          "cipher.iv"                    : iv,
@@ -155,6 +286,8 @@ def new_cipher_caps(proto, cipher, encryption_key, padding_options):
          "cipher.key_stretch_iterations": iterations,
          "cipher.padding"               : padding,
          "cipher.padding.options"       : PADDING_OPTIONS,
+         "cipher.mode"                  : mode,
+         "cipher.mode.options"          : get_cipher_modes(cipher),
          }
 
 def get_crypto_caps():
@@ -162,31 +295,39 @@ def get_crypto_caps():
         return {}
     caps = {
             "padding"       : {"options"    : PADDING_OPTIONS},
+            "mode"          : {"options"    : MODE_OPTIONS},
+            "threads"       : CRYPTO_THREADS,
             }
     caps.update(backend.get_info())
     return caps
 
 
-def get_encryptor(ciphername, iv, password, key_salt, iterations):
-    log("get_encryptor(%s, %s, %s, %s, %s)", ciphername, iv, password, key_salt, iterations)
+def get_encryptor(ciphername, iv, password, key_salt, iterations, mode=DEFAULT_MODE):
+    log("get_encryptor(%s, %s, %s, %s, %s, %s)", ciphername, iv, password, key_salt, iterations, mode)
     if not ciphername:
         return None, 0
     assert iterations>=100
-    assert ciphername=="AES"
+    assert ciphername.split("-")[0]=="AES"
     assert password and iv
     block_size = DEFAULT_BLOCKSIZE
     key = backend.get_key(password, key_salt, block_size, iterations)
+    if mode in AEAD_MODES:
+        return AEADCipher(backend.get_aead(key), iv, get_crypto_pool()), block_size
+    assert mode==MODE_CBC, "invalid cipher mode: %s" % mode
     return backend.get_encryptor(key, iv), block_size
 
-def get_decryptor(ciphername, iv, password, key_salt, iterations):
-    log("get_encryptor(%s, %s, %s, %s, %s)", ciphername, iv, password, key_salt, iterations)
+def get_decryptor(ciphername, iv, password, key_salt, iterations, mode=DEFAULT_MODE):
+    log("get_decryptor(%s, %s, %s, %s, %s, %s)", ciphername, iv, password, key_salt, iterations, mode)
     if not ciphername:
         return None, 0
     assert iterations>=100
-    assert ciphername=="AES"
+    assert ciphername.split("-")[0]=="AES"
     assert password and iv
     block_size = DEFAULT_BLOCKSIZE
     key = backend.get_key(password, key_salt, block_size, iterations)
+    if mode in AEAD_MODES:
+        return AEADCipher(backend.get_aead(key), iv, get_crypto_pool()), block_size
+    assert mode==MODE_CBC, "invalid cipher mode: %s" % mode
     return backend.get_decryptor(key, iv), block_size
 
 
@@ -5,15 +5,151 @@
 # later version. See the file COPYING for details.
 
 import os
+import time
+import hashlib
 
 from xpra.log import Logger
 printlog = Logger("printing")
 filelog = Logger("file")
 
 from xpra.child_reaper import getChildReaper
+from xpra.os_util import strtobytes, bytestostr, load_binary_file
 from xpra.util import typedict, csv
 
 DELETE_PRINTER_FILE = os.environ.get("XPRA_DELETE_PRINTER_FILE", "1")=="1"
+#files are sent in chunks of this size, 0 to send them in a single packet:
+FILE_CHUNK_SIZE = int(os.environ.get("XPRA_FILE_CHUNK_SIZE", "65536"))
+#how many chunks can be sent without being acknowledged:
+FILE_CHUNK_WINDOW = max(1, int(os.environ.get("XPRA_FILE_CHUNK_WINDOW", "8")))
+#transfers are cancelled when the other end does not respond for this long (in seconds):
+FILE_CHUNK_TIMEOUT = int(os.environ.get("XPRA_FILE_CHUNK_TIMEOUT", "30"))
+#partial files left by the transfers interrupted by a disconnection
+#can be resumed for this long (in seconds):
+FILE_PART_MAX_AGE = int(os.environ.get("XPRA_FILE_PART_MAX_AGE", "3600"))
+DIGEST_BLOCK_SIZE = 1024*1024
+
+EXTS = {"application/postscript"    : "ps",
+        "application/pdf"           : "pdf",
+        "raw"                       : "raw",
+        }
+
+
+def file_digest(filename, data=None):
+    """ the sha1 hex digest of the data, or of the file if the data is None """
+    u = hashlib.sha1()
+    if data is not None:
+        u.update(data)
+        return u.hexdigest()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(DIGEST_BLOCK_SIZE)
+            if not block:
+                break
+            u.update(block)
+    return u.hexdigest()
+
+def valid_chunk_id(chunk_id):
+    return len(chunk_id)==40 and all(c in "0123456789abcdef" for c in chunk_id)
+
+
+class ChunkedTransfer(object):
+    """ the state common to the sending and receiving ends of a chunked file transfer """
+
+    def __init__(self, chunk_id, basefilename, filesize, chunk_size, printit):
+        self.chunk_id = chunk_id
+        self.basefilename = basefilename
+        self.filesize = filesize
+        self.chunk_size = chunk_size
+        self.printit = printit
+        self.nchunks = max(1, (filesize+chunk_size-1)//chunk_size)
+        self.start = time.time()
+        self.last_activity = self.start
+        self.timer = None
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, self.basefilename)
+
+    def get_info(self):
+        return {
+                "file"      : self.basefilename,
+                "size"      : self.filesize,
+                "elapsed"   : int(time.time()-self.start),
+                }
+
+
+class FileSendState(ChunkedTransfer):
+    """
+        A file we are sending one chunk at a time,
+        either from memory or from disk when 'data' is None.
+    """
+
+    def __init__(self, chunk_id, filename, basefilename, data, filesize, chunk_size, printit, maxbitrate=0):
+        ChunkedTransfer.__init__(self, chunk_id, basefilename, filesize, chunk_size, printit)
+        self.filename = filename
+        self.data = data
+        self.maxbitrate = maxbitrate
+        self.file = None
+        self.next_chunk = 0                 #the next chunk we send
+        self.acked = -1                     #chunks acknowledged, -1 until the receiver has accepted the transfer
+        self.sent_bytes = 0
+        self.rate_timer = None
+
+    def read_chunk(self, chunk_no):
+        offset = chunk_no*self.chunk_size
+        if self.data is not None:
+            return self.data[offset:offset+self.chunk_size]
+        if self.file is None:
+            self.file = open(self.filename, "rb")
+        self.file.seek(offset)
+        return self.file.read(self.chunk_size)
+
+    def close(self):
+        f = self.file
+        if f:
+            self.file = None
+            f.close()
+
+    def get_info(self):
+        info = ChunkedTransfer.get_info(self)
+        info["sent"] = min(self.filesize, self.next_chunk*self.chunk_size)
+        info["acked"] = min(self.filesize, max(0, self.acked)*self.chunk_size)
+        if self.maxbitrate>0:
+            info["max-bitrate"] = self.maxbitrate
+        return info
+
+
+class FileReceiveState(ChunkedTransfer):
+    """
+        A file we are receiving one chunk at a time:
+        each chunk is written to the partial file as soon as it arrives,
+        the partial file is kept when the transfer is interrupted so that it can be resumed.
+    """
+
+    def __init__(self, chunk_id, basefilename, mimetype, printit, openit, filesize, chunk_size, options, partname, send):
+        ChunkedTransfer.__init__(self, chunk_id, basefilename, filesize, chunk_size, printit)
+        self.mimetype = mimetype
+        self.openit = openit
+        self.options = options
+        self.partname = partname
+        self.send = send
+        self.digest = hashlib.sha1()
+        self.fd = None
+        self.written = 0
+        self.resumed = 0
+        self.next_chunk = 0                 #the next chunk we expect
+
+    def close(self):
+        fd = self.fd
+        if fd is not None:
+            self.fd = None
+            os.close(fd)
+
+    def get_info(self):
+        info = ChunkedTransfer.get_info(self)
+        info["received"] = self.written
+        if self.resumed:
+            info["resumed"] = self.resumed
+        return info
 
 
 class FileTransferHandler(object):
@@ -27,6 +163,10 @@ class FileTransferHandler(object):
         self.printing = False
         self.open_files = False
         self.open_command = None
+        #the chunk size the other end accepts, 0 if it does not support chunks:
+        self.remote_file_chunks = 0
+        self.send_chunks_in_progress = {}
+        self.receive_chunks_in_progress = {}
 
     def init(self, opts):
         #printing and file transfer:
@@ -36,11 +176,19 @@ class FileTransferHandler(object):
         self.open_command = opts.open_command
         self.open_files = opts.open_files
 
+    def cleanup_file_transfers(self):
+        for transfers in (self.send_chunks_in_progress, self.receive_chunks_in_progress):
+            for chunk_id in list(transfers.keys()):
+                state = transfers.pop(chunk_id, None)
+                if state:
+                    self._end_chunked_transfer(state)
+
 
     def get_file_transfer_features(self):
         return {
                  "file-transfer"                : self.file_transfer,
                  "file-size-limit"              : self.file_size_limit,
+                 "file-chunks"                  : FILE_CHUNK_SIZE,
                  "open-files"                   : self.open_files,
                  "printing"                     : self.printing,
                  }
@@ -48,16 +196,21 @@ class FileTransferHandler(object):
     def get_file_transfer_info(self):
         #slightly different from above... for legacy reasons
         #this one is used in a proper "file." namespace from server_base.py
-        return {
+        info = {
                  "transfer"                     : self.file_transfer,
                  "size-limit"                   : self.file_size_limit,
                  "open"                         : self.open_files,
+                 "chunk-size"                   : FILE_CHUNK_SIZE,
                  }
+        for name, transfers in (("sending", self.send_chunks_in_progress), ("receiving", self.receive_chunks_in_progress)):
+            states = list(transfers.values())
+            if states:
+                info[name] = dict((i, state.get_info()) for i, state in enumerate(states))
+        return info
 
 
-    def _process_send_file(self, packet):
+    def _process_send_file(self, packet, send=None):
         #send-file basefilename, printit, openit, filesize, 0, data)
-        from xpra.platform.paths import get_download_dir
         basefilename, mimetype, printit, openit, filesize, file_data, options = packet[1:11]
         options = typedict(options)
         if printit:
@@ -68,38 +221,55 @@ class FileTransferHandler(object):
             assert self.file_transfer
         l("received file: %s", [basefilename, mimetype, printit, openit, filesize, "%s bytes" % len(file_data), options])
         assert filesize>0, "invalid file size: %s" % filesize
+        chunk_id = options.strget("file-chunk-id")
+        if filesize>self.file_size_limit*1024*1024:
+            l.error("Error: file '%s' is too large:", basefilename)
+            l.error(" %iMB, the file size limit is %iMB", filesize//1024//1024, self.file_size_limit)
+            if chunk_id:
+                (send or self.send)("ack-file-chunk", chunk_id, False, "file is too large", 0)
+            return
+        if chunk_id:
+            self._accept_file_chunks(chunk_id, basefilename, mimetype, printit, openit, filesize, options, send or self.send)
+            return
         assert file_data, "no data!"
         if len(file_data)!=filesize:
             l.error("Error: invalid data size for file '%s'", basefilename)
             l.error(" received %i bytes, expected %i bytes", len(file_data), filesize)
             return
-        if filesize>self.file_size_limit*1024*1024:
-            l.error("Error: file '%s' is too large:", basefilename)
-            l.error(" %iMB, the file size limit is %iMB", filesize//1024//1024, self.file_size_limit)
-            return
         #check digest if present:
-        import hashlib
         def check_digest(algo="sha1", libfn=hashlib.sha1):
             digest = options.get(algo)
             if not digest:
-                return
+                return True
             u = libfn()
             u.update(file_data)
             l("%s digest: %s - expected: %s", algo, u.hexdigest(), digest)
             if digest!=u.hexdigest():
                 l.error("Error: data does not match, invalid %s file digest for %s", algo, basefilename)
                 l.error(" received %s, expected %s", u.hexdigest(), digest)
-                return
-        check_digest("sha1", hashlib.sha1)
-        check_digest("md5", hashlib.md5)
+                return False
+            return True
+        if not check_digest("sha1", hashlib.sha1) or not check_digest("md5", hashlib.md5):
+            return
+        filename = self._get_download_filename(basefilename, mimetype, printit)
+        flags = os.O_CREAT | os.O_RDWR | os.O_EXCL
+        try:
+            flags |= os.O_BINARY                #@UndefinedVariable (win32 only)
+        except:
+            pass
+        fd = os.open(filename, flags)
+        try:
+            os.write(fd, file_data)
+        finally:
+            os.close(fd)
+        self._file_received(filename, mimetype, printit, openit, filesize, options)
 
+    def _get_download_filename(self, basefilename, mimetype, printit):
+        from xpra.platform.paths import get_download_dir
+        l = printlog if printit else filelog
         #make sure we use a filename that does not exist already:
         dd = os.path.expanduser(get_download_dir())
         wanted_filename = os.path.abspath(os.path.join(dd, os.path.basename(basefilename)))
-        EXTS = {"application/postscript"    : "ps",
-                "application/pdf"           : "pdf",
-                "raw"                       : "raw",
-                }
         ext = EXTS.get(mimetype)
         if ext:
             #on some platforms (win32),
@@ -114,16 +284,10 @@ class FileTransferHandler(object):
             root, ext = os.path.splitext(wanted_filename)
             base += 1
             filename = root+("-%s" % base)+ext
-        flags = os.O_CREAT | os.O_RDWR | os.O_EXCL
-        try:
-            flags |= os.O_BINARY                #@UndefinedVariable (win32 only)
-        except:
-            pass
-        fd = os.open(filename, flags)
-        try:
-            os.write(fd, file_data)
-        finally:
-            os.close(fd)
+        return filename
+
+    def _file_received(self, filename, mimetype, printit, openit, filesize, options):
+        l = printlog if printit else filelog
         l.info("downloaded %s bytes to %s file%s:", filesize, (mimetype or "unknown"), ["", " for printing"][int(printit)])
         l.info(" %s", filename)
         if printit:
@@ -140,8 +304,277 @@ class FileTransferHandler(object):
         elif openit:
             self._open_file(filename)
 
+
+    def _accept_file_chunks(self, chunk_id, basefilename, mimetype, printit, openit, filesize, options, send):
+        from xpra.platform.paths import get_download_dir
+        l = printlog if printit else filelog
+        chunk_size = options.intget("file-chunk-size")
+        if not valid_chunk_id(chunk_id) or chunk_size<=0 or not options.strget("sha1"):
+            l.error("Error: invalid chunked transfer request for file '%s'", basefilename)
+            send("ack-file-chunk", chunk_id, False, "invalid request", 0)
+            return
+        old = self.receive_chunks_in_progress.pop(chunk_id, None)
+        if old:
+            #the sender has reconnected, start again from what we have on disk:
+            self._end_chunked_transfer(old)
+        dd = os.path.expanduser(get_download_dir())
+        self._remove_stale_partial_files(dd)
+        partname = os.path.join(dd, ".%s.part" % chunk_id)
+        state = FileReceiveState(chunk_id, basefilename, mimetype, printit, openit, filesize, chunk_size, options, partname, send)
+        flags = os.O_CREAT | os.O_RDWR | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_BINARY", 0)
+        try:
+            state.fd = os.open(partname, flags, 0o600)
+            #resume: re-hash the whole chunks we already have, discard the rest
+            size = os.fstat(state.fd).st_size
+            keep = min(size, filesize)//chunk_size*chunk_size
+            pos = 0
+            while pos<keep:
+                block = os.read(state.fd, min(DIGEST_BLOCK_SIZE, keep-pos))
+                if not block:
+                    break
+                state.digest.update(block)
+                pos += len(block)
+            if pos<size:
+                os.ftruncate(state.fd, pos)
+                os.lseek(state.fd, pos, os.SEEK_SET)
+        except (OSError, IOError) as e:
+            l("failed to open %s", partname, exc_info=True)
+            l.error("Error: cannot save file '%s':", basefilename)
+            l.error(" %s", e)
+            state.close()
+            send("ack-file-chunk", chunk_id, False, "cannot write file", 0)
+            return
+        state.written = state.resumed = pos
+        state.next_chunk = pos//chunk_size
+        if pos:
+            l.info("resuming the transfer of '%s' from %i bytes", basefilename, pos)
+        self.receive_chunks_in_progress[chunk_id] = state
+        self._schedule_chunk_timeout(self.receive_chunks_in_progress, state)
+        send("ack-file-chunk", chunk_id, True, "", state.next_chunk)
+
+    def _process_send_file_chunk(self, packet, send=None):
+        chunk_id, chunk_no, file_data, has_more = packet[1:5]
+        chunk_id = bytestostr(chunk_id)
+        send = send or self.send
+        state = self.receive_chunks_in_progress.get(chunk_id)
+        if not state:
+            filelog.error("Error: cannot find the file transfer for chunk %s", chunk_no)
+            send("ack-file-chunk", chunk_id, False, "unknown transfer", 0)
+            return
+        l = printlog if state.printit else filelog
+        def fail(message, *args):
+            self.receive_chunks_in_progress.pop(chunk_id, None)
+            self._end_chunked_transfer(state)
+            l.error("Error: transfer of file '%s' failed:", state.basefilename)
+            l.error(" "+message, *args)
+            self._remove_partial_file(state)
+            send("ack-file-chunk", chunk_id, False, message % args, 0)
+        if chunk_no!=state.next_chunk:
+            fail("received chunk %i, expected %i", chunk_no, state.next_chunk)
+            return
+        if len(file_data)>state.chunk_size or state.written+len(file_data)>state.filesize:
+            fail("too much data: %i bytes", state.written+len(file_data))
+            return
+        try:
+            os.write(state.fd, file_data)
+        except (OSError, IOError) as e:
+            fail("%s", e)
+            return
+        state.digest.update(file_data)
+        state.written += len(file_data)
+        state.next_chunk += 1
+        state.last_activity = time.time()
+        if has_more:
+            send("ack-file-chunk", chunk_id, True, "", state.next_chunk)
+            return
+        #that was the last chunk:
+        if state.written!=state.filesize:
+            fail("received %i bytes, expected %i bytes", state.written, state.filesize)
+            return
+        digest = state.options.strget("sha1")
+        if state.digest.hexdigest()!=digest:
+            fail("invalid sha1 file digest %s, expected %s", state.digest.hexdigest(), digest)
+            return
+        self.receive_chunks_in_progress.pop(chunk_id, None)
+        self._end_chunked_transfer(state)
+        filename = self._get_download_filename(state.basefilename, state.mimetype, state.printit)
+        try:
+            os.rename(state.partname, filename)
+        except OSError as e:
+            l("failed to rename %s to %s", state.partname, filename, exc_info=True)
+            fail("cannot save file '%s': %s", filename, e)
+            return
+        send("ack-file-chunk", chunk_id, True, "", state.next_chunk)
+        self._file_received(filename, state.mimetype, state.printit, state.openit, state.filesize, state.options)
+
+    def _remove_partial_file(self, state):
+        try:
+            os.unlink(state.partname)
+        except OSError:
+            filelog("failed to remove %s", state.partname, exc_info=True)
+
+    def _remove_stale_partial_files(self, download_dir):
+        """
+            The partial files are kept when the connection is lost,
+            so the transfer can be resumed when the sender reconnects.
+            Remove the ones that have not been resumed in time.
+        """
+        in_progress = set(state.partname for state in self.receive_chunks_in_progress.values())
+        try:
+            filenames = os.listdir(download_dir)
+        except OSError:
+            filelog("cannot list %s", download_dir, exc_info=True)
+            return
+        now = time.time()
+        for x in filenames:
+            if not (x.startswith(".") and x.endswith(".part") and valid_chunk_id(x[1:-5])):
+                continue
+            partname = os.path.join(download_dir, x)
+            if partname in in_progress:
+                continue
+            try:
+                if now-os.path.getmtime(partname)>FILE_PART_MAX_AGE:
+                    filelog("removing stale partial file %s", partname)
+                    os.unlink(partname)
+            except OSError:
+                filelog("failed to remove %s", partname, exc_info=True)
+
+
+    def do_send_file(self, filename, mimetype, data, filesize, printit, openit, options={}, maxbitrate=0):
+        """
+            Sends the file in chunks if the other end supports it,
+            with 'data' set to None the chunks are read from disk as they are sent.
+            The 'maxbitrate' is in bits per second, 0 for unlimited.
+        """
+        l = printlog if printit else filelog
+        basefilename = os.path.basename(filename)
+        options = dict(options or {})
+        try:
+            options["sha1"] = file_digest(filename, data)
+        except (OSError, IOError) as e:
+            l.error("Error: cannot read file '%s':", filename)
+            l.error(" %s", e)
+            return False
+        chunk_size = min(FILE_CHUNK_SIZE, self.remote_file_chunks)
+        if chunk_size<=0:
+            #the other end does not support chunks, send it all in one packet:
+            if data is None:
+                data = load_binary_file(filename)
+            cdata = self.compressed_wrapper("file-data", data)
+            self.send("send-file", basefilename, mimetype, printit, openit, filesize, cdata, options)
+            return True
+        #the same file sent again (ie: after a reconnection) gets the same id,
+        #so the receiver can resume the transfer:
+        chunk_id = hashlib.sha1(strtobytes("%s:%s:%i:%s" % (basefilename, options["sha1"], filesize, printit))).hexdigest()
+        if chunk_id in self.send_chunks_in_progress:
+            l.warn("Warning: the file '%s' is already being sent", basefilename)
+            return False
+        options["file-chunk-id"] = chunk_id
+        options["file-chunk-size"] = chunk_size
+        state = FileSendState(chunk_id, filename, basefilename, data, filesize, chunk_size, printit, maxbitrate)
+        l("do_send_file: %s in %i chunks of %i bytes", state, state.nchunks, chunk_size)
+        self.send_chunks_in_progress[chunk_id] = state
+        self._schedule_chunk_timeout(self.send_chunks_in_progress, state)
+        #the chunks will be sent when the receiver acknowledges this packet:
+        self.send("send-file", basefilename, mimetype, printit, openit, filesize, "", options)
+        return True
+
+    def send_file_chunk_packet(self, *packet):
+        self.send(*packet)
+
+    def _process_ack_file_chunk(self, packet):
+        chunk_id, ok, message, next_chunk = packet[1:5]
+        chunk_id = bytestostr(chunk_id)
+        state = self.send_chunks_in_progress.get(chunk_id)
+        if not state:
+            filelog("ack for unknown file transfer %s", chunk_id)
+            return
+        l = printlog if state.printit else filelog
+        if not ok:
+            self.send_chunks_in_progress.pop(chunk_id, None)
+            self._end_chunked_transfer(state)
+            l.error("Error: the transfer of file '%s' failed:", state.basefilename)
+            l.error(" %s", bytestostr(message))
+            return
+        state.last_activity = time.time()
+        if state.acked<0:
+            #the receiver may already have some of the chunks:
+            next_chunk = max(0, min(state.nchunks, next_chunk))
+            if next_chunk>0:
+                l.info("resuming the transfer of '%s' from chunk %i", state.basefilename, next_chunk)
+            state.next_chunk = next_chunk
+            state.start = state.last_activity
+        elif next_chunk<=state.acked or next_chunk>state.next_chunk:
+            l("ignoring out of order ack %i for %s", next_chunk, state)
+            return
+        state.acked = next_chunk
+        if next_chunk>=state.nchunks:
+            self.send_chunks_in_progress.pop(chunk_id, None)
+            self._end_chunked_transfer(state)
+            l("%s sent in %ims", state, int(1000*(time.time()-state.start)))
+            return
+        self._send_file_chunks(state)
+
+    def _send_file_chunks(self, state):
+        if state.rate_timer:
+            #we're already waiting for the rate limit:
+            return
+        while state.next_chunk<state.nchunks and state.next_chunk-state.acked<FILE_CHUNK_WINDOW:
+            if state.maxbitrate>0:
+                delay = state.sent_bytes*8.0/state.maxbitrate-(time.time()-state.start)
+                if delay>0:
+                    state.rate_timer = self.timeout_add(max(1, int(1000*delay)), self._rate_limit_done, state)
+                    return
+            chunk_no = state.next_chunk
+            try:
+                data = state.read_chunk(chunk_no)
+            except (OSError, IOError) as e:
+                self.send_chunks_in_progress.pop(state.chunk_id, None)
+                self._end_chunked_transfer(state)
+                filelog.error("Error: cannot read file '%s':", state.filename)
+                filelog.error(" %s", e)
+                return
+            state.next_chunk += 1
+            state.sent_bytes += len(data)
+            cdata = self.compressed_wrapper("file-data", data)
+            self.send_file_chunk_packet("send-file-chunk", state.chunk_id, chunk_no, cdata, state.next_chunk<state.nchunks)
+
+    def _rate_limit_done(self, state):
+        state.rate_timer = None
+        if state.chunk_id in self.send_chunks_in_progress:
+            self._send_file_chunks(state)
+        return False
+
+
+    def _schedule_chunk_timeout(self, transfers, state, delay=FILE_CHUNK_TIMEOUT):
+        state.timer = self.timeout_add(max(1, int(1000*delay)), self._check_chunk_timeout, transfers, state)
+
+    def _check_chunk_timeout(self, transfers, state):
+        state.timer = None
+        if transfers.get(state.chunk_id) is not state:
+            return False
+        elapsed = time.time()-state.last_activity
+        if elapsed<FILE_CHUNK_TIMEOUT:
+            self._schedule_chunk_timeout(transfers, state, FILE_CHUNK_TIMEOUT-elapsed)
+            return False
+        transfers.pop(state.chunk_id, None)
+        self._end_chunked_transfer(state)
+        l = printlog if state.printit else filelog
+        l.warn("Warning: the transfer of file '%s' timed out", state.basefilename)
+        if isinstance(state, FileReceiveState):
+            l.warn(" received %i bytes out of %i", state.written, state.filesize)
+            self._remove_partial_file(state)
+        return False
+
+    def _end_chunked_transfer(self, state):
+        for attr in ("timer", "rate_timer"):
+            timer = getattr(state, attr, None)
+            if timer:
+                setattr(state, attr, None)
+                self.source_remove(timer)
+        state.close()
+
     def _print_file(self, filename, mimetype, printer, title, options):
-        import time
         from xpra.platform.printing import print_files, printing_finished, get_printers
         printers = get_printers()
         if printer not in printers:
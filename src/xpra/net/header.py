@@ -1,5 +1,5 @@
 # This file is part of Xpra.
-# Copyright (C) 2011-2014 Antoine Martin <antoine@devloop.org.uk>
+# Copyright (C) 2011-2016 Antoine Martin <antoine@devloop.org.uk>
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
@@ -10,12 +10,14 @@ FLAGS_BENCODE   = 0x0       #assume bencode if not other flag is set
 FLAGS_RENCODE   = 0x1
 FLAGS_CIPHER    = 0x2
 FLAGS_YAML      = 0x4
+FLAGS_AEAD      = 0x8       #with FLAGS_CIPHER: the payload uses an AEAD cipher mode
 
 #compression flags are carried in the "level" field,
 #the low bits contain the compression level, the high bits the compression algo:
 ZLIB_FLAG       = 0x0       #assume zlib if no other compression flag is set
 LZ4_FLAG        = 0x10
 LZO_FLAG        = 0x20
+ZSTD_FLAG       = 0x80
 FLAGS_NOHEADER  = 0x40
 
 
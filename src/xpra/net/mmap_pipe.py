@@ -4,7 +4,10 @@
 # later version. See the file COPYING for details.
 
 import os
+import time
 import ctypes
+from collections import deque
+from threading import Lock, Event
 from xpra.os_util import memoryview_to_bytes
 from xpra.simple_stats import to_std_unit
 from xpra.log import Logger
@@ -14,6 +17,23 @@ log = Logger("mmap")
 Utility functions for communicating via mmap
 """
 
+#number of frame slots the client asks for, 0 to use the legacy ring buffer:
+MMAP_SLOTS = int(os.environ.get("XPRA_MMAP_SLOTS", "64"))
+#maximum time to wait for the client to free some space when the area is full (in seconds):
+MMAP_WAIT = float(os.environ.get("XPRA_MMAP_WAIT", "0.1"))
+
+#layout of the mmap area when using slots:
+#[ legacy indexes (8 bytes) | .. | token (at 512) | .. | slot table (at 1024) | .. | frame data (from 4096) ]
+#each slot in the table has two 32-bit counters:
+#* the sequence number of the frame written in the slot, only updated by the server
+#* the sequence number of the last frame released, only updated by the client
+#when both values are equal, the slot and the memory it points to can be re-used
+SLOT_TABLE_OFFSET = 1024
+SLOT_SIZE = 8
+MAX_SLOTS = 256
+DATA_OFFSET = 4096
+
+
 def can_use_mmap():
     return hasattr(ctypes.c_ubyte, "from_buffer")
 
@@ -175,12 +195,27 @@ def mmap_read(mmap_area, descr_data):
         data_start.value = offset+length
         return arraytype.from_buffer(mmap_area, offset)
     #re-construct the buffer from discontiguous chunks:
-    data = ""
+    chunks = []
     for offset, length in descr_data:
-        mmap_area.seek(offset)
-        data += mmap_area.read(length)
-        data_start.value = offset+length
-    return data
+        chunks.append(mmap_area[offset:offset+length])
+    data_start.value = offset+length
+    return b"".join(chunks)
+
+
+def mmap_read_frame(mmap_area, descr_data):
+    """
+        Returns the data of a frame written by MmapSlotWriter,
+        without copying it: the caller must release the slot once it is done with it.
+    """
+    assert len(descr_data)==1, "frames must be contiguous"
+    offset, length = descr_data[0]
+    arraytype = ctypes.c_char * length
+    return arraytype.from_buffer(mmap_area, offset)
+
+def mmap_release(mmap_area, slot, seq):
+    """ tells the server that we no longer need the frame in this slot """
+    assert 0<=slot<MAX_SLOTS, "invalid mmap slot %s" % slot
+    int_from_buffer(mmap_area, SLOT_TABLE_OFFSET+slot*SLOT_SIZE+4).value = seq
 
 
 def mmap_write(mmap_area, mmap_size, data):
@@ -263,3 +298,170 @@ def mmap_write(mmap_area, mmap_size, data):
             mmap_data_end.value = 8+l2
     log("sending damage with mmap: %s", data)
     return data, mmap_free_size
+
+
+class MmapSlotWriter(object):
+    """
+        Writes frames to the mmap area using explicit frame descriptors:
+        each frame is written contiguously and is associated with a slot,
+        so the client can read it without copying it
+        and release it once it has been painted (in any order).
+        The frames are allocated in a ring, and the space is reclaimed
+        in allocation order when the client releases the slots.
+        Each counter in the slot table only has a single writer,
+        so we don't need any locking between the server and the client.
+        When the area is full, the caller waits for the client to release some frames,
+        without holding the lock so the other windows can still use the space available.
+    """
+
+    def __init__(self, mmap_area, mmap_size, nslots=MMAP_SLOTS):
+        assert 0<nslots<=MAX_SLOTS, "invalid number of mmap slots: %s" % nslots
+        assert mmap_size>DATA_OFFSET
+        self.mmap_area = mmap_area
+        self.mmap_size = mmap_size
+        self.nslots = nslots
+        #windows may be encoded by different threads:
+        self.lock = Lock()
+        #set when the client may have released some frames:
+        self.release_event = Event()
+        self.written = []
+        self.released = []
+        for i in range(nslots):
+            pos = SLOT_TABLE_OFFSET+i*SLOT_SIZE
+            w = int_from_buffer(mmap_area, pos)
+            r = int_from_buffer(mmap_area, pos+4)
+            w.value = 0
+            r.value = 0
+            self.written.append(w)
+            self.released.append(r)
+        self.free_slots = deque(range(nslots))
+        #frames the client has not released yet, in allocation order:
+        #(slot, seq, offset, length)
+        self.frames = deque()
+        self.write_pos = DATA_OFFSET
+        self.seq = 0
+        #statistics:
+        self.frame_count = 0
+        self.bytes_written = 0
+        self.waits = 0
+        self.wait_time = 0
+        self.failures = 0
+        self.max_used = 0
+
+    def __repr__(self):
+        return "MmapSlotWriter(%i slots)" % self.nslots
+
+    def reclaim(self):
+        """ frees the oldest frames which have been released by the client """
+        frames = self.frames
+        while frames:
+            slot, seq = frames[0][:2]
+            if self.released[slot].value!=seq:
+                break
+            frames.popleft()
+            self.free_slots.append(slot)
+        if not frames:
+            self.write_pos = DATA_OFFSET
+
+    def get_used(self):
+        if not self.frames:
+            return 0
+        tail = self.frames[0][2]
+        if self.write_pos>tail:
+            return self.write_pos-tail
+        return self.mmap_size-tail+self.write_pos-DATA_OFFSET
+
+    def get_free(self):
+        return self.mmap_size-DATA_OFFSET-self.get_used()
+
+    def allocate(self, l):
+        """ returns the position where we can write 'l' bytes contiguously, or -1 """
+        self.reclaim()
+        if not self.free_slots:
+            return -1
+        if not self.frames:
+            return DATA_OFFSET
+        tail = self.frames[0][2]
+        if self.write_pos>tail:
+            #[------T++++++++W------]
+            if self.write_pos+l<=self.mmap_size:
+                return self.write_pos
+            #wrap around:
+            if DATA_OFFSET+l<=tail:
+                return DATA_OFFSET
+            return -1
+        #we have wrapped around already:
+        #[+++W----------T+++++++]
+        if self.write_pos+l<=tail:
+            return self.write_pos
+        return -1
+
+    def write(self, data):
+        """
+            Writes the data to a free area and returns the chunks used,
+            the free space left and the frame descriptor options for the client,
+            or None if we failed.
+        """
+        l = len(data)
+        start = 0
+        while True:
+            with self.lock:
+                self.release_event.clear()
+                if l>self.mmap_size-DATA_OFFSET:
+                    log.warn("Warning: mmap area is too small!")
+                    log.warn(" we need to store %s bytes but the mmap area is limited to %i", l, self.mmap_size-DATA_OFFSET)
+                    self.failures += 1
+                    return None, self.get_free()-l, {}
+                pos = self.allocate(l)
+                now = time.time()
+                if pos>=0:
+                    if start>0:
+                        self.wait_time += now-start
+                    return self.do_write(data, pos)
+                if start==0:
+                    start = now
+                    self.waits += 1
+                elif now-start>=MMAP_WAIT:
+                    self.wait_time += now-start
+                    log("mmap area is full: %i bytes needed, %i frames pending, %i bytes free", l, len(self.frames), self.get_free())
+                    self.failures += 1
+                    return None, self.get_free()-l, {}
+            #back-pressure: give the client a chance to catch up,
+            #we poll in case the client does not acknowledge the frames it releases:
+            self.release_event.wait(max(0, min(0.01, start+MMAP_WAIT-now)))
+
+    def frames_released(self):
+        """ the client has acknowledged some frames, wake up the writers waiting for space """
+        self.release_event.set()
+
+    def do_write(self, data, pos):
+        """ the lock must be held """
+        l = len(data)
+        try:
+            self.mmap_area[pos:pos+l] = data
+        except TypeError:
+            self.mmap_area[pos:pos+l] = memoryview_to_bytes(data)
+        slot = self.free_slots.popleft()
+        self.seq = (self.seq+1) & 0xffffffff or 1
+        self.written[slot].value = self.seq
+        self.frames.append((slot, self.seq, pos, l))
+        self.write_pos = pos+l
+        self.frame_count += 1
+        self.bytes_written += l
+        self.max_used = max(self.max_used, self.get_used())
+        return [(pos, l)], self.get_free(), {"mmap-slot" : slot, "mmap-seq" : self.seq}
+
+    def get_info(self):
+        return {
+                "slots"     : {
+                               "total"  : self.nslots,
+                               "free"   : len(self.free_slots),
+                               },
+                "used"      : self.get_used(),
+                "max-used"  : self.max_used,
+                "frames"    : self.frame_count,
+                "bytes"     : self.bytes_written,
+                "waits"     : self.waits,
+                "wait-time" : int(self.wait_time*1000),
+                "failures"  : self.failures,
+                }
@@ -15,16 +15,36 @@ from xpra.net.header import FLAGS_RENCODE, FLAGS_YAML, FLAGS_BENCODE
 use_rencode = os.environ.get("XPRA_USE_RENCODER", "1")=="1"
 use_bencode = os.environ.get("XPRA_USE_BENCODER", "1")=="1"
 use_yaml    = os.environ.get("XPRA_USE_YAML", "1")=="1"
+#use the packet schemas with rencode:
+use_schemas = os.environ.get("XPRA_RENCODE_SCHEMAS", "1")=="1"
+
+#the types of the items which follow the packet type for the most frequent packets,
+#one character per item: 'i' for int, 's' for strings, 'b' for bool, 'l' for lists and 'd' for dicts
+#(the encoder falls back to the generic code for the items which don't match)
+PACKET_SCHEMAS = {
+    #wid, x, y, width, height, coding, data, packet_sequence, rowstride, client_options
+    "draw"              : b"iiiiissiid",
+    #packet_sequence, wid, width, height, decode_time, message, decode_info
+    "damage-sequence"   : b"iiiiisd",
+    #wid, pointer, modifiers, buttons
+    "pointer-position"  : b"illl",
+    #wid, keyname, pressed, modifiers, keyval, string, keycode, group
+    "key-action"        : b"isblisii",
+    #codec, data, metadata
+    "sound-data"        : b"ssd",
+    }
 
 
 has_rencode = None
-rencode_dumps, rencode_loads, rencode_version = None, None, None
+rencode_dumps, rencode_dumps_packet, rencode_loads, rencode_version = None, None, None, None
 def init_rencode():
-    global use_rencode, has_rencode, rencode_dumps, rencode_loads, rencode_version
+    global use_rencode, has_rencode, rencode_dumps, rencode_dumps_packet, rencode_loads, rencode_version
     try:
         import rencode
         rencode_dumps = rencode.dumps
         rencode_loads = rencode.loads
+        #older versions don't have the schema encoder:
+        rencode_dumps_packet = getattr(rencode, "dumps_packet", None)
         try:
             rencode_version = rencode.__version__
             log("loaded rencode version %s from %s", rencode_version, rencode.__file__)
@@ -82,14 +102,20 @@ def init():
     init_yaml()
 init()
 
-def do_bencode(data):
+def get_packet_schema(packet_type):
+    return PACKET_SCHEMAS.get(packet_type)
+
+def do_bencode(data, schema=None):
     return bencode(data), FLAGS_BENCODE
 
-def do_rencode(data):
+def do_rencode(data, schema=None):
+    if schema and use_schemas and rencode_dumps_packet:
+        return rencode_dumps_packet(data, schema), FLAGS_RENCODE
     return  rencode_dumps(data), FLAGS_RENCODE
 
-def do_yaml(data):
-    return yaml_encode(data), FLAGS_YAML
+def do_yaml(data, schema=None):
+    #yaml would encode tuples as python objects:
+    return yaml_encode(list(data)), FLAGS_YAML
 
 
 def get_packet_encoding_caps():
@@ -97,6 +123,7 @@ def get_packet_encoding_caps():
     if has_rencode:
         assert rencode_version is not None
         r["version"]    = rencode_version
+        r["schemas"]    = use_schemas and rencode_dumps_packet is not None
     b = {"" : use_bencode}
     if has_bencode:
         assert bencode_version is not None
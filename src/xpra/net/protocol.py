@@ -11,6 +11,7 @@
 import sys
 from socket import error as socket_error
 import os
+import time
 import binascii
 from threading import Lock, Event
 
@@ -19,17 +20,18 @@ from xpra.log import Logger
 log = Logger("network", "protocol")
 cryptolog = Logger("network", "crypto")
 
-from xpra.os_util import Queue, strtobytes
+from xpra.os_util import Queue, strtobytes, _memoryview
 from xpra.util import repr_ellipsized, csv
 from xpra.net import ConnectionClosedException
 from xpra.net.bytestreams import ABORT
 from xpra.net import compression
 from xpra.net import packet_encoding
+from xpra.net.compression_chooser import CompressionChooser, ADAPTIVE_COMPRESSION
 from xpra.net.compression import get_compression_caps, decompress, sanity_checks as compression_sanity_checks,\
         InvalidCompressionException, Compressed, LevelCompressed, Uncompressed
 from xpra.net.packet_encoding import get_packet_encoding_caps, decode, sanity_checks as packet_encoding_sanity_checks, InvalidPacketEncodingException
-from xpra.net.header import unpack_header, pack_header, FLAGS_CIPHER, FLAGS_NOHEADER
-from xpra.net.crypto import get_crypto_caps, get_encryptor, get_decryptor, pad, INITIAL_PADDING
+from xpra.net.header import unpack_header, pack_header, FLAGS_CIPHER, FLAGS_AEAD, FLAGS_NOHEADER
+from xpra.net.crypto import get_crypto_caps, get_encryptor, get_decryptor, pad, INITIAL_PADDING, INITIAL_MODE, AEAD_MODES
 
 
 #stupid python version breakage:
@@ -63,6 +65,14 @@ LARGE_PACKET_SIZE = int(os.environ.get("XPRA_LARGE_PACKET_SIZE", 4096))
 INLINE_SIZE = int(os.environ.get("XPRA_INLINE_SIZE", 32768))
 FAKE_JITTER = int(os.environ.get("XPRA_FAKE_JITTER", "0"))
 MIN_COMPRESS_SIZE = int(os.environ.get("XPRA_MIN_COMPRESS_SIZE", 378))
+#packets which have a zstd dictionary are compressed if larger than:
+MIN_DICT_COMPRESS_SIZE = int(os.environ.get("XPRA_MIN_DICT_COMPRESS_SIZE", 32))
+#encrypt in a separate thread so encryption overlaps with encoding and writing:
+ENCRYPT_THREAD = os.environ.get("XPRA_ENCRYPT_THREAD", "1")=="1"
+ENCRYPT_QUEUE_SIZE = max(1, int(os.environ.get("XPRA_ENCRYPT_QUEUE_SIZE", 2)))
+WRITE_QUEUE_SIZE = max(1, int(os.environ.get("XPRA_WRITE_QUEUE_SIZE", 1)))
+#the stages packets go through before reaching the socket:
+PIPELINE_STAGES = ("encode", "encrypt", "write")
 
 
 def get_network_caps():
@@ -108,7 +118,8 @@ class Protocol(object):
             self._process_packet_cb =  fj.process_packet_cb
         else:
             self._process_packet_cb = process_packet_cb
-        self._write_queue = Queue(1)
+        self._write_queue = Queue(WRITE_QUEUE_SIZE)
+        self._encrypt_queue = Queue(ENCRYPT_QUEUE_SIZE)
         self._read_queue = Queue(20)
         self._read_queue_put = self.read_queue_put
         # Invariant: if .source is None, then _source_has_more == False
@@ -120,6 +131,8 @@ class Protocol(object):
         self.output_stats = {}
         self.output_packetcount = 0
         self.output_raw_packetcount = 0
+        #for each pipeline stage: number of items processed and time spent (in seconds)
+        self.stage_stats = dict((x, [0, 0]) for x in PIPELINE_STAGES)
         #initial value which may get increased by client/server after handshake:
         self.max_packet_size = 256*1024
         self.abs_max_packet_size = 256*1024*1024
@@ -133,25 +146,39 @@ class Protocol(object):
         self.compressor = "none"
         self._compress = compression.nocompress
         self.compression_level = 0
+        self.zstd_dictionaries = {}
+        self.compression_chooser = CompressionChooser()
+        #pass-through mode (used by the proxy):
+        #raw chunks compressed with one of these compressors ("none" for uncompressed chunks)
+        #are not decompressed, they are added to the packet as 'LevelCompressed' items
+        #so they can be sent on as they are
+        self.passthrough_compressors = None
+        self.passthrough_count = 0
+        self.passthrough_bytes = 0
         self.cipher_in = None
         self.cipher_in_name = None
         self.cipher_in_block_size = 0
         self.cipher_in_padding = INITIAL_PADDING
+        self.cipher_in_mode = INITIAL_MODE
+        self.cipher_in_args = None
+        self.cipher_in_mode_options = None
         self.cipher_out = None
         self.cipher_out_name = None
         self.cipher_out_block_size = 0
         self.cipher_out_padding = INITIAL_PADDING
+        self.cipher_out_mode = INITIAL_MODE
         self._write_lock = Lock()
         from xpra.make_thread import make_thread
         self._write_thread = make_thread(self._write_thread_loop, "write", daemon=True)
         self._read_thread = make_thread(self._read_thread_loop, "read", daemon=True)
         self._read_parser_thread = None         #started when needed
         self._write_format_thread = None        #started when needed
+        self._encrypt_thread = None             #started when needed
         self._source_has_more = Event()
 
     STATE_FIELDS = ("max_packet_size", "large_packets", "send_aliases", "receive_aliases",
-                    "cipher_in", "cipher_in_name", "cipher_in_block_size", "cipher_in_padding",
-                    "cipher_out", "cipher_out_name", "cipher_out_block_size", "cipher_out_padding",
+                    "cipher_in", "cipher_in_name", "cipher_in_block_size", "cipher_in_padding", "cipher_in_mode",
+                    "cipher_out", "cipher_out_name", "cipher_out_block_size", "cipher_out_padding", "cipher_out_mode",
                     "compression_level", "encoder", "compressor")
     def save_state(self):
         state = {}
@@ -184,28 +211,49 @@ class Protocol(object):
         self._get_packet_cb = get_packet_cb
 
 
-    def set_cipher_in(self, ciphername, iv, password, key_salt, iterations, padding):
-        if self.cipher_in_name!=ciphername:
-            cryptolog.info("receiving data using %s encryption", ciphername)
+    def set_cipher_in(self, ciphername, iv, password, key_salt, iterations, padding, mode=INITIAL_MODE, mode_options=None):
+        """
+            mode_options: the other modes the peer may choose to send with,
+            the mode is switched if the first encrypted packet we receive uses one of those instead.
+        """
+        if self.cipher_in_name!=ciphername or self.cipher_in_mode!=mode:
+            cryptolog.info("receiving data using %s-%s encryption", ciphername, mode)
             self.cipher_in_name = ciphername
-        cryptolog("set_cipher_in%s", (ciphername, iv, password, key_salt, iterations))
-        self.cipher_in, self.cipher_in_block_size = get_decryptor(ciphername, iv, password, key_salt, iterations)
+        cryptolog("set_cipher_in%s", (ciphername, iv, password, key_salt, iterations, padding, mode, mode_options))
+        self.cipher_in, self.cipher_in_block_size = get_decryptor(ciphername, iv, password, key_salt, iterations, mode)
         self.cipher_in_padding = padding
+        self.cipher_in_mode = mode
+        self.cipher_in_args = (ciphername, iv, password, key_salt, iterations)
+        self.cipher_in_mode_options = mode_options
+
+    def switch_cipher_in_mode(self, aead):
+        """
+            The peer chose a mode other than the one we expected,
+            use the first one it is allowed to use with the same AEAD-ness.
+        """
+        for mode in (self.cipher_in_mode_options or ()):
+            if (mode in AEAD_MODES)==aead:
+                cryptolog.info("receiving data using %s-%s encryption", self.cipher_in_name, mode)
+                self.cipher_in, self.cipher_in_block_size = get_decryptor(*(self.cipher_in_args+(mode,)))
+                self.cipher_in_mode = mode
+                return True
+        return False
 
-    def set_cipher_out(self, ciphername, iv, password, key_salt, iterations, padding):
-        if self.cipher_out_name!=ciphername:
-            cryptolog.info("sending data using %s encryption", ciphername)
+    def set_cipher_out(self, ciphername, iv, password, key_salt, iterations, padding, mode=INITIAL_MODE):
+        if self.cipher_out_name!=ciphername or self.cipher_out_mode!=mode:
+            cryptolog.info("sending data using %s-%s encryption", ciphername, mode)
             self.cipher_out_name = ciphername
-        cryptolog("set_cipher_out%s", (ciphername, iv, password, key_salt, iterations, padding))
-        self.cipher_out, self.cipher_out_block_size = get_encryptor(ciphername, iv, password, key_salt, iterations)
+        cryptolog("set_cipher_out%s", (ciphername, iv, password, key_salt, iterations, padding, mode))
+        self.cipher_out, self.cipher_out_block_size = get_encryptor(ciphername, iv, password, key_salt, iterations, mode)
         self.cipher_out_padding = padding
+        self.cipher_out_mode = mode
 
 
     def __repr__(self):
         return "Protocol(%s)" % self._conn
 
     def get_threads(self):
-        return  [x for x in [self._write_thread, self._read_thread, self._read_parser_thread, self._write_format_thread] if x is not None]
+        return  [x for x in [self._write_thread, self._read_thread, self._read_parser_thread, self._write_format_thread, self._encrypt_thread] if x is not None]
 
 
     def get_info(self, alias_info=True):
@@ -221,6 +269,7 @@ class Protocol(object):
                        "count"                  : self.input_stats,
                        "cipher"                 : {"": self.cipher_in_name or "",
                                                    "padding"        : self.cipher_in_padding,
+                                                   "mode"           : self.cipher_in_mode,
                                                    },
                         },
             "output" : {
@@ -232,13 +281,24 @@ class Protocol(object):
                         "raw_packetcount"       : self.output_raw_packetcount,
                         "count"                 : self.output_stats,
                         "cipher"                : {"": self.cipher_out_name or "",
-                                                   "padding" : self.cipher_out_padding
+                                                   "padding" : self.cipher_out_padding,
+                                                   "mode"    : self.cipher_out_mode,
                                                    },
                         },
             }
         c = self._compress
         if c:
             info["compressor"] = compression.get_compressor_name(self._compress)
+        if ADAPTIVE_COMPRESSION:
+            info["compression-chooser"] = self.compression_chooser.get_info()
+        if self.zstd_dictionaries:
+            info["zstd-dictionaries"] = sorted(self.zstd_dictionaries.keys())
+        if self.passthrough_compressors is not None:
+            info["passthrough"] = {
+                                   "compressors"    : sorted(self.passthrough_compressors),
+                                   "chunks"         : self.passthrough_count,
+                                   "bytes"          : self.passthrough_bytes,
+                                   }
         e = self._encoder
         if e:
             if self._encoder==self.noencode:
@@ -255,7 +315,23 @@ class Protocol(object):
             except:
                 log.error("error collecting connection information on %s", self._conn, exc_info=True)
         info["has_more"] = self._source_has_more.is_set()
-        for t in (self._write_thread, self._read_thread, self._read_parser_thread, self._write_format_thread):
+        pinfo = {}
+        for stage, (count, elapsed) in self.stage_stats.items():
+            pinfo[stage] = {
+                            "count"     : count,
+                            "time"      : int(elapsed*1000),
+                            }
+        pinfo["encrypt"]["queue"] = {
+                                     "size"     : self._encrypt_queue.qsize(),
+                                     "max"      : ENCRYPT_QUEUE_SIZE,
+                                     "threaded" : ENCRYPT_THREAD,
+                                     }
+        pinfo["write"]["queue"] = {
+                                   "size"       : self._write_queue.qsize(),
+                                   "max"        : WRITE_QUEUE_SIZE,
+                                   }
+        info["pipeline"] = pinfo
+        for t in (self._write_thread, self._read_thread, self._read_parser_thread, self._write_format_thread, self._encrypt_thread):
             if t:
                 info.setdefault("thread", {})[t.name] = t.is_alive()
         return info
@@ -304,20 +380,59 @@ class Protocol(object):
                 return
             self._internal_error("error in network packet write/format", e, exc_info=True)
 
+    def record_stage_time(self, stage, start):
+        stats = self.stage_stats[stage]
+        stats[0] += 1
+        stats[1] += time.time()-start
+
     def _add_packet_to_queue(self, packet, start_send_cb=None, end_send_cb=None, has_more=False):
         if has_more:
             self._source_has_more.set()
         if packet is None:
             return
         log("add_packet_to_queue(%s ...)", packet[0])
+        start = time.time()
         chunks = self.encode(packet)
+        self.record_stage_time("encode", start)
+        if self.cipher_out and ENCRYPT_THREAD:
+            #let the encrypt thread deal with it,
+            #so we can start encoding the next packet:
+            self.start_encrypt_thread()
+            self._encrypt_queue.put((chunks, start_send_cb, end_send_cb))
+            return
         with self._write_lock:
             if self._closed:
                 return
             self._add_chunks_to_queue(chunks, start_send_cb, end_send_cb)
 
+    def start_encrypt_thread(self):
+        if not self._encrypt_thread and not self._closed:
+            from xpra.make_thread import make_thread
+            self._encrypt_thread = make_thread(self._encrypt_thread_loop, "encrypt", daemon=True)
+            self._encrypt_thread.start()
+
+    def _encrypt_thread_loop(self):
+        log("encrypt_thread_loop starting")
+        try:
+            while not self._closed:
+                item = self._encrypt_queue.get()
+                if item is None:
+                    log("encrypt thread: empty marker, exiting")
+                    return
+                with self._write_lock:
+                    if self._closed:
+                        return
+                    self._add_chunks_to_queue(*item)
+                #flush_then_close waits for all the items to be done:
+                self._encrypt_queue.task_done()
+        except Exception as e:
+            if self._closed:
+                return
+            self._internal_error("error in network packet encryption", e, exc_info=True)
+
     def _add_chunks_to_queue(self, chunks, start_send_cb=None, end_send_cb=None):
         """ the write_lock must be held when calling this function """
+        start = time.time()
         counter = 0
         items = []
         for proto_flags,index,level,data in chunks:
@@ -330,7 +445,18 @@ class Protocol(object):
                 ecb = end_send_cb
             payload_size = len(data)
             actual_size = payload_size
-            if self.cipher_out:
+            if self.cipher_out and self.cipher_out_mode in AEAD_MODES:
+                proto_flags |= FLAGS_CIPHER | FLAGS_AEAD
+                #no padding, but each chunk has a tag,
+                #the header contains the size of the encrypted payload:
+                encrypted = self.cipher_out.encrypt_chunks(data)
+                payload_size = actual_size = sum(len(x) for x in encrypted)
+                if len(encrypted)==1 or actual_size<PACKET_JOIN_SIZE:
+                    data = b"".join(encrypted)
+                else:
+                    data = encrypted
+                cryptolog("sending %s bytes %s-%s encrypted", payload_size, self.cipher_out_name, self.cipher_out_mode)
+            elif self.cipher_out:
                 proto_flags |= FLAGS_CIPHER
                 #note: since we are padding: l!=len(data)
                 padding_size = self.cipher_out_block_size - (payload_size % self.cipher_out_block_size)
@@ -355,10 +481,16 @@ class Protocol(object):
                 header_and_data = pack_header(proto_flags, level, index, payload_size) + data
                 items.append((header_and_data, scb, ecb))
             else:
+                #send the header and the payload as a list of buffers,
+                #so the payload never needs to be copied
                 header = pack_header(proto_flags, level, index, payload_size)
-                items.append((header, scb, None))
-                items.append((strtobytes(data), None, ecb))
+                if type(data)==list:
+                    items.append(([header]+data, scb, ecb))
+                else:
+                    items.append(([header, strtobytes(data)], scb, ecb))
             counter += 1
+        if self.cipher_out:
+            self.record_stage_time("encrypt", start)
         self._write_queue.put(items)
         self.output_packetcount += 1
 
@@ -424,11 +556,16 @@ class Protocol(object):
         if self.compression_level==0:
             self.enable_compressor("none")
             return
+        #dictionaries we both have can be used for small packets:
+        self.zstd_dictionaries = compression.get_zstd_dictionaries(caps.intlistget("zstd.dictionaries", []))
+        log("enable_compressor_from_caps(..) zstd dictionaries=%s", csv(self.zstd_dictionaries.keys()))
         opts = compression.get_enabled_compressors(order=compression.PERFORMANCE_ORDER)
         log("enable_compressor_from_caps(..) options=%s", opts)
         for c in opts:      #ie: [zlib, lz4, lzo]
             if caps.boolget(c):
                 self.enable_compressor(c)
+                #the chooser may use any of the compressors we both support:
+                self.compression_chooser.set_compressors([x for x in opts if caps.boolget(x)])
                 return
         log.warn("compression disabled: no matching compressor found")
         self.enable_compressor("none")
@@ -436,10 +573,11 @@ class Protocol(object):
     def enable_compressor(self, compressor):
         self._compress = compression.get_compressor(compressor)
         self.compressor = compressor
+        self.compression_chooser.set_compressors([compressor])
         log("enable_compressor(%s): %s", compressor, self._compress)
 
 
-    def noencode(self, data):
+    def noencode(self, data, schema=None):
         #just send data as a string for clients that don't understand xpra packet format:
         if sys.version_info[0] >= 3:
             import codecs
@@ -468,7 +606,8 @@ class Protocol(object):
         ]
         """
         packets = []
-        packet = list(packet_in)
+        #we only copy the packet if we need to modify it:
+        packet = packet_in
         level = self.compression_level
         size_check = LARGE_PACKET_SIZE
         min_comp_size = MIN_COMPRESS_SIZE
@@ -487,7 +626,7 @@ class Protocol(object):
                 #this is a marker used to tell us we should compress it now
                 #(used by the client for clipboard data)
                 item = item.compress()
-                packet[i] = item
+                packet = self._modify(packet, packet_in, i, item)
                 ti = type(item)
                 #(it may now be a "Compressed" item and be processed further)
             if ti in (Compressed, LevelCompressed):
@@ -500,19 +639,19 @@ class Protocol(object):
                         #so we must tell it how to do that and pass the level flag
                         il = item.level
                     packets.append((0, i, il, item.data))
-                    packet[i] = ''
+                    packet = self._modify(packet, packet_in, i, '')
                 else:
                     #data is small enough, inline it:
-                    packet[i] = item.data
+                    packet = self._modify(packet, packet_in, i, item.data)
                     min_comp_size += l
                     size_check += l
             elif ti in (str, bytes) and level>0 and l>LARGE_PACKET_SIZE:
                 log.warn("found a large uncompressed item in packet '%s' at position %s: %s bytes", packet[0], i, len(item))
                 #add new binary packet with large item:
-                cl, cdata = self._compress(item, level)
+                cl, cdata = self.compress(packet[0], item, level)
                 packets.append((0, i, cl, cdata))
                 #replace this item with an empty string placeholder:
-                packet[i] = ''
+                packet = self._modify(packet, packet_in, i, '')
             elif ti not in (str, bytes):
                 log.warn("unexpected data type %s in %s packet: %s", ti, packet[0], repr_ellipsized(item))
         #now the main packet (or what is left of it):
@@ -520,28 +659,48 @@ class Protocol(object):
         self.output_stats[packet_type] = self.output_stats.get(packet_type, 0)+1
         if USE_ALIASES and self.send_aliases and packet_type in self.send_aliases:
             #replace the packet type with the alias:
-            packet[0] = self.send_aliases[packet_type]
+            packet = self._modify(packet, packet_in, 0, self.send_aliases[packet_type])
         try:
-            main_packet, proto_flags = self._encoder(packet)
+            main_packet, proto_flags = self._encoder(packet, packet_encoding.get_packet_schema(packet_type))
         except Exception:
             if self._closed:
                 return [], 0
             log.error("failed to encode packet: %s", packet, exc_info=True)
             #make the error a bit nicer to parse: undo aliases:
-            packet[0] = packet_type
+            packet = [packet_type]+list(packet[1:])
             self.verify_packet(packet)
             raise
         if len(main_packet)>size_check and packet_in[0] not in self.large_packets:
             log.warn("found large packet (%s bytes): %s, argument types:%s, sizes: %s, packet head=%s",
                      len(main_packet), packet_in[0], [type(x) for x in packet[1:]], [len(str(x)) for x in packet[1:]], repr_ellipsized(packet))
+        zdict = self.zstd_dictionaries.get(packet_type)
+        if level>0 and zdict is not None and len(main_packet)>MIN_DICT_COMPRESS_SIZE:
+            #we have a dictionary for this type of packet,
+            #so even small packets may compress well:
+            cl, cdata = compression.zstd_compress(main_packet, level, zdict)
+            if len(cdata)<len(main_packet):
+                packets.append((proto_flags, 0, cl, cdata))
+                return packets
         #compress, but don't bother for small packets:
         if level>0 and len(main_packet)>min_comp_size:
-            cl, cdata = self._compress(main_packet, level)
+            cl, cdata = self.compress(packet_type, main_packet, level)
             packets.append((proto_flags, 0, cl, cdata))
         else:
             packets.append((proto_flags, 0, 0, main_packet))
         return packets
 
+    def _modify(self, packet, packet_in, index, value):
+        """ replaces the item at index, copying the packet first if it is still the caller's """
+        if packet is packet_in:
+            packet = list(packet_in)
+        packet[index] = value
+        return packet
+
+    def compress(self, packet_type, data, level):
+        if ADAPTIVE_COMPRESSION and self._compress!=compression.nocompress:
+            return self.compression_chooser.compress(packet_type, data, level)
+        return self._compress(data, level)
+
     def set_compression_level(self, level):
         #this may be used next time encode() is called
         assert level>=0 and level<=10, "invalid compression level: %s (must be between 0 and 10" % level
@@ -575,6 +734,7 @@ class Protocol(object):
             log("write thread: empty marker, exiting")
             self.close()
             return
+        start = time.time()
         for buf, start_cb, end_cb in items:
             con = self._conn
             if not con:
@@ -585,17 +745,38 @@ class Protocol(object):
                 except:
                     if not self._closed:
                         log.error("error on %s", start_cb, exc_info=True)
-            while buf and not self._closed:
-                written = con.write(buf)
-                if written:
-                    buf = buf[written:]
-                    self.output_raw_packetcount += 1
+            if type(buf)!=list:
+                buf = [buf]
+            self._write_buffers(con, buf)
             if end_cb:
                 try:
                     end_cb(self._conn.output_bytecount)
                 except:
                     if not self._closed:
                         log.error("error on %s", end_cb, exc_info=True)
+        self.record_stage_time("write", start)
+
+    def _write_buffers(self, con, buffers):
+        """
+            Writes all the buffers to the connection, using vectored writes if the connection supports it.
+            Partial writes only move the offsets into the memoryviews, the data is never copied.
+        """
+        if _memoryview:
+            buffers = [_memoryview(x) for x in buffers if len(x)>0]
+        else:
+            buffers = [x for x in buffers if len(x)>0]
+        while buffers and not self._closed:
+            written = con.writev(buffers)
+            if not written:
+                continue
+            self.output_raw_packetcount += 1
+            while written>0:
+                l = len(buffers[0])
+                if written<l:
+                    buffers[0] = buffers[0][written:]
+                    break
+                written -= l
+                buffers.pop(0)
 
     def _read_thread_loop(self):
         self._io_thread_loop("read", self._read)
@@ -674,16 +855,20 @@ class Protocol(object):
     def do_read_parse_thread_loop(self):
         """
             Process the individual network packets placed in _read_queue.
-            Concatenate the raw packet data, then try to parse it.
-            Extract the individual packets from the potentially large buffer,
-            saving the rest of the buffer for later, and optionally decompress this data
+            Parse the 8 bytes header, then collect the payload from as many buffers as needed:
+            the payload is joined only once complete, so large packets are assembled in linear time,
+            and payloads contained in a single buffer are only sliced from it.
+            Optionally decrypt and decompress this data
             and re-construct the one python-object-packet from potentially multiple packets (see packet_index).
             The 8 bytes packet header gives us information on the packet index, packet size and compression.
             The actual processing of the packet is done via the callback process_packet_cb,
             this will be called from this parsing thread so any calls that need to be made
             from the UI thread will need to use a callback (usually via 'idle_add')
         """
-        read_buffer = None
+        header = b""
+        #the pieces of the current packet's payload:
+        chunks = []
+        chunks_size = 0
         payload_size = -1
         padding_size = 0
         packet_index = 0
@@ -696,44 +881,55 @@ class Protocol(object):
                 log("parse thread: empty marker, exiting")
                 self.idle_add(self.close)
                 return
-            if read_buffer:
-                read_buffer = read_buffer + buf
-            else:
-                read_buffer = buf
-            bl = len(read_buffer)
-            while not self._closed:
+            #we only ever slice the buffer to extract the data we need,
+            #so each byte is copied at most once, even for very large packets:
+            pos = 0
+            bl = len(buf)
+            while pos<bl and not self._closed:
                 packet = None
-                bl = len(read_buffer)
-                if bl<=0:
-                    break
                 if payload_size<0:
-                    if read_buffer[0] not in ("P", ord("P")):
-                        self._invalid_header(read_buffer)
+                    if not header and buf[pos] not in ("P", ord("P")):
+                        self._invalid_header(buf[pos:])
                         return
-                    if bl<8:
+                    need = 8-len(header)
+                    header += buf[pos:pos+need]
+                    pos = min(bl, pos+need)
+                    if len(header)<8:
                         break   #packet still too small
                     #packet format: struct.pack('cBBBL', ...) - 8 bytes
-                    _, protocol_flags, compression_level, packet_index, data_size = unpack_header(read_buffer[:8])
+                    _, protocol_flags, compression_level, packet_index, data_size = unpack_header(header)
 
                     #sanity check size (will often fail if not an xpra client):
                     if data_size>self.abs_max_packet_size:
-                        self._invalid_header(read_buffer)
+                        self._invalid_header(header+buf[pos:])
                         return
 
-                    bl = len(read_buffer)-8
                     if protocol_flags & FLAGS_CIPHER:
                         if self.cipher_in_block_size==0 or not self.cipher_in_name:
                             cryptolog.warn("received cipher block but we don't have a cipher to decrypt it with, not an xpra client?")
-                            self._invalid_header(read_buffer)
+                            self._invalid_header(header+buf[pos:])
+                            return
+                        aead = bool(protocol_flags & FLAGS_AEAD)
+                        if aead!=(self.cipher_in_mode in AEAD_MODES) and not self.switch_cipher_in_mode(aead):
+                            cryptolog.warn("Warning: received a packet encrypted with an unexpected cipher mode")
+                            cryptolog.warn(" expected %s-%s", self.cipher_in_name, self.cipher_in_mode)
+                            self._invalid_header(header+buf[pos:])
                             return
-                        padding_size = self.cipher_in_block_size - (data_size % self.cipher_in_block_size)
+                        #the peer cannot change the mode after the first encrypted packet:
+                        self.cipher_in_mode_options = None
+                        if aead:
+                            #no padding, the size includes the tags
+                            padding_size = 0
+                        else:
+                            padding_size = self.cipher_in_block_size - (data_size % self.cipher_in_block_size)
                         payload_size = data_size + padding_size
                     else:
                         #no cipher, no padding:
                         padding_size = 0
                         payload_size = data_size
                     assert payload_size>0, "invalid payload size: %i" % payload_size
-                    read_buffer = read_buffer[8:]
+                    packet_header = header
+                    header = b""
 
                     if payload_size>self.max_packet_size:
                         #this packet is seemingly too big, but check again from the main UI thread
@@ -747,22 +943,41 @@ class Protocol(object):
                                               (size_to_check, self.max_packet_size)
                                 self.invalid(msg, packet_header)
                             return False
-                        self.timeout_add(1000, check_packet_size, payload_size, read_buffer[:32])
-
-                if bl<payload_size:
-                    # incomplete packet, wait for the rest to arrive
-                    break
-
-                #chop this packet from the buffer:
-                if len(read_buffer)==payload_size:
-                    raw_string = read_buffer
-                    read_buffer = ''
+                        self.timeout_add(1000, check_packet_size, payload_size, packet_header+buf[pos:pos+24])
+                    if pos>=bl:
+                        break
+
+                n = min(payload_size-chunks_size, bl-pos)
+                if n==payload_size:
+                    #the whole payload is in this buffer:
+                    raw_string = buf[pos:pos+n]
                 else:
-                    raw_string = read_buffer[:payload_size]
-                    read_buffer = read_buffer[payload_size:]
+                    if pos==0 and n==bl:
+                        #use the whole buffer as it is, without copying it
+                        chunks.append(buf)
+                    else:
+                        chunks.append(buf[pos:pos+n])
+                    chunks_size += n
+                    if chunks_size<payload_size:
+                        # incomplete packet, wait for the rest to arrive
+                        pos += n
+                        break
+                    raw_string = b"".join(chunks)
+                    chunks = []
+                    chunks_size = 0
+                pos += n
+
                 #decrypt if needed:
                 data = raw_string
-                if self.cipher_in and protocol_flags & FLAGS_CIPHER:
+                if self.cipher_in and protocol_flags & FLAGS_CIPHER and self.cipher_in_mode in AEAD_MODES:
+                    cryptolog("received %i %s-%s encrypted bytes", payload_size, self.cipher_in_name, self.cipher_in_mode)
+                    try:
+                        data = self.cipher_in.decrypt(raw_string)
+                    except Exception:
+                        cryptolog("%s decryption failed", self.cipher_in_mode, exc_info=True)
+                        cryptolog.warn("Warning: %s-%s decryption failed: invalid authentication tag", self.cipher_in_name, self.cipher_in_mode)
+                        return self._internal_error("%s-%s authentication error - wrong key?" % (self.cipher_in_name, self.cipher_in_mode))
+                elif self.cipher_in and protocol_flags & FLAGS_CIPHER:
                     cryptolog("received %i %s encrypted bytes with %s padding", payload_size, self.cipher_in_name, padding_size)
                     data = self.cipher_in.decrypt(raw_string)
                     if padding_size > 0:
@@ -783,8 +998,18 @@ class Protocol(object):
                             cryptolog(" decrypted data: %s", debug_str(data[:128]))
                             return self._internal_error("%s encryption padding error - wrong key?" % self.cipher_in_name)
                         data = data[:-padding_size]
+                #chunks we forward as they are:
+                ptc = self.passthrough_compressors
+                passthrough = None
+                if packet_index>0 and ptc is not None:
+                    if compression_level>0:
+                        passthrough = compression.get_compression_type(compression_level)
+                    else:
+                        passthrough = "none"
+                    if passthrough not in ptc:
+                        passthrough = None
                 #uncompress if needed:
-                if compression_level>0:
+                if compression_level>0 and not passthrough:
                     try:
                         data = decompress(data, compression_level)
                     except InvalidCompressionException as e:
@@ -810,6 +1035,10 @@ class Protocol(object):
                     return
                 if packet_index>0:
                     #raw packet, store it and continue:
+                    if passthrough:
+                        data = LevelCompressed("raw", data, compression_level, passthrough, False)
+                        self.passthrough_count += 1
+                        self.passthrough_bytes += len(data)
                     raw_packets[packet_index] = data
                     payload_size = -1
                     packet_index = 0
@@ -863,7 +1092,8 @@ class Protocol(object):
         """ Note: this is best effort only
             the packet may not get sent.
 
-            We try to get the write lock,
+            We wait for the packets being encrypted,
+            we try to get the write lock,
             we try to wait for the write queue to flush
             we queue our last packet,
             we wait again for the queue to flush,
@@ -876,6 +1106,21 @@ class Protocol(object):
         if self._closed:
             log("flush_then_close: already closed")
             return done()
+        def encrypt_pending():
+            #includes the items the encrypt thread has already taken from the queue:
+            return self._encrypt_queue.unfinished_tasks>0
+        def wait_for_encrypt(timeout=10):
+            #the encrypt thread needs the write lock, so we must not hold it here
+            if encrypt_pending():
+                if timeout<=0:
+                    log("flush_then_close: encrypt queue still busy, closing without sending the last packet")
+                    self.close()
+                    done()
+                else:
+                    log("flush_then_close: still waiting for encrypt queue to flush")
+                    self.timeout_add(100, wait_for_encrypt, timeout-1)
+            else:
+                wait_for_write_lock()
         def wait_for_queue(timeout=10):
             #IMPORTANT: if we are here, we have the write lock held!
             if not self._write_queue.empty():
@@ -925,19 +1170,30 @@ class Protocol(object):
                 else:
                     log("flush_then_close: write lock is busy, will retry %s more times", timeout)
                     self.timeout_add(10, wait_for_write_lock, timeout-1)
+            elif encrypt_pending():
+                #more packets were queued for encryption before we got the lock,
+                #they must be written before the last packet:
+                self._write_lock.release()
+                if timeout<=0:
+                    log("flush_then_close: timeout waiting for the encrypt queue")
+                    self.close()
+                    done()
+                else:
+                    self.timeout_add(10, wait_for_write_lock, timeout-1)
             else:
                 log("flush_then_close: acquired the write lock")
                 #we have the write lock - we MUST free it!
                 wait_for_queue()
         #normal codepath:
+        # -> wait_for_encrypt
         # -> wait_for_write_lock
         # -> wait_for_queue
         # -> _add_chunks_to_queue
         # -> packet_queued
         # -> wait_for_packet_sent
         # -> close_and_release
-        log("flush_then_close: wait_for_write_lock()")
-        wait_for_write_lock()
+        log("flush_then_close: wait_for_encrypt()")
+        wait_for_encrypt()
 
     def close(self):
         log("Protocol.close() closed=%s, connection=%s", self._closed, self._conn)
@@ -994,6 +1250,7 @@ class Protocol(object):
         self._read_thread = None
         self._read_parser_thread = None
         self._write_format_thread = None
+        self._encrypt_thread = None
         self._process_packet_cb = None
 
     def terminate_queue_threads(self):
@@ -1017,3 +1274,9 @@ class Protocol(object):
             orq.put_nowait(None)
         except:
             pass
+        try:
+            oeq = self._encrypt_queue
+            self._encrypt_queue = exit_queue
+            oeq.put_nowait(None)
+        except:
+            pass
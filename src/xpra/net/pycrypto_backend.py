@@ -4,7 +4,7 @@
 # Xpra is released under the terms of the GNU GPL v2, or, at your option, any
 # later version. See the file COPYING for details.
 
-from xpra.os_util import strtobytes
+from xpra.os_util import strtobytes, memoryview_to_bytes
 from xpra.log import Logger
 log = Logger("network", "crypto")
 
@@ -12,8 +12,12 @@ import Crypto
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Cipher import AES
 ENCRYPTION_CIPHERS = ["AES"]
+MODES = ["CBC"]
+#only available with pycryptodome:
+if hasattr(AES, "MODE_GCM"):
+    MODES.append("GCM")
 
-__all__ = ("get_info", "get_key", "get_encryptor", "get_decryptor", "ENCRYPTION_CIPHERS")
+__all__ = ("get_info", "get_key", "get_encryptor", "get_decryptor", "get_aead", "ENCRYPTION_CIPHERS", "MODES")
 
 
 def init():
@@ -43,6 +47,27 @@ def get_decryptor(secret, iv):
     return AES.new(secret, AES.MODE_CBC, iv)
 
 
+class AESGCM(object):
+    """ no associated data, returns the ciphertext followed by the tag """
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def __repr__(self):
+        return "AES-GCM"
+
+    def encrypt(self, nonce, data):
+        ciphertext, tag = AES.new(self.secret, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(memoryview_to_bytes(data))
+        return ciphertext+tag
+
+    def decrypt(self, nonce, data):
+        data = memoryview_to_bytes(data)
+        return AES.new(self.secret, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(data[:-16], data[-16:])
+
+def get_aead(secret):
+    return AESGCM(secret)
+
+
 
 def main():
     from xpra.platform import program_context
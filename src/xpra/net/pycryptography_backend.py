@@ -8,9 +8,10 @@ from xpra.os_util import strtobytes
 from xpra.log import Logger
 log = Logger("network", "crypto")
 
-__all__ = ("get_info", "get_key", "get_encryptor", "get_decryptor", "ENCRYPTION_CIPHERS")
+__all__ = ("get_info", "get_key", "get_encryptor", "get_decryptor", "get_aead", "ENCRYPTION_CIPHERS", "MODES")
 
 ENCRYPTION_CIPHERS = []
+MODES = []
 backend = None
 
 
@@ -44,7 +45,7 @@ def init():
     import sys
     if getattr(sys, 'frozen', False) or sys.platform.startswith("darwin"):
         patch_crypto_be_discovery()
-    global backend, ENCRYPTION_CIPHERS
+    global backend, ENCRYPTION_CIPHERS, MODES
     from cryptography.hazmat.backends import default_backend
     backend = default_backend()
     log("default_backend()=%s", backend)
@@ -53,6 +54,13 @@ def init():
     from cryptography.hazmat.primitives import hashes
     assert Cipher and algorithms and modes and hashes
     ENCRYPTION_CIPHERS[:] = ["AES"]
+    MODES[:] = ["CBC"]
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        assert AESGCM
+        MODES.append("GCM")
+    except ImportError:
+        log("AES-GCM is not available", exc_info=True)
 
 def ci(v):
     try:
@@ -93,6 +101,26 @@ def get_decryptor(key, iv):
     return decryptor
 
 
+class AESGCMWrapper(object):
+    """ no associated data, returns the ciphertext followed by the tag """
+
+    def __init__(self, key):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        self.aesgcm = AESGCM(key)
+
+    def __repr__(self):
+        return "AES-GCM"
+
+    def encrypt(self, nonce, data):
+        return self.aesgcm.encrypt(nonce, data, None)
+
+    def decrypt(self, nonce, data):
+        return self.aesgcm.decrypt(nonce, data, None)
+
+def get_aead(key):
+    return AESGCMWrapper(key)
+
+
 def main():
     from xpra.platform import program_context
     from xpra.util import print_nested_dict
@@ -298,8 +298,8 @@ class ShadowServer(GTKShadowServerBase):
         capabilities["server_type"] = "Python/gtk2/win32-shadow"
         return capabilities
 
-    def get_info(self, proto):
-        info = GTKServerBase.get_info(self, proto)
+    def get_info(self, proto, *args):
+        info = GTKServerBase.get_info(self, proto, *args)
         info.setdefault("features", {})["shadow"] = True
         info.setdefault("server", {
                                    "type"       : "Python/gtk2/win32-shadow",
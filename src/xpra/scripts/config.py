@@ -319,6 +319,7 @@ OPTION_TYPES = {
                     "exec-wrapper"      : str,
                     "dbus-launch"       : str,
                     "webcam"            : str,
+                    "bandwidth-limit"   : str,
                     #int options:
                     "quality"           : int,
                     "min-quality"       : int,
@@ -497,6 +498,7 @@ def get_defaults():
                     "exec-wrapper"      : "",
                     "dbus-launch"       : "dbus-launch --close-stderr",
                     "webcam"            : "auto",
+                    "bandwidth-limit"   : "",
                     "quality"           : 0,
                     "min-quality"       : 30,
                     "speed"             : 0,
@@ -0,0 +1,291 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Headless encoder benchmark:
+# replays the damage traces recorded with XPRA_DAMAGE_TRACE (see damage_trace)
+# through WindowVideoSource.make_data_packet,
+# for every combination of encoding, video encoder, csc module and compressor available.
+# ie: python ./xpra/scripts/damage_replay.py ~/.xpra/traces/window-*.trace
+
+import sys
+import time
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.util import typedict, csv
+from xpra.net import compression
+from xpra.server.window.damage_trace import read_damage_trace
+from xpra.codecs.image_wrapper import ImageWrapper
+
+RGB_ENCODINGS = ("rgb24", "rgb32")
+RGB_COMPRESSORS = ("zlib", "lz4", "lzo")
+RGB_FORMATS = ["XRGB", "BGRX", "ARGB", "BGRA", "RGB", "BGR"]
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    index = min(len(values)-1, int(len(values)*pct/100.0))
+    return values[index]
+
+
+class ReplayWindow(object):
+    """ just enough of a window model for WindowSource """
+
+    def __init__(self, has_alpha=False):
+        self._has_alpha = has_alpha
+
+    def is_tray(self):
+        return False
+
+    def is_shadow(self):
+        return False
+
+    def is_OR(self):
+        return False
+
+    def has_alpha(self):
+        return self._has_alpha
+
+    def is_managed(self):
+        return True
+
+    def get_property(self, prop):
+        return None
+
+    def get_dynamic_property_names(self):
+        return []
+
+    def connect(self, *args):
+        return 0
+
+    def disconnect(self, *args):
+        pass
+
+
+def noop(*args):
+    return 0
+
+
+def get_rgb_compressors():
+    return [x for x in RGB_COMPRESSORS if getattr(compression, "use_%s" % x, False)]
+
+def get_combinations(encodings=None):
+    """
+        Returns the list of (encoding, video encoder, csc module, compressor)
+        we can benchmark with the codecs available on this system.
+    """
+    from xpra.codecs.loader import load_codecs, get_codec
+    from xpra.codecs.video_helper import VideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+    load_codecs(decoders=False)
+    combinations = []
+    def add(encoding, encoder="", csc="", compressor=""):
+        if encodings and encoding not in encodings:
+            return
+        combinations.append((encoding, encoder, csc, compressor))
+    for encoding in RGB_ENCODINGS:
+        for compressor in get_rgb_compressors():
+            add(encoding, compressor=compressor)
+    enc_pillow = get_codec("enc_pillow")
+    if enc_pillow:
+        for encoding in enc_pillow.get_encodings():
+            add(encoding, "pillow")
+    if get_codec("enc_webp"):
+        add("webp", "webp")
+    for encoder in ALL_VIDEO_ENCODER_OPTIONS:
+        for csc in ALL_CSC_MODULE_OPTIONS:
+            vh = VideoHelper()
+            vh.set_modules([encoder], [csc])
+            vh.init()
+            for encoding in vh.get_encodings():
+                add(encoding, encoder, csc)
+            vh.cleanup()
+    return combinations
+
+
+def make_window_source(combination, has_alpha=False, quality=-1, speed=-1):
+    from xpra.codecs.video_helper import VideoHelper
+    from xpra.server.source_stats import GlobalPerformanceStatistics
+    from xpra.server.window.batch_config import DamageBatchConfig
+    from xpra.server.window.window_source import WindowSource
+    from xpra.server.window.window_video_source import WindowVideoSource
+    encoding, encoder, csc, compressor = combination
+    WindowSource.staticinit(noop, noop, noop)
+    vh = VideoHelper()
+    if csc:
+        vh.set_modules([encoder], [csc])
+    vh.init()
+    core_encodings = [encoding]
+    if encoding in vh.get_encodings():
+        #the video source needs a non-video encoding for the edges and small regions:
+        core_encodings.append("rgb24")
+    encoding_options = typedict({
+                                 "rgb_zlib"     : compressor=="zlib",
+                                 "rgb_lz4"      : compressor=="lz4",
+                                 "rgb_lzo"      : compressor=="lzo",
+                                 "transparency" : has_alpha,
+                                 })
+    default_encoding_options = {}
+    if quality>=0:
+        default_encoding_options["quality"] = quality
+    if speed>=0:
+        default_encoding_options["speed"] = speed
+    ws = WindowVideoSource(noop, noop, noop, compression.compressed_wrapper, None,
+                           None,
+                           GlobalPerformanceStatistics(),
+                           1, ReplayWindow(has_alpha), DamageBatchConfig(), 0,
+                           False, 0,
+                           vh,
+                           core_encodings, core_encodings,
+                           encoding, core_encodings, core_encodings, encoding_options, typedict(),
+                           RGB_FORMATS,
+                           typedict(default_encoding_options),
+                           None, 0, None)
+    #keep the compressor we want to measure:
+    ws.rgb_zlib = compressor=="zlib"
+    ws.rgb_lz4 = compressor=="lz4"
+    ws.rgb_lzo = compressor=="lzo"
+    return ws
+
+
+class ReplayResult(object):
+
+    def __init__(self, combination):
+        self.combination = combination
+        self.frames = 0
+        self.pixels = 0
+        self.bytes = 0
+        self.errors = 0
+        self.encode_times = []
+        self.latencies = []
+        self.encodings_used = {}
+
+    def __repr__(self):
+        return "ReplayResult(%s)" % csv(x for x in self.combination if x)
+
+    def get_info(self):
+        elapsed = sum(self.encode_times)
+        info = {
+                "frames"    : self.frames,
+                "pixels"    : self.pixels,
+                "bytes"     : self.bytes,
+                "errors"    : self.errors,
+                "encodings" : self.encodings_used,
+                }
+        if elapsed>0:
+            info["pixels-per-second"] = int(self.pixels/elapsed)
+        if self.pixels>0:
+            info["bits-per-pixel"] = round(self.bytes*8.0/self.pixels, 3)
+        for name, values in (("encode-time", self.encode_times), ("latency", self.latencies)):
+            info[name] = dict(("p%i" % pct, int(1000*1000*percentile(values, pct))) for pct in PERCENTILES)
+        return info
+
+
+def replay(records, combination, quality=-1, speed=-1):
+    """
+        Encodes the damage records with the given combination.
+        The frames are queued at the time they were recorded
+        and encoded one at a time using the encode times measured,
+        so the latency includes the time spent waiting for the previous frames.
+    """
+    result = ReplayResult(combination)
+    if not records:
+        return result
+    has_alpha = any(image.get_pixel_format().find("A")>=0 for _, _, _, image in records)
+    ws = make_window_source(combination, has_alpha, quality, speed)
+    ws.window_dimensions = max(image.get_width() for _,_,_,image in records), max(image.get_height() for _,_,_,image in records)
+    encoding = combination[0]
+    first_timestamp = records[0][0]
+    busy_until = 0
+    try:
+        for sequence, (timestamp, wid, _, image) in enumerate(records):
+            #the encoders may modify the image, so give them a copy:
+            x, y, w, h, depth = image.get_geometry()
+            image = ImageWrapper(x, y, w, h, image.get_pixels(), image.get_pixel_format(), depth, image.get_rowstride())
+            start = time.time()
+            try:
+                packet = ws.make_data_packet(start, start, wid, image, encoding, sequence+1, {}, 0)
+            except Exception as e:
+                log("make_data_packet failed for %s", combination, exc_info=True)
+                log.error("Error encoding frame %i with %s:", sequence, csv(x for x in combination if x))
+                log.error(" %s", e)
+                packet = None
+            elapsed = time.time()-start
+            if not packet:
+                result.errors += 1
+                continue
+            coding, data = packet[6:8]
+            result.frames += 1
+            result.pixels += w*h
+            result.bytes += len(getattr(data, "data", data))
+            result.encodings_used[coding] = result.encodings_used.get(coding, 0)+1
+            result.encode_times.append(elapsed)
+            due = timestamp-first_timestamp
+            busy_until = max(busy_until, due)+elapsed
+            result.latencies.append(busy_until-due)
+    finally:
+        ws.cleanup()
+        ws.video_helper.cleanup()
+    return result
+
+
+def load_records(filenames):
+    records = []
+    for filename in filenames:
+        records += list(read_damage_trace(filename))
+    records.sort(key=lambda record : record[0])
+    return records
+
+
+def main(argv):
+    from xpra.platform import program_context
+    from xpra.log import enable_color
+    with program_context("Damage-Replay", "Damage Replay"):
+        enable_color()
+        if "-v" in argv or "--verbose" in argv:
+            log.enable_debug()
+            argv = [x for x in argv if x not in ("-v", "--verbose")]
+        encodings = None
+        quality = speed = -1
+        filenames = []
+        for arg in argv[1:]:
+            if arg.startswith("--encodings="):
+                encodings = arg[len("--encodings="):].split(",")
+            elif arg.startswith("--quality="):
+                quality = int(arg[len("--quality="):])
+            elif arg.startswith("--speed="):
+                speed = int(arg[len("--speed="):])
+            else:
+                filenames.append(arg)
+        if not filenames:
+            print("usage: %s [--encodings=ENC1,ENC2] [--quality=Q] [--speed=S] TRACEFILE..." % argv[0])
+            return 1
+        records = load_records(filenames)
+        if not records:
+            log.warn("no damage records found in %s", csv(filenames))
+            return 1
+        pixels = sum(image.get_width()*image.get_height() for _,_,_,image in records)
+        log.info("loaded %i damage records, %iMPixels", len(records), pixels//1024//1024)
+        header = "%-8s %-10s %-10s %-6s %7s %10s %8s %8s %8s %8s %8s %8s" % (
+                    "encoding", "encoder", "csc", "comp", "frames", "bytes", "bpp", "MPix/s",
+                    "enc-p50", "enc-p99", "lat-p50", "lat-p99")
+        print(header)
+        for combination in get_combinations(encodings):
+            result = replay(records, combination, quality, speed)
+            info = result.get_info()
+            print("%-8s %-10s %-10s %-6s %7i %10i %8s %8.1f %8.1f %8.1f %8.1f %8.1f" % (
+                    combination + (result.frames, result.bytes, info.get("bits-per-pixel", "-"),
+                    info.get("pixels-per-second", 0)/1000.0/1000.0,
+                    info["encode-time"]["p50"]/1000.0, info["encode-time"]["p99"]/1000.0,
+                    info["latency"]["p50"]/1000.0, info["latency"]["p99"]/1000.0)))
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
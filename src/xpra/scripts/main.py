@@ -194,11 +194,12 @@ def do_parse_cmdline(cmdline, defaults):
                         "\t%prog attach [DISPLAY]\n",
                         "\t%prog detach [DISPLAY]\n",
                         "\t%prog screenshot filename [DISPLAY]\n",
-                        "\t%prog info [DISPLAY]\n",
+                        "\t%prog info [DISPLAY] [PATTERN]...\n",
                         "\t%prog control DISPLAY command [arg1] [arg2]..\n",
                         "\t%prog print DISPLAY filename",
                         "\t%prog version [DISPLAY]\n"
                         "\t%prog showconfig\n"
+                        "\t%prog codec-calibrate [CODEC]...\n"
                       ]
     server_modes = []
     if supports_server:
@@ -562,6 +563,10 @@ def do_parse_cmdline(cmdline, defaults):
                       metavar="SPEED",
                       dest="speed", type="int", default=defaults.speed,
                       help="Use image compression with the given encoding speed, from 1 to 100, 0 to use automatic setting. Default: %default.")
+    group.add_option("--bandwidth-limit", action="store",
+                      metavar="BANDWIDTH",
+                      dest="bandwidth_limit", default=defaults.bandwidth_limit,
+                      help="Limit the bandwidth used for sending window updates, ie: '10Mbps' or '512K' (in bits per second), empty or 0 for no limit. Default: '%default'.")
     group.add_option("--auto-refresh-delay", action="store",
                       dest="auto_refresh_delay", type="float", default=defaults.auto_refresh_delay,
                       metavar="DELAY",
@@ -919,7 +924,7 @@ def show_sound_codec_help(is_server, speaker_codecs, microphone_codecs):
 
 def configure_logging(options, mode):
     to = sys.stderr
-    if mode in ("showconfig", "info", "control", "list", "attach", "stop", "version", "print", "opengl"):
+    if mode in ("showconfig", "info", "control", "list", "attach", "stop", "version", "print", "opengl", "codec-calibrate"):
         to = sys.stdout
     if mode in ("start", "upgrade", "attach", "shadow", "proxy", "_sound_record", "_sound_play", "stop", "print", "showconfig"):
         if "help" in options.speaker_codec or "help" in options.microphone_codec:
@@ -1030,6 +1035,9 @@ def run_mode(script_file, error_cb, options, args, mode, defaults):
             return 0
         elif mode == "showconfig":
             return run_showconfig(options, args)
+        elif mode == "codec-calibrate":
+            from xpra.codecs.codec_calibration import run_calibration
+            return run_calibration(args)
         else:
             error_cb("invalid mode '%s'" % mode)
             return 1
@@ -1506,7 +1514,11 @@ def run_client(error_cb, opts, extra_args, mode):
         app = ScreenshotXpraClient(connect(), opts, screenshot_filename)
     elif mode=="info":
         from xpra.client.gobject_client_base import InfoXpraClient
+        #the arguments after the display select parts of the info, ie: "client.*.window.*.encoding"
+        info_select = extra_args[1:]
+        extra_args = extra_args[:1]
         app = InfoXpraClient(connect(), opts)
+        app.info_select = info_select
     elif mode=="_monitor":
         from xpra.client.gobject_client_base import MonitorXpraClient
         app = MonitorXpraClient(connect(), opts)
@@ -0,0 +1,241 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Estimates the bandwidth available for sending damage packets to a client,
+# from the byte counts recorded as the packets are sent and from the damage acks,
+# and paces the packets when the client has a bandwidth limit.
+
+import os
+import time
+from math import sqrt
+from collections import deque
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("stats")
+
+from xpra.server.incremental_stats import logp
+
+#how long the delivery rate samples are used for (in seconds):
+RATE_WINDOW = float(os.environ.get("XPRA_BANDWIDTH_RATE_WINDOW", "5"))
+#the minimum round trip time is measured over this period (in seconds):
+RTT_WINDOW = float(os.environ.get("XPRA_BANDWIDTH_RTT_WINDOW", "10"))
+#the send rate is measured over this period (in seconds):
+SEND_WINDOW = float(os.environ.get("XPRA_BANDWIDTH_SEND_WINDOW", "1"))
+#when pacing, how much data we can send in one go (in milliseconds worth of the limit):
+BURST_TIME = int(os.environ.get("XPRA_BANDWIDTH_BURST_TIME", "20"))
+MIN_BURST = 16*1024
+#packets which haven't been acked after this delay are forgotten (in seconds):
+ACK_TIMEOUT = 60
+
+
+class BandwidthEstimator(object):
+    """
+        The delivery rate is sampled when a damage packet is acknowledged:
+        it is the number of bytes acked since the packet was sent,
+        divided by the time it took to deliver them.
+        (the client's decoding time is excluded and the packet's own send time is a lower bound)
+        The estimate is the maximum delivery rate seen over the last RATE_WINDOW seconds,
+        the minimum round trip time gives us the bandwidth delay product,
+        and from there how many bytes we should allow in flight:
+        more than that and the packets are just queuing up somewhere along the link.
+        All the rates are in bits per second.
+    """
+
+    def __init__(self, bandwidth_limit=0):
+        self.lock = Lock()
+        self.bandwidth_limit = bandwidth_limit      #0 for unlimited
+        self.reset()
+
+    def __repr__(self):
+        return "BandwidthEstimator(%s)" % self.bandwidth_limit
+
+    def reset(self):
+        with self.lock:
+            self.delivered = 0                      #number of bytes acknowledged
+            self.delivered_time = 0                 #when we received the last ack
+            self.inflight = {}                      #(wid, sequence) -> (start_time, end_time, bytecount, delivered, delivered_time)
+            self.inflight_bytes = 0
+            self.max_rates = deque()                #sliding window maximum: (event_time, rate)
+            self.min_rtts = deque()                 #sliding window minimum: (event_time, rtt)
+            self.sent = deque()                     #(event_time, bytecount)
+            self.sent_bytes = 0                     #total for the records in 'sent'
+            self.tokens = 0                         #bytes we can send now (may be negative)
+            self.tokens_time = 0
+            self.samples = 0
+            self.paced = 0
+
+    def set_bandwidth_limit(self, bandwidth_limit):
+        log("set_bandwidth_limit(%s)", bandwidth_limit)
+        self.bandwidth_limit = max(0, int(bandwidth_limit or 0))
+
+    def record_send(self, key, start_time, end_time, bytecount):
+        """ a damage packet has been written to the connection """
+        if bytecount<=0:
+            return
+        with self.lock:
+            if not self.inflight:
+                #nothing was in flight, so we were not using the link:
+                #start measuring the delivery rate from this packet
+                self.delivered_time = start_time
+            self.inflight[key] = (start_time, end_time, bytecount, self.delivered, self.delivered_time)
+            self.inflight_bytes += bytecount
+            self.sent.append((end_time, bytecount))
+            self.sent_bytes += bytecount
+            self._expire_sent(end_time)
+            if self.bandwidth_limit>0:
+                self._update_tokens(end_time)
+                self.tokens -= bytecount
+
+    def record_ack(self, key, ack_time, decode_time=0):
+        """
+            The client has acknowledged the damage packet,
+            the decode time is in seconds.
+        """
+        with self.lock:
+            v = self.inflight.pop(key, None)
+            if v is None:
+                return
+            start_time, end_time, bytecount, delivered, delivered_time = v
+            self.inflight_bytes -= bytecount
+            #when the packet was received, more or less:
+            t = max(end_time, ack_time-max(0, decode_time))
+            self.delivered += bytecount
+            self.delivered_time = max(self.delivered_time, t)
+            self._add_sample(self.min_rtts, RTT_WINDOW, t, t-end_time, lambda a,b : a<=b)
+            interval = max(end_time-start_time, self.delivered_time-delivered_time)
+            if interval>0:
+                rate = (self.delivered-delivered)*8.0/interval
+                self._add_sample(self.max_rates, RATE_WINDOW, t, rate, lambda a,b : a>=b)
+                self.samples += 1
+
+    def _add_sample(self, samples, window, event_time, value, better):
+        #only keep the samples which may become the best value:
+        while samples and better(value, samples[-1][1]):
+            samples.pop()
+        samples.append((event_time, value))
+        while samples[0][0]<event_time-window:
+            samples.popleft()
+
+    def _expire_sent(self, now):
+        sent = self.sent
+        while sent and sent[0][0]<now-SEND_WINDOW:
+            self.sent_bytes -= sent.popleft()[1]
+
+    def _expire_inflight(self, now):
+        expired = [k for k,v in self.inflight.items() if v[0]<now-ACK_TIMEOUT]
+        for k in expired:
+            self.inflight_bytes -= self.inflight.pop(k)[2]
+
+    def _update_tokens(self, now):
+        limit = self.bandwidth_limit
+        burst = max(MIN_BURST, limit/8*BURST_TIME//1000)
+        elapsed = now-self.tokens_time
+        if elapsed>0:
+            self.tokens = min(burst, self.tokens+elapsed*limit/8)
+            self.tokens_time = now
+
+    def get_estimate(self):
+        """ the estimated bandwidth, or 0 if we don't have any data """
+        with self.lock:
+            if not self.max_rates:
+                return 0
+            return int(self.max_rates[0][1])
+
+    def get_min_rtt(self):
+        with self.lock:
+            if not self.min_rtts:
+                return 0
+            return self.min_rtts[0][1]
+
+    def get_send_rate(self, now=None):
+        with self.lock:
+            self._expire_sent(now or time.time())
+            return int(self.sent_bytes*8/SEND_WINDOW)
+
+    def get_target_rate(self):
+        """ the rate we should not exceed: the limit or what we think the link can take """
+        estimate = self.get_estimate()
+        limit = self.bandwidth_limit
+        if limit>0 and estimate>0:
+            return min(limit, estimate)
+        return limit or estimate
+
+    def get_pacing_delay(self, now=None):
+        """ how long we should wait before sending the next damage packet (in seconds) """
+        limit = self.bandwidth_limit
+        if limit<=0:
+            return 0
+        with self.lock:
+            self._update_tokens(now or time.time())
+            if self.tokens>=0:
+                return 0
+            self.paced += 1
+            return -self.tokens*8.0/limit
+
+    def get_load(self, now=None):
+        """
+            How close we are to the capacity available:
+            1.0 means that we are using all the bandwidth we should,
+            higher values mean that we are sending too much,
+            either because the send rate exceeds the bandwidth limit
+            or because too many bytes are waiting to be delivered.
+            (we can't compare the send rate with the estimate,
+            since the estimate never exceeds what we actually send)
+            Returns None until we have a limit or an estimate.
+        """
+        now = now or time.time()
+        load = None
+        limit = self.bandwidth_limit
+        if limit>0:
+            load = self.get_send_rate(now)/float(limit)
+        rtt = self.get_min_rtt()
+        estimate = self.get_estimate()
+        if rtt>0 and estimate>0:
+            with self.lock:
+                self._expire_inflight(now)
+                inflight = self.inflight_bytes
+            #allow twice the bandwidth delay product to be in flight:
+            bdp = max(MIN_BURST, estimate/8*rtt)
+            load = max(load or 0, inflight/(2.0*bdp))
+        return load
+
+    def get_factor(self, now=None):
+        """ the batch delay factor, in the format used by calculate_batch_delay """
+        load = self.get_load(now)
+        if load is None:
+            return None
+        factor = min(4.0, max(0.5, sqrt(load)))
+        if load>1:
+            #too much data: slow down quickly
+            weight = logp(load-1.0)*4.0
+        else:
+            #we have some spare capacity:
+            weight = (1.0-load)/4.0
+        info = {"load"      : int(100.0*load),
+                "target"    : self.get_target_rate()}
+        return "bandwidth", info, factor, weight
+
+    def get_info(self):
+        info = {
+                "estimate"  : self.get_estimate(),
+                "send-rate" : self.get_send_rate(),
+                "samples"   : self.samples,
+                "inflight"  : {
+                               "packets"    : len(self.inflight),
+                               "bytes"      : self.inflight_bytes,
+                               },
+                }
+        rtt = self.get_min_rtt()
+        if rtt>0:
+            info["min-rtt"] = int(1000*rtt)
+        target = self.get_target_rate()
+        if target>0:
+            info["target"] = target
+        if self.bandwidth_limit>0:
+            info["limit"] = self.bandwidth_limit
+            info["paced"] = self.paced
+        return info
@@ -190,6 +190,15 @@ def queue_inspect(metric, time_values, float target=1.0, float div=1.0, smoothin
     #inspect a queue size history: figure out if things are better or worse than before
     if len(time_values)==0:
         return  metric, {}, 1.0, 0.0
-    avg, recent = calculate_time_weighted_average(list(time_values))
+    return queue_inspect_averages(metric, calculate_time_weighted_average(list(time_values)), target, div, smoothing)
+
+def queue_inspect_averages(metric, averages, float target=1.0, float div=1.0, smoothing=logp):
+    """
+        Same as queue_inspect, but using the average and recent values
+        which have already been calculated (ie: by incremental_stats)
+    """
+    if not averages:
+        return  metric, {}, 1.0, 0.0
+    avg, recent = averages
     weight_multiplier = sqrt(max(avg, recent) / div / target)
     return  calculate_for_target(metric, target, avg, recent, aim=0.25, div=div, slope=1.0, smoothing=smoothing, weight_multiplier=weight_multiplier)
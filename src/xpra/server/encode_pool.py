@@ -0,0 +1,231 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.os_util import Queue
+from xpra.make_thread import make_thread
+from xpra.thread_pool import ThreadPool
+
+
+NOYIELD = os.environ.get("XPRA_YIELD") is None
+try:
+    ENCODE_THREADS = max(1, int(os.environ.get("XPRA_ENCODE_THREADS", "1")))
+except:
+    ENCODE_THREADS = 1
+
+def get_default_slice_threads():
+    try:
+        from multiprocessing import cpu_count
+        return min(8, cpu_count())
+    except:
+        return 1
+try:
+    SLICE_THREADS = int(os.environ.get("XPRA_SLICE_THREADS", get_default_slice_threads()))
+except:
+    SLICE_THREADS = 1
+
+
+class EncodeWorker(object):
+    """
+        A single encode thread with its own work queue.
+        Items are called in the order they were queued.
+    """
+
+    def __init__(self, name, is_closed):
+        self.name = name
+        self.is_closed = is_closed
+        self.work_queue = Queue()
+        self.busy_time = 0.0
+        self.items_processed = 0
+        self.current_start = 0
+        self.max_qsize = 0
+        self.thread = make_thread(self.encode_loop, name)
+
+    def __repr__(self):
+        return "EncodeWorker(%s)" % self.name
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        #end of queue marker:
+        self.work_queue.put(None)
+
+    def qsize(self):
+        return self.work_queue.qsize()
+
+    def add(self, fn_and_args):
+        self.work_queue.put(fn_and_args)
+        self.max_qsize = max(self.max_qsize, self.work_queue.qsize())
+
+    def encode_loop(self):
+        """
+            This runs in a separate thread and calls all the function callbacks
+            which are added to the 'work_queue'.
+            Must run until we hit the end of queue marker,
+            to ensure all the queued items get called.
+        """
+        while not self.is_closed():
+            fn_and_args = self.work_queue.get(True)
+            if fn_and_args is None:
+                return              #empty marker
+            self.current_start = time.time()
+            try:
+                fn_and_args[0](*fn_and_args[1:])
+            except Exception as e:
+                if self.is_closed():
+                    log("ignoring encoding error in %s as source is already closed:", fn_and_args[0])
+                    log(" %s", e)
+                    return
+                log.error("Error during encoding:", exc_info=True)
+            finally:
+                self.busy_time += time.time()-self.current_start
+                self.current_start = 0
+                self.items_processed += 1
+            NOYIELD or time.sleep(0)
+
+    def get_info(self):
+        busy = self.busy_time
+        if self.current_start>0:
+            busy += time.time()-self.current_start
+        return {
+                "queue"     : {
+                               "size"   : self.work_queue.qsize(),
+                               "max"    : self.max_qsize,
+                               },
+                "busy"      : int(busy*1000),
+                "items"     : self.items_processed,
+                "active"    : self.current_start>0,
+                }
+
+
+class EncodeWorkerPool(object):
+    """
+        Dispatches encoding work to a pool of encode threads.
+        All the work for a given window id is always handled by the same worker,
+        so the frames of a window are encoded in the order they were queued,
+        but different windows can be encoded concurrently.
+        Non window specific work (clipboard, etc) uses the window id 0.
+    """
+
+    def __init__(self, is_closed, nworkers=ENCODE_THREADS):
+        assert nworkers>0, "invalid number of encode workers: %s" % nworkers
+        self.workers = []
+        for i in range(nworkers):
+            name = "encode"
+            if i>0:
+                name = "encode-%i" % i
+            self.workers.append(EncodeWorker(name, is_closed))
+        self.assignments = {}
+        self.single_worker = False
+        self.lock = Lock()
+        log("EncodeWorkerPool(%s, %i)", is_closed, nworkers)
+
+    def __repr__(self):
+        return "EncodeWorkerPool(%i)" % len(self.workers)
+
+    def start(self):
+        for w in self.workers:
+            w.start()
+
+    def stop(self):
+        for w in self.workers:
+            w.stop()
+
+    def use_single_worker(self):
+        """
+            Encode all the windows using the first worker,
+            must be called before any window work is queued.
+        """
+        with self.lock:
+            log("%s: using a single worker", self)
+            self.single_worker = True
+            self.assignments = {}
+
+    def get_threads(self):
+        return [w.thread for w in self.workers]
+
+    def get_worker(self, wid):
+        """
+            Returns the worker assigned to this window,
+            new windows are given to the worker with the smallest queue.
+        """
+        w = self.assignments.get(wid)
+        if w is not None:
+            return w
+        with self.lock:
+            w = self.assignments.get(wid)
+            if w is None:
+                if len(self.workers)==1 or self.single_worker:
+                    w = self.workers[0]
+                else:
+                    counts = dict((x, 0) for x in self.workers)
+                    for x in self.assignments.values():
+                        counts[x] += 1
+                    w = sorted(self.workers, key=lambda x : (x.qsize(), counts[x]))[0]
+                self.assignments[wid] = w
+                log("window %i assigned to %s", wid, w)
+        return w
+
+    def release(self, wid):
+        """
+            Forget the worker assignment for this window,
+            the caller must ensure that no more work is queued for it.
+        """
+        with self.lock:
+            try:
+                del self.assignments[wid]
+            except KeyError:
+                pass
+
+    def queue(self, wid, fn_and_args):
+        self.get_worker(wid).add(fn_and_args)
+
+    def qsize(self, wid=None):
+        if wid is None:
+            return sum(w.qsize() for w in self.workers)
+        return self.get_worker(wid).qsize()
+
+    def get_info(self):
+        winfo = {}
+        for i, w in enumerate(self.workers):
+            wi = w.get_info()
+            wi["name"] = w.name
+            wi["windows"] = sorted(wid for wid,x in list(self.assignments.items()) if x==w and wid>0)
+            winfo[i] = wi
+        return {
+                "workers"   : len(self.workers),
+                "worker"    : winfo,
+                "size"      : {"current" : self.qsize()},
+                }
+
+
+class SliceEncodePool(ThreadPool):
+    """
+        A pool of threads shared by all the window sources,
+        used for encoding the slices of a single large frame concurrently.
+        (this works because the picture encoders release the GIL)
+    """
+
+    def __init__(self, nthreads=SLICE_THREADS):
+        ThreadPool.__init__(self, "slice-encode", nthreads)
+
+    def __repr__(self):
+        return "SliceEncodePool(%i)" % self.nthreads
+
+
+_slice_pool = None
+def get_slice_pool():
+    global _slice_pool
+    if _slice_pool is None:
+        _slice_pool = SliceEncodePool()
+    return _slice_pool
@@ -0,0 +1,231 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Statistics which are updated as records are added,
+# so they can be queried in constant time.
+
+import os
+from array import array
+from threading import Lock
+from collections import deque
+from math import exp, log
+
+#the "average" and "recent" values decay exponentially with these time constants (in seconds):
+AVG_PERIOD = float(os.environ.get("XPRA_STATS_AVG_PERIOD", "5"))
+RECENT_PERIOD = float(os.environ.get("XPRA_STATS_RECENT_PERIOD", "0.25"))
+
+
+def logp(x):
+    return log(1.0+x)*1.4426950408889634
+
+
+class TimeWeightedAverage(object):
+    """
+        Maintains two time-weighted averages of a series of values,
+        where recent values matter a lot more than more ancient ones:
+        the weight of each value decays exponentially with its age,
+        the "recent" average decays much faster than the "average".
+        Since all the weights decay at the same rate,
+        the averages only change when a new value is added.
+    """
+    __slots__ = ("avg_period", "recent_period", "last_time", "count", "tv", "tw", "rv", "rw")
+
+    def __init__(self, avg_period=AVG_PERIOD, recent_period=RECENT_PERIOD):
+        self.avg_period = avg_period
+        self.recent_period = recent_period
+        self.reset()
+
+    def __repr__(self):
+        return "TimeWeightedAverage(%s)" % (self.get(),)
+
+    def __len__(self):
+        return self.count
+
+    def reset(self):
+        self.last_time = 0
+        self.count = 0
+        self.tv = 0.0
+        self.tw = 0.0
+        self.rv = 0.0
+        self.rw = 0.0
+
+    def add(self, event_time, value, weight=1.0):
+        if weight<=0:
+            return
+        self.count += 1
+        delta = event_time-self.last_time
+        if delta>=0:
+            #decay the existing values:
+            self.last_time = event_time
+            ad = exp(-delta/self.avg_period)
+            rd = exp(-delta/self.recent_period)
+            self.tv *= ad
+            self.tw *= ad
+            self.rv *= rd
+            self.rw *= rd
+            aw = rw = weight
+        else:
+            #this record is older than the last one:
+            aw = weight*exp(delta/self.avg_period)
+            rw = weight*exp(delta/self.recent_period)
+        self.tv += value*aw
+        self.tw += aw
+        self.rv += value*rw
+        self.rw += rw
+
+    def get(self):
+        """ returns the average and recent values, or None if we don't have any data """
+        if self.tw<=0 or self.rw<=0:
+            return None
+        return self.tv/self.tw, self.rv/self.rw
+
+
+class RingBuffer(object):
+    """
+        A fixed size buffer of numeric records, stored in one typed array per field.
+        It can be used like the 'deque(maxlen=N)' it replaces:
+        append a tuple, iterate over it, index it or get its length.
+        The minimum of the 'min_field' is maintained as records are added and dropped.
+        Records can be added from any thread.
+    """
+
+    def __init__(self, maxlen, nfields, typecode="d", min_field=None):
+        self.maxlen = maxlen
+        self.nfields = nfields
+        self.fields = [array(typecode, [0]*maxlen) for _ in range(nfields)]
+        self.min_field = min_field
+        self.lock = Lock()
+        self.clear()
+
+    def __repr__(self):
+        return "RingBuffer(%i/%i)" % (self.count, self.maxlen)
+
+    def clear(self):
+        self.index = 0          #where the next record goes
+        self.count = 0
+        self.added = 0          #total number of records added
+        self.min_values = deque()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, record):
+        with self.lock:
+            self.do_append(record)
+
+    def do_append(self, record):
+        assert len(record)==self.nfields, "expected %i fields but got %i" % (self.nfields, len(record))
+        i = self.index
+        for f, v in zip(self.fields, record):
+            f[i] = v
+        self.index = (i+1) % self.maxlen
+        self.count = min(self.maxlen, self.count+1)
+        mf = self.min_field
+        if mf is not None:
+            #sliding window minimum: only keep the values which may become the minimum
+            mv = self.min_values
+            v = record[mf]
+            while mv and mv[-1][1]>=v:
+                mv.pop()
+            mv.append((self.added, v))
+            while mv[0][0]<=self.added-self.maxlen:
+                mv.popleft()
+        self.added += 1
+
+    def min(self):
+        """ the minimum value of the 'min_field' """
+        assert self.min_field is not None
+        if not self.min_values:
+            return None
+        return self.min_values[0][1]
+
+    def _pos(self, n):
+        return (self.index-self.count+n) % self.maxlen
+
+    def __getitem__(self, n):
+        if n<0:
+            n += self.count
+        if n<0 or n>=self.count:
+            raise IndexError("ring buffer index out of range")
+        p = self._pos(n)
+        return tuple(f[p] for f in self.fields)
+
+    def __iter__(self):
+        for n in range(self.count):
+            p = self._pos(n)
+            yield tuple(f[p] for f in self.fields)
+
+    def get_field(self, field):
+        """ the values of the given field, oldest first """
+        f = self.fields[field]
+        return [f[self._pos(n)] for n in range(self.count)]
+
+
+class TimeWeightedRecords(RingBuffer):
+    """
+        Records of the form (.., event_time, .., value, ..),
+        we maintain the time-weighted average of the value.
+    """
+
+    def __init__(self, maxlen, nfields, time_field=0, value_field=-1, min_field=None):
+        self.time_field = time_field
+        self.value_field = value_field
+        self.average = TimeWeightedAverage()
+        RingBuffer.__init__(self, maxlen, nfields, min_field=min_field)
+
+    def clear(self):
+        RingBuffer.clear(self)
+        self.average.reset()
+
+    def do_append(self, record):
+        RingBuffer.do_append(self, record)
+        self.average.add(record[self.time_field], record[self.value_field])
+
+    def get_averages(self):
+        return self.average.get()
+
+
+class TimeSizeWeightedRecords(RingBuffer):
+    """
+        Records of the form (event_time, size, elapsed_time),
+        we maintain the time-weighted average of the speed (size*sizeunit/elapsed_time)
+        where the size of each record also gives it a weight boost,
+        so small records don't skew the average.
+        With 'score' set, the records are of the form (event_time, size, value)
+        and we maintain the average value, weighted by the size.
+    """
+
+    def __init__(self, maxlen, sizeunit=1.0, time_field=0, score=False):
+        self.sizeunit = sizeunit
+        self.time_field = time_field
+        self.score = score
+        self.average = TimeWeightedAverage()
+        RingBuffer.__init__(self, maxlen, time_field+3)
+
+    def clear(self):
+        RingBuffer.clear(self)
+        self.average.reset()
+        self.size_total = 0.0
+
+    def do_append(self, record):
+        tf = self.time_field
+        if self.count==self.maxlen:
+            #this record is about to be dropped:
+            self.size_total -= self.fields[tf+1][self.index]
+        RingBuffer.do_append(self, record)
+        event_time, size, value = record[tf:tf+3]
+        self.size_total += size
+        if size<=0:
+            return
+        pw = logp(size/(self.size_total/self.count))
+        if self.score:
+            if value>=0:
+                self.average.add(event_time, value, pw*size)
+        elif value>0:
+            self.average.add(event_time, max(1, size*self.sizeunit/value), pw)
+
+    def get_averages(self):
+        return self.average.get()
@@ -0,0 +1,155 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Caching, selection and delta support for the server info.
+
+import os
+from fnmatch import fnmatch
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("info")
+
+INFO_CACHE = os.environ.get("XPRA_INFO_CACHE", "1")=="1"
+
+
+def copy_dict(d):
+    """ copies the nested dictionaries so the caller can modify them """
+    return dict((k, copy_dict(v) if isinstance(v, dict) else v) for k,v in d.items())
+
+
+class InfoCache(object):
+    """
+        Caches the subtrees of the info dictionary,
+        so frequent info requests don't rebuild the whole tree every time.
+        Each subtree is cached until its owner marks it as dirty by calling invalidate,
+        so only the subtrees which have an owner keeping track of their changes
+        should be cached, the others must be collected every time.
+        Keys are dotted paths (ie: "window.<wid>"),
+        invalidating a key also invalidates all the keys below it.
+    """
+
+    def __init__(self):
+        self.entries = {}               #key -> value
+        self.lock = Lock()
+        #incremented every time some entries are invalidated,
+        #so we don't cache a value which may have been collected before the change:
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "InfoCache(%i)" % len(self.entries)
+
+    def get(self, key, fn, *args):
+        """ returns the cached value for this key, or calls fn to get it """
+        if not INFO_CACHE:
+            return fn(*args)
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.hits += 1
+                return copy_dict(value)
+            self.misses += 1
+            generation = self.generation
+        value = fn(*args)
+        if isinstance(value, dict):
+            with self.lock:
+                if generation==self.generation:
+                    self.entries[key] = copy_dict(value)
+        return value
+
+    def invalidate(self, key=None):
+        """ marks this subtree as dirty, or the whole cache if no key is specified """
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.entries = {}
+                return
+            prefix = key+"."
+            for k in [k for k in self.entries.keys() if k==key or k.startswith(prefix)]:
+                del self.entries[k]
+
+    def get_info(self):
+        return {
+                "enabled"   : INFO_CACHE,
+                "entries"   : len(self.entries),
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                }
+
+
+class InfoSelection(object):
+    """
+        Selects parts of the info dictionary using dotted patterns,
+        each component of a pattern can use wildcards, ie: "client.*.window.*.encoding"
+    """
+
+    def __init__(self, patterns=None):
+        self.patterns = [str(p).split(".") for p in (patterns or []) if p]
+
+    def __repr__(self):
+        return "InfoSelection(%s)" % [".".join(x) for x in self.patterns]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def wants(self, *path):
+        """
+            Returns True if some of the info below this path is selected,
+            so the subtrees which are not can be skipped before they are collected.
+        """
+        if not self.patterns:
+            return True
+        for pattern in self.patterns:
+            if all(fnmatch(str(k), p) for k,p in zip(path, pattern)):
+                return True
+        return False
+
+    def filter(self, info):
+        if not self.patterns:
+            return info
+        selected = {}
+        for pattern in self.patterns:
+            merge_selected(selected, select_info(info, pattern))
+        return selected
+
+
+def select_info(info, pattern):
+    if not pattern:
+        return info
+    selected = {}
+    p = pattern[0]
+    for k,v in info.items():
+        if not fnmatch(str(k), p):
+            continue
+        if len(pattern)==1:
+            selected[k] = v
+        elif isinstance(v, dict):
+            s = select_info(v, pattern[1:])
+            if s:
+                selected[k] = s
+    return selected
+
+def merge_selected(to, d):
+    for k,v in d.items():
+        if isinstance(v, dict) and isinstance(to.get(k), dict):
+            merge_selected(to[k], v)
+        else:
+            to[k] = v
+
+
+def info_delta(previous, current):
+    """
+        Compares two flattened info dictionaries,
+        returns the values which have changed and the list of keys which have been removed.
+    """
+    changed = {}
+    for k,v in current.items():
+        if k not in previous or previous[k]!=v:
+            changed[k] = v
+    removed = [k for k in previous.keys() if k not in current]
+    return changed, removed
@@ -77,7 +77,7 @@ def webp_encode(coding, image, rgb_formats, supports_transparency, quality, spee
 def roundup(n, m):
     return (n + m - 1) & ~(m - 1)
 
-def rgb_encode(coding, image, rgb_formats, supports_transparency, speed, rgb_zlib=True, rgb_lz4=True, rgb_lzo=False):
+def rgb_encode(coding, image, rgb_formats, supports_transparency, speed, rgb_zlib=True, rgb_lz4=True, rgb_lzo=False, chooser=None):
     pixel_format = image.get_pixel_format()
     #log("rgb_encode%s pixel_format=%s, rgb_formats=%s", (coding, image, rgb_formats, supports_transparency, speed, rgb_zlib, rgb_lz4), pixel_format, rgb_formats)
     if pixel_format not in rgb_formats:
@@ -112,8 +112,21 @@ def rgb_encode(coding, image, rgb_formats, supports_transparency, speed, rgb_zli
         if len(pixels)<1024:
             #fewer pixels, make it more likely we won't bother compressing:
             level = level // 2
+    if level>0 and chooser:
+        #let the chooser pick the compressor (if any) that will be fastest for this link:
+        allowed = [x for x, enabled in {"lz4" : rgb_lz4 and compression.use_lz4,
+                                        "lzo" : rgb_lzo and compression.use_lzo,
+                                        "zlib": rgb_zlib and compression.use_zlib}.items() if enabled]
+        algo, level = chooser.choose(coding, len(pixels), allowed, level)
+        if algo=="none":
+            chooser.record(coding, algo, level, len(pixels), len(pixels), 0)
+            algo = "not"
+            level = 0
     if level>0:
-        if rgb_lz4 and compression.use_lz4:
+        start = time.time()
+        if chooser:
+            cwrapper = compression.compressed_wrapper(coding, pixels, level=level, **{algo : True})
+        elif rgb_lz4 and compression.use_lz4:
             cwrapper = compression.compressed_wrapper(coding, pixels, lz4=True)
             algo = "lz4"
             level = 1
@@ -126,6 +139,8 @@ def rgb_encode(coding, image, rgb_formats, supports_transparency, speed, rgb_zli
             algo = "zlib"
         else:
             cwrapper = None
+        if chooser and cwrapper is not None:
+            chooser.record(coding, algo, level, len(pixels), len(cwrapper), time.time()-start)
         if cwrapper is None or len(cwrapper)>=(len(pixels)-32):
             #no compression is enabled, or compressed is actually bigger!
             #(fall through to uncompressed)
@@ -250,7 +265,7 @@ def rgb_reformat(image, rgb_formats, supports_transparency):
     return True
 
 
-def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency):
+def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency, mmap_writer=None):
     if mmap_write is None:
         warn_encoding_once("mmap_write missing", "cannot use mmap!")
         return None
@@ -262,10 +277,14 @@ def mmap_send(mmap, mmap_size, image, rgb_formats, supports_transparency):
     start = time.time()
     data = image.get_pixels()
     assert data, "failed to get pixels from %s" % image
-    mmap_data, mmap_free_size = mmap_write(mmap, mmap_size, data)
+    mmap_options = {}
+    if mmap_writer:
+        mmap_data, mmap_free_size, mmap_options = mmap_writer.write(data)
+    else:
+        mmap_data, mmap_free_size = mmap_write(mmap, mmap_size, data)
     elapsed = time.time()-start+0.000000001 #make sure never zero!
     log("%s MBytes/s - %s bytes written to mmap in %.1f ms", int(len(data)/elapsed/1024/1024), len(data), 1000*elapsed)
     if mmap_data is None:
         return None
     #replace pixels with mmap info:
-    return mmap_data, mmap_free_size, len(data)
+    return mmap_data, mmap_free_size, len(data), mmap_options
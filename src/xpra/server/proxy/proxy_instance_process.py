@@ -39,6 +39,11 @@ from multiprocessing import Process
 PROXY_QUEUE_SIZE = int(os.environ.get("XPRA_PROXY_QUEUE_SIZE", "10"))
 #for testing only: passthrough as RGB:
 PASSTHROUGH = os.environ.get("XPRA_PROXY_PASSTHROUGH", "0")=="1"
+#forward the pixel data and other large chunks as they are, without decompressing them
+#and without going through the encode thread (only when we don't proxy video):
+SPLICE = os.environ.get("XPRA_PROXY_SPLICE", "1")=="1"
+#(zstd frames may depend on the dictionaries negotiated with each peer)
+SPLICE_COMPRESSORS = ("lz4", "lzo", "zlib")
 MAX_CONCURRENT_CONNECTIONS = 20
 VIDEO_TIMEOUT = 5                  #destroy video encoder after N seconds of idle state
 
@@ -90,6 +95,7 @@ class ProxyInstanceProcess(Process):
         self.video_encoder_types = None
         self.video_helper = None
         self.lost_windows = None
+        self.splice = False
         #for handling the local unix domain socket:
         self.control_socket = None
         self.control_socket_thread = None
@@ -184,6 +190,12 @@ class ProxyInstanceProcess(Process):
             self.server_protocol.large_packets.append("send-file")
         self.server_protocol.set_compression_level(self.session_options.get("compression_level", 0))
         self.server_protocol.enable_default_encoder()
+        #proxy video encoding needs the actual pixels:
+        self.splice = SPLICE and not PASSTHROUGH and not self.video_encoding_defs
+        if self.splice:
+            #the client's capabilities tell us which chunks we can forward to it:
+            self.server_protocol.passthrough_compressors = self.get_splice_compressors(self.caps)
+        log("splice=%s", self.splice)
 
         self.lost_windows = set()
         self.encode_queue = Queue()
@@ -358,11 +370,17 @@ class ProxyInstanceProcess(Process):
         return {"proxy" : {
                            "version"    : local_version,
                            ""           : sinfo,
+                           "splice"     : self.splice,
                            },
                 "window" : self.get_window_info(),
                 }
 
 
+    def get_splice_compressors(self, caps):
+        """ the compressed chunks we can forward as they are to the peer with these capabilities """
+        return set(["none"]+[x for x in SPLICE_COMPRESSORS if caps.boolget(x, x=="zlib")])
+
+
     def sanitize_session_options(self, options):
         d = {}
         def number(k, v):
@@ -371,6 +389,7 @@ class ProxyInstanceProcess(Process):
                             "lz4"               : parse_bool,
                             "lzo"               : parse_bool,
                             "zlib"              : parse_bool,
+                            "zstd"              : parse_bool,
                             "rencode"           : parse_bool,
                             "bencode"           : parse_bool,
                             "yaml"              : parse_bool}
@@ -385,7 +404,7 @@ class ProxyInstanceProcess(Process):
         return d
 
     def filter_client_caps(self, caps):
-        fc = self.filter_caps(caps, ("cipher", "digest", "aliases", "compression", "lz4", "lz0", "zlib"))
+        fc = self.filter_caps(caps, ("cipher", "digest", "aliases", "compression", "lz4", "lz0", "zlib", "zstd"))
         #update with options provided via config if any:
         fc.update(self.session_options)
         #add video proxies if any:
@@ -526,6 +545,9 @@ class ProxyInstanceProcess(Process):
     def _packet_recompress(self, packet, index, name):
         if len(packet)>index:
             data = packet[index]
+            if isinstance(data, Compressed):
+                #pass-through: forward it as it is
+                return
             if len(data)<512:
                 packet[8] = str(data)
                 return
@@ -557,10 +579,11 @@ class ProxyInstanceProcess(Process):
             caps = self.filter_server_caps(c)
             #add new encryption caps:
             if self.cipher:
-                from xpra.net.crypto import crypto_backend_init, new_cipher_caps, DEFAULT_PADDING
+                from xpra.net.crypto import crypto_backend_init, new_cipher_caps, DEFAULT_PADDING, DEFAULT_MODE
                 crypto_backend_init()
                 padding_options = self.caps.strlistget("cipher.padding.options", [DEFAULT_PADDING])
-                auth_caps = new_cipher_caps(self.client_protocol, self.cipher, self.encryption_key, padding_options)
+                mode_options = self.caps.strlistget("cipher.mode.options", [DEFAULT_MODE])
+                auth_caps = new_cipher_caps(self.client_protocol, self.cipher, self.encryption_key, padding_options, mode_options)
                 caps.update(auth_caps)
             #may need to bump packet size:
             proto.max_packet_size = maxw*maxh*4*4
@@ -569,6 +592,9 @@ class ProxyInstanceProcess(Process):
             file_max_packet_size = int(file_transfer) * (1024 + file_size_limit*1024*1024)
             self.client_protocol.max_packet_size = max(self.client_protocol.max_packet_size, file_max_packet_size)
             self.server_protocol.max_packet_size = max(self.server_protocol.max_packet_size, file_max_packet_size)
+            if self.splice:
+                #and now we know which chunks we can forward to the server:
+                self.client_protocol.passthrough_compressors = self.get_splice_compressors(c)
             packet = ("hello", caps)
         elif packet_type=="info-response":
             #adds proxy info:
@@ -584,6 +610,10 @@ class ProxyInstanceProcess(Process):
             self.encode_queue.put(packet)
             #and fall through so tell the client immediately
         elif packet_type=="draw":
+            if self.splice:
+                #the pixel data is forwarded as it is:
+                self.queue_client_packet(packet)
+                return
             #use encoder thread:
             self.encode_queue.put(packet)
             #which will queue the packet itself when done:
@@ -257,7 +257,7 @@ class ProxyServer(ServerCore):
         if sessions:
             uid, gid = sessions[:2]
             if uid==os.getuid() and gid==os.getgid():
-                info.update(ServerCore.get_info(self, proto))
+                info.update(ServerCore.get_info(self, proto, *args))
                 self.reap()
                 i = 0
                 for p,v in self.processes.items():
@@ -32,10 +32,11 @@ webcamlog = Logger("webcam")
 from xpra.keyboard.mask import DEFAULT_MODIFIER_MEANINGS
 from xpra.server.server_core import ServerCore, get_thread_info
 from xpra.server.control_command import ArgsControlCommand, ControlError
+from xpra.server.info_cache import InfoSelection, info_delta
 from xpra.simple_stats import to_std_unit
 from xpra.child_reaper import getChildReaper
-from xpra.os_util import BytesIOClass, thread, get_hex_uuid, livefds, load_binary_file
-from xpra.util import typedict, flatten_dict, updict, log_screen_sizes, engs, repr_ellipsized, csv, iround, \
+from xpra.os_util import BytesIOClass, thread, get_hex_uuid, livefds
+from xpra.util import typedict, flatten_dict, updict, log_screen_sizes, engs, repr_ellipsized, csv, iround, parse_with_unit, \
     SERVER_EXIT, SERVER_ERROR, SERVER_SHUTDOWN, DETACH_REQUEST, NEW_CLIENT, DONE, IDLE_TIMEOUT
 from xpra.net.bytestreams import set_socket_timeout
 from xpra.platform import get_username
@@ -45,7 +46,9 @@ from xpra.scripts.config import python_platform, parse_bool_or_int, FALSE_OPTION
 from xpra.scripts.main import sound_option
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, PROBLEMATIC_ENCODINGS, load_codecs, codec_versions, has_codec, get_codec
 from xpra.codecs.video_helper import getVideoHelper, ALL_VIDEO_ENCODER_OPTIONS, ALL_CSC_MODULE_OPTIONS
+from xpra.server.window.codec_pool import get_codec_pool
 from xpra.net.file_transfer import FileTransferHandler
+from xpra.server.window.shared_encode import SharedEncodeCache, SHARED_ENCODE
 if sys.version > '3':
     unicode = str           #@ReservedAssignment
 
@@ -92,6 +95,8 @@ class ServerBase(ServerCore, FileTransferHandler):
 
         # This must happen early, before loading in windows at least:
         self._server_sources = {}
+        #the last info sent to each protocol, for info requests in delta mode:
+        self.info_snapshots = {}
 
         #so clients can store persistent attributes on windows:
         self.client_properties = {}
@@ -110,8 +115,10 @@ class ServerBase(ServerCore, FileTransferHandler):
         self.default_min_quality = 0
         self.default_speed = -1
         self.default_min_speed = 0
+        self.bandwidth_limit = 0
         self.pulseaudio = False
         self.sharing = False
+        self.shared_encode_cache = None
         self.bell = False
         self.cursors = False
         self.default_dpi = 96
@@ -220,8 +227,14 @@ class ServerBase(ServerCore, FileTransferHandler):
         self.default_min_quality = opts.min_quality
         self.default_speed = opts.speed
         self.default_min_speed = opts.min_speed
+        try:
+            self.bandwidth_limit = parse_with_unit(opts.bandwidth_limit)
+        except ValueError as e:
+            log.warn("Warning: invalid bandwidth limit '%s': %s", opts.bandwidth_limit, e)
         self.pulseaudio = opts.pulseaudio
         self.sharing = opts.sharing
+        if self.sharing and SHARED_ENCODE:
+            self.shared_encode_cache = SharedEncodeCache()
         self.bell = opts.bell
         self.cursors = opts.cursors
         self.default_dpi = int(opts.dpi)
@@ -645,6 +658,8 @@ class ServerBase(ServerCore, FileTransferHandler):
             "command_request":                      self._process_command_request,
             "printers":                             self._process_printers,
             "send-file":                            self._process_send_file,
+            "send-file-chunk":                      self._process_send_file_chunk,
+            "ack-file-chunk":                       self._process_ack_file_chunk,
             "webcam-start":                         self._process_webcam_start,
             "webcam-stop":                          self._process_webcam_stop,
             "webcam-frame":                         self._process_webcam_frame,
@@ -725,6 +740,7 @@ class ServerBase(ServerCore, FileTransferHandler):
             ArgsControlCommand("send-file",             "sends the file to the client(s)",  min_args=3),
             ArgsControlCommand("compression",           "sets the packet compressor",       min_args=1, max_args=1),
             ArgsControlCommand("encoder",               "sets the packet encoder",          min_args=1, max_args=1),
+            ArgsControlCommand("bandwidth-limit",       "sets the bandwidth limit for window updates (ie: 10Mbps, 0 for none)", min_args=1, max_args=1, validation=[parse_with_unit]),
             #session and clients:
             ArgsControlCommand("client",                "forwards a control command to the client(s)", min_args=1),
             ArgsControlCommand("name",                  "set the session name",             min_args=1, max_args=1),
@@ -834,10 +850,12 @@ class ServerBase(ServerCore, FileTransferHandler):
         if self.notifications_forwarder:
             thread.start_new_thread(self.notifications_forwarder.release, ())
             self.notifications_forwarder = None
+        get_codec_pool().cleanup()
         getVideoHelper().cleanup()
         reaper_cleanup()
         self.cleanup_pulseaudio()
         self.stop_virtual_webcam()
+        self.cleanup_file_transfers()
         ds = self.dbus_server
         if ds:
             ds.cleanup()
@@ -874,6 +892,7 @@ class ServerBase(ServerCore, FileTransferHandler):
             del self._potential_protocols[protocol]
         except:
             pass
+        self.info_snapshots.pop(protocol, None)
         source = self._server_sources.get(protocol)
         if source:
             self.cleanup_source(source)
@@ -881,8 +900,14 @@ class ServerBase(ServerCore, FileTransferHandler):
                 del self._server_sources[protocol]
             except:
                 pass
+            self.update_shared_encode_cache()
         return source
 
+    def update_shared_encode_cache(self):
+        sec = self.shared_encode_cache
+        if sec:
+            sec.set_clients(len([x for x in self._server_sources.values() if x.ui_client]))
+
     def cleanup_source(self, source):
         self.server_event("connection-lost", source.uuid)
         source.close()
@@ -954,7 +979,7 @@ class ServerBase(ServerCore, FileTransferHandler):
             return
         if c.boolget("info_request", False):
             flatten = not c.boolget("info-namespace", False)
-            self.send_hello_info(proto, flatten)
+            self.send_hello_info(proto, flatten, c.strlistget("info-select"))
             return
 
         detach_request  = c.boolget("detach_request", False)
@@ -1047,7 +1072,9 @@ class ServerBase(ServerCore, FileTransferHandler):
                           self.supports_speaker, self.supports_microphone,
                           self.speaker_codecs, self.microphone_codecs,
                           self.default_quality, self.default_min_quality,
-                          self.default_speed, self.default_min_speed)
+                          self.default_speed, self.default_min_speed,
+                          self.bandwidth_limit,
+                          self.shared_encode_cache)
         log("process_hello serversource=%s", ss)
         try:
             ss.parse_hello(c, self.min_mmap_size)
@@ -1057,6 +1084,7 @@ class ServerBase(ServerCore, FileTransferHandler):
             ss.close()
             raise
         self._server_sources[proto] = ss
+        self.update_shared_encode_cache()
         #process ui half in ui thread:
         send_ui = ui_client and not is_request
         self.idle_add(self.parse_hello_ui, ss, c, auth_caps, send_ui, share_count)
@@ -1421,17 +1449,24 @@ class ServerBase(ServerCore, FileTransferHandler):
         sources = self._control_get_sources(client_uuids)
         if not sources:
             raise ControlError("no clients found matching: %s" % client_uuids)
-        data = load_binary_file(actual_filename)
-        file_size_MB = len(data)//1024//1024
+        maxbitrate = self._parse_maxbitrate(maxbitrate)
+        file_size_MB = os.path.getsize(actual_filename)//1024//1024
         if file_size_MB>self.file_size_limit:
             raise ControlError("file '%s' is too large: %iMB (limit is %iMB)" % (filename, file_size_MB, self.file_size_limit))
         for ss in sources:
             if ss.file_transfer:
-                ss.send_file(filename, "", data, False, openit)
+                #the file is streamed from disk:
+                ss.send_file(actual_filename, "", None, False, openit, maxbitrate=maxbitrate)
             else:
                 log.warn("cannot send file, client %s does not support file transfers!", ss)
         return "file transfer of '%s' to %s initiated" % (filename, client_uuids)
 
+    def _parse_maxbitrate(self, maxbitrate):
+        try:
+            return parse_with_unit(maxbitrate)
+        except ValueError as e:
+            raise ControlError("invalid maximum bitrate '%s': %s" % (maxbitrate, e))
+
     def control_command_print(self, filename, printer, client_uuids, maxbitrate=0, title="", *options_strs):
         actual_filename = os.path.abspath(os.path.expanduser(filename))
         try:
@@ -1450,17 +1485,23 @@ class ServerBase(ServerCore, FileTransferHandler):
             argp = arg.split("=", 1)
             if len(argp)==2 and len(argp[0])>0:
                 options[argp[0]] = argp[1]
-        data = load_binary_file(actual_filename)
-        file_size_MB = len(data)//1024//1024
+        maxbitrate = self._parse_maxbitrate(maxbitrate)
+        file_size_MB = os.path.getsize(actual_filename)//1024//1024
         if file_size_MB>self.file_size_limit:
             raise ControlError("file '%s' is too large: %iMB (limit is %iMB)" % (filename, file_size_MB, self.file_size_limit))
         for ss in sources:
             if ss.printing:
-                ss.send_file(filename, "", data, True, True, options)
+                ss.send_file(actual_filename, "", None, True, True, options, maxbitrate)
             else:
                 printlog.warn("client %s does not support printing!", ss)
         return "printing to %s initiated" % client_uuids
 
+    def control_command_bandwidth_limit(self, bandwidth_limit):
+        self.bandwidth_limit = bandwidth_limit
+        for csource in list(self._server_sources.values()):
+            csource.set_bandwidth_limit(bandwidth_limit)
+        return "bandwidth-limit set to %s" % (bandwidth_limit or "unlimited")
+
     def control_command_compression(self, compression):
         c = compression.lower()
         from xpra.net import compression
@@ -1675,8 +1716,28 @@ class ServerBase(ServerCore, FileTransferHandler):
 
 
     def _process_send_file(self, proto, packet):
-        #superclass does not take the protocol as argument:
-        FileTransferHandler._process_send_file(self, packet)
+        #superclass does not take the protocol as argument,
+        #but it needs to know where to send the chunk acks:
+        ss = self._server_sources.get(proto)
+        if not ss:
+            log.warn("Warning: invalid client source for file transfer")
+            return
+        FileTransferHandler._process_send_file(self, packet, ss.send)
+
+    def _process_send_file_chunk(self, proto, packet):
+        ss = self._server_sources.get(proto)
+        if not ss:
+            log.warn("Warning: invalid client source for file chunk")
+            return
+        FileTransferHandler._process_send_file_chunk(self, packet, ss.send)
+
+    def _process_ack_file_chunk(self, proto, packet):
+        #the client is acknowledging a file chunk we sent:
+        ss = self._server_sources.get(proto)
+        if not ss:
+            log.warn("Warning: invalid client source for file chunk ack")
+            return
+        ss._process_ack_file_chunk(packet)
 
     def _process_print(self, proto, packet):
         #ie: from the xpraforwarder we call this command:
@@ -1758,38 +1819,66 @@ class ServerBase(ServerCore, FileTransferHandler):
         log("process_info_request(%s, %s)", proto, packet)
         #ignoring the list of client uuids supplied in packet[1]
         ss = self._server_sources.get(proto)
-        if ss:
-            def info_callback(_proto, info):
-                assert proto==_proto
-                ss.send_info_response(info)
-            self.get_all_info(info_callback, proto, *packet[2:])
-
-    def send_hello_info(self, proto, flatten=True):
+        if not ss:
+            return
+        wids = None
+        if len(packet)>=3:
+            wids = packet[2]
+        options = typedict()
+        if len(packet)>=4:
+            options = typedict(packet[3] or {})
+        selection = InfoSelection(options.strlistget("select"))
+        delta = options.boolget("delta")
+        def info_callback(_proto, info):
+            assert proto==_proto
+            info = selection.filter(info)
+            if delta:
+                info = self.get_info_delta(proto, info)
+            ss.send_info_response(info)
+        self.get_all_info(info_callback, proto, selection, wids)
+
+    def get_info_delta(self, proto, info):
+        """
+            Only returns the values which have changed since the previous request,
+            the keys which have been removed are listed in "delta.removed".
+            (the delta is always flattened)
+        """
+        current = flatten_dict(info)
+        previous = self.info_snapshots.get(proto, {})
+        self.info_snapshots[proto] = current
+        changed, removed = info_delta(previous, current)
+        changed["delta.removed"] = removed
+        return changed
+
+    def send_hello_info(self, proto, flatten=True, select=None):
         start = time.time()
+        selection = InfoSelection(select)
         def cb(proto, info):
-            self.do_send_info(proto, info, flatten)
+            self.do_send_info(proto, selection.filter(info), flatten)
             end = time.time()
             log.info("processed info request from %s in %ims", proto._conn, (end-start)*1000)
-        self.get_all_info(cb, proto, self._id_to_window.keys())
+        self.get_all_info(cb, proto, selection, self._id_to_window.keys())
 
-    def get_ui_info(self, proto, wids=None, *args):
+    def get_ui_info(self, proto, selection=None, wids=None, *args):
         """ info that must be collected from the UI thread
             (ie: things that query the display)
         """
+        wants = (selection or InfoSelection()).wants
         info = {"server"    : {"max_desktop_size"   : self.get_max_screen_size()}}
-        if self.keyboard_config:
+        if self.keyboard_config and wants("keyboard"):
             info["keyboard"] = {"state" : {"modifiers"          : self.keyboard_config.get_current_mask()}}
         #window info:
-        self.add_windows_info(info, wids)
+        if wants("window"):
+            self.add_windows_info(info, wids)
         return info
 
     def get_thread_info(self, proto):
         return get_thread_info(proto, list(self._server_sources.keys()))
 
 
-    def get_info(self, proto=None, client_uuids=None, wids=None, *args):
+    def get_info(self, proto=None, selection=None, client_uuids=None, wids=None, *args):
         start = time.time()
-        info = ServerCore.get_info(self, proto)
+        info = ServerCore.get_info(self, proto, selection)
         if client_uuids:
             sources = [ss for ss in self._server_sources.values() if ss.uuid in client_uuids]
         else:
@@ -1797,7 +1886,7 @@ class ServerBase(ServerCore, FileTransferHandler):
         if not wids:
             wids = self._id_to_window.keys()
         log("info-request: sources=%s, wids=%s", sources, wids)
-        info.update(self.do_get_info(proto, sources, wids))
+        info.update(self.do_get_info(proto, sources, wids, selection))
         info.setdefault("dpi", {}).update({
                              "default"      : self.default_dpi,
                              "value"        : self.dpi,
@@ -1838,6 +1927,7 @@ class ServerBase(ServerCore, FileTransferHandler):
              "bell"             : self.bell,
              "notifications"    : self.notifications_forwarder is not None,
              "sharing"          : self.sharing,
+             "shared-encode"    : self.shared_encode_cache.get_info() if self.shared_encode_cache else False,
              "pulseaudio"       : {
                                    ""           : self.pulseaudio,
                                    "command"    : self.pulseaudio_command,
@@ -1887,25 +1977,31 @@ class ServerBase(ServerCore, FileTransferHandler):
         return {""                          : self.webcam_forwarding,
                 "virtual-video-devices"     : self.virtual_video_devices}
 
-    def do_get_info(self, proto, server_sources=None, window_ids=None):
+    def do_get_info(self, proto, server_sources=None, window_ids=None, selection=None):
         start = time.time()
         info = {"server" : {"python" : {"version" : python_platform.python_version()}}}
-
-        def up(prefix, d):
-            info[prefix] = d
-
-        up("webcam",    self.get_webcam_info())
-        up("file",      self.get_file_transfer_info())
-        up("printing",  self.get_printing_info())
-        up("commands",  self.get_commands_info())
-        up("features",  self.get_features_info())
-        up("clipboard", self.get_clipboard_info())
-        up("keyboard",  self.get_keyboard_info())
-        up("encodings", self.get_encoding_info())
+        wants = (selection or InfoSelection()).wants
+
+        def up(prefix, fn, *args):
+            if wants(prefix):
+                info[prefix] = fn(*args)
+
+        #only the subtrees which are invalidated when they change are cached (see info_cache):
+        cache = self.info_cache
+        up("webcam",    cache.get, "webcam", self.get_webcam_info)
+        up("file",      self.get_file_transfer_info)
+        up("printing",  self.get_printing_info)
+        up("commands",  self.get_commands_info)
+        up("features",  self.get_features_info)
+        up("clipboard", self.get_clipboard_info)
+        up("keyboard",  self.get_keyboard_info)
+        up("encodings", cache.get, "encodings", self.get_encoding_info)
         for k,v in codec_versions.items():
             info.setdefault("encoding", {}).setdefault(k, {})["version"] = v
         # csc and video encoders:
-        up("video",     getVideoHelper().get_info())
+        up("video",     cache.get, "video", getVideoHelper().get_info)
+        if "video" in info:
+            info["video"]["pool"] = get_codec_pool().get_info()
 
         info.setdefault("state", {})["windows"] = len([window for window in list(self._id_to_window.values()) if window.is_managed()])
         # other clients:
@@ -1915,15 +2011,16 @@ class ServerBase(ServerCore, FileTransferHandler):
         n = len(server_sources or [])
         if n==1:
             ss = server_sources[0]
-            up("client", ss.get_info())
-            info.update(ss.get_window_info(window_ids))
-        elif n>1:
+            up("client", ss.get_info)
+            if wants("window"):
+                info.update(ss.get_window_info(window_ids))
+        elif n>1 and wants("client"):
             cinfo = {}
             for i, ss in enumerate(server_sources):
                 sinfo = ss.get_info()
                 sinfo.update(ss.get_window_info(window_ids))
                 cinfo[i] = sinfo
-            up("client", cinfo)
+            info["client"] = cinfo
         log("ServerBase.do_get_info took %ims", (time.time()-start)*1000)
         return info
 
@@ -1932,7 +2029,9 @@ class ServerBase(ServerCore, FileTransferHandler):
         for wid, window in self._id_to_window.items():
             if window_ids is not None and wid not in window_ids:
                 continue
-            winfo.setdefault(wid, {}).update(self.get_window_info(window))
+            wi = self.info_cache.get("window.%s" % wid, self.get_window_info, window)
+            wi.update(self.get_window_state_info(window))
+            winfo.setdefault(wid, {}).update(wi)
 
     def get_window_info(self, window):
         from xpra.server.source import make_window_metadata
@@ -1948,10 +2047,13 @@ class ServerBase(ServerCore, FileTransferHandler):
         info.update({
              "override-redirect"    : window.is_OR(),
              "tray"                 : window.is_tray(),
-             "size"                 : window.get_dimensions(),
              })
         return info
 
+    def get_window_state_info(self, window):
+        """ the window info which changes without a metadata update, never cached """
+        return {"size" : window.get_dimensions()}
+
 
     def clipboard_progress(self, local_requests, remote_requests):
         assert self._clipboard_helper is not None
@@ -1999,6 +2101,7 @@ class ServerBase(ServerCore, FileTransferHandler):
     def _update_metadata(self, window, pspec):
         metalog("updating metadata on %s: %s", window, pspec)
         wid = self._window_to_id[window]
+        self.info_cache.invalidate("window.%s" % wid)
         for ss in self._server_sources.values():
             ss.window_metadata(wid, window, pspec.name)
 
@@ -2500,10 +2603,13 @@ class ServerBase(ServerCore, FileTransferHandler):
                 message = packet[6]
             else:
                 message = ""
+            decode_info = {}
+            if len(packet)>=8:
+                decode_info = packet[7]
             ss = self._server_sources.get(proto)
             if ss:
                 window = self._id_to_window.get(wid)
-                ss.client_ack_damage(packet_sequence, wid, window, width, height, decode_time, message)
+                ss.client_ack_damage(packet_sequence, wid, window, width, height, decode_time, message, typedict(decode_info))
 
 
     def _damage(self, window, x, y, width, height, options=None):
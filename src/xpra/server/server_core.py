@@ -35,11 +35,13 @@ from xpra.os_util import load_binary_file, get_machine_id, get_user_uuid, platfo
 from xpra.version_util import version_compat_check, get_version_info_full, get_platform_info, get_host_info, local_version
 from xpra.net.protocol import Protocol, get_network_caps, sanity_checks
 from xpra.net.crypto import crypto_backend_init, new_cipher_caps, \
-        ENCRYPTION_CIPHERS, ENCRYPT_FIRST_PACKET, DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, DEFAULT_PADDING, ALL_PADDING_OPTIONS
+        ENCRYPTION_CIPHERS, ENCRYPT_FIRST_PACKET, DEFAULT_IV, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, DEFAULT_PADDING, ALL_PADDING_OPTIONS, \
+        INITIAL_MODE, DEFAULT_MODE, choose_mode
 from xpra.server.background_worker import stop_worker, get_worker
 from xpra.make_thread import make_thread
 from xpra.scripts.fdproxy import XpraProxy
 from xpra.server.control_command import ControlError, HelloCommand, HelpCommand, DebugControl
+from xpra.server.info_cache import InfoCache, InfoSelection
 from xpra.util import csv, merge_dicts, typedict, notypedict, flatten_dict, parse_simple_dict, repr_ellipsized, dump_all_frames, \
         SERVER_SHUTDOWN, SERVER_UPGRADE, LOGIN_TIMEOUT, DONE, PROTOCOL_ERROR, SERVER_ERROR, VERSION_ERROR, CLIENT_REQUEST
 
@@ -156,6 +158,7 @@ class ServerCore(object):
         self.unix_socket_paths = []
 
         self.session_name = ""
+        self.info_cache = InfoCache()
 
         #Features:
         self.digest_modes = ("hmac", )
@@ -504,7 +507,7 @@ class ServerCore(object):
         authlog("socktype=%s, auth class=%s, encryption=%s, keyfile=%s", socktype, protocol.auth_class, protocol.encryption, protocol.keyfile)
         if protocol.encryption and ENCRYPT_FIRST_PACKET:
             password = self.get_encryption_key(None, protocol.keyfile)
-            protocol.set_cipher_in(protocol.encryption, DEFAULT_IV, password, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING)
+            protocol.set_cipher_in(protocol.encryption, DEFAULT_IV, password, DEFAULT_SALT, DEFAULT_ITERATIONS, INITIAL_PADDING, INITIAL_MODE)
         protocol.start()
         self.timeout_add(SOCKET_TIMEOUT*1000, self.verify_connection_accepted, protocol)
         return True
@@ -674,7 +677,7 @@ class ServerCore(object):
         if auth_caps is not False:
             if c.boolget("info_request", False):
                 flatten = not c.boolget("info-namespace", False)
-                self.send_hello_info(proto, flatten)
+                self.send_hello_info(proto, flatten, c.strlistget("info-select"))
                 return
             command_req = c.strlistget("command_request")
             if len(command_req)>0:
@@ -733,6 +736,9 @@ class ServerCore(object):
         iterations = c.intget("cipher.key_stretch_iterations")
         padding = c.strget("cipher.padding", DEFAULT_PADDING)
         padding_options = c.strlistget("cipher.padding.options", [DEFAULT_PADDING])
+        #older clients only tell us the mode they expect:
+        mode = c.strget("cipher.mode", DEFAULT_MODE)
+        mode_options = c.strlistget("cipher.mode.options", [mode])
         auth_caps = {}
         if cipher and cipher_iv:
             if cipher not in ENCRYPTION_CIPHERS:
@@ -746,10 +752,17 @@ class ServerCore(object):
             if padding not in ALL_PADDING_OPTIONS:
                 auth_failed("unsupported padding: %s" % padding)
                 return False
+            #we choose the mode we send with from the ones the client supports:
+            try:
+                out_mode = choose_mode(mode_options, cipher)
+            except Exception:
+                authlog("choose_mode(%s, %s)", mode_options, cipher, exc_info=True)
+                auth_failed("unsupported cipher modes: %s" % csv(mode_options))
+                return False
             authlog("set output cipher using encryption key '%s'", repr_ellipsized(encryption_key))
-            proto.set_cipher_out(cipher, cipher_iv, encryption_key, key_salt, iterations, padding)
+            proto.set_cipher_out(cipher, cipher_iv, encryption_key, key_salt, iterations, padding, out_mode)
             #use the same cipher as used by the client:
-            auth_caps = new_cipher_caps(proto, cipher, encryption_key, padding_options)
+            auth_caps = new_cipher_caps(proto, cipher, encryption_key, padding_options, mode_options)
             authlog("server cipher=%s", auth_caps)
         else:
             if proto.encryption:
@@ -844,6 +857,8 @@ class ServerCore(object):
                 return 6, "invalid command"
             commandlog("process_control_command calling %s%s", command.run, args[1:])
             v = command.run(*args[1:])
+            #the command may have changed anything:
+            self.info_cache.invalidate()
             return 0, v
         except ControlError as e:
             commandlog.error("error %s processing control command '%s'", e.code, name)
@@ -909,13 +924,14 @@ class ServerCore(object):
         return capabilities
 
 
-    def send_hello_info(self, proto, flatten=True):
+    def send_hello_info(self, proto, flatten=True, select=None):
         #Note: this can be overriden in subclasses to pass arguments to get_ui_info()
         #(ie: see server_base)
         log.info("processing info request from %s", proto._conn)
+        selection = InfoSelection(select)
         def cb(proto, info):
-            self.do_send_info(proto, info, flatten)
-        self.get_all_info(cb, proto)
+            self.do_send_info(proto, selection.filter(info), flatten)
+        self.get_all_info(cb, proto, selection)
 
     def do_send_info(self, proto, info, flatten):
         if flatten:
@@ -924,16 +940,20 @@ class ServerCore(object):
             info = notypedict(info)
         proto.send_now(("hello", info))
 
-    def get_all_info(self, callback, proto=None, *args):
+    def get_all_info(self, callback, proto=None, selection=None, *args):
+        """
+            The selection is used to skip the subtrees which have not been requested,
+            the callback must still filter the result.
+        """
         start = time.time()
-        ui_info = self.get_ui_info(proto, *args)
+        ui_info = self.get_ui_info(proto, selection, *args)
         end = time.time()
         log("get_all_info: ui info collected in %ims", (end-start)*1000)
         def in_thread(*args):
             start = time.time()
             #this runs in a non-UI thread
             try:
-                info = self.get_info(proto, *args)
+                info = self.get_info(proto, selection, *args)
                 merge_dicts(ui_info, info)
             except Exception as e:
                 log.error("error during info collection: %s", e, exc_info=True)
@@ -942,25 +962,50 @@ class ServerCore(object):
             callback(proto, ui_info)
         make_thread(in_thread, "Info", daemon=True).start()
 
-    def get_ui_info(self, proto, *args):
+    def get_ui_info(self, proto, selection=None, *args):
         #this function is for info which MUST be collected from the UI thread
         return {}
 
     def get_thread_info(self, proto):
         return get_thread_info(proto)
 
-    def get_info(self, proto, *args):
+    def get_info(self, proto, selection=None, *args):
         start = time.time()
         #this function is for non UI thread info
         info = {}
+        wants = (selection or InfoSelection()).wants
         def up(prefix, d):
             info[prefix] = d
+        #the subtrees which only change when they are invalidated are cached (see info_cache):
+        cache = self.info_cache
+        if wants("server"):
+            si = cache.get("server", self.get_server_info)
+            si["info-cache"] = cache.get_info()
+            up("server", si)
+        if wants("network"):
+            #interfaces can change at any time, so this one is not cached:
+            up("network",   self.get_network_info())
+        if wants("threads"):
+            up("threads",   self.get_thread_info(proto))
+        if wants("env"):
+            up("env",       cache.get("env", self.get_env_info))
+        if self.session_name:
+            info["session"] = {"name" : self.session_name}
+        if self.child_reaper:
+            info.update(self.child_reaper.get_info())
+        end = time.time()
+        log("ServerCore.get_info took %ims", (end-start)*1000)
+        return info
+
+    def get_env_info(self):
         filtered_env = os.environ.copy()
         if filtered_env.get('XPRA_PASSWORD'):
             filtered_env['XPRA_PASSWORD'] = "*****"
         if filtered_env.get('XPRA_ENCRYPTION_KEY'):
             filtered_env['XPRA_ENCRYPTION_KEY'] = "*****"
+        return filtered_env
 
+    def get_server_info(self):
         si = get_server_info()
         si.update({
                    "mode"              : self.get_server_mode(),
@@ -974,7 +1019,9 @@ class ServerCore(object):
                 })
         if self.original_desktop_display:
             si["original-desktop-display"] = self.original_desktop_display
-        up("server", si)
+        return si
+
+    def get_network_info(self):
         from xpra.net.net_util import get_info as get_net_info
         ni = get_net_info()
         ni.update({
@@ -982,16 +1029,7 @@ class ServerCore(object):
                    "encryption"     : self.encryption or "",
                    "tcp-encryption" : self.tcp_encryption or "",
                    })
-        up("network", ni)
-        up("threads",   self.get_thread_info(proto))
-        up("env",       filtered_env)
-        if self.session_name:
-            info["session"] = {"name" : self.session_name}
-        if self.child_reaper:
-            info.update(self.child_reaper.get_info())
-        end = time.time()
-        log("ServerCore.get_info took %ims", (end-start)*1000)
-        return info
+        return ni
 
     def get_socket_info(self):
         si = {}
@@ -30,6 +30,7 @@ dbuslog = Logger("dbus")
 
 from xpra.server import ClientException
 from xpra.server.source_stats import GlobalPerformanceStatistics
+from xpra.server.encode_pool import EncodeWorkerPool, get_slice_pool
 from xpra.server.window.window_video_source import WindowVideoSource
 from xpra.server.window.window_source import WindowSource
 from xpra.server.window.batch_config import DamageBatchConfig
@@ -38,13 +39,13 @@ from xpra.codecs.video_helper import getVideoHelper
 from xpra.codecs.codec_constants import video_spec
 from xpra.net import compression
 from xpra.net.compression import compressed_wrapper, Compressed, Uncompressed
-from xpra.make_thread import make_thread
-from xpra.os_util import platform_name, Queue, get_machine_id, get_user_uuid
+from xpra.net.compression_chooser import ADAPTIVE_COMPRESSION
+from xpra.net.file_transfer import FileTransferHandler
+from xpra.os_util import platform_name, get_machine_id, get_user_uuid
 from xpra.server.background_worker import add_work_item
 from xpra.util import csv, std, typedict, updict, flatten_dict, notypedict, get_screen_info, CLIENT_PING_TIMEOUT, WORKSPACE_UNSET, DEFAULT_METADATA_SUPPORTED
 
 
-NOYIELD = os.environ.get("XPRA_YIELD") is None
 MAX_CLIPBOARD_PER_SECOND = int(os.environ.get("XPRA_CLIPBOARD_LIMIT", "20"))
 ADD_LOCAL_PRINTERS = os.environ.get("XPRA_ADD_LOCAL_PRINTERS", "0")=="1"
 try:
@@ -189,7 +190,7 @@ class WindowPropertyNotIn(WindowPropertyIn):
         return not(WindowPropertyIn.evaluate(window_value))
 
 
-class ServerSource(object):
+class ServerSource(FileTransferHandler):
     """
     A ServerSource represents a client connection.
     It mediates between the server class (which only knows about actual window objects and display server events)
@@ -204,9 +205,9 @@ class ServerSource(object):
     See 'next_packet'.
 
     The UI thread calls damage(), which goes into WindowSource and eventually (batching may be involved)
-    adds the damage pixels ready for processing to the encode_work_queue,
-    items are picked off by the separate 'encode' thread (see 'encode_loop')
-    and added to the damage_packet_queue.
+    adds the damage pixels ready for processing to the encode_pool,
+    items are picked off by the 'encode' worker thread assigned to this window
+    (see EncodeWorkerPool) and added to the damage_packet_queue.
     """
 
     def __init__(self, protocol, disconnect_cb, idle_add, timeout_add, source_remove,
@@ -223,7 +224,9 @@ class ServerSource(object):
                  supports_speaker, supports_microphone,
                  speaker_codecs, microphone_codecs,
                  default_quality, default_min_quality,
-                 default_speed, default_min_speed):
+                 default_speed, default_min_speed,
+                 bandwidth_limit,
+                 shared_encode_cache):
         log("ServerSource%s", (protocol, disconnect_cb, idle_add, timeout_add, source_remove,
                  idle_timeout, idle_timeout_cb, idle_grace_timeout_cb,
                  socket_dir, unix_socket_paths, dbus_control,
@@ -238,7 +241,10 @@ class ServerSource(object):
                  supports_speaker, supports_microphone,
                  speaker_codecs, microphone_codecs,
                  default_quality, default_min_quality,
-                 default_speed, default_min_speed))
+                 default_speed, default_min_speed,
+                 bandwidth_limit,
+                 shared_encode_cache))
+        FileTransferHandler.__init__(self)
         self.close_event = Event()
         self.ordinary_packets = []
         self.protocol = protocol
@@ -269,6 +275,7 @@ class ServerSource(object):
         self.supports_mmap = supports_mmap
         self.mmap = None
         self.mmap_size = 0
+        self.mmap_writer = None
         self.mmap_client_token = None                   #the token we write that the client may check
         # mouse echo:
         self.mouse_echo = False
@@ -299,6 +306,8 @@ class ServerSource(object):
         self.default_min_quality = default_min_quality #default minimum encoding quality
         self.default_speed = default_speed          #encoding speed (only used by x264)
         self.default_min_speed = default_min_speed  #default minimum encoding speed
+        self.bandwidth_limit = bandwidth_limit      #server limit, in bits per second (0 for none)
+        self.shared_encode_cache = shared_encode_cache  #encode results shared between clients (sharing mode only)
 
         self.default_batch_config = DamageBatchConfig()     #contains default values, some of which may be supplied by the client
         self.global_batch_config = self.default_batch_config.clone()      #global batch config
@@ -306,8 +315,8 @@ class ServerSource(object):
         self.connection_time = time.time()
 
         # the queues of damage requests we work through:
-        self.encode_work_queue = Queue()            #holds functions to call to compress data (pixels, clipboard)
-                                                    #items placed in this queue are picked off by the "encode" thread,
+        self.encode_pool = EncodeWorkerPool(self.is_closed)  #holds functions to call to compress data (pixels, clipboard)
+                                                    #items are queued per window id and picked off by the "encode" threads,
                                                     #the functions should add the packets they generate to the 'packet_queue'
         self.packet_queue = deque()                 #holds actual packets ready for sending (already encoded)
                                                     #these packets are picked off by the "protocol" via 'next_packet()'
@@ -319,6 +328,10 @@ class ServerSource(object):
         self.video_helper = getVideoHelper().clone()
         #these statistics are shared by all WindowSource instances:
         self.statistics = GlobalPerformanceStatistics()
+        if ADAPTIVE_COMPRESSION:
+            #the compression chooser uses the bandwidth measured from the damage acks:
+            protocol.compression_chooser.set_bandwidth_estimate(self.statistics.bandwidth.get_estimate)
+        self.pacing_timer = None
         self.last_user_event = time.time()
         self.last_ping_echoed_time = 0
 
@@ -328,8 +341,7 @@ class ServerSource(object):
 
         # ready for processing:
         protocol.set_packet_source(self.next_packet)
-        self.encode_thread = make_thread(self.encode_loop, "encode")
-        self.encode_thread.start()
+        self.encode_pool.start()
         #for managing the recalculate_delays work:
         self.calculate_window_ids = set()
         self.calculate_due = False
@@ -433,21 +445,27 @@ class ServerSource(object):
     def close(self):
         log("%s.close()", self)
         self.close_event.set()
+        pt = self.pacing_timer
+        if pt:
+            self.pacing_timer = None
+            self.source_remove(pt)
         for window_source in self.window_sources.values():
             window_source.cleanup()
         self.window_sources = {}
-        #it is now safe to add the end of queue marker:
+        #it is now safe to add the end of queue markers:
         #(all window sources will have stopped queuing data)
-        self.encode_work_queue.put(None)
+        self.encode_pool.stop()
         #this should be a noop since we inherit an initialized helper:
         self.video_helper.cleanup()
         if self.mmap:
+            self.mmap_writer = None
             self.mmap.close()
             self.mmap = None
             self.mmap_size = 0
         self.stop_sending_sound()
         self.stop_receiving_sound()
         self.remove_printers()
+        self.cleanup_file_transfers()
         ds = self.dbus_server
         if ds:
             ds.cleanup()
@@ -684,6 +702,7 @@ class ServerSource(object):
         self.share = c.boolget("share")
         self.file_transfer = c.boolget("file-transfer")
         self.file_size_limit = c.intget("file-size-limit")
+        self.remote_file_chunks = c.intget("file-chunks")
         self.printing = self.printing and c.boolget("printing")
         self.named_cursors = c.boolget("named_cursors")
         self.window_initiate_moveresize = c.boolget("window.initiate-moveresize")
@@ -694,6 +713,11 @@ class ServerSource(object):
         self.vrefresh = c.intget("vrefresh", -1)
         self.double_click_time = c.intget("double_click.time")
         self.double_click_distance = c.intpair("double_click.distance")
+        #the client may ask for a lower bandwidth limit than ours:
+        client_bandwidth_limit = c.intget("bandwidth-limit", 0)
+        if client_bandwidth_limit>0 and (self.bandwidth_limit<=0 or client_bandwidth_limit<self.bandwidth_limit):
+            self.bandwidth_limit = client_bandwidth_limit
+        self.set_bandwidth_limit(self.bandwidth_limit)
         self.window_frame_sizes = typedict(c.dictget("window.frame_sizes") or {})
 
         self.desktop_size = c.intpair("desktop_size")
@@ -843,7 +867,7 @@ class ServerSource(object):
             elif not os.path.exists(mmap_filename):
                 mmaplog("client supplied an mmap_file: %s but we cannot find it", mmap_filename)
             else:
-                from xpra.net.mmap_pipe import init_server_mmap
+                from xpra.net.mmap_pipe import init_server_mmap, MmapSlotWriter, MAX_SLOTS
                 from xpra.os_util import get_int_uuid
                 new_token = get_int_uuid()
                 self.mmap, self.mmap_size = init_server_mmap(mmap_filename, mmap_token, new_token)
@@ -856,6 +880,14 @@ class ServerSource(object):
                         self.mmap_size = 0
                     else:
                         self.mmap_client_token = new_token
+                        slots = min(MAX_SLOTS, c.intget("mmap.slots", 0))
+                        if slots>0:
+                            self.mmap_writer = MmapSlotWriter(self.mmap, self.mmap_size, slots)
+                            mmaplog("using %i mmap frame slots", slots)
+                        else:
+                            #the legacy ring must be written to in the same order
+                            #the client reads it, from a single thread:
+                            self.encode_pool.use_single_worker()
 
         if self.mmap_size>0:
             mmaplog.info(" mmap is enabled using %sB area in %s", std_unit(self.mmap_size, unit=1024), mmap_filename)
@@ -1251,10 +1283,35 @@ class ServerSource(object):
             if len(self.ordinary_packets)>0:
                 packet = self.ordinary_packets.pop(0)
             elif len(self.packet_queue)>0:
+                #damage packets are paced to stay within the bandwidth limit:
+                delay = self.statistics.bandwidth.get_pacing_delay()
+                if delay>0:
+                    self.schedule_pacing(delay)
+                    return None, None, None, False
                 packet, _, _, start_send_cb, end_send_cb = self.packet_queue.popleft()
             have_more = packet is not None and (len(self.ordinary_packets)>0 or len(self.packet_queue)>0)
         return packet, start_send_cb, end_send_cb, have_more
 
+    def schedule_pacing(self, delay):
+        #(called from the network format thread)
+        if self.pacing_timer:
+            return
+        def pacing_done():
+            self.pacing_timer = None
+            p = self.protocol
+            if p:
+                p.source_has_more()
+        self.pacing_timer = self.timeout_add(max(1, int(1000*delay)), pacing_done)
+
+    def set_bandwidth_limit(self, bandwidth_limit):
+        """ in bits per second, 0 for no limit """
+        log("set_bandwidth_limit(%s)", bandwidth_limit)
+        self.bandwidth_limit = bandwidth_limit
+        self.statistics.bandwidth.set_bandwidth_limit(bandwidth_limit)
+        if ADAPTIVE_COMPRESSION and self.protocol:
+            #the compression chooser uses bytes per second:
+            self.protocol.compression_chooser.set_bandwidth_limit(bandwidth_limit//8)
+
     def send(self, *parts):
         """ This method queues non-damage packets (higher priority) """
         self.ordinary_packets.append(parts)
@@ -1340,6 +1397,8 @@ class ServerSource(object):
                          "mmap_enabled"         : self.mmap_size>0,
                          "auto_refresh_delay"   : self.auto_refresh_delay,
                          })
+            if self.mmap_writer:
+                capabilities["mmap.slots"] = self.mmap_writer.nslots
         if self.mmap_client_token:
             capabilities["mmap_token"] = self.mmap_client_token
         if self.keyboard_config:
@@ -1415,6 +1474,7 @@ class ServerSource(object):
         info.update(self.get_sound_info())
         info.update(self.get_features_info())
         info.update(self.get_screen_info())
+        info["file"] = self.get_file_transfer_info()
         return info
 
     def get_screen_info(self):
@@ -1476,12 +1536,15 @@ class ServerSource(object):
         if len(pqpixels)>0:
             pqpi["current"] = pqpixels[-1]
         info = {"damage"    : {
-                               "compression_queue"      : {"size" : {"current" : self.encode_work_queue.qsize()}},
+                               "compression_queue"      : self.encode_pool.get_info(),
+                               "slice_pool"             : get_slice_pool().get_info(),
                                "packet_queue"           : {"size" : {"current" : len(self.packet_queue)}},
                                "packet_queue_pixels"    : pqpi,
                                },
                 "batch"     : self.global_batch_config.get_info(),
                 }
+        if self.mmap_writer:
+            info["mmap"] = self.mmap_writer.get_info()
         info.update(self.statistics.get_info())
 
         if len(window_ids)>0:
@@ -1542,7 +1605,7 @@ class ServerSource(object):
                 self.send_clipboard_enabled(msg)
                 return
         #call compress_clibboard via the work queue:
-        self.encode_work_queue.put((self.compress_clipboard, packet))
+        self.encode_pool.queue(0, (self.compress_clipboard, packet))
 
     def compress_clipboard(self, packet):
         #Note: this runs in the 'encode' thread!
@@ -1743,7 +1806,8 @@ class ServerSource(object):
             remove_printer(k)
 
 
-    def send_file(self, filename, mimetype, data, printit, openit, options={}):
+    def send_file(self, filename, mimetype, data, printit, openit, options={}, maxbitrate=0):
+        """ when 'data' is None, the file is streamed from disk """
         if printit:
             if not self.printing:
                 printlog.warn("Warning: printing is not enabled for %s", self)
@@ -1756,24 +1820,22 @@ class ServerSource(object):
                 return False
             action = "transfer"
             l = filelog
-        l("send_file%s", (filename, mimetype, "%s bytes" % len(data), printit, openit, options))
-        #TODO:
-        # * client ACK
-        # * stream it (don't load the whole file!)
-        # * timeouts
-        # * rate control
-        # * xpra info with queue and progress
+        if data is None:
+            filesize = os.path.getsize(filename)
+        else:
+            filesize = len(data)
+        l("send_file%s", (filename, mimetype, "%s bytes" % filesize, printit, openit, options, maxbitrate))
         basefilename = os.path.basename(filename)
-        filesize = len(data)
-        cdata = self.compressed_wrapper("file-data", data)
-        assert len(cdata)<=filesize     #compressed wrapper ensures this is true
         if filesize>self.file_size_limit*1024*1024:
             l.warn("Warning: cannot %s the file '%s'", action, basefilename)
             l.warn(" this file is too large: %sB", std_unit(filesize, unit=1024))
             l.warn(" the file size limit for %s is %iMB", self, self.file_size_limit)
             return False
-        self.send("send-file", basefilename, mimetype, printit, openit, filesize, cdata, options)
-        return True
+        return self.do_send_file(filename, mimetype, data, filesize, printit, openit, options, maxbitrate)
+
+    def send_file_chunk_packet(self, *packet):
+        #file chunks go in the low priority queue, behind the interactive packets:
+        self.queue_packet(packet)
 
     def send_client_command(self, *args):
         self.send("control", *args)
@@ -1965,6 +2027,8 @@ class ServerSource(object):
         if ws:
             del self.window_sources[wid]
             ws.cleanup()
+            self.encode_pool.release(wid)
+        self.statistics.remove_window(wid)
 
 
     def set_min_quality(self, min_quality):
@@ -2026,7 +2090,15 @@ class ServerSource(object):
         ws = self.window_sources.get(wid)
         if ws is None:
             batch_config = self.make_batch_config(wid, window)
-            ws = WindowVideoSource(self.queue_size, self.call_in_encode_thread, self.queue_packet, self.compressed_wrapper,
+            def queue_size():
+                return self.encode_pool.qsize(wid)
+            def call_in_encode_thread(*fn_and_args):
+                self.queue_encode(wid, fn_and_args)
+            chooser = None
+            if ADAPTIVE_COMPRESSION:
+                chooser = self.protocol.compression_chooser
+            ws = WindowVideoSource(queue_size, call_in_encode_thread, self.queue_packet, self.compressed_wrapper, chooser,
+                              self.shared_encode_cache,
                               self.statistics,
                               wid, window, batch_config, self.auto_refresh_delay,
                               self.av_sync, self.av_sync_delay,
@@ -2035,7 +2107,7 @@ class ServerSource(object):
                               self.encoding, self.encodings, self.core_encodings, self.encoding_options, self.icons_encoding_options,
                               self.rgb_formats,
                               self.default_encoding_options,
-                              self.mmap, self.mmap_size)
+                              self.mmap, self.mmap_size, self.mmap_writer)
             self.window_sources[wid] = ws
         return ws
 
@@ -2057,36 +2129,49 @@ class ServerSource(object):
         ws = self.make_window_source(wid, window)
         ws.damage(window, x, y, w, h, damage_options)
 
-    def client_ack_damage(self, damage_packet_sequence, wid, window, width, height, decode_time, message):
+    def client_ack_damage(self, damage_packet_sequence, wid, window, width, height, decode_time, message, decode_info=None):
         """
             The client is acknowledging a damage packet,
             we record the 'client decode time' (which is provided by the client)
             and WindowSource will calculate and record the "client latency".
             (since it knows when the "draw" packet was sent)
+            Newer clients also tell us how many draw packets they have queued for this window.
         """
         if not self.send_windows:
             log.error("client_ack_damage when we don't send any window data!?")
             return
         if decode_time>0:
             self.statistics.client_decode_time.append((wid, time.time(), width*height, decode_time))
+        if self.mmap_writer:
+            #the client may have released some mmap frames:
+            self.mmap_writer.frames_released()
         ws = self.window_sources.get(wid)
         if ws:
             ws.damage_packet_acked(window, damage_packet_sequence, width, height, decode_time, message)
+            if decode_info and "queue" in decode_info:
+                ws.statistics.client_decode_queue.append((time.time(), decode_info.intget("queue")))
             self.may_recalculate(wid)
 
 #
 # Methods used by WindowSource:
 #
     def queue_size(self):
-        return self.encode_work_queue.qsize()
+        return self.encode_pool.qsize()
 
     def call_in_encode_thread(self, *fn_and_args):
         """
-            This is used by WindowSource to queue damage processing to be done in the 'encode' thread.
+            Queues work which is not specific to any window in the 'encode' thread.
+        """
+        self.queue_encode(0, fn_and_args)
+
+    def queue_encode(self, wid, fn_and_args):
+        """
+            This is used by WindowSource to queue damage processing to be done in the 'encode' thread
+            assigned to this window.
             The 'encode_and_send_cb' will then add the resulting packet to the 'packet_queue' via 'queue_packet'.
         """
-        self.statistics.compression_work_qsizes.append((time.time(), self.encode_work_queue.qsize()))
-        self.encode_work_queue.put(fn_and_args)
+        self.statistics.compression_work_qsizes.append((time.time(), self.encode_pool.qsize()))
+        self.encode_pool.queue(wid, fn_and_args)
 
     def queue_packet(self, packet, wid=0, pixels=0, start_send_cb=None, end_send_cb=None):
         """
@@ -2096,32 +2181,8 @@ class ServerSource(object):
         now = time.time()
         self.statistics.packet_qsizes.append((now, len(self.packet_queue)))
         if wid>0:
-            self.statistics.damage_packet_qpixels.append((now, wid, sum(x[2] for x in list(self.packet_queue) if x[1]==wid)))
+            self.statistics.add_damage_packet_qpixels(now, wid, sum(x[2] for x in list(self.packet_queue) if x[1]==wid))
         self.packet_queue.append((packet, wid, pixels, start_send_cb, end_send_cb))
         p = self.protocol
         if p:
             p.source_has_more()
-
-#
-# The damage packet thread loop:
-#
-    def encode_loop(self):
-        """
-            This runs in a separate thread and calls all the function callbacks
-            which are added to the 'encode_work_queue'.
-            Must run until we hit the end of queue marker,
-            to ensure all the queued items get called.
-        """
-        while not self.is_closed():
-            fn_and_args = self.encode_work_queue.get(True)
-            if fn_and_args is None:
-                return              #empty marker
-            try:
-                fn_and_args[0](*fn_and_args[1:])
-            except Exception as e:
-                if self.is_closed():
-                    log("ignoring encoding error in %s as source is already closed:", fn_and_args[0])
-                    log(" %s", e)
-                    return
-                log.error("Error during encoding:", exc_info=True)
-            NOYIELD or time.sleep(0)
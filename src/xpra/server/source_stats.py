@@ -8,12 +8,13 @@
 
 from math import sqrt
 import time
-from collections import deque
 
 from xpra.log import Logger
 log = Logger("stats")
 
-from xpra.server.cystats import logp, calculate_time_weighted_average, calculate_for_target, queue_inspect  #@UnresolvedImport
+from xpra.server.cystats import logp, calculate_for_target, queue_inspect_averages  #@UnresolvedImport
+from xpra.server.incremental_stats import RingBuffer, TimeWeightedAverage, TimeWeightedRecords
+from xpra.server.bandwidth_estimator import BandwidthEstimator
 from xpra.simple_stats import get_list_stats
 
 NRECS = 500
@@ -24,6 +25,8 @@ class GlobalPerformanceStatistics(object):
     Statistics which are shared by all WindowSources
     """
     def __init__(self):
+        #the bandwidth limit survives a reset:
+        self.bandwidth = BandwidthEstimator()
         self.reset()
 
     #assume 100ms until we get some data to compute the real values
@@ -35,23 +38,31 @@ class GlobalPerformanceStatistics(object):
         self.mmap_bytes_sent = 0
         self.mmap_free_size = 0                             #how much of the mmap space is left (may be negative if we failed to write the last chunk)
         # queue statistics:
-        self.compression_work_qsizes = deque(maxlen=NRECS)  #size of the compression_work_queue before we add a new record to it
+        #(the records below maintain their time weighted averages as they are added, see incremental_stats)
+        self.compression_work_qsizes = TimeWeightedRecords(NRECS, 2)
+                                                            #size of the compression_work_queue before we add a new record to it
                                                             #(event_time, size)
-        self.packet_qsizes = deque(maxlen=NRECS)            #size of the packet_queue before we add a new packet to it
+        self.packet_qsizes = TimeWeightedRecords(NRECS, 2)  #size of the packet_queue before we add a new packet to it
                                                             #(event_time, size)
-        self.damage_packet_qpixels = deque(maxlen=NRECS)    #number of pixels waiting in the packet_queue for a specific window,
+        self.damage_packet_qpixels = TimeWeightedRecords(NRECS, 3)
+                                                            #number of pixels waiting in the packet_queue for a specific window,
                                                             #before we add a new packet to it
                                                             #(event_time, wid, size)
-        self.damage_last_events = deque(maxlen=NRECS)       #records the x11 damage requests as they are received:
+        self.damage_packet_qpixels_wid = {}                 #the same, for each window: wid -> TimeWeightedAverage
+        self.damage_last_events = RingBuffer(NRECS, 3)      #records the x11 damage requests as they are received:
                                                             #(wid, event time, no of pixels)
-        self.client_decode_time = deque(maxlen=NRECS)       #records how long it took the client to decode frames:
+        self.client_decode_time = RingBuffer(NRECS, 4)      #records how long it took the client to decode frames:
                                                             #(wid, event_time, no of pixels, decoding_time*1000*1000)
-        self.client_latency = deque(maxlen=NRECS)           #how long it took for a packet to get to the client and get the echo back.
+        self.client_latency = TimeWeightedRecords(NRECS, 4, time_field=1, min_field=3)
+                                                            #how long it took for a packet to get to the client and get the echo back.
                                                             #(wid, event_time, no of pixels, client_latency)
-        self.client_ping_latency = deque(maxlen=NRECS)      #time it took to get a ping_echo back from the client:
+        self.client_ping_latency = TimeWeightedRecords(NRECS, 2, min_field=1)
+                                                            #time it took to get a ping_echo back from the client:
                                                             #(event_time, elapsed_time_in_seconds)
-        self.server_ping_latency = deque(maxlen=NRECS)      #time it took for the client to get a ping_echo back from us:
+        self.server_ping_latency = TimeWeightedRecords(NRECS, 2, min_field=1)
+                                                            #time it took for the client to get a ping_echo back from us:
                                                             #(event_time, elapsed_time_in_seconds)
+        self.bandwidth.reset()
         self.client_load = None
         self.damage_events_count = 0
         self.packet_count = 0
@@ -79,25 +90,39 @@ class GlobalPerformanceStatistics(object):
             self.min_client_latency = send_latency
         self.client_latency.append((wid, time.time(), pixels, send_latency))
 
-    def get_damage_pixels(self, wid):
-        """ returns the list of (event_time, pixelcount) for the given window id """
-        return [(event_time, value) for event_time, dwid, value in list(self.damage_packet_qpixels) if dwid==wid]
+    def add_damage_packet_qpixels(self, event_time, wid, pixels):
+        self.damage_packet_qpixels.append((event_time, wid, pixels))
+        twa = self.damage_packet_qpixels_wid.get(wid)
+        if twa is None:
+            twa = self.damage_packet_qpixels_wid.setdefault(wid, TimeWeightedAverage())
+        twa.add(event_time, pixels)
+
+    def get_damage_pixels_averages(self, wid):
+        """ returns the average and recent number of pixels waiting in the packet queue for the given window id """
+        twa = self.damage_packet_qpixels_wid.get(wid)
+        if twa is None:
+            return None
+        return twa.get()
+
+    def remove_window(self, wid):
+        self.damage_packet_qpixels_wid.pop(wid, None)
 
     def update_averages(self):
-        if len(self.client_latency)>0:
-            data = [(when, latency) for _, when, _, latency in list(self.client_latency)]
-            self.min_client_latency = min([x for _,x in data])
-            self.avg_client_latency, self.recent_client_latency = calculate_time_weighted_average(data)
+        #all the averages are maintained as the records are added, so this is cheap:
+        v = self.client_latency.get_averages()
+        if v:
+            self.min_client_latency = self.client_latency.min()
+            self.avg_client_latency, self.recent_client_latency = v
         #client ping latency: from ping packets
-        if len(self.client_ping_latency)>0:
-            data = list(self.client_ping_latency)
-            self.min_client_ping_latency = min([x for _,x in data])
-            self.avg_client_ping_latency, self.recent_client_ping_latency = calculate_time_weighted_average(data)
+        v = self.client_ping_latency.get_averages()
+        if v:
+            self.min_client_ping_latency = self.client_ping_latency.min()
+            self.avg_client_ping_latency, self.recent_client_ping_latency = v
         #server ping latency: from ping packets
-        if len(self.server_ping_latency)>0:
-            data = list(self.server_ping_latency)
-            self.min_server_ping_latency = min([x for _,x in data])
-            self.avg_server_ping_latency, self.recent_server_ping_latency = calculate_time_weighted_average(data)
+        v = self.server_ping_latency.get_averages()
+        if v:
+            self.min_server_ping_latency = self.server_ping_latency.min()
+            self.avg_server_ping_latency, self.recent_server_ping_latency = v
 
     def get_factors(self, target_latency, pixel_count):
         factors = []
@@ -118,17 +143,22 @@ class GlobalPerformanceStatistics(object):
             wm = logp(l / 0.050)
             factors.append(calculate_for_target(metric, l, self.avg_server_ping_latency, self.recent_server_ping_latency, aim=0.95, slope=0.005, smoothing=sqrt, weight_multiplier=wm))
         #packet queue size: (includes packets from all windows)
-        factors.append(queue_inspect("packet-queue-size", self.packet_qsizes, smoothing=sqrt))
+        factors.append(queue_inspect_averages("packet-queue-size", self.packet_qsizes.get_averages(), smoothing=sqrt))
         #packet queue pixels (global):
-        qpix_time_values = [(event_time, value) for event_time, _, value in list(self.damage_packet_qpixels)]
-        factors.append(queue_inspect("packet-queue-pixels", qpix_time_values, div=pixel_count, smoothing=sqrt))
+        factors.append(queue_inspect_averages("packet-queue-pixels", self.damage_packet_qpixels.get_averages(), div=pixel_count, smoothing=sqrt))
         #compression data queue: (This is an important metric since each item will consume a fair amount of memory and each will later on go through the other queues.)
-        factors.append(queue_inspect("compression-work-queue", self.compression_work_qsizes))
+        factors.append(queue_inspect_averages("compression-work-queue", self.compression_work_qsizes.get_averages()))
         if self.mmap_size>0:
             #full: effective range is 0.0 to ~1.2
             full = 1.0-float(self.mmap_free_size)/self.mmap_size
             #aim for ~33%
             factors.append(("mmap-area", "%s%% full" % int(100*full), logp(3*full), (3*full)**2))
+        else:
+            #how close we are to the bandwidth available (or to the bandwidth limit),
+            #(there is no factor until we get the first ack or a limit is set):
+            bf = self.bandwidth.get_factor()
+            if bf:
+                factors.append(bf)
         return factors
 
     def get_client_info(self):
@@ -151,8 +181,8 @@ class GlobalPerformanceStatistics(object):
 
 
     def get_info(self):
-        cwqsizes = [x for _,x in list(self.compression_work_qsizes)]
-        pqsizes = [x for _,x in list(self.packet_qsizes)]
+        cwqsizes = self.compression_work_qsizes.get_field(1)
+        pqsizes = self.packet_qsizes.get_field(1)
         info = {"damage" : {
                             "events"        : self.damage_events_count,
                             "packets_sent"  : self.packet_count,
@@ -164,6 +194,7 @@ class GlobalPerformanceStatistics(object):
                                                },
                             },
                 "encoding" : {"decode_errors"   : self.decode_errors},
+                "bandwidth": self.bandwidth.get_info(),
             }
         #client pixels per second:
         now = time.time()
@@ -10,7 +10,7 @@ from math import log as mathlog, sqrt
 from xpra.log import Logger
 log = Logger("server", "stats")
 
-from xpra.server.cystats import queue_inspect, logp, time_weighted_average, calculate_timesize_weighted_average_score   #@UnresolvedImport
+from xpra.server.cystats import queue_inspect_averages, logp, time_weighted_average   #@UnresolvedImport
 
 
 def get_low_limit(mmap_enabled, window_dimensions):
@@ -39,9 +39,9 @@ def calculate_batch_delay(wid, window_dimensions, has_focus, other_is_fullscreen
     factors = statistics.get_factors(low_limit, batch.delay)
     statistics.target_latency = statistics.get_target_client_latency(global_statistics.min_client_latency, global_statistics.avg_client_latency)
     factors += global_statistics.get_factors(statistics.target_latency, low_limit)
-    #damage pixels waiting in the packet queue: (extract data for our window id only)
-    time_values = global_statistics.get_damage_pixels(wid)
-    factors.append(queue_inspect("damage-packet-queue-pixels", time_values, div=low_limit, smoothing=sqrt))
+    #damage pixels waiting in the packet queue: (for our window id only)
+    averages = global_statistics.get_damage_pixels_averages(wid)
+    factors.append(queue_inspect_averages("damage-packet-queue-pixels", averages, div=low_limit, smoothing=sqrt))
     #boost window that has focus and OR windows:
     factors.append(("focus", {"has_focus" : has_focus}, int(not has_focus), int(has_focus)))
     factors.append(("override-redirect", {"is_OR" : is_OR}, int(not is_OR), int(is_OR)))
@@ -165,6 +165,12 @@ def get_target_speed(wid, window_dimensions, batch, global_statistics, statistic
     #combine factors: use the highest one:
     target = min(1.0, max(dam_lat_abs, dam_lat_rel, dec_lat, pps, 0.0))
 
+    #if we are sending more than the link can take,
+    #lower the speed so we compress better:
+    bw_load = global_statistics.bandwidth.get_load()
+    if bw_load is not None and bw_load>1:
+        target /= sqrt(bw_load)
+
     #scale target between min_speed and 100:
     ms = min(100.0, max(min_speed, 0.0))
     target_speed = int(ms + (100.0-ms) * target)
@@ -187,6 +193,8 @@ def get_target_speed(wid, window_dimensions, batch, global_statistics, statistic
                                            "factor"   : int(100.0*dec_lat),
                                            },
             }
+    if bw_load is not None:
+        info["bandwidth_load"] = int(100.0*bw_load)
     return info, target_speed
 
 
@@ -214,11 +222,11 @@ def get_target_quality(wid, window_dimensions, batch, global_statistics, statist
             target = min(1.0, target, batch_q)
     cratio_factor = None
     #from here on, the compression ratio integer value is in per-1000:
-    es = [(t, pixels, 1000*compressed_size*bpp//pixels//32) for (t, _, pixels, bpp, compressed_size, _) in list(statistics.encoding_stats) if pixels>=4096]
-    if len(es)>=2:
+    scores = statistics.compression_score.get_averages()
+    if len(statistics.compression_score)>=2 and scores:
         #use the recent vs average compression ratio
         #(add 10 to smooth things out a bit, so very low compression ratios don't skew things)
-        ascore, rscore = calculate_timesize_weighted_average_score(es)
+        ascore, rscore = int(scores[0]), int(scores[1])
         bump = 0
         if ascore>rscore:
             #raise the quality
@@ -236,6 +244,12 @@ def get_target_quality(wid, window_dimensions, batch, global_statistics, statist
     if len(global_statistics.client_latency)>0 and global_statistics.recent_client_latency>0:
         latency_q = 3.0 * statistics.target_latency / global_statistics.recent_client_latency
         target = min(target, latency_q)
+    bandwidth_q = -1
+    bw_load = global_statistics.bandwidth.get_load()
+    if bw_load is not None and bw_load>1:
+        #we are sending more than the link can take:
+        bandwidth_q = 1.0/bw_load
+        target = min(target, bandwidth_q)
     target = min(1.0, max(0.0, target))
     if min_speed>0:
         #discount the quality more aggressively if we have speed requirements to satisfy:
@@ -258,4 +272,6 @@ def get_target_quality(wid, window_dimensions, batch, global_statistics, statist
         info["batch-delay-ratio"] = int(100.0*batch_q)
     if latency_q>=0:
         info["latency"] = int(100.0*latency_q)
+    if bandwidth_q>=0:
+        info["bandwidth"] = int(100.0*bandwidth_q)
     return info, target_quality
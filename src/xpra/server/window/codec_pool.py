@@ -0,0 +1,143 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Server-wide pool of idle csc and video encoder instances,
+# so the window sources can re-use a codec which has already been initialized
+# for the same dimensions and formats instead of paying the setup cost again.
+# (ie: when a window is resized back and forth, or re-mapped)
+
+import os
+import time
+import weakref
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("video")
+
+CODEC_POOL = os.environ.get("XPRA_CODEC_POOL", "1")=="1"
+#maximum number of idle instances:
+CODEC_POOL_SIZE = int(os.environ.get("XPRA_CODEC_POOL_SIZE", "4"))
+#idle instances are freed after this delay (in seconds):
+CODEC_POOL_TIMEOUT = int(os.environ.get("XPRA_CODEC_POOL_TIMEOUT", "10"))
+
+
+class CodecPool(object):
+    """
+        The codec instances are registered with the key describing
+        how they were initialized, when they are released
+        they are kept idle until someone acquires them with the same key,
+        or until they expire.
+        Only the instances which are not in use can be in the pool,
+        so we can clean them from any thread.
+    """
+
+    def __init__(self, max_size=CODEC_POOL_SIZE, timeout=CODEC_POOL_TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = Lock()
+        self.keys = weakref.WeakKeyDictionary()
+        #(key, instance, release time), oldest first:
+        self.idle = []
+        self.timer = False
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __repr__(self):
+        return "CodecPool(%i idle)" % len(self.idle)
+
+    def register(self, instance, key):
+        """ the instance can be pooled when it is released """
+        if self.max_size>0:
+            with self.lock:
+                self.keys[instance] = key
+
+    def has(self, key):
+        with self.lock:
+            return any(k==key for k, _, _ in self.idle)
+
+    def acquire(self, key):
+        """ returns an idle instance initialized for this key, or None """
+        with self.lock:
+            for i, (k, instance, _) in enumerate(self.idle):
+                if k==key:
+                    del self.idle[i]
+                    self.hits += 1
+                    log("acquire(%s)=%s", key, instance)
+                    return instance
+            self.misses += 1
+        return None
+
+    def release(self, instance):
+        """
+            Adds the instance to the pool,
+            returns False if it cannot be pooled and the caller must clean it.
+        """
+        evicted = []
+        with self.lock:
+            key = self.keys.get(instance)
+            if key is None or self.max_size<=0 or instance.is_closed():
+                return False
+            self.idle.append((key, instance, time.time()))
+            while len(self.idle)>self.max_size:
+                evicted.append(self.idle.pop(0)[1])
+        log("release(%s) key=%s, evicted=%s", instance, key, evicted)
+        for x in evicted:
+            x.clean()
+        return True
+
+    def claim_timer(self):
+        """ returns True if the caller should schedule a call to expire_timer """
+        with self.lock:
+            if self.timer or not self.idle:
+                return False
+            self.timer = True
+            return True
+
+    def expire_timer(self):
+        """ for use with timeout_add: repeats until the pool is empty """
+        self.expire()
+        with self.lock:
+            self.timer = len(self.idle)>0
+            return self.timer
+
+    def expire(self, now=None):
+        cutoff = (now or time.time())-self.timeout
+        with self.lock:
+            expired = [instance for _, instance, released in self.idle if released<=cutoff]
+            self.idle = [x for x in self.idle if x[2]>cutoff]
+            self.expired += len(expired)
+        if expired:
+            log("expire() freeing %s", expired)
+        for x in expired:
+            x.clean()
+
+    def cleanup(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for _, instance, _ in idle:
+            instance.clean()
+
+    def get_info(self):
+        with self.lock:
+            return {
+                    "size"      : len(self.idle),
+                    "max-size"  : self.max_size,
+                    "timeout"   : self.timeout,
+                    "hits"      : self.hits,
+                    "misses"    : self.misses,
+                    "expired"   : self.expired,
+                    "idle"      : [instance.get_type() for _, instance, _ in self.idle],
+                    }
+
+
+_codec_pool = None
+def get_codec_pool():
+    global _codec_pool
+    if _codec_pool is None:
+        _codec_pool = CodecPool(CODEC_POOL_SIZE*int(CODEC_POOL))
+    return _codec_pool
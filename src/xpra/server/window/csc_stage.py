@@ -0,0 +1,207 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# The colourspace conversion stage of a window's video pipeline:
+# frames are converted in a separate thread as soon as they are captured,
+# so the csc step of the next frame runs whilst the encode thread
+# is still compressing the previous one.
+
+import os
+import time
+from threading import Lock, RLock, Event
+
+from xpra.log import Logger
+log = Logger("csc")
+
+from xpra.os_util import Queue
+from xpra.make_thread import make_thread
+
+CSC_PIPELINE = os.environ.get("XPRA_CSC_PIPELINE", "1")=="1"
+
+
+class CSCJob(object):
+
+    def __init__(self, image, csce):
+        self.image = image
+        self.csce = csce
+        self.result = None
+        self.cancelled = False
+        #the stage thread is converting the image:
+        self.converting = False
+        #the image was freed by its owner during the conversion, the stage frees it instead:
+        self.free_source = False
+        self.elapsed = 0
+        self.event = Event()
+
+    def __repr__(self):
+        return "CSCJob(%s)" % self.image
+
+    def wait(self):
+        """ returns the converted image, or None if the job was skipped """
+        self.event.wait()
+        return self.result
+
+
+class CSCStage(object):
+    """
+        Converts the images with the csc instance they were submitted with,
+        one at a time and in the order they were submitted.
+        The 'lock' is held during each conversion:
+        the owner of the csc instances must hold it to convert,
+        replace or release them, so a csc instance is never used by two threads at once.
+        Jobs are only converted if 'is_current(csce)' is still True.
+        Cancelling jobs never waits for the 'lock', so it is safe from the UI thread:
+        the job states are only updated whilst holding the short lived 'jobs_lock',
+        and the stage thread frees the results of the jobs cancelled during their conversion.
+    """
+
+    def __init__(self, name, is_current, free_image):
+        self.name = name
+        self.is_current = is_current
+        self.free_image = free_image
+        self.lock = RLock()
+        self.jobs_lock = Lock()
+        self.jobs = []
+        self.work_queue = Queue()
+        self.thread = None
+        self.submitted = 0
+        self.converted = 0
+        self.cancelled = 0
+        self.busy_time = 0
+
+    def __repr__(self):
+        return "CSCStage(%s)" % self.name
+
+    def submit(self, image, csce):
+        job = CSCJob(image, csce)
+        with self.jobs_lock:
+            self.jobs.append(job)
+            self.submitted += 1
+            if self.thread is None:
+                self.thread = make_thread(self.convert_loop, self.name, daemon=True)
+                self.thread.start()
+        self.work_queue.put(job)
+        return job
+
+    def convert_loop(self):
+        while True:
+            job = self.work_queue.get(True)
+            if job is None:
+                return
+            self.convert(job)
+
+    def convert(self, job):
+        result = None
+        try:
+            with self.lock:
+                with self.jobs_lock:
+                    if job.cancelled or not self.is_current(job.csce):
+                        return
+                    job.converting = True
+                start = time.time()
+                result = job.csce.convert_image(job.image)
+                job.elapsed = time.time()-start
+                self.busy_time += job.elapsed
+                self.converted += 1
+        except Exception as e:
+            log("%s failed to convert %s", self, job.image, exc_info=True)
+            log.warn("Warning: csc conversion failed: %s", e)
+        finally:
+            with self.jobs_lock:
+                job.converting = False
+                cancelled = job.cancelled
+                if cancelled:
+                    if job in self.jobs:
+                        self.jobs.remove(job)
+                else:
+                    job.result = result
+            if cancelled:
+                #the job was cancelled whilst we were converting it:
+                if result is not None:
+                    self.free_image(result)
+                if job.free_source:
+                    self.free_image(job.image)
+            job.event.set()
+
+    def take(self, image):
+        """
+            Returns the job for this image (if any),
+            the caller owns it from then on.
+        """
+        with self.jobs_lock:
+            return self.remove_job(image)
+
+    def remove_job(self, image):
+        """ must be called with the 'jobs_lock' held """
+        for i, job in enumerate(self.jobs):
+            if job.image is image:
+                del self.jobs[i]
+                return job
+        return None
+
+    def cancel_jobs(self, jobs, free_source=False):
+        """
+            Must be called with the 'jobs_lock' held,
+            returns the converted images which must be freed.
+            The stage thread frees the output of the jobs it is still converting,
+            and their source image if 'free_source' is set.
+        """
+        results = []
+        for job in jobs:
+            if not job.cancelled:
+                job.cancelled = True
+                self.cancelled += 1
+            if job.converting:
+                job.free_source = job.free_source or free_source
+            elif job.result is not None:
+                results.append(job.result)
+                job.result = None
+        return results
+
+    def discard(self, image):
+        """
+            The image is being freed, cancel its job.
+            Returns True if the caller can free the image now,
+            False if the stage thread is converting it and will free it.
+        """
+        with self.jobs_lock:
+            job = self.remove_job(image)
+            if job is None:
+                return True
+            results = self.cancel_jobs([job], True)
+            converting = job.converting
+        for result in results:
+            self.free_image(result)
+        return not converting
+
+    def drain(self):
+        """ cancels all the pending jobs """
+        with self.jobs_lock:
+            jobs = self.jobs
+            #the jobs being converted stay listed until the conversion ends,
+            #so the owner of the source image cannot free it before then (see discard):
+            self.jobs = [job for job in jobs if job.converting]
+            results = self.cancel_jobs(jobs)
+        if jobs:
+            log("%s.drain() cancelled %i jobs", self, len(jobs))
+        for result in results:
+            self.free_image(result)
+
+    def stop(self):
+        self.drain()
+        with self.jobs_lock:
+            if self.thread:
+                self.work_queue.put(None)
+                self.thread = None
+
+    def get_info(self):
+        return {
+                "pending"   : len(self.jobs),
+                "submitted" : self.submitted,
+                "converted" : self.converted,
+                "cancelled" : self.cancelled,
+                "busy"      : int(self.busy_time*1000),
+                }
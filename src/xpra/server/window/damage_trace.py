@@ -0,0 +1,137 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+# Records the damage regions of a window (geometry and raw pixels)
+# so the encoders can be benchmarked offline, see xpra.scripts.damage_replay.
+
+import os
+import time
+import zlib
+import struct
+from threading import Lock
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.os_util import strtobytes, bytestostr, memoryview_to_bytes
+from xpra.codecs.image_wrapper import ImageWrapper
+
+#directory where the damage traces are saved, recording is disabled if empty:
+DAMAGE_TRACE = os.environ.get("XPRA_DAMAGE_TRACE", "")
+#stop recording once a trace file reaches this size (in MB):
+DAMAGE_TRACE_MAX_SIZE = int(os.environ.get("XPRA_DAMAGE_TRACE_MAX_SIZE", "1024"))*1024*1024
+
+MAGIC = b"XPRADT01"
+#timestamp, wid, x, y, width, height, rowstride, depth,
+#followed by the length of: pixel format, coding, compressed pixels
+RECORD_HEADER = struct.Struct("!dIiiIIIBHHI")
+
+
+def get_trace_filename(wid, directory=DAMAGE_TRACE):
+    return os.path.join(os.path.expanduser(directory), "window-%i-%i.trace" % (wid, int(time.time()*1000)))
+
+
+class DamageTraceWriter(object):
+    """
+        Appends damage records to a trace file,
+        the pixels are compressed with zlib at the fastest level
+        so recording doesn't slow down the encode thread too much.
+        Only packed pixel formats can be recorded.
+    """
+
+    def __init__(self, filename, max_size=DAMAGE_TRACE_MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.lock = Lock()
+        self.records = 0
+        self.size = len(MAGIC)
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+        log("DamageTraceWriter(%s)", filename)
+
+    def __repr__(self):
+        return "DamageTraceWriter(%s)" % self.filename
+
+    def record(self, wid, image, coding, timestamp=None):
+        if image.get_planes()!=ImageWrapper.PACKED:
+            return False
+        x, y, w, h, _ = image.get_geometry()
+        rowstride = image.get_rowstride()
+        pixel_format = strtobytes(image.get_pixel_format())
+        coding = strtobytes(coding)
+        pixels = memoryview_to_bytes(image.get_pixels())[:rowstride*h]
+        data = zlib.compress(pixels, 1)
+        header = RECORD_HEADER.pack(timestamp or time.time(), wid, x, y, w, h, rowstride, image.get_depth(),
+                                    len(pixel_format), len(coding), len(data))
+        with self.lock:
+            if self.file is None:
+                return False
+            size = len(header)+len(pixel_format)+len(coding)+len(data)
+            if self.size+size>self.max_size:
+                log.warn("Warning: damage trace '%s' is full", self.filename)
+                log.warn(" recorded %i damage regions", self.records)
+                self.do_close()
+                return False
+            try:
+                self.file.write(header)
+                self.file.write(pixel_format)
+                self.file.write(coding)
+                self.file.write(data)
+            except (IOError, OSError) as e:
+                log.error("Error writing to damage trace '%s':", self.filename)
+                log.error(" %s", e)
+                self.do_close()
+                return False
+            self.size += size
+            self.records += 1
+        return True
+
+    def close(self):
+        with self.lock:
+            self.do_close()
+
+    def do_close(self):
+        f = self.file
+        if f:
+            self.file = None
+            f.close()
+            log("closed %s: %i records, %iKB", self.filename, self.records, self.size//1024)
+
+    def get_info(self):
+        return {
+                "file"      : self.filename,
+                "records"   : self.records,
+                "size"      : self.size,
+                "recording" : self.file is not None,
+                }
+
+
+def read_damage_trace(filename):
+    """
+        Generator for the records of a trace file:
+        (timestamp, wid, coding, image)
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic!=MAGIC:
+            raise Exception("'%s' is not a damage trace file" % filename)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                break
+            if len(header)<RECORD_HEADER.size:
+                log.warn("Warning: damage trace '%s' is truncated", filename)
+                break
+            timestamp, wid, x, y, w, h, rowstride, depth, lpf, lcoding, ldata = RECORD_HEADER.unpack(header)
+            pixel_format = bytestostr(f.read(lpf))
+            coding = bytestostr(f.read(lcoding))
+            data = f.read(ldata)
+            if len(data)<ldata:
+                log.warn("Warning: damage trace '%s' is truncated", filename)
+                break
+            pixels = zlib.decompress(data)
+            image = ImageWrapper(x, y, w, h, pixels, pixel_format, depth, rowstride)
+            yield timestamp, wid, coding, image
@@ -0,0 +1,149 @@
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+from zlib import crc32, adler32
+
+from xpra.log import Logger
+log = Logger("delta")
+
+
+#maximum amount of pixel data we keep for each window (in bytes):
+DELTA_CACHE_SIZE = max(0, int(os.environ.get("XPRA_DELTA_CACHE_SIZE", 32*1024*1024)))
+#largest region we store so we can send cache references for it (in pixels):
+DELTA_CACHE_MAX_PIXELS = int(os.environ.get("XPRA_DELTA_CACHE_MAX_PIXELS", 1024*1024))
+MAX_DELTA_BUCKETS = int(os.environ.get("XPRA_MAX_DELTA_BUCKETS", "64"))
+
+
+class DeltaEntry(object):
+    """ the pixels stored in one of the client's delta buckets """
+    __slots__ = ("width", "height", "pixel_format", "coding", "store", "pixels", "key", "hits", "last_used")
+
+    def __init__(self, width, height, pixel_format, coding, store, pixels, key):
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.coding = coding
+        self.store = store
+        self.pixels = pixels
+        self.key = key
+        self.hits = 0
+        self.last_used = time.time()
+
+    def get_info(self, now):
+        return (self.width, self.height, self.pixel_format, self.coding, self.store, len(self.pixels), self.hits,
+                int((now-self.last_used)*1000))
+
+
+class DeltaCache(object):
+    """
+        Mirrors the pixel data the client keeps in its delta buckets.
+        Entries are addressed by their content (dimensions, pixel format and hash)
+        so that a region the client already has can be sent as a reference to the bucket,
+        wherever it is painted in the window.
+        Entries with the same dimensions can also be used for xor deltas.
+        The total amount of pixel data is bounded,
+        the least recently used entries are evicted first.
+    """
+
+    def __init__(self, buckets, max_size=DELTA_CACHE_SIZE):
+        self.buckets = [None]*buckets
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        #buckets the client can free:
+        self.evicted_buckets = []
+
+    def __repr__(self):
+        return "DeltaCache(%i buckets)" % len(self.buckets)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def reset(self):
+        self.buckets = [None]*len(self.buckets)
+        self.size = 0
+        self.evicted_buckets = []
+
+    def get_info(self):
+        now = time.time()
+        return {
+                "size"      : self.size,
+                "max-size"  : self.max_size,
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evicted"   : self.evicted,
+                "bucket"    : dict((i, e.get_info(now)) for i, e in enumerate(self.buckets) if e),
+                }
+
+    def get_key(self, width, height, pixel_format, pixels):
+        return (width, height, pixel_format, len(pixels), crc32(pixels), adler32(pixels))
+
+    def find(self, key):
+        """ returns the bucket containing these exact pixels, or (-1, None) """
+        for i, e in enumerate(self.buckets):
+            if e and e.key==key:
+                self.hits += 1
+                e.hits += 1
+                e.last_used = time.time()
+                return i, e
+        self.misses += 1
+        return -1, None
+
+    def find_delta(self, width, height, pixel_format, coding, size):
+        """ returns a bucket we can xor with, or (-1, None) """
+        for i, e in enumerate(self.buckets):
+            if e and e.width==width and e.height==height and e.pixel_format==pixel_format and \
+                e.coding==coding and len(e.pixels)==size:
+                return i, e
+        return -1, None
+
+    def clear(self, bucket):
+        e = self.buckets[bucket]
+        if e:
+            self.size -= len(e.pixels)
+            self.buckets[bucket] = None
+
+    def choose_bucket(self):
+        """ an empty bucket if we have one, otherwise the least recently used """
+        lru = 0
+        for i, e in enumerate(self.buckets):
+            if e is None:
+                return i
+            if e.last_used<self.buckets[lru].last_used:
+                lru = i
+        return lru
+
+    def store(self, bucket, entry):
+        """
+            The client will store these pixels in the given bucket,
+            evicts other entries if we exceed the memory limit.
+        """
+        self.clear(bucket)
+        self.buckets[bucket] = entry
+        self.size += len(entry.pixels)
+        while self.size>self.max_size:
+            lru = -1
+            for i, e in enumerate(self.buckets):
+                if e and i!=bucket and (lru<0 or e.last_used<self.buckets[lru].last_used):
+                    lru = i
+            if lru<0:
+                break
+            log("delta cache: evicting bucket %i", lru)
+            self.clear(lru)
+            self.evicted += 1
+            if lru not in self.evicted_buckets:
+                self.evicted_buckets.append(lru)
+        if bucket in self.evicted_buckets:
+            self.evicted_buckets.remove(bucket)
+
+    def take_evicted(self):
+        """ the buckets we have evicted since the last call, so the client can free them """
+        evicted = [x for x in self.evicted_buckets if self.buckets[x] is None]
+        self.evicted_buckets = []
+        return evicted
@@ -0,0 +1,131 @@
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+from zlib import crc32, adler32
+
+from xpra.log import Logger
+log = Logger("scroll")
+
+from xpra.os_util import memoryview_to_bytes
+
+
+#minimum percentage of the rows that must match for a given scroll offset:
+MIN_SCROLL_PERCENT = int(os.environ.get("XPRA_SCROLL_MIN_PERCENT", "30"))
+MIN_SCROLL_LINES = int(os.environ.get("XPRA_SCROLL_MIN_LINES", "16"))
+#rows which are found many times (ie: blank lines) cannot be used for detecting the scroll offset:
+MAX_ROW_REPEAT = int(os.environ.get("XPRA_SCROLL_MAX_ROW_REPEAT", "4"))
+
+
+def hash_rows(pixels, y, height, x_offset, row_bytes, rowstride):
+    """
+        Returns a list with one hash value per row of pixels.
+        We use two different checksums to make collisions very unlikely.
+    """
+    #crc32 and adler32 do not accept memoryviews with python2:
+    pixels = memoryview_to_bytes(pixels)
+    hashes = []
+    pos = y*rowstride+x_offset
+    for _ in range(height):
+        row = pixels[pos:pos+row_bytes]
+        hashes.append((crc32(row), adler32(row)))
+        pos += rowstride
+    return hashes
+
+
+class ScrollData(object):
+    """
+        Keeps the hash of every row of pixels the client has for this window,
+        so we can detect when the new pixels are the same rows moved up or down.
+        Only full-width updates sent using a lossless encoding are recorded,
+        any other update invalidates the rows it modifies.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.row_hashes = [None]*height
+        self.scroll_count = 0
+        self.scrolled_rows = 0
+        self.skipped_rows = 0
+
+    def __repr__(self):
+        return "ScrollData(%ix%i)" % (self.width, self.height)
+
+    def get_info(self):
+        return {
+                "rows"      : len([x for x in self.row_hashes if x is not None]),
+                "count"     : self.scroll_count,
+                "scrolled"  : self.scrolled_rows,
+                "skipped"   : self.skipped_rows,
+                }
+
+    def invalidate(self, y, h):
+        y = max(0, y)
+        h = min(self.height, y+h)-y
+        if h>0:
+            self.row_hashes[y:y+h] = [None]*h
+
+    def update(self, y, hashes):
+        """ record the hashes for the rows the client now has, starting at y """
+        h = min(self.height-y, len(hashes))
+        if y>=0 and h>0:
+            self.row_hashes[y:y+h] = hashes[:h]
+
+    def calculate(self, y, hashes):
+        """
+            Compare the new rows starting at 'y' with the rows the client has.
+            Returns the vertical distance the contents have moved by
+            (negative when scrolling up), or 0 if we did not find a scroll.
+        """
+        h = len(hashes)
+        prev = self.row_hashes[y:y+h]
+        index = {}
+        for i, v in enumerate(prev):
+            if v is not None:
+                index.setdefault(v, []).append(i)
+        votes = {}
+        for i, v in enumerate(hashes):
+            rows = index.get(v)
+            if not rows or len(rows)>MAX_ROW_REPEAT:
+                continue
+            for j in rows:
+                if j!=i:
+                    d = i-j
+                    votes[d] = votes.get(d, 0)+1
+        if not votes:
+            return 0
+        best = sorted(votes.items(), key=lambda x : -x[1])[0]
+        distance, count = best
+        if count<max(MIN_SCROLL_LINES, h*MIN_SCROLL_PERCENT//100):
+            log("calculate(%i, %i hashes) best match %s not good enough", y, h, best)
+            return 0
+        log("calculate(%i, %i hashes) scroll distance=%i, matching rows=%i", y, h, distance, count)
+        return distance
+
+    def get_scroll_values(self, y, hashes, distance):
+        """
+            Using the scroll distance, splits the rows starting at 'y' into:
+            * 'scrolls': (y, h) row ranges which can be copied from 'y-distance' in the client's backing
+            * 'unchanged': (y, h) row ranges which are already identical
+            * 'changed': (y, h) row ranges which must be sent
+        """
+        h = len(hashes)
+        prev = self.row_hashes[y:y+h]
+        scrolls, unchanged, changed = [], [], []
+        def add(l, start, count):
+            if l and l[-1][0]+l[-1][1]==start:
+                l[-1] = (l[-1][0], l[-1][1]+count)
+            else:
+                l.append((start, count))
+        for i, v in enumerate(hashes):
+            j = i-distance
+            if prev[i] is not None and prev[i]==v:
+                add(unchanged, y+i, 1)
+            elif 0<=j<h and prev[j] is not None and prev[j]==v:
+                add(scrolls, y+i, 1)
+            else:
+                add(changed, y+i, 1)
+        return scrolls, unchanged, changed
@@ -0,0 +1,141 @@
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Event
+from zlib import crc32, adler32
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.os_util import memoryview_to_bytes
+
+
+SHARED_ENCODE = os.environ.get("XPRA_SHARED_ENCODE", "1")=="1"
+#maximum number of encoded regions we keep:
+SHARED_ENCODE_CACHE_SIZE = max(1, int(os.environ.get("XPRA_SHARED_ENCODE_CACHE_SIZE", "64")))
+#discard results older than this (in seconds):
+SHARED_ENCODE_EXPIRY = float(os.environ.get("XPRA_SHARED_ENCODE_EXPIRY", "2"))
+#how long we wait for another client's encoder to finish the same region (in seconds):
+SHARED_ENCODE_WAIT = float(os.environ.get("XPRA_SHARED_ENCODE_WAIT", "0.5"))
+
+#stateless encoders only:
+SHARED_ENCODINGS = ("png", "png/P", "png/L", "jpeg", "webp", "rgb24", "rgb32")
+
+
+class SharedEncodeCache(object):
+    """
+        When a session is shared, each client has its own window sources
+        which all encode the same damage regions.
+        Clients using identical settings can share the result of a single encoding:
+        the results are keyed on the window, the pixels and the encoder settings,
+        and kept for a short time only.
+        When another client is already encoding the same region,
+        we wait for its result rather than encoding it again.
+    """
+
+    def __init__(self, max_size=SHARED_ENCODE_CACHE_SIZE, expiry=SHARED_ENCODE_EXPIRY):
+        self.max_size = max_size
+        self.expiry = expiry
+        self.lock = Lock()
+        self.results = OrderedDict()
+        self.pending = {}
+        self.clients = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def __repr__(self):
+        return "SharedEncodeCache(%i clients)" % self.clients
+
+    def set_clients(self, clients):
+        self.clients = clients
+        if clients<=1:
+            with self.lock:
+                self.results.clear()
+
+    def is_enabled(self):
+        return self.clients>1
+
+    def get_info(self):
+        with self.lock:
+            return {
+                    ""          : SHARED_ENCODE,
+                    "clients"   : self.clients,
+                    "size"      : len(self.results),
+                    "max-size"  : self.max_size,
+                    "hits"      : self.hits,
+                    "misses"    : self.misses,
+                    "waits"     : self.waits,
+                    }
+
+    def get_key(self, wid, image, coding, settings):
+        """
+            Identifies the result of encoding this image with the given settings,
+            returns None if the image cannot be shared.
+        """
+        pixels = image.get_pixels()
+        if not pixels:
+            return None
+        #crc32 and adler32 do not accept memoryviews with python2:
+        pixels = memoryview_to_bytes(pixels)
+        x, y, w, h, depth = image.get_geometry()
+        return (wid, x, y, w, h, depth, image.get_pixel_format(), image.get_rowstride(), len(pixels),
+                crc32(pixels), adler32(pixels), coding, settings)
+
+    def encode(self, key, encoder, coding, image, options):
+        """
+            Returns the encoding result for this key,
+            either from the cache or by calling the encoder.
+            The 'client_options' dictionary is copied since the caller will modify it.
+        """
+        with self.lock:
+            ret = self.get_result(key)
+            if ret:
+                return ret
+            event = self.pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.pending[key] = Event()
+            else:
+                self.waits += 1
+        if not owner:
+            #another client is encoding this region already:
+            event.wait(SHARED_ENCODE_WAIT)
+            with self.lock:
+                ret = self.get_result(key)
+            if ret:
+                return ret
+            log("shared encode result not found for %s", key[:13])
+            return encoder(coding, image, options)
+        ret = None
+        try:
+            ret = encoder(coding, image, options)
+        finally:
+            with self.lock:
+                self.misses += 1
+                if ret:
+                    coding, data, client_options, outw, outh, outstride, bpp = ret
+                    self.results[key] = (time.time(), (coding, data, dict(client_options), outw, outh, outstride, bpp))
+                    while len(self.results)>self.max_size:
+                        self.results.popitem(last=False)
+                self.pending.pop(key, None)
+            event.set()
+        return ret
+
+    def get_result(self, key):
+        #must be called with the lock held
+        v = self.results.get(key)
+        if v is None:
+            return None
+        now = time.time()
+        if v[0]<now-self.expiry:
+            del self.results[key]
+            return None
+        self.hits += 1
+        coding, data, client_options, outw, outh, outstride, bpp = v[1]
+        return coding, data, dict(client_options), outw, outh, outstride, bpp
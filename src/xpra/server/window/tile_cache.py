@@ -0,0 +1,147 @@
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+import os
+from collections import OrderedDict
+from zlib import crc32, adler32
+
+from xpra.log import Logger
+log = Logger("encoding")
+
+from xpra.os_util import memoryview_to_bytes
+
+
+TILE_SIZE = max(16, int(os.environ.get("XPRA_TILE_SIZE", "64")))
+#maximum number of tile hashes we keep for each window:
+TILE_CACHE_SIZE = max(16, int(os.environ.get("XPRA_TILE_CACHE_SIZE", "8192")))
+
+
+class TileCache(object):
+    """
+        Keeps the hash of the pixels the client has for each tile of the window,
+        so we can skip the tiles that have not actually changed.
+        Tiles are aligned on a fixed grid of TILE_SIZE pixels,
+        and the least recently used tiles are evicted first.
+    """
+
+    def __init__(self, width, height, tile_size=TILE_SIZE, max_size=TILE_CACHE_SIZE):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.max_size = max_size
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def __repr__(self):
+        return "TileCache(%ix%i)" % (self.width, self.height)
+
+    def get_info(self):
+        return {
+                "tile-size" : self.tile_size,
+                "size"      : len(self.tiles),
+                "max-size"  : self.max_size,
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evicted"   : self.evicted,
+                }
+
+    def get_tile_range(self, x, y, w, h):
+        """ the range of tiles fully contained in this rectangle """
+        ts = self.tile_size
+        tx1 = (x+ts-1)//ts
+        ty1 = (y+ts-1)//ts
+        tx2 = (x+w)//ts
+        ty2 = (y+h)//ts
+        return tx1, ty1, tx2, ty2
+
+    def hash_tiles(self, x, y, w, h, pixels, rowstride, Bpp):
+        """
+            Returns a dictionary with the hash of every tile fully contained
+            in the given rectangle of pixels.
+        """
+        #crc32 and adler32 do not accept memoryviews with python2:
+        pixels = memoryview_to_bytes(pixels)
+        ts = self.tile_size
+        tx1, ty1, tx2, ty2 = self.get_tile_range(x, y, w, h)
+        tile_bytes = ts*Bpp
+        hashes = {}
+        for ty in range(ty1, ty2):
+            #the rows of this band of tiles:
+            pos = (ty*ts-y)*rowstride
+            rows = [pixels[pos+i*rowstride:pos+(i+1)*rowstride] for i in range(ts)]
+            for tx in range(tx1, tx2):
+                start = (tx*ts-x)*Bpp
+                end = start+tile_bytes
+                data = b"".join(row[start:end] for row in rows)
+                hashes[(tx, ty)] = (crc32(data), adler32(data))
+        return hashes
+
+    def get_contained(self, hashes, x, y, w, h):
+        """ only keeps the hashes of the tiles fully contained in the given rectangle """
+        ts = self.tile_size
+        return dict((k, v) for k, v in hashes.items() if
+                    k[0]*ts>=x and k[1]*ts>=y and (k[0]+1)*ts<=x+w and (k[1]+1)*ts<=y+h)
+
+    def get_unchanged(self, hashes):
+        """ returns the list of tiles the client already has """
+        unchanged = []
+        for k, v in hashes.items():
+            if self.tiles.get(k)==v:
+                unchanged.append(k)
+        self.hits += len(unchanged)
+        self.misses += len(hashes)-len(unchanged)
+        return unchanged
+
+    def update(self, hashes):
+        """ the client now has these tiles """
+        tiles = self.tiles
+        for k, v in hashes.items():
+            tiles.pop(k, None)
+            tiles[k] = v
+        while len(tiles)>self.max_size:
+            tiles.popitem(last=False)
+            self.evicted += 1
+
+    def invalidate(self, x, y, w, h):
+        """ forget all the tiles that intersect with this rectangle """
+        if not self.tiles or w<=0 or h<=0:
+            return
+        ts = self.tile_size
+        for ty in range(y//ts, (y+h+ts-1)//ts):
+            for tx in range(x//ts, (x+w+ts-1)//ts):
+                self.tiles.pop((tx, ty), None)
+
+    def get_tile_rects(self, tiles):
+        """
+            Converts a list of tiles into a list of (x, y, w, h) rectangles,
+            merging the tiles horizontally and then vertically.
+        """
+        ts = self.tile_size
+        rows = {}
+        for tx, ty in sorted(tiles, key=lambda t : (t[1], t[0])):
+            runs = rows.setdefault(ty, [])
+            if runs and runs[-1][1]==tx:
+                runs[-1][1] = tx+1
+            else:
+                runs.append([tx, tx+1])
+        rects = []
+        #spans still open from the previous row: (tx1, tx2) -> [ty1, ty2]
+        open_spans = {}
+        for ty in sorted(rows.keys()):
+            spans = dict(((tx1, tx2), None) for tx1, tx2 in rows[ty])
+            for span, v in list(open_spans.items()):
+                if span in spans and v[1]==ty:
+                    v[1] = ty+1
+                    del spans[span]
+                else:
+                    rects.append((span[0]*ts, v[0]*ts, (span[1]-span[0])*ts, (v[1]-v[0])*ts))
+                    del open_spans[span]
+            for span in spans.keys():
+                open_spans[span] = [ty, ty+1]
+        for span, v in open_spans.items():
+            rects.append((span[0]*ts, v[0]*ts, (span[1]-span[0])*ts, (v[1]-v[0])*ts))
+        return rects
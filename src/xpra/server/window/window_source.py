@@ -32,6 +32,25 @@ DELTA = os.environ.get("XPRA_DELTA", "1")=="1"
 MIN_DELTA_SIZE = int(os.environ.get("XPRA_MIN_DELTA_SIZE", "1024"))
 MAX_DELTA_SIZE = int(os.environ.get("XPRA_MAX_DELTA_SIZE", "32768"))
 MAX_DELTA_HITS = int(os.environ.get("XPRA_MAX_DELTA_HITS", "20"))
+SCROLL_ENCODING = os.environ.get("XPRA_SCROLL_ENCODING", "1")=="1"
+#picture encodings we can send the scrolled strips with:
+SCROLL_ENCODINGS = ("png", "rgb24", "rgb32", "jpeg", "webp", "png/P", "png/L")
+#encodings which give the client exactly the same pixels as we have:
+#references to pixels the client has stored in one of its delta buckets:
+DELTA_CACHE_ENCODING = "cache"
+LOSSLESS_ENCODINGS = ("png", "rgb24", "rgb32", "mmap", DELTA_CACHE_ENCODING)
+SCROLL_PIXEL_FORMATS = ("BGRX", "BGRA", "RGBX", "RGBA", "XRGB", "ARGB", "RGB", "BGR")
+TILE_CACHE = os.environ.get("XPRA_TILE_CACHE", "1")=="1"
+#only skip tiles if that saves at least this percentage of the pixels:
+TILE_MIN_PERCENT = int(os.environ.get("XPRA_TILE_MIN_PERCENT", "10"))
+#don't split the update into more rectangles than this:
+MAX_TILE_RECTS = int(os.environ.get("XPRA_MAX_TILE_RECTS", "16"))
+SLICE_ENCODE = os.environ.get("XPRA_SLICE_ENCODE", "1")=="1"
+#only split frames larger than this number of pixels:
+SLICE_MIN_PIXELS = int(os.environ.get("XPRA_SLICE_MIN_PIXELS", 1024*1024))
+SLICE_MIN_HEIGHT = max(16, int(os.environ.get("XPRA_SLICE_MIN_HEIGHT", "64")))
+#the encoders which release the GIL:
+SLICE_ENCODINGS = ("png", "png/P", "png/L", "jpeg", "webp")
 MIN_WINDOW_REGION_SIZE = int(os.environ.get("XPRA_MIN_WINDOW_REGION_SIZE", "1024"))
 MAX_SOFT_EXPIRED = int(os.environ.get("XPRA_MAX_SOFT_EXPIRED", "5"))
 
@@ -48,7 +67,7 @@ LOG_THEME_DEFAULT_ICONS = os.environ.get("XPRA_LOG_THEME_DEFAULT_ICONS", "0")=="
 SAVE_WINDOW_ICONS = os.environ.get("XPRA_SAVE_WINDOW_ICONS", "0")=="1"
 
 
-from xpra.os_util import StringIOClass, memoryview_to_bytes
+from xpra.os_util import StringIOClass, memoryview_to_bytes, _memoryview
 from xpra.server.window.window_stats import WindowPerformanceStatistics
 from xpra.server.window.batch_config import DamageBatchConfig
 from xpra.simple_stats import get_list_stats
@@ -56,6 +75,13 @@ from xpra.server.window.batch_delay_calculator import calculate_batch_delay, get
 from xpra.server.cystats import time_weighted_average   #@UnresolvedImport
 from xpra.server.window.region import rectangle, add_rectangle, remove_rectangle, merge_all   #@UnresolvedImport
 from xpra.codecs.xor.cyxor import xor_str           #@UnresolvedImport
+from xpra.codecs.image_wrapper import ImageWrapper
+from xpra.server.window.scroll_data import ScrollData, hash_rows, MIN_SCROLL_LINES
+from xpra.server.window.tile_cache import TileCache
+from xpra.server.window.shared_encode import SHARED_ENCODINGS
+from xpra.server.window.delta_cache import DeltaCache, DeltaEntry, DELTA_CACHE_MAX_PIXELS, MAX_DELTA_BUCKETS
+from xpra.server.window.damage_trace import DamageTraceWriter, get_trace_filename, DAMAGE_TRACE
+from xpra.server.encode_pool import get_slice_pool
 from xpra.server.picture_encode import webp_encode, rgb_encode, mmap_send
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, get_codec
 from xpra.codecs.codec_constants import LOSSY_PIXEL_FORMATS
@@ -81,7 +107,8 @@ class WindowSource(object):
         WindowSource.timeout_add = timeout_add
         WindowSource.source_remove = source_remove
 
-    def __init__(self, queue_size, call_in_encode_thread, queue_packet, compressed_wrapper,
+    def __init__(self, queue_size, call_in_encode_thread, queue_packet, compressed_wrapper, compression_chooser,
+                    shared_encode_cache,
                     statistics,
                     wid, window, batch_config, auto_refresh_delay,
                     av_sync, av_sync_delay,
@@ -90,10 +117,11 @@ class WindowSource(object):
                     encoding, encodings, core_encodings, encoding_options, icons_encoding_options,
                     rgb_formats,
                     default_encoding_options,
-                    mmap, mmap_size):
+                    mmap, mmap_size, mmap_writer):
         # mmap:
         self._mmap = mmap
         self._mmap_size = mmap_size
+        self._mmap_writer = mmap_writer                 #allocates frame slots (None when using the legacy ring)
 
         self.init_vars()
 
@@ -101,6 +129,8 @@ class WindowSource(object):
         self.call_in_encode_thread = call_in_encode_thread  #callback to add damage data which is ready to compress to the damage processing queue
         self.queue_packet = queue_packet                #callback to add a network packet to the outgoing queue
         self.compressed_wrapper = compressed_wrapper    #callback utility for making compressed wrappers
+        self.compression_chooser = compression_chooser  #picks the rgb pixel compressor
+        self.shared_encode_cache = shared_encode_cache  #encode results shared with other clients (may be None)
         self.wid = wid
         self.global_statistics = statistics             #shared/global statistics from ServerSource
         self.statistics = WindowPerformanceStatistics()
@@ -130,12 +160,15 @@ class WindowSource(object):
         ropts = ropts.intersection(set(self.core_encodings))        #ensure the client has support for it
         self.client_refresh_encodings = encoding_options.strlistget("auto_refresh_encodings", list(ropts))
         self.max_soft_expired = max(0, min(100, encoding_options.intget("max-soft-expired", MAX_SOFT_EXPIRED)))
+        self.supports_scrolling = SCROLL_ENCODING and not window.is_tray() and encoding_options.boolget("scrolling")
+        self.supports_tile_cache = TILE_CACHE and not window.is_tray() and encoding_options.boolget("tile_cache")
         self.supports_delta = []
         if not window.is_tray() and DELTA:
             self.supports_delta = [x for x in encoding_options.strlistget("supports_delta", []) if x in ("png", "rgb24", "rgb32")]
             if self.supports_delta:
-                self.delta_buckets = min(25, encoding_options.intget("delta_buckets", 1))
-                self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+                self.delta_buckets = min(MAX_DELTA_BUCKETS, encoding_options.intget("delta_buckets", 1))
+                self.supports_delta_cache = encoding_options.boolget("delta_cache")
+                self.delta_cache = DeltaCache(self.delta_buckets)
         self.batch_config = batch_config
         #auto-refresh:
         self.auto_refresh_delay = auto_refresh_delay
@@ -209,6 +242,18 @@ class WindowSource(object):
         self.init_encoders()
         self.update_encoding_selection(encoding)
         log("initial encoding for %s: %s", self.wid, self.encoding)
+        if DAMAGE_TRACE:
+            self.init_damage_trace()
+
+    def init_damage_trace(self):
+        filename = get_trace_filename(self.wid)
+        try:
+            self.damage_trace = DamageTraceWriter(filename)
+        except Exception as e:
+            log.error("Error: cannot record the damage trace for window %i:", self.wid)
+            log.error(" %s", e)
+        else:
+            log.info("recording damage trace for window %i to '%s'", self.wid, filename)
 
     def __repr__(self):
         return "WindowSource(%s : %s)" % (self.wid, self.window_dimensions)
@@ -246,7 +291,13 @@ class WindowSource(object):
         self.full_frames_only = False
         self.supports_delta = []
         self.delta_buckets = 0
-        self.delta_pixel_data = []
+        self.supports_delta_cache = False
+        self.delta_cache = None
+        self.supports_scrolling = False
+        self.scroll_data = None
+        self.supports_tile_cache = False
+        self.tile_cache = None
+        self.damage_trace = None
         self.suspended = False
         self.strict = STRICT_MODE
         #
@@ -301,6 +352,9 @@ class WindowSource(object):
         self.cancel_damage()
         self.statistics.reset()
         log("encoding_totals for wid=%s with primary encoding=%s : %s", self.wid, self.encoding, self.statistics.encoding_totals)
+        dt = self.damage_trace
+        if dt:
+            dt.close()
         self.init_vars()
         self._damage_cancelled = float("inf")
         def window_signal_handlers_cleanup():
@@ -348,12 +402,12 @@ class WindowSource(object):
                                            }
                       }
 
-        now = time.time()
-        buckets_info = {}
-        for i,x in enumerate(self.delta_pixel_data):
-            if x:
-                w, h, pixel_format, coding, store, buflen, _, hits, last_used = x
-                buckets_info[i] = w, h, pixel_format, coding, store, buflen, hits, int((now-last_used)*1000)
+        dinfo = {""               : self.supports_delta,
+                 "buckets"        : self.delta_buckets,
+                 "cache"          : self.supports_delta_cache,
+                 }
+        if self.delta_cache:
+            dinfo.update(self.delta_cache.get_info())
         #remove large default dict:
         info.update({
                 "dimensions"            : self.window_dimensions,
@@ -368,10 +422,9 @@ class WindowSource(object):
                 "last_used"             : self.encoding_last_used or "",
                 "full-frames-only"      : self.full_frames_only,
                 "supports-transparency" : self.supports_transparency,
-                "delta"                 : {""               : self.supports_delta,
-                                           "buckets"        : self.delta_buckets,
-                                           "bucket"         : buckets_info,
-                                           },
+                "delta"                 : dinfo,
+                "scrolling"             : self.get_scroll_info(),
+                "tiles"                 : self.get_tile_info(),
                 "property"              : self.get_property_info(),
                 "batch"                 : self.batch_config.get_info(),
                 "soft-timeout"          : {
@@ -383,6 +436,8 @@ class WindowSource(object):
                  })
         if self.pixel_format:
             info["pixel-format"] = self.pixel_format
+        if self.damage_trace:
+            info["damage-trace"] = self.damage_trace.get_info()
         idata = self.window_icon_data
         if idata:
             pixel_data, stride, w, h = idata
@@ -608,6 +663,7 @@ class WindowSource(object):
             #remove rgb formats with alpha
             rgb_formats = [x for x in rgb_formats if x.find("A")<0]
         self.rgb_formats = rgb_formats
+        self.supports_scrolling = SCROLL_ENCODING and not self.is_tray and properties.boolget("encoding.scrolling", self.supports_scrolling)
         self.update_encoding_selection(self.encoding)
 
     def set_auto_refresh_delay(self, d):
@@ -650,7 +706,8 @@ class WindowSource(object):
         if self.encoding==encoding:
             return
         self.statistics.reset()
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        self.scroll_data = None
+        self.tile_cache = None
         self.update_encoding_selection(encoding)
 
 
@@ -787,7 +844,10 @@ class WindowSource(object):
                 self.free_image_wrapper(item[6])
         self._damage_delayed = None
         self._damage_delayed_expired = False
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        if self.delta_cache:
+            self.delta_cache.reset()
+        self.scroll_data = None
+        self.tile_cache = None
         #make sure we don't account for those as they will get dropped
         #(generally before encoding - only one may still get encoded):
         for sequence in self.statistics.encoding_pending.keys():
@@ -1350,14 +1410,17 @@ class WindowSource(object):
         av_sync = options.get("av-sync", False)
         av_delay = self.av_sync_delay*int(av_sync)
         if not av_sync:
+            self.prepare_image(image, coding)
             self.call_in_encode_thread(self.make_data_packet_cb, *item)
         else:
             #schedule encode via queue, after freezing the pixels:
             if not image.freeze():
                 avsynclog("Warning: failed to freeze image pixels for:")
                 avsynclog(" %s", image)
+                self.prepare_image(image, coding)
                 self.call_in_encode_thread(self.make_data_packet_cb, *item)
                 return
+            self.prepare_image(image, coding)
             self.encode_queue.append(item)
             l = len(self.encode_queue)
             if l>=self.encode_queue_max_size:
@@ -1365,6 +1428,22 @@ class WindowSource(object):
             avsynclog("scheduling encode queue iteration in %ims, encode queue size=%i (max=%i)", av_delay, l, self.encode_queue_max_size)
             self.timeout_add(av_delay, self.call_in_encode_thread, self.encode_from_queue)
 
+    def prepare_image(self, image, coding):
+        """
+            Called from the UI thread just before the image is queued for encoding,
+            WindowVideoSource overrides this method to start the csc step early.
+        """
+        pass
+
+    def is_direct_encoding(self, coding):
+        """
+            Returns True if frames using this encoding are always given
+            to the encoder whole: never sent as scroll or tile packets, slices,
+            delta cache references or shared encode results.
+        """
+        return coding not in SCROLL_ENCODINGS and coding not in SLICE_ENCODINGS and \
+            coding not in self.supports_delta and coding not in SHARED_ENCODINGS
+
     def encode_from_queue(self):
         #note: we use a queue here to ensure we preserve the order
         #(so we encode frames in the same order they were grabbed)
@@ -1421,8 +1500,30 @@ class WindowSource(object):
             Extra care must be taken to prevent access to X11 functions on window.
         """
         self.statistics.encoding_pending[sequence] = (damage_time, w, h)
+        dt = self.damage_trace
+        if dt:
+            dt.record(wid, image, coding, damage_time)
+        packets = None
         try:
-            packet = self.make_data_packet(damage_time, process_damage_time, wid, image, coding, sequence, options, flush)
+            row_hashes = tile_hashes = None
+            direct = self.is_direct_encoding(coding)
+            if self.supports_scrolling and not direct:
+                row_hashes = self.get_scroll_hashes(image, coding)
+                if row_hashes:
+                    packets = self.make_scroll_packets(damage_time, process_damage_time, wid, image, coding, sequence, options, flush, row_hashes)
+            if packets is None and self.supports_tile_cache and not direct:
+                tile_hashes = self.get_tile_hashes(image, coding)
+                if tile_hashes:
+                    packets = self.make_tile_packets(damage_time, process_damage_time, wid, image, coding, sequence, options, flush, tile_hashes)
+            if packets is None and SLICE_ENCODE and not direct:
+                packets = self.make_slice_packets(wid, image, coding, sequence, options, flush, row_hashes, tile_hashes)
+            if packets is None:
+                ix, iy, iw, ih, _ = image.get_geometry()
+                packet = self.make_data_packet(damage_time, process_damage_time, wid, image, coding, sequence, options, flush)
+                packets = []
+                if packet:
+                    packets.append(packet)
+                    self.record_client_pixels(ix, iy, iw, ih, packet, row_hashes, tile_hashes)
         finally:
             self.free_image_wrapper(image)
             del image
@@ -1433,20 +1534,27 @@ class WindowSource(object):
                 pass
         #NOTE: we MUST send it (even if the window is cancelled by now..)
         #because the code may rely on the client having received this frame
-        if not packet:
+        if not packets:
             return
-        #queue packet for sending:
-        self.queue_damage_packet(packet, damage_time, process_damage_time)
+        #queue packets for sending:
+        for packet in packets:
+            self.queue_damage_packet(packet, damage_time, process_damage_time)
 
         if not self.can_refresh(window):
             self.cancel_refresh_timer()
             return
+        for packet in packets:
+            self.schedule_auto_refresh(window, packet, options)
+
+    def schedule_auto_refresh(self, window, packet, options):
+        """ figure out if we need to schedule an auto-refresh for the region of this packet """
         encoding = packet[6]
         #the actual encoding used may be different from the global one we specify
         x, y, w, h = packet[2:6]
         client_options = packet[10]     #info about this packet from the encoder
         actual_quality = client_options.get("quality", 0)
-        if encoding.startswith("png") or encoding.startswith("rgb"):
+        if encoding.startswith("png") or encoding.startswith("rgb") or encoding in ("scroll", DELTA_CACHE_ENCODING):
+            #(we only scroll or cache pixels which were sent losslessly)
             actual_quality = 100
         #jpeg uses colour subsampling by default, otherwise check the csc format value:
         lossy_csc = encoding=="jpeg" or client_options.get("csc") in LOSSY_PIXEL_FORMATS
@@ -1510,6 +1618,284 @@ class WindowSource(object):
         self.last_auto_refresh_message = time.time(), msg
         refreshlog("auto refresh: %5s screen update (quality=%3i), %s (region=%s, refresh regions=%s)", encoding, actual_quality, msg, region, self.refresh_regions)
 
+
+    def get_scroll_info(self):
+        sd = self.scroll_data
+        info = {"" : self.supports_scrolling}
+        if sd:
+            info.update(sd.get_info())
+        return info
+
+    def get_scroll_hashes(self, image, coding):
+        """
+            Returns the hash of each row of pixels in the image,
+            or None if this image cannot be used for scroll detection.
+            (runs in the encode thread)
+        """
+        x, y, w, h, _ = image.get_geometry()
+        ww, wh = self.window_dimensions
+        sd = self.scroll_data
+        if coding not in SCROLL_ENCODINGS:
+            #don't bother hashing the rows (ie: video),
+            #the client will not have the same pixels anyway:
+            if sd:
+                sd.invalidate(y, h)
+            return None
+        if sd is None or sd.width!=ww or sd.height!=wh:
+            sd = self.scroll_data = ScrollData(ww, wh)
+        pixel_format = image.get_pixel_format()
+        if x!=0 or w!=ww or image.get_planes()!=ImageWrapper.PACKED or pixel_format not in SCROLL_PIXEL_FORMATS:
+            #we can't match partial rows, so we won't know what the client has for these rows:
+            sd.invalidate(y, h)
+            return None
+        pixels = image.get_pixels()
+        if not pixels:
+            sd.invalidate(y, h)
+            return None
+        return hash_rows(pixels, 0, h, 0, w*len(pixel_format), image.get_rowstride())
+
+    def make_slice_packets(self, wid, image, coding, sequence, options, flush, row_hashes, tile_hashes):
+        """
+            Splits large frames into horizontal slices which are encoded concurrently,
+            each slice is sent as a separate packet using the flush sequence.
+            Returns None if the frame should not be split.
+        """
+        x, y, w, h, depth = image.get_geometry()
+        if coding not in SLICE_ENCODINGS or w*h<SLICE_MIN_PIXELS:
+            return None
+        pool = get_slice_pool()
+        n = min(pool.nthreads+1, h//SLICE_MIN_HEIGHT)
+        if n<=1 or image.get_planes()!=ImageWrapper.PACKED:
+            return None
+        encoder = self._encoders.get(coding)
+        pixels = image.get_pixels()
+        if not encoder or not pixels:
+            return None
+        if _memoryview and not isinstance(pixels, _memoryview):
+            pixels = _memoryview(pixels)
+        if self.is_cancelled(sequence) or self.suspended:
+            return None
+        rowstride = image.get_rowstride()
+        pixel_format = image.get_pixel_format()
+        slices = []
+        sy = 0
+        for i in range(n):
+            sh = (h-sy)//(n-i)
+            #each slice uses the same buffer, without copying the pixels:
+            buf = pixels[sy*rowstride:(sy+sh)*rowstride]
+            slices.append(ImageWrapper(x, y+sy, w, sh, buf, pixel_format, depth, rowstride))
+            sy += sh
+        start = time.time()
+        def encode(sub):
+            return encoder(coding, sub, options)
+        results = pool.map(encode, slices)
+        log("make_slice_packets: %i slices of %ix%i %s encoded in %.1fms", n, w, h, coding, (time.time()-start)*1000)
+        if self.is_cancelled(sequence) or self.suspended:
+            return []
+        if None in results:
+            log("make_slice_packets: failed to encode some slices, trying the full frame")
+            return None
+        packets = []
+        tc = self.tile_cache
+        for i, (sub, ret) in enumerate(zip(slices, results)):
+            scoding, data, client_options, outw, outh, outstride, bpp = ret
+            sx, sy, sw, sh, _ = sub.get_geometry()
+            sflush = None
+            if self.supports_flush:
+                sflush = (flush or 0)+n-1-i
+            packet = self.make_draw_packet(wid, sx, sy, sw, sh, scoding, data, client_options, outw, outh, outstride, bpp, sflush, start)
+            packets.append(packet)
+            srow_hashes = None
+            if row_hashes:
+                srow_hashes = row_hashes[sy-y:sy-y+sh]
+            stile_hashes = None
+            if tile_hashes and tc:
+                stile_hashes = tc.get_contained(tile_hashes, sx, sy, sw, sh)
+            self.record_client_pixels(sx, sy, sw, sh, packet, srow_hashes, stile_hashes)
+        return packets
+
+    def record_client_pixels(self, x, y, w, h, packet, row_hashes=None, tile_hashes=None):
+        """
+            Records the rows and tiles the client will have once it has processed this packet,
+            we can only do that if the packet gives it exactly the same pixels as we have,
+            otherwise we just forget about the area modified.
+            The row hashes, if specified, must be for the full width of the window,
+            and the tile hashes must be for tiles fully contained in the area.
+        """
+        lossless = packet[6] in LOSSLESS_ENCODINGS
+        sd = self.scroll_data
+        if sd:
+            if row_hashes and lossless:
+                sd.update(y, row_hashes)
+            else:
+                sd.invalidate(y, h)
+        tc = self.tile_cache
+        if tc:
+            tc.invalidate(x, y, w, h)
+            if tile_hashes and lossless:
+                tc.update(tile_hashes)
+
+    def make_scroll_packets(self, damage_time, process_damage_time, wid, image, coding, sequence, options, flush, hashes):
+        """
+            If the rows of this image are the same as some of the rows the client already has,
+            but moved up or down, we tell the client to copy those rows using a 'scroll' packet,
+            and only encode the rows that have actually changed.
+            Returns None if we can't use scrolling for this image.
+        """
+        sd = self.scroll_data
+        x, y, w, h, depth = image.get_geometry()
+        if sd is None or h<MIN_SCROLL_LINES*2 or coding not in SCROLL_ENCODINGS:
+            return None
+        if self.is_cancelled(sequence) or self.suspended:
+            return None
+        start = time.time()
+        distance = sd.calculate(y, hashes)
+        if distance==0:
+            return None
+        scrolls, unchanged, changed = sd.get_scroll_values(y, hashes, distance)
+        scrolled = sum(sh for _, sh in scrolls)
+        if scrolled<MIN_SCROLL_LINES:
+            return None
+        def get_flush(n):
+            if not self.supports_flush:
+                return None
+            return (flush or 0)+n
+        #each item is a rectangle the client should copy, and how far it should be moved:
+        scroll_list = [(x, sy-distance, w, sh, 0, distance) for sy, sh in scrolls]
+        client_options = {}
+        f = get_flush(len(changed))
+        if f is not None:
+            client_options["flush"] = f
+        packet = ("draw", wid, x, y, w, h, "scroll", scroll_list, self._damage_packet_sequence, 0, client_options)
+        self._damage_packet_sequence += 1
+        self.global_statistics.packet_count += 1
+        self.statistics.packet_count += 1
+        totals = self.statistics.encoding_totals.setdefault("scroll", [0, 0])
+        totals[0] = totals[0] + 1
+        totals[1] = totals[1] + w*scrolled
+        sd.scroll_count += 1
+        sd.scrolled_rows += scrolled
+        sd.skipped_rows += sum(sh for _, sh in unchanged)
+        #once the client has processed the scroll packet, it will have these rows:
+        for sy, sh in scrolls+unchanged:
+            sd.update(sy, hashes[sy-y:sy-y+sh])
+        #but the tiles have moved:
+        tc = self.tile_cache
+        if tc:
+            tc.invalidate(x, y, w, h)
+        compresslog("scroll: %5.1fms for %4ix%-4i pixels for wid=%-5i, distance=%i, scrolled rows=%s, unchanged rows=%s, changed rows=%s",
+                 (time.time()-start)*1000.0, w, h, wid, distance, scrolls, unchanged, changed)
+        packets = [packet]
+        if not changed:
+            return packets
+        #now encode the rows that have changed:
+        pixels = memoryview_to_bytes(image.get_pixels())
+        rowstride = image.get_rowstride()
+        pixel_format = image.get_pixel_format()
+        for i, (sy, sh) in enumerate(changed):
+            offset = (sy-y)*rowstride
+            sub = ImageWrapper(x, sy, w, sh, pixels[offset:offset+sh*rowstride], pixel_format, depth, rowstride)
+            try:
+                strip_packet = self.make_data_packet(damage_time, process_damage_time, wid, sub, coding, sequence, options, get_flush(len(changed)-1-i))
+            finally:
+                sub.free()
+            if strip_packet:
+                packets.append(strip_packet)
+                self.record_client_pixels(x, sy, w, sh, strip_packet, hashes[sy-y:sy-y+sh])
+            else:
+                sd.invalidate(sy, sh)
+        return packets
+
+
+    def get_tile_info(self):
+        tc = self.tile_cache
+        info = {"" : self.supports_tile_cache}
+        if tc:
+            info.update(tc.get_info())
+        return info
+
+    def get_tile_hashes(self, image, coding):
+        """
+            Returns the hash of each tile fully contained in the image,
+            or None if we can't or shouldn't use the tile cache for this image.
+            (runs in the encode thread)
+        """
+        x, y, w, h, _ = image.get_geometry()
+        ww, wh = self.window_dimensions
+        tc = self.tile_cache
+        if tc is None or tc.width!=ww or tc.height!=wh:
+            tc = self.tile_cache = TileCache(ww, wh)
+        if coding not in SCROLL_ENCODINGS:
+            return None
+        if coding not in LOSSLESS_ENCODINGS and not tc.tiles:
+            #we can't record the tiles sent lossily, and there is nothing to compare with:
+            return None
+        pixel_format = image.get_pixel_format()
+        if image.get_planes()!=ImageWrapper.PACKED or pixel_format not in SCROLL_PIXEL_FORMATS:
+            return None
+        tx1, ty1, tx2, ty2 = tc.get_tile_range(x, y, w, h)
+        if tx2<=tx1 or ty2<=ty1:
+            return None
+        pixels = image.get_pixels()
+        if not pixels:
+            return None
+        return tc.hash_tiles(x, y, w, h, pixels, image.get_rowstride(), len(pixel_format))
+
+    def make_tile_packets(self, damage_time, process_damage_time, wid, image, coding, sequence, options, flush, tile_hashes):
+        """
+            Skips the tiles the client already has,
+            and only encodes the rectangles that have actually changed.
+            Returns None if this would not save enough.
+        """
+        tc = self.tile_cache
+        x, y, w, h, depth = image.get_geometry()
+        if self.is_cancelled(sequence) or self.suspended:
+            return None
+        unchanged = tc.get_unchanged(tile_hashes)
+        ts = tc.tile_size
+        if not unchanged or len(unchanged)*ts*ts<w*h*TILE_MIN_PERCENT//100:
+            return None
+        rects = [rectangle(x, y, w, h)]
+        for tx, ty, tw, th in tc.get_tile_rects(unchanged):
+            remove_rectangle(rects, rectangle(tx, ty, tw, th))
+        if len(rects)>MAX_TILE_RECTS:
+            log("make_tile_packets: too many rectangles (%i) for %s", len(rects), image)
+            return None
+        log("make_tile_packets: %i unchanged tiles, %i rectangles to send", len(unchanged), len(rects))
+        totals = self.statistics.encoding_totals.setdefault("tiles-skipped", [0, 0])
+        totals[0] = totals[0] + len(unchanged)
+        totals[1] = totals[1] + len(unchanged)*ts*ts
+        if not rects:
+            if self.supports_flush and flush is not None:
+                #the client is waiting for this packet to flush the previous ones
+                return None
+            #nothing has changed, nothing to send!
+            return []
+        packets = []
+        pixels = memoryview_to_bytes(image.get_pixels())
+        rowstride = image.get_rowstride()
+        pixel_format = image.get_pixel_format()
+        Bpp = len(pixel_format)
+        for i, r in enumerate(rects):
+            rx, ry, rw, rh = r.x, r.y, r.width, r.height
+            #copy the pixels for this rectangle:
+            start = (ry-y)*rowstride+(rx-x)*Bpp
+            stride = rw*Bpp
+            data = b"".join(pixels[start+j*rowstride:start+j*rowstride+stride] for j in range(rh))
+            sub = ImageWrapper(rx, ry, rw, rh, data, pixel_format, depth, stride)
+            rflush = None
+            if self.supports_flush:
+                rflush = (flush or 0)+len(rects)-1-i
+            try:
+                packet = self.make_data_packet(damage_time, process_damage_time, wid, sub, coding, sequence, options, rflush)
+            finally:
+                sub.free()
+            if packet:
+                packets.append(packet)
+                rhashes = tc.get_contained(tile_hashes, rx, ry, rw, rh)
+                self.record_client_pixels(rx, ry, rw, rh, packet, None, rhashes)
+        return packets
+
     def remove_refresh_region(self, region):
         #removes the given region from the refresh list
         #(also overriden in window video source)
@@ -1640,6 +2026,7 @@ class WindowSource(object):
                 damage_out_latency = now-process_damage_time
                 self.statistics.damage_out_latency.append((now, width*height, actual_batch_delay, damage_out_latency))
                 self.statistics.damage_send_speed.append((now, bytecount-start_bytecount, now-start_send_time))
+                self.global_statistics.bandwidth.record_send((self.wid, damage_packet_sequence), start_send_time, now, bytecount-start_bytecount)
         now = time.time()
         damage_in_latency = now-process_damage_time
         self.statistics.damage_in_latency.append((now, width*height, actual_batch_delay, damage_in_latency))
@@ -1665,6 +2052,7 @@ class WindowSource(object):
             log("cannot find sent time for sequence %s", damage_packet_sequence)
             return
         del self.statistics.damage_ack_pending[damage_packet_sequence]
+        self.global_statistics.bandwidth.record_ack((self.wid, damage_packet_sequence), time.time(), max(0, decode_time)/1000.0/1000.0)
         if decode_time>0:
             start_send_at, start_bytes, end_send_at, end_bytes, pixels = pending
             bytecount = end_bytes-start_bytes
@@ -1686,7 +2074,10 @@ class WindowSource(object):
         log.warn("Warning: client decoding error: %s%s", message, emsg)
         self.global_statistics.decode_errors += 1
         #something failed client-side, so we can't rely on the delta being available
-        self.delta_pixel_data = [None for _ in range(self.delta_buckets)]
+        if self.delta_cache:
+            self.delta_cache.reset()
+        self.scroll_data = None
+        self.tile_cache = None
         if window:
             self.timeout_add(250, self.full_quality_refresh, window)
 
@@ -1718,13 +2109,19 @@ class WindowSource(object):
         start = time.time()
         delta, store, bucket, hits = -1, -1, -1, 0
         pixel_format = image.get_pixel_format()
+        dc = self.delta_cache
+        max_store_size = self.max_delta_size
+        if self.supports_delta_cache and self.max_delta_size>0:
+            #we can store larger regions since the client can re-use them without any xoring:
+            max_store_size = max(self.max_delta_size, DELTA_CACHE_MAX_PIXELS)
+        entry = None
         #use delta pre-compression for this encoding if:
         #* client must support delta (at least one bucket)
         #* encoding must be one that supports delta (usually rgb24/rgb32 or png)
         #* size is worth xoring (too small is pointless, too big is too expensive)
         #* the pixel format is supported by the client
         # (if we have to rgb_reformat the buffer, it really complicates things)
-        if self.delta_buckets>0 and (coding in self.supports_delta) and self.min_delta_size<isize<self.max_delta_size and \
+        if dc and (coding in self.supports_delta) and self.min_delta_size<isize<max_store_size and \
             pixel_format in self.rgb_formats:
             #this may save space (and lower the cost of xoring):
             image.restride()
@@ -1736,36 +2133,50 @@ class WindowSource(object):
             dlen = len(dpixels)
             store = sequence
             deltalog("delta available for %s and %i %s pixels on wid=%i", coding, isize, pixel_format, wid)
-            for i, dr in enumerate(list(self.delta_pixel_data)):
-                if dr is None:
-                    continue
-                lw, lh, lpixel_format, lcoding, lsequence, buflen, ldata, hits, _ = dr
-                if lw==w and lh==h and lpixel_format==pixel_format and lcoding==coding and buflen==dlen:
-                    bucket = i
+            content_key = dc.get_key(w, h, pixel_format, dpixels)
+            if self.supports_delta_cache:
+                bucket, entry = dc.find(content_key)
+                if entry:
+                    deltalog("delta: the client already has these pixels in bucket %i (sequence=%i)", bucket, entry.store)
+                    store = -1
+            if not entry and isize<self.max_delta_size:
+                bucket, dr = dc.find_delta(w, h, pixel_format, coding, dlen)
+                if dr:
+                    hits = dr.hits
                     if MAX_DELTA_HITS>0 and hits<MAX_DELTA_HITS:
-                        deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", i, lw, lh, lpixel_format, dlen, lsequence, hits)
+                        deltalog("delta: using matching bucket %s: %sx%s (%s, %i bytes, sequence=%i, hit count=%s)", bucket, w, h, pixel_format, dlen, dr.store, hits)
                         #xor with this matching delta bucket:
-                        delta = lsequence
-                        xored = xor_str(dpixels, ldata)
+                        delta = dr.store
+                        xored = xor_str(dpixels, dr.pixels)
                         image.set_pixels(xored)
-                        dr[-1] = time.time()            #update last used time
+                        dr.last_used = time.time()
                         hits += 1
-                        dr[-2] = hits               #update hit count
+                        dr.hits = hits
                     else:
                         deltalog("delta: too many hits for bucket %s: %s, clearing it", bucket, hits)
                         hits = 0
-                        self.delta_pixel_data[i] = None
+                        dc.clear(bucket)
                         delta = -1
-                    break
 
-        #by default, don't set rowstride (the container format will take care of providing it):
-        encoder = self._encoders.get(coding)
-        if encoder is None:
-            if self.is_cancelled(sequence):
-                return None
+        if entry:
+            #no need to encode anything, just tell the client which bucket to use:
+            ret = DELTA_CACHE_ENCODING, b"", {"bucket" : bucket, "delta" : entry.store}, w, h, 0, len(pixel_format)*8
+        else:
+            #by default, don't set rowstride (the container format will take care of providing it):
+            encoder = self._encoders.get(coding)
+            if encoder is None:
+                if self.is_cancelled(sequence):
+                    return None
+                else:
+                    raise Exception("BUG: no encoder not found for %s" % coding)
+            sec = self.shared_encode_cache
+            key = None
+            if sec and sec.is_enabled() and delta<0 and coding in SHARED_ENCODINGS:
+                key = sec.get_key(wid, image, coding, self.get_shared_encode_settings(coding, options))
+            if key:
+                ret = sec.encode(key, encoder, coding, image, options)
             else:
-                raise Exception("BUG: no encoder not found for %s" % coding)
-        ret = encoder(coding, image, options)
+                ret = encoder(coding, image, options)
         if ret is None:
             log("%s%s returned None", encoder, (coding, image, options))
             #something went wrong.. nothing we can do about it here!
@@ -1786,27 +2197,18 @@ class WindowSource(object):
             if delta>0 and csize>=psize*40//100:
                 #compressed size is more than 40% of the original
                 #maybe delta is not helping us, so clear it:
-                self.delta_pixel_data[bucket] = None
+                dc.clear(bucket)
                 deltalog("delta: clearing bucket %i (compressed size=%s, original size=%s)", bucket, csize, psize)
                 #TODO: could tell the clients they can clear it too
                 #(add a new client capability and send it a zero store value)
             else:
                 #find the bucket to use:
                 if bucket<0:
-                    lpd = self.delta_pixel_data
-                    try:
-                        bucket = lpd.index(None)
-                        deltalog("delta: found empty bucket %i", bucket)
-                    except ValueError:
-                        #find a bucket which has not been used recently
-                        t = 0
-                        bucket = 0
-                        for i,dr in enumerate(lpd):
-                            if dr and (t==0 or dr[-1]<t):
-                                t = dr[-1]
-                                bucket = i
-                        deltalog("delta: using oldest bucket %i", bucket)
-                self.delta_pixel_data[bucket] = [w, h, pixel_format, coding, store, len(dpixels), dpixels, hits, time.time()]
+                    bucket = dc.choose_bucket()
+                    deltalog("delta: using bucket %i", bucket)
+                dentry = DeltaEntry(w, h, pixel_format, coding, store, dpixels, content_key)
+                dentry.hits = hits
+                dc.store(bucket, dentry)
                 client_options["store"] = store
                 client_options["bucket"] = bucket
                 #record number of frames and pixels:
@@ -1814,6 +2216,17 @@ class WindowSource(object):
                 totals[0] = totals[0] + 1
                 totals[1] = totals[1] + w*h
                 deltalog("delta: client options=%s (for region %s)", client_options, (x, y, w, h))
+        if dc and self.supports_delta_cache and coding in self.supports_delta:
+            #let the client free the buckets we have evicted:
+            evicted = dc.take_evicted()
+            if evicted:
+                client_options["evict"] = evicted
+        return self.make_draw_packet(wid, x, y, w, h, coding, data, client_options, outw, outh, outstride, bpp, flush, start)
+
+    def make_draw_packet(self, wid, x, y, w, h, coding, data, client_options, outw, outh, outstride, bpp, flush, start):
+        """ makes the actual network packet from the encoder output and records the statistics """
+        csize = len(data)
+        psize = w*h*4
         if INTEGRITY_HASH and coding!="mmap":
             #could be a compressed wrapper or just raw bytes:
             try:
@@ -1834,7 +2247,7 @@ class WindowSource(object):
         self.global_statistics.packet_count += 1
         self.statistics.packet_count += 1
         self._damage_packet_sequence += 1
-        self.statistics.encoding_stats.append((end, coding, w*h, bpp, len(data), end-start))
+        self.statistics.add_encoding_stats(end, coding, w*h, bpp, len(data), end-start)
         #record number of frames and pixels:
         totals = self.statistics.encoding_totals.setdefault(coding, [0, 0])
         totals[0] = totals[0] + 1
@@ -1844,6 +2257,17 @@ class WindowSource(object):
         return packet
 
 
+    def get_shared_encode_settings(self, coding, options):
+        """
+            All the settings that can affect the output of the encoder,
+            other clients can only re-use our encoded data if they match.
+        """
+        q = options.get("quality") or self.get_quality(coding)
+        s = options.get("speed") or self.get_speed(coding)
+        return (q, s, self.supports_transparency, tuple(self.rgb_formats),
+                self.rgb_zlib, self.rgb_lz4, self.rgb_lzo,
+                tuple(sorted((k, repr(v)) for k, v in options.items())))
+
     def webp_encode(self, coding, image, options):
         q = options.get("quality") or self.get_quality(coding)
         s = options.get("speed") or self.get_speed(coding)
@@ -1852,7 +2276,7 @@ class WindowSource(object):
     def rgb_encode(self, coding, image, options):
         s = options.get("speed") or self._current_speed
         return rgb_encode(coding, image, self.rgb_formats, self.supports_transparency, s,
-                          self.rgb_zlib, self.rgb_lz4, self.rgb_lzo)
+                          self.rgb_zlib, self.rgb_lz4, self.rgb_lzo, self.compression_chooser)
 
     def pillow_encode(self, coding, image, options):
         #for more information on pixel formats supported by PIL / Pillow, see:
@@ -1866,11 +2290,12 @@ class WindowSource(object):
 
     def mmap_encode(self, coding, image, options):
         assert self._mmap and self._mmap_size>0
-        v = mmap_send(self._mmap, self._mmap_size, image, self.rgb_formats, self.supports_transparency)
+        v = mmap_send(self._mmap, self._mmap_size, image, self.rgb_formats, self.supports_transparency, self._mmap_writer)
         if v is None:
             return None
-        mmap_info, mmap_free_size, written = v
+        mmap_info, mmap_free_size, written, client_options = v
         self.global_statistics.mmap_bytes_sent += written
         self.global_statistics.mmap_free_size = mmap_free_size
         #the data we send is the index within the mmap area:
-        return "mmap", mmap_info, {"rgb_format" : image.get_pixel_format()}, image.get_width(), image.get_height(), image.get_rowstride(), 32
+        client_options["rgb_format"] = image.get_pixel_format()
+        return "mmap", mmap_info, client_options, image.get_width(), image.get_height(), image.get_rowstride(), 32
@@ -21,11 +21,13 @@ log = Logger("stats")
 from collections import deque
 from xpra.simple_stats import get_list_stats, get_weighted_list_stats
 from xpra.util import engs, csv
+from xpra.server.incremental_stats import TimeWeightedRecords, TimeSizeWeightedRecords
 from xpra.server.cystats import (logp,      #@UnresolvedImport
-    calculate_time_weighted_average,        #@UnresolvedImport
-    calculate_timesize_weighted_average,    #@UnresolvedImport
     calculate_for_average)                  #@UnresolvedImport
 
+#only regions at least this big are used for the compression score:
+MIN_SCORE_PIXELS = 4096
+
 
 class WindowPerformanceStatistics(object):
     """
@@ -40,15 +42,26 @@ class WindowPerformanceStatistics(object):
     DEFAULT_TARGET_LATENCY = 0.1
 
     def reset(self):
-        self.client_decode_time = deque(maxlen=NRECS)       #records how long it took the client to decode frames:
+        #the records below maintain their time weighted averages as they are added (see incremental_stats):
+        self.client_decode_time = TimeSizeWeightedRecords(NRECS, sizeunit=1000*1000)
+                                                            #records how long it took the client to decode frames:
                                                             #(ack_time, no of pixels, decoding_time*1000*1000)
+        self.client_decode_queue = TimeWeightedRecords(NRECS, 2)
+                                                            #how many draw packets the client had queued for this window:
+                                                            #(ack_time, queue size)
         self.encoding_stats = deque(maxlen=NRECS)           #encoding: (time, coding, pixels, bpp, compressed_size, encoding_time)
+        self.compression_score = TimeSizeWeightedRecords(NRECS, score=True)
+                                                            #compression ratio of the larger regions, in per-1000:
+                                                            #(time, pixels, ratio)
         # statistics:
-        self.damage_in_latency = deque(maxlen=NRECS)        #records how long it took for a damage request to be sent
+        self.damage_in_latency = TimeWeightedRecords(NRECS, 4)
+                                                            #records how long it took for a damage request to be sent
                                                             #last NRECS: (sent_time, no of pixels, actual batch delay, damage_latency)
-        self.damage_out_latency = deque(maxlen=NRECS)       #records how long it took for a damage request to be processed
+        self.damage_out_latency = TimeWeightedRecords(NRECS, 4)
+                                                            #records how long it took for a damage request to be processed
                                                             #last NRECS: (processed_time, no of pixels, actual batch delay, damage_latency)
-        self.damage_send_speed = deque(maxlen=NRECS)        #how long it took to send damage packets (this is not a sustained speed)
+        self.damage_send_speed = TimeSizeWeightedRecords(NRECS)
+                                                            #how long it took to send damage packets (this is not a sustained speed)
                                                             #last NRECS: (sent_time, no_of_pixels, elapsed_time)
         self.damage_ack_pending = {}                        #records when damage packets are sent
                                                             #so we can calculate the "client_latency" when the client sends
@@ -76,22 +89,30 @@ class WindowPerformanceStatistics(object):
         self.avg_send_speed = -1
         self.recent_send_speed = -1
 
+    def add_encoding_stats(self, end, coding, pixels, bpp, compressed_size, encoding_time):
+        self.encoding_stats.append((end, coding, pixels, bpp, compressed_size, encoding_time))
+        if pixels>=MIN_SCORE_PIXELS:
+            self.compression_score.append((end, pixels, 1000*compressed_size*bpp//pixels//32))
+
     def update_averages(self):
+        #all the averages are maintained as the records are added, so this is cheap:
         #damage "in" latency: (the time it takes for damage requests to be processed only)
-        if len(self.damage_in_latency)>0:
-            data = [(when, latency) for when, _, _, latency in list(self.damage_in_latency)]
-            self.avg_damage_in_latency, self.recent_damage_in_latency =  calculate_time_weighted_average(data)
+        v = self.damage_in_latency.get_averages()
+        if v:
+            self.avg_damage_in_latency, self.recent_damage_in_latency = v
         #damage "out" latency: (the time it takes for damage requests to be processed and sent out)
-        if len(self.damage_out_latency)>0:
-            data = [(when, latency) for when, _, _, latency in list(self.damage_out_latency)]
-            self.avg_damage_out_latency, self.recent_damage_out_latency = calculate_time_weighted_average(data)
+        v = self.damage_out_latency.get_averages()
+        if v:
+            self.avg_damage_out_latency, self.recent_damage_out_latency = v
         #client decode speed:
-        if len(self.client_decode_time)>0:
-            #the elapsed time recorded is in microseconds, so multiply by 1000*1000 to get the real value:
-            self.avg_decode_speed, self.recent_decode_speed = calculate_timesize_weighted_average(list(self.client_decode_time), sizeunit=1000*1000)
+        #(the elapsed time recorded is in microseconds, the sizeunit takes care of it)
+        v = self.client_decode_time.get_averages()
+        if v:
+            self.avg_decode_speed, self.recent_decode_speed = v
         #network send speed:
-        if len(self.damage_send_speed)>0:
-            self.avg_send_speed, self.recent_send_speed = calculate_timesize_weighted_average(list(self.damage_send_speed))
+        v = self.damage_send_speed.get_averages()
+        if v:
+            self.avg_send_speed, self.recent_send_speed = v
         all_l = [0.1,
                  self.avg_damage_in_latency, self.recent_damage_in_latency,
                  self.avg_damage_out_latency, self.recent_damage_out_latency]
@@ -135,6 +156,18 @@ class WindowPerformanceStatistics(object):
             recent1MB = 1.0*1024*1024/rds
             weight_div = max(0.25, rds/(4*1000*1000))
             factors.append(calculate_for_average(metric, avg1MB, recent1MB, weight_offset=0.0, weight_div=weight_div))
+        #client decode queue:
+        v = self.client_decode_queue.get_averages()
+        if v:
+            avg_qsize, recent_qsize = v
+            #the client's draw threads are falling behind,
+            #the more packets are waiting the more we slow down:
+            metric = "client-decode-queue"
+            info = {"avg"       : int(100*avg_qsize),
+                    "recent"    : int(100*recent_qsize)}
+            target = 1.0+recent_qsize/2.0
+            weight = logp(recent_qsize)
+            factors.append((metric, info, target, weight))
         ldet = self.last_damage_event_time
         if ldet:
             #If nothing happens for a while then we can reduce the batch delay,
@@ -189,6 +222,8 @@ class WindowPerformanceStatistics(object):
         dinfo["in_latency"]  = get_list_stats(latencies, show_percentile=[9])
         latencies = [x*1000 for _, _, _, x in list(self.damage_out_latency)]
         dinfo["out_latency"] = get_list_stats(latencies, show_percentile=[9])
+        if len(self.client_decode_queue)>0:
+            dinfo["client_queue"] = get_list_stats(self.client_decode_queue.get_field(1))
         #per encoding totals:
         if self.encoding_totals:
             tf = info.setdefault("total_frames", {})
@@ -206,9 +241,10 @@ class WindowPerformanceStatistics(object):
             Then we add the average decoding latency.
             """
         decoding_latency = 0.010
-        if len(self.client_decode_time)>0:
-            decoding_latency, _ = calculate_timesize_weighted_average(list(self.client_decode_time))
-            decoding_latency /= 1000.0
+        v = self.client_decode_time.get_averages()
+        if v:
+            #convert the average decode speed back to pixels per microsecond:
+            decoding_latency = v[0]/1000.0/1000.0/1000.0
         min_latency = max(abs_min, min_client_latency or abs_min)*1.2
         avg_latency = max(min_latency, avg_client_latency or abs_min)
         max_latency = 2.0*min_latency
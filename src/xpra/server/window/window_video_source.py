@@ -14,6 +14,8 @@ from xpra.codecs.codec_constants import get_subsampling_divs, \
 from xpra.server.window.window_source import WindowSource, STRICT_MODE, AUTO_REFRESH_SPEED, AUTO_REFRESH_QUALITY
 from xpra.server.window.region import merge_all            #@UnresolvedImport
 from xpra.server.window.video_subregion import VideoSubregion
+from xpra.server.window.codec_pool import get_codec_pool
+from xpra.server.window.csc_stage import CSCStage, CSC_PIPELINE
 from xpra.codecs.loader import PREFERED_ENCODING_ORDER, EDGE_ENCODING_ORDER
 from xpra.util import parse_scaling_value, engs
 from xpra.log import Logger
@@ -75,6 +77,8 @@ class WindowVideoSource(WindowSource):
         self._csc_encoder = None
         self._video_encoder = None
         self._last_pipeline_check = 0
+        #converts the frames before the encode thread gets to them:
+        self.csc_stage = CSCStage("csc-%i" % self.wid, self.is_current_csc, self.free_image_wrapper)
 
     def __repr__(self):
         return "WindowVideoSource(%s : %s)" % (self.wid, self.window_dimensions)
@@ -159,6 +163,7 @@ class WindowVideoSource(WindowSource):
                 log.error("Error collecting codec information from %s", x, exc_info=True)
         addcinfo("csc", self._csc_encoder)
         addcinfo("encoder", self._video_encoder)
+        info["csc_stage"] = self.csc_stage.get_info()
         info.setdefault("encodings", {}).update({
                                                  "non-video"    : self.non_video_encodings,
                                                  "edge"         : self.edge_encoding or "",
@@ -217,6 +222,7 @@ class WindowVideoSource(WindowSource):
     def cleanup(self):
         WindowSource.cleanup(self)
         self.cleanup_codecs()
+        self.csc_stage.stop()
 
     def cleanup_codecs(self):
         """ Video encoders (x264, nvenc and vpx) and their csc helpers
@@ -230,18 +236,45 @@ class WindowVideoSource(WindowSource):
             self.video_encoder_clean()
 
     def csc_encoder_clean(self):
-        """ Calls self._csc_encoder.clean() from the encode thread """
+        """ Releases self._csc_encoder from the encode thread """
         csce = self._csc_encoder
         if csce:
             self._csc_encoder = None
-            self.call_in_encode_thread(csce.clean)
+            self.call_in_encode_thread(self.release_codec, csce)
 
     def video_encoder_clean(self):
-        """ Calls self._video_encoder.clean() from the encode thread """
+        """ Releases self._video_encoder from the encode thread """
         ve = self._video_encoder
         if ve:
             self._video_encoder = None
-            self.call_in_encode_thread(ve.clean)
+            self.call_in_encode_thread(self.release_codec, ve)
+
+    def release_codec(self, instance):
+        """ Returns the csc or encoder instance to the pool, or cleans it up if it cannot be re-used """
+        pool = get_codec_pool()
+        #wait for the csc stage to finish with it:
+        with self.csc_stage.lock:
+            released = pool.release(instance)
+            if not released:
+                instance.clean()
+        if released and pool.claim_timer():
+            self.timeout_add(pool.timeout*1000, pool.expire_timer)
+
+    def get_csc_pool_key(self, csc_spec, src_format, csc_width, csc_height, enc_in_format, enc_width, enc_height):
+        return ("csc", csc_spec.codec_class, src_format, csc_width, csc_height, enc_in_format, enc_width, enc_height)
+
+    def get_encoder_pool_key(self, encoder_spec, enc_in_format, enc_width, enc_height, encoder_scaling):
+        """
+            Only encoders that can restart their stream can be re-used,
+            the key includes the encoder options specific to this encoding (ie: "h264.YUV420P.profile")
+        """
+        if not hasattr(encoder_spec.codec_class, "restart"):
+            return None
+        encoding = encoder_spec.encoding
+        dst_formats = tuple(self.full_csc_modes.get(encoding) or ())
+        prefix = "%s." % encoding
+        options = tuple(sorted((k, str(v)) for k,v in self.encoding_options.items() if str(k).startswith(prefix)))
+        return ("encoder", encoder_spec.codec_class, encoding, enc_in_format, enc_width, enc_height, encoder_scaling, dst_formats, options)
 
 
     def parse_csc_modes(self, full_csc_modes):
@@ -423,11 +456,13 @@ class WindowVideoSource(WindowSource):
 
     def unmap(self):
         WindowSource.cancel_damage(self)
+        self.csc_stage.drain()
         self.cleanup_codecs()
 
     def cancel_damage(self):
         self.video_subregion.cancel_refresh_timer()
         WindowSource.cancel_damage(self)
+        self.csc_stage.drain()
         #we must clean the video encoder to ensure
         #we will resend a key frame because we may be missing a frame
         self.cleanup_codecs()
@@ -631,6 +666,39 @@ class WindowVideoSource(WindowSource):
         WindowSource.process_damage_region(self, damage_time, window, x, y, w-dw, h-dh, coding, options, flush=flush)
 
 
+    def prepare_image(self, image, coding):
+        """
+            Submits the image to the csc stage,
+            so it can be converted whilst the encode thread is busy with the previous frame.
+            Only if we know the encode thread will give the whole image
+            to the current video pipeline: the frame is sent as it is (see is_direct_encoding),
+            its dimensions need no trimming and the pipeline check will not replace the csc instance.
+
+            Runs in the UI thread.
+        """
+        if not CSC_PIPELINE or coding not in self.video_encodings or not self.is_direct_encoding(coding):
+            return
+        if self._encoders.get(coding)!=self.video_encode:
+            return
+        csce = self._csc_encoder
+        if csce is None:
+            return
+        w, h = image.get_width(), image.get_height()
+        if (w & self.width_mask)!=w or (h & self.height_mask)!=h:
+            return
+        if not self.do_check_pipeline(coding, w, h, image.get_pixel_format()) or csce is not self._csc_encoder:
+            return
+        self.csc_stage.submit(image, csce)
+
+    def is_current_csc(self, csce):
+        return csce is self._csc_encoder
+
+    def free_image_wrapper(self, image):
+        #if the csc stage is still converting this image, it will free it when it is done:
+        if self.csc_stage.discard(image):
+            WindowSource.free_image_wrapper(self, image)
+
+
     def must_encode_full_frame(self, window, encoding):
         return self.full_frames_only or (encoding in self.video_encodings) or not self.non_video_encodings
 
@@ -928,6 +996,7 @@ class WindowVideoSource(WindowSource):
             height_mask = csc_spec.height_mask & encoder_spec.height_mask
             csc_width = width & width_mask
             csc_height = height & height_mask
+            enc_width, enc_height = self.get_encoder_dimensions(csc_spec, encoder_spec, csc_width, csc_height, scaling)
             if enc_in_format=="RGB":
                 #converting to "RGB" is often a waste of CPU
                 #(can only get selected because the csc step will do scaling,
@@ -936,8 +1005,10 @@ class WindowVideoSource(WindowSource):
             elif self._csc_encoder is None or self._csc_encoder.get_dst_format()!=enc_in_format or \
                type(self._csc_encoder)!=csc_spec.codec_class or \
                self._csc_encoder.get_src_width()!=csc_width or self._csc_encoder.get_src_height()!=csc_height:
-                #if we have to change csc, account for new csc setup cost:
-                ecsc_score = max(0, 80 - csc_spec.setup_cost*80.0/100.0)
+                ecsc_score = 80
+                if not get_codec_pool().has(self.get_csc_pool_key(csc_spec, self.pixel_format, csc_width, csc_height, enc_in_format, enc_width, enc_height)):
+                    #if we have to change csc, account for new csc setup cost:
+                    ecsc_score = max(0, 80 - csc_spec.setup_cost*80.0/100.0)
             else:
                 ecsc_score = 80
             ecsc_score += csc_spec.score_boost
@@ -953,7 +1024,6 @@ class WindowVideoSource(WindowSource):
                 #if we are (down)scaling, we should prefer lossy pixel formats:
                 v = LOSSY_PIXEL_FORMATS.get(enc_in_format, 1)
                 qscore *= (v/2)
-            enc_width, enc_height = self.get_encoder_dimensions(csc_spec, encoder_spec, csc_width, csc_height, scaling)
         else:
             #not using csc at all!
             ecsc_score = 100
@@ -974,8 +1044,10 @@ class WindowVideoSource(WindowSource):
         if ve is None or ve.get_type()!=encoder_spec.codec_type or \
            ve.get_src_format()!=enc_in_format or \
            ve.get_width()!=enc_width or ve.get_height()!=enc_height:
-            #account for new encoder setup cost:
-            ee_score = 100 - encoder_spec.setup_cost
+            pool_key = self.get_encoder_pool_key(encoder_spec, enc_in_format, enc_width, enc_height, encoder_scaling)
+            if not pool_key or not get_codec_pool().has(pool_key):
+                #account for new encoder setup cost:
+                ee_score = 100 - encoder_spec.setup_cost
             ee_score += encoder_spec.score_boost
         #edge resistance score: average of csc and encoder score:
         er_score = (ecsc_score + ee_score) / 2.0
@@ -1086,18 +1158,20 @@ class WindowVideoSource(WindowSource):
             return True  #OK!
 
         videolog("check_pipeline%s setting up a new pipeline as check failed", (encoding, width, height, src_format))
-        #cleanup existing one if needed:
-        csce = self._csc_encoder
-        if csce:
-            self._csc_encoder = None
-            csce.clean()
-        ve = self._video_encoder
-        if ve:
-            self._video_encoder = None
-            ve.clean()
-        #and make a new one:
-        scores = self.get_video_pipeline_options(encoding, width, height, src_format)
-        return self.setup_pipeline(scores, width, height, src_format)
+        #the csc stage must not use the csc instances whilst we replace them:
+        with self.csc_stage.lock:
+            #release existing one if needed:
+            csce = self._csc_encoder
+            if csce:
+                self._csc_encoder = None
+                self.release_codec(csce)
+            ve = self._video_encoder
+            if ve:
+                self._video_encoder = None
+                self.release_codec(ve)
+            #and make a new one:
+            scores = self.get_video_pipeline_options(encoding, width, height, src_format)
+            return self.setup_pipeline(scores, width, height, src_format)
 
     def do_check_pipeline(self, encoding, width, height, src_format):
         """
@@ -1220,9 +1294,13 @@ class WindowVideoSource(WindowSource):
             #so make sure it never degrades quality
             csc_speed = min(speed, 100-quality/2.0)
             csc_start = time.time()
-            csce = csc_spec.make_instance()
-            csce.init_context(csc_width, csc_height, src_format,
-                                   enc_width, enc_height, enc_in_format, csc_speed)
+            csc_key = self.get_csc_pool_key(csc_spec, src_format, csc_width, csc_height, enc_in_format, enc_width, enc_height)
+            csce = get_codec_pool().acquire(csc_key)
+            if csce is None:
+                csce = csc_spec.make_instance()
+                csce.init_context(csc_width, csc_height, src_format,
+                                       enc_width, enc_height, enc_in_format, csc_speed)
+                get_codec_pool().register(csce, csc_key)
             csc_end = time.time()
             videolog("setup_pipeline: csc=%s, info=%s, setup took %.2fms",
                   csce, csce.get_info(), (csc_end-csc_start)*1000.0)
@@ -1243,8 +1321,18 @@ class WindowVideoSource(WindowSource):
         enc_start = time.time()
         #FIXME: filter dst_formats to only contain formats the encoder knows about?
         dst_formats = self.full_csc_modes.get(encoder_spec.encoding)
-        ve = encoder_spec.make_instance()
-        ve.init_context(enc_width, enc_height, enc_in_format, dst_formats, encoder_spec.encoding, quality, speed, encoder_scaling, self.encoding_options)
+        encoder_key = self.get_encoder_pool_key(encoder_spec, enc_in_format, enc_width, enc_height, encoder_scaling)
+        ve = None
+        if encoder_key:
+            ve = get_codec_pool().acquire(encoder_key)
+        if ve:
+            #the client will start a new decoder for this stream:
+            ve.restart()
+        else:
+            ve = encoder_spec.make_instance()
+            ve.init_context(enc_width, enc_height, enc_in_format, dst_formats, encoder_spec.encoding, quality, speed, encoder_scaling, self.encoding_options)
+            if encoder_key:
+                get_codec_pool().register(ve, encoder_key)
         #record new actual limits:
         self.actual_scaling = scaling
         self.width_mask = width_mask
@@ -1364,13 +1452,27 @@ class WindowVideoSource(WindowSource):
             return image, image.get_pixel_format(), width, height
 
         start = time.time()
-        csc_image = csce.convert_image(image)
-        end = time.time()
-        #the image comes from the UI server, free it in the UI thread:
-        self.idle_add(image.free)
-        videolog("csc_image(%s, %s, %s) converted to %s in %.1fms (%.1f MPixels/s)",
-                        image, width, height,
-                        csc_image, (1000.0*end-1000.0*start), (width*height/(end-start+0.000001)/1024.0/1024.0))
+        csc_image = None
+        job = self.csc_stage.take(image)
+        if job:
+            csc_image = job.wait()
+            if csc_image is not None and job.csce is not csce:
+                #converted with a csc instance which has since been replaced:
+                self.free_image_wrapper(csc_image)
+                csc_image = None
+        if csc_image is None:
+            with self.csc_stage.lock:
+                csc_image = csce.convert_image(image)
+            #the image comes from the UI server, free it in the UI thread:
+            self.idle_add(image.free)
+            elapsed = time.time()-start
+            videolog("csc_image(%s, %s, %s) converted to %s in %.1fms (%.1f MPixels/s)",
+                            image, width, height,
+                            csc_image, 1000.0*elapsed, (width*height/(elapsed+0.000001)/1024.0/1024.0))
+        else:
+            videolog("csc_image(%s, %s, %s) converted to %s by the csc stage in %.1fms, waited %.1fms",
+                            image, width, height,
+                            csc_image, 1000.0*job.elapsed, 1000.0*(time.time()-start))
         if not csc_image:
             raise Exception("csc_image: conversion of %s to %s failed" % (image, csce.get_dst_format()))
         assert csce.get_dst_format()==csc_image.get_pixel_format()
@@ -0,0 +1,94 @@
+# coding=utf8
+# This file is part of Xpra.
+# Copyright (C) 2016 Antoine Martin <antoine@devloop.org.uk>
+# Xpra is released under the terms of the GNU GPL v2, or, at your option, any
+# later version. See the file COPYING for details.
+
+from threading import Lock, Event
+
+from xpra.log import Logger
+log = Logger("util")
+
+from xpra.os_util import Queue
+from xpra.make_thread import make_thread
+
+
+class ThreadPool(object):
+    """
+        A pool of threads used for processing the items of a single job concurrently.
+        (this is only useful if the work releases the GIL)
+        The calling thread also processes one of the items,
+        so it always makes progress even when the pool threads are busy.
+        The threads are only started when they are first needed.
+    """
+
+    def __init__(self, name, nthreads):
+        self.name = name
+        self.nthreads = nthreads
+        self.work_queue = Queue()
+        self.threads = []
+        self.lock = Lock()
+        self.jobs = 0
+        self.items = 0
+
+    def __repr__(self):
+        return "ThreadPool(%s, %i)" % (self.name, self.nthreads)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.nthreads):
+                t = make_thread(self.work_loop, "%s-%i" % (self.name, i), daemon=True)
+                self.threads.append(t)
+                t.start()
+
+    def work_loop(self):
+        while True:
+            item = self.work_queue.get(True)
+            if item is None:
+                return
+            item[0](*item[1:])
+
+    def map(self, fn, items):
+        """
+            Returns the result of calling fn for each item, in the same order,
+            blocks until all the items have been processed.
+        """
+        n = len(items)
+        self.jobs += 1
+        self.items += n
+        if n<=1 or self.nthreads<=0:
+            return [fn(x) for x in items]
+        self.start()
+        results = [None]*n
+        errors = []
+        remaining = [n]
+        done = Event()
+        lock = Lock()
+        def run(i):
+            try:
+                results[i] = fn(items[i])
+            except Exception as e:
+                log("%s error processing item %i", self, i, exc_info=True)
+                errors.append(e)
+            finally:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]==0:
+                        done.set()
+        for i in range(1, n):
+            self.work_queue.put((run, i))
+        run(0)
+        done.wait()
+        if errors:
+            raise errors[0]
+        return results
+
+    def get_info(self):
+        return {
+                "threads"   : self.nthreads,
+                "jobs"      : self.jobs,
+                "items"     : self.items,
+                "queue"     : self.work_queue.qsize(),
+                }
@@ -279,6 +279,29 @@ def parse_scaling_value(v):
         ret = values[0], values[1]
     return ret
 
+def parse_with_unit(v, unit="bps", min_value=0):
+    """
+        Parses values like "10Mbps", "512K" or "1000",
+        the unit suffix is optional and the multipliers are powers of 1000.
+        Empty values and values which mean "disabled" return 0.
+    """
+    if not v:
+        return 0
+    s = str(v).strip()
+    if s.lower() in ("no", "none", "off", "false", "0"):
+        return 0
+    if unit and s.lower().endswith(unit.lower()):
+        s = s[:-len(unit)]
+    mult = 1
+    m = s[-1:].upper()
+    if m in ("K", "M", "G"):
+        mult = {"K" : 1000, "M" : 1000**2, "G" : 1000**3}[m]
+        s = s[:-1]
+    value = int(float(s)*mult)
+    if value<min_value:
+        raise ValueError("value must be greater than %i" % min_value)
+    return value
+
 def from0to100(v):
     return intrangevalidator(v, 0, 100)
 
@@ -285,8 +285,8 @@ class XpraServer(gobject.GObject, X11ServerBase):
         return capabilities
 
 
-    def do_get_info(self, proto, server_sources, window_ids):
-        info = X11ServerBase.do_get_info(self, proto, server_sources, window_ids)
+    def do_get_info(self, proto, server_sources, window_ids, selection=None):
+        info = X11ServerBase.do_get_info(self, proto, server_sources, window_ids, selection)
         log("do_get_info: adding cursor=%s", self.last_cursor_data)
         info.setdefault("state", {}).update({
                                              "focused"  : self._has_focus,
@@ -309,8 +309,8 @@ class XpraServer(gobject.GObject, X11ServerBase):
                 cinfo[x] = v
         return cinfo
 
-    def get_ui_info(self, proto, wids=None, *args):
-        info = X11ServerBase.get_ui_info(self, proto, wids, *args)
+    def get_ui_info(self, proto, selection=None, wids=None, *args):
+        info = X11ServerBase.get_ui_info(self, proto, selection, wids, *args)
         #_NET_WM_NAME:
         wm = self._wm
         if wm:
@@ -332,8 +332,8 @@ class XpraServer(gobject.GObject, X11ServerBase):
         return cinfo
 
 
-    def get_window_info(self, window):
-        info = X11ServerBase.get_window_info(self, window)
+    def get_window_state_info(self, window):
+        info = X11ServerBase.get_window_state_info(self, window)
         info.update({
                      "focused"  : self._has_focus and self._window_to_id.get(window, -1)==self._has_focus,
                      "grabbed"  : self._has_grab and self._window_to_id.get(window, -1)==self._has_grab,
@@ -750,6 +750,7 @@ class XpraServer(gobject.GObject, X11ServerBase):
             ss.lost_window(wid, window)
         del self._window_to_id[window]
         del self._id_to_window[wid]
+        self.info_cache.invalidate("window.%s" % wid)
         for ss in self._server_sources.values():
             ss.remove_window(wid, window)
         self.repaint_root_overlay()
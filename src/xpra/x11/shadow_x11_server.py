@@ -122,8 +122,8 @@ class ShadowX11Server(GTKShadowServerBase, X11ServerBase):
         capabilities["server_type"] = "Python/gtk2/x11-shadow"
         return capabilities
 
-    def get_info(self, proto):
-        info = X11ServerBase.get_info(self, proto)
+    def get_info(self, proto, *args):
+        info = X11ServerBase.get_info(self, proto, *args)
         info.setdefault("features", {})["shadow"] = True
         info.setdefault("server", {})["type"] = "Python/gtk2/x11-shadow"
         return info
@@ -216,9 +216,9 @@ class X11ServerBase(GTKServerBase):
                     })
         return capabilities
 
-    def do_get_info(self, proto, server_sources, window_ids):
+    def do_get_info(self, proto, server_sources, window_ids, selection=None):
         start = time.time()
-        info = GTKServerBase.do_get_info(self, proto, server_sources, window_ids)
+        info = GTKServerBase.do_get_info(self, proto, server_sources, window_ids, selection)
         if self.opengl_props:
             info["opengl"] = self.opengl_props
         #this is added here because the server keyboard config doesn't know about "keys_pressed"..
@@ -250,8 +250,8 @@ class X11ServerBase(GTKServerBase):
         log("X11ServerBase.do_get_info took %ims", (time.time()-start)*1000)
         return info
 
-    def get_window_info(self, window):
-        info = GTKServerBase.get_window_info(self, window)
+    def get_window_state_info(self, window):
+        info = GTKServerBase.get_window_state_info(self, window)
         info["XShm"] = window.uses_XShm()
         return info
 